@@ -6,7 +6,10 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import hashlib
+
 from django.contrib.auth.models import User, Group
+from django.core.cache import cache
 from django.db import models as db
 from django.db.utils import DatabaseError
 from django.dispatch import receiver
@@ -19,6 +22,7 @@ from lck.django.profile.models import BasicInfo, ActivationSupport,\
         GravatarSupport
 
 from ralph.business.models import Venture, VentureRole
+from ralph.util.tableversion import TableVersion
 
 
 class Perm(Choices):
@@ -58,6 +62,83 @@ class Perm(Choices):
     read_device_info_reports = _("read device reports")
 
 
+PERM_MATRIX_KEY = 'ralph.account.perm_matrix.%s.%s'
+PERM_MATRIX_TIMEOUT = 24 * 3600
+# how many levels of the venture tree a permission is inherited through
+PERM_MATRIX_DEPTH = 3
+
+
+class PermMatrix(object):
+    """
+    All the permissions of a single profile, compiled from its bound
+    permissions and those of its groups. The inheritance over the venture
+    tree is expanded when the matrix is built, so that the checks don't need
+    to touch the database.
+    """
+
+    def __init__(self, rows, parents):
+        """
+        ``rows`` are ``(perm, venture_id, role_id)`` triples of the bound
+        permissions, ``parents`` maps every venture id to its parent id.
+        """
+        children = {}
+        for venture_id, parent_id in parents.iteritems():
+            if parent_id is not None:
+                children.setdefault(parent_id, []).append(venture_id)
+        self.unrestricted = set()
+        self.everywhere = set()
+        self.bound = {}
+        self.ancestors = {}
+        self.descendants = {}
+        for perm, venture_id, role_id in rows:
+            if venture_id is None:
+                self.everywhere.add(perm)
+                if role_id is None:
+                    self.unrestricted.add(perm)
+                continue
+            self.bound.setdefault(perm, set()).add(venture_id)
+            ancestors = self.ancestors.setdefault(perm, set())
+            ancestors.add(venture_id)
+            parent_id = parents.get(venture_id)
+            for i in xrange(PERM_MATRIX_DEPTH):
+                if parent_id is None:
+                    break
+                ancestors.add(parent_id)
+                parent_id = parents.get(parent_id)
+            descendants = self.descendants.setdefault(perm, set())
+            level = [venture_id]
+            descendants.add(venture_id)
+            for i in xrange(PERM_MATRIX_DEPTH):
+                level = [child for v in level for child in children.get(v, ())]
+                descendants.update(level)
+
+    def has_perm(self, perm_id, venture_id=None):
+        if venture_id is None:
+            return perm_id in self.unrestricted
+        return (perm_id in self.everywhere or
+                venture_id in self.ancestors.get(perm_id, ()))
+
+
+_perm_tables = None
+
+
+def _perm_matrix_version():
+    # the matrices depend on the bound permissions, the group memberships
+    # and the venture tree
+    global _perm_tables
+    if _perm_tables is None:
+        _perm_tables = TableVersion([BoundPerm, Venture,
+                                     User.groups.through])
+    return hashlib.md5(repr(_perm_tables.get())).hexdigest()
+
+
+def invalidate_perm_matrix():
+    """Make this process check if the permissions changed on next use, e.g.
+    after a bulk update."""
+    if _perm_tables is not None:
+        _perm_tables.expire()
+
+
 class Profile(BasicInfo, ActivationSupport, GravatarSupport,
         MonitoredActivity):
 
@@ -68,12 +149,38 @@ class Profile(BasicInfo, ActivationSupport, GravatarSupport,
     def __unicode__(self):
         return self.nick
 
+    def perm_matrix(self):
+        """
+        Return the compiled ``PermMatrix`` of this profile. It is kept in the
+        cache under the version of the bound permissions, group memberships
+        and ventures in the database, so a matrix is never used after any of
+        them changed, in any process.
+        """
+        version = _perm_matrix_version()
+        cached = getattr(self, '_perm_matrix', None)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        key = PERM_MATRIX_KEY % (version, self.id)
+        matrix = cache.get(key)
+        if matrix is None:
+            rows = BoundPerm.objects.filter(
+                db.Q(profile=self) | db.Q(group__in=self.groups.all()),
+            ).values_list('perm', 'venture', 'role')
+            parents = dict(Venture.objects.values_list('id', 'parent'))
+            matrix = PermMatrix(rows, parents)
+            cache.set(key, matrix, PERM_MATRIX_TIMEOUT)
+        self._perm_matrix = version, matrix
+        return matrix
+
     def has_perm(self, perm, obj=None, role=None):
-        if not self.is_active:
+        if not self.user.is_active:
             return False
-        if self.is_superuser:
+        if self.user.is_superuser:
             return True
         if isinstance(perm, Choices.Choice):
+            if role is None:
+                return self.perm_matrix().has_perm(
+                    perm.id, obj.id if obj else None)
             groups = self.groups.all()
             if obj:
                 return BoundPerm.objects.filter(
@@ -102,47 +209,28 @@ class Profile(BasicInfo, ActivationSupport, GravatarSupport,
     def perm_ventures(self, perm):
         """Lists all ventures to which the user has permission."""
 
-        if not self.is_active:
+        if not self.user.is_active:
             return []
-        groups = self.groups.all()
-        if self.is_superuser or BoundPerm.objects.filter(
-                db.Q(profile=self) | db.Q(group__in=groups),
-                perm=perm.id,
-                venture=None,
-            ).exists():
+        if self.user.is_superuser:
+            return Venture.objects.all()
+        matrix = self.perm_matrix()
+        if perm.id in matrix.everywhere:
             return Venture.objects.all()
         return Venture.objects.filter(
-                db.Q(boundperm__profile=self) | db.Q(boundperm__group__in=groups),
-                boundperm__perm=perm.id,
-            )
+            id__in=sorted(matrix.bound.get(perm.id, ())),
+        )
 
     def filter_by_perm(self, query, perm):
         """Filters a device search query according to the permissions."""
 
         profile = self
-        if not profile.is_active:
+        if not profile.user.is_active:
             return query.none()
-        if profile.is_superuser or profile.has_perm(perm):
+        if profile.user.is_superuser or profile.has_perm(perm):
             return query
-        groups = self.groups.all()
-        return query.filter(
-                db.Q(venture__boundperm__profile=profile,
-                  venture__boundperm__perm=perm.id) |
-                db.Q(venture__parent__boundperm__profile=profile,
-                  venture__parent__boundperm__perm=perm.id) |
-                db.Q(venture__parent__parent__boundperm__profile=profile,
-                  venture__parent__parent__boundperm__perm=perm.id) |
-                db.Q(venture__parent__parent__parent__boundperm__profile=profile,
-                  venture__parent__parent__parent__boundperm__perm=perm.id) |
-                db.Q(venture__boundperm__group__in=groups,
-                  venture__boundperm__perm=perm.id) |
-                db.Q(venture__parent__boundperm__group__in=groups,
-                  venture__parent__boundperm__perm=perm.id) |
-                db.Q(venture__parent__parent__boundperm__group__in=groups,
-                  venture__parent__parent__boundperm__perm=perm.id) |
-                db.Q(venture__parent__parent__parent__boundperm__group__in=groups,
-                  venture__parent__parent__parent__boundperm__perm=perm.id)
-            ).distinct()
+        return query.filter(venture_id__in=sorted(
+            profile.perm_matrix().descendants.get(perm.id, ()),
+        ))
 
 
 def create_a_user_profile_ignoring_dberrors(instance):
@@ -187,3 +275,31 @@ class BoundPerm(TimeTrackable, EditorTrackable):
     class Meta:
         verbose_name = _("bound permission")
         verbose_name_plural = _("bound permissions")
+
+
+@receiver(db.signals.post_save, sender=BoundPerm,
+          dispatch_uid='ralph.perm_matrix')
+@receiver(db.signals.post_delete, sender=BoundPerm,
+          dispatch_uid='ralph.perm_matrix')
+def bound_perm_changed(sender, instance, **kwargs):
+    invalidate_perm_matrix()
+
+
+@receiver(db.signals.m2m_changed, sender=User.groups.through,
+          dispatch_uid='ralph.perm_matrix')
+def user_groups_changed(sender, instance, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_perm_matrix()
+
+
+@receiver(db.signals.post_save, sender=Venture,
+          dispatch_uid='ralph.perm_matrix')
+def venture_post_save(sender, instance, created, **kwargs):
+    if created or 'parent_id' in instance.dirty_fields:
+        invalidate_perm_matrix()
+
+
+@receiver(db.signals.post_delete, sender=Venture,
+          dispatch_uid='ralph.perm_matrix')
+def venture_post_delete(sender, instance, **kwargs):
+    invalidate_perm_matrix()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import time
+
+from django.contrib.auth.models import User, Group
+from django.test import TestCase
+import mock
+
+from ralph.account.models import BoundPerm, Perm
+from ralph.business.models import Venture
+from ralph.discovery.models import Device, DeviceType
+
+
+class PermMatrixTest(TestCase):
+    def setUp(self):
+        self.top = Venture(name='Top', symbol='top')
+        self.top.save()
+        self.middle = Venture(name='Middle', symbol='middle',
+                              parent=self.top)
+        self.middle.save()
+        self.bottom = Venture(name='Bottom', symbol='bottom',
+                              parent=self.middle)
+        self.bottom.save()
+        user = User.objects.create_user('perms', 'perms@example.com', 'pw')
+        self.group = Group(name='perms')
+        self.group.save()
+        user.groups.add(self.group)
+        self.profile = user.get_profile()
+
+    def test_venture_perms(self):
+        BoundPerm(group=self.group, venture=self.middle,
+                  perm=Perm.read_device_info_generic).save()
+        perm = Perm.read_device_info_generic
+        profile = self.profile
+        self.assertTrue(profile.has_perm(perm, self.top))
+        self.assertTrue(profile.has_perm(perm, self.middle))
+        self.assertFalse(profile.has_perm(perm, self.bottom))
+        self.assertFalse(profile.has_perm(perm))
+        self.assertFalse(profile.has_perm(Perm.run_discovery, self.middle))
+        later = time.time() + 3600
+        with mock.patch('time.time', return_value=later):
+            # the tables are only checked once in a while after the changes
+            profile.has_perm(perm, self.top)
+            with self.assertNumQueries(0):
+                profile.has_perm(perm, self.top)
+        self.assertEqual(
+            list(profile.perm_ventures(perm)), [self.middle],
+        )
+        devices = []
+        for venture in (self.top, self.middle, self.bottom):
+            device = Device.create(sn='sn-%s' % venture.symbol,
+                                   model_name='server',
+                                   model_type=DeviceType.unknown)
+            device.venture = venture
+            device.save()
+            devices.append(device)
+        self.assertEqual(
+            set(profile.filter_by_perm(Device.objects.all(), perm)),
+            set(devices[1:]),
+        )
+        self.bottom.parent = None
+        self.bottom.save()
+        self.assertEqual(
+            list(profile.filter_by_perm(Device.objects.all(), perm)),
+            [devices[1]],
+        )
+
+    def test_global_perms(self):
+        perm = Perm.run_discovery
+        self.assertFalse(self.profile.has_perm(perm))
+        BoundPerm(profile=self.profile, perm=perm).save()
+        self.assertTrue(self.profile.has_perm(perm))
+        self.assertTrue(self.profile.has_perm(perm, self.bottom))
+        self.assertEqual(self.profile.perm_ventures(perm).count(), 3)
+        self.group.user_set.clear()
+        self.assertTrue(self.profile.has_perm(perm))
+
+    def test_changes_without_signals(self):
+        perm = Perm.run_discovery
+        self.assertFalse(self.profile.has_perm(perm))
+        # another process grants the permission
+        BoundPerm.objects.bulk_create([
+            BoundPerm(profile=self.profile, perm=perm),
+        ])
+        with mock.patch('time.time', return_value=time.time() + 3600):
+            self.assertTrue(self.profile.has_perm(perm))
@@ -6,9 +6,10 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import hashlib
 import re
-import ipaddr
 
+import ipaddr
 from django.conf import settings
 from django.db import models as db
 from django.utils.translation import ugettext_lazy as _
@@ -16,7 +17,7 @@ from lck.django.common.models import Named, TimeTrackable
 from lck.django.common.models import WithConcurrentGetOrCreate
 from dj.choices import Choices
 from dj.choices.fields import ChoiceField
-from django.db.models.signals import post_save, pre_delete
+from django.db.models.signals import post_save, post_delete, pre_delete
 from django.dispatch import receiver
 from exceptions import AttributeError
 
@@ -25,6 +26,7 @@ from ralph.discovery.models_history import HistoryCost
 from ralph.discovery.models_network import Network
 
 from ralph.cmdb.models_ci import CI, CIOwner, CIOwnershipType, CIOwnership
+from ralph.util.tableversion import TableVersion
 
 SYNERGY_URL_BASE = settings.SYNERGY_URL_BASE
 
@@ -45,21 +47,54 @@ class PrebootMixin(db.Model):
 
 
 class HasSymbolBasedPath(db.Model):
-    path = db.TextField(verbose_name=_("symbol path"), blank=True,
-            default="", editable=False)
+    path = db.CharField(verbose_name=_("symbol path"), max_length=255,
+            blank=True, default="", editable=False, db_index=True)
 
     class Meta:
         abstract = True
 
     def save(self, *args, **kwargs):
-        if self.parent:
-           self.path = self.parent.path + "/" + self.symbol
-        else:
-            self.path = self.symbol
+        self.path = self.symbol_path()
         super(HasSymbolBasedPath, self).save(*args, **kwargs)
         for child in self.child_set.all():
             child.save()
 
+    def symbol_path(self):
+        """
+        Return the path of this node for the ``path`` column. Paths longer
+        than the column are cut short: they still start with the paths of
+        all the ancestors that fit, which keep finding them by prefix.
+        """
+        if not self.parent:
+            return self.symbol
+        path = self.parent.path + "/" + self.symbol
+        return path[:self._meta.get_field('path').max_length]
+
+    def subtree_q(self, prefix=''):
+        """
+        Return a condition matching this node and all of its descendants, at
+        any depth, using the indexed symbol paths. ``prefix`` is the lookup
+        leading to the model, for example ``'venture__'`` to filter devices.
+        Nodes without a symbol, and those whose path was cut short or leaves
+        no room for the paths of their children, have no usable path, so
+        their descendants are found by following the parents instead, one
+        query per level.
+        """
+        if (not self.path or len(self.path) + 1 >=
+                self._meta.get_field('path').max_length):
+            ids = {self.id}
+            level = [self.id]
+            while level:
+                level = [
+                    id for id in self.__class__._base_manager.filter(
+                        parent__in=level).values_list('id', flat=True)
+                    if id not in ids
+                ]
+                ids.update(level)
+            return db.Q(**{prefix + 'id__in': ids})
+        return (db.Q(**{prefix + 'path': self.path}) |
+                db.Q(**{prefix + 'path__startswith': self.path + '/'}))
+
 
 class Venture(Named, PrebootMixin, HasSymbolBasedPath, TimeTrackable):
     data_center = db.ForeignKey(DataCenter, verbose_name=_("data center"),
@@ -91,10 +126,7 @@ class Venture(Named, PrebootMixin, HasSymbolBasedPath, TimeTrackable):
         self.symbol = re.sub(r'[^\w]', '.', self.symbol).lower()
 
     def save(self, *args, **kwargs):
-        if self.parent:
-            self.path = self.parent.path + "/" + self.symbol
-        else:
-            self.path = self.symbol
+        self.path = self.symbol_path()
         super(Venture, self).save(*args, **kwargs)
         for child in self.child_set.all():
             child.save()
@@ -201,6 +233,11 @@ class VentureRole(Named.NonUnique, PrebootMixin, HasSymbolBasedPath,
         verbose_name_plural = _("venture roles")
         ordering = ('parent__name', 'name')
 
+    def subtree_q(self, prefix=''):
+        # role paths are only unique within a venture
+        return (super(VentureRole, self).subtree_q(prefix) &
+                db.Q(**{prefix + 'venture': self.venture_id}))
+
     @property
     def full_name(self):
         parents = [self.name]
@@ -385,3 +422,27 @@ def cost_post_save(sender, instance, raw, using, **kwargs):
 @receiver(pre_delete, sender=VentureExtraCost, dispatch_uid='ralph.costhistory')
 def cost_pre_delete(sender, instance, using, **kwargs):
     HistoryCost.end_span(extra=instance)
+
+
+_venture_tables = TableVersion([Venture, Department])
+
+
+def venture_tree_version():
+    """
+    Return the current version of the venture tree. It changes whenever any
+    venture or department is saved or deleted, in any process, so it can be
+    used in the keys of cached data derived from the tree.
+    """
+    return hashlib.md5(repr(_venture_tables.get())).hexdigest()
+
+
+def invalidate_venture_tree():
+    _venture_tables.expire()
+
+
+@receiver(post_save, sender=Venture, dispatch_uid='ralph.venture_tree')
+@receiver(post_delete, sender=Venture, dispatch_uid='ralph.venture_tree')
+@receiver(post_save, sender=Department, dispatch_uid='ralph.venture_tree')
+@receiver(post_delete, sender=Department, dispatch_uid='ralph.venture_tree')
+def venture_tree_changed(sender, instance, **kwargs):
+    invalidate_venture_tree()
@@ -7,7 +7,8 @@ from __future__ import unicode_literals
 
 from django.test import TestCase
 from django.conf import settings
-from ralph.business.models import Venture, VentureRole
+from ralph.business.models import (Venture, VentureRole,
+                                   venture_tree_version)
 from ralph.discovery.models_network import Network, NetworkTerminator, DataCenter
 from ralph.deployment.models import Preboot
 
@@ -28,6 +29,74 @@ class TestModels(TestCase):
         self.assertEqual(a.path, 'a')
         self.assertEqual(b.path, 'a/b')
 
+    def test_venture_subtree(self):
+        a = Venture(name='A', symbol='a')
+        a.save()
+        b = Venture(name='B', symbol='b', parent=a)
+        b.save()
+        c = Venture(name='C', symbol='c', parent=b)
+        c.save()
+        ab = Venture(name='AB', symbol='ab')
+        ab.save()
+
+        def subtree(venture):
+            return set(Venture.objects.filter(venture.subtree_q()))
+
+        self.assertEqual(subtree(a), {a, b, c})
+        self.assertEqual(subtree(b), {b, c})
+        self.assertEqual(subtree(ab), {ab})
+
+        version = venture_tree_version()
+        b.parent = ab
+        b.save()
+        self.assertNotEqual(venture_tree_version(), version)
+        self.assertEqual(Venture.objects.get(id=c.id).path, 'ab/b/c')
+        self.assertEqual(subtree(a), {a})
+        self.assertEqual(subtree(ab), {ab, b, c})
+
+        x = VentureRole(name='x', venture=a)
+        x.save()
+        y = VentureRole(name='y', venture=a, parent=x)
+        y.save()
+        other = VentureRole(name='x', venture=ab)
+        other.save()
+        self.assertEqual(set(VentureRole.objects.filter(x.subtree_q())),
+                         {x, y})
+
+    def test_venture_subtree_without_symbols(self):
+        a = Venture(name='A')
+        a.save()
+        b = Venture(name='B', symbol='b', parent=a)
+        b.save()
+        c = Venture(name='C')
+        c.save()
+        self.assertEqual(a.path, '')
+        self.assertEqual(set(Venture.objects.filter(a.subtree_q())), {a, b})
+        self.assertEqual(set(Venture.objects.filter(c.subtree_q())), {c})
+
+    def test_role_subtree_with_long_names(self):
+        a = Venture(name='A', symbol='a')
+        a.save()
+        roles = []
+        parent = None
+        for i in xrange(5):
+            parent = VentureRole(name='%d' % i * 75, venture=a,
+                                 parent=parent)
+            parent.save()
+            roles.append(parent)
+        self.assertEqual(len(roles[3].path), 255)
+        self.assertEqual(len(roles[4].path), 255)
+
+        def subtree(role):
+            return list(VentureRole.objects.filter(
+                role.subtree_q()).order_by('id'))
+
+        self.assertEqual(subtree(roles[0]), roles)
+        self.assertEqual(subtree(roles[2]), roles[2:])
+        # the paths cut short are not used for prefix matching
+        self.assertEqual(subtree(roles[3]), roles[3:])
+        self.assertEqual(subtree(roles[4]), roles[4:])
+
     def test_role_full_name(self):
         a = Venture(name='A', symbol='a')
         a.save()
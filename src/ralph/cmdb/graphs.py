@@ -6,12 +6,9 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import pygraph
-from pygraph.algorithms.searching import breadth_first_search
-from pygraph.classes.exceptions import AdditionError
-
-from ralph.cmdb.models import CI, CIRelation, CI_TYPES, CI_RELATION_TYPES
-from ralph.discovery.models import DeviceModel, DeviceType
+from ralph.cmdb.models import CI, CI_TYPES
+from ralph.cmdb.models_graph import relation_graph, IMPACT_RELATION_TYPES
+from ralph.discovery.models import Device, DeviceModel, DeviceType
 
 
 def search_tree(tree, root):
@@ -27,62 +24,52 @@ def search_tree(tree, root):
             DeviceType.data_center.id,
             DeviceType.virtual_server.id
         ])]
-    relations = [dict(
-        parent=x.parent.id, child=x.child.id, parent_name=x.parent.name,
-        child_name=x.child.name)
-        for x in CIRelation.objects.filter(parent=root, child__type=CI_TYPES.DEVICE.id) if
-        x.child.content_object.model and x.child.content_object.model.id in models_to_display]
-
     tree['name'] = root.name
     tree['children'] = []
-    for x in relations:
-        new = dict(name=x.get('child'), children=[])
-        tree['children'].append(new)
-        search_tree(root=CI.objects.get(id=x.get('child')), tree=new)
+    # one level of the tree at a time, with two queries for every level
+    level = {root.id: tree}
+    seen = {root.id}
+    while level:
+        children = dict(
+            (ci_id, relation_graph.children_of(ci_id)) for ci_id in level)
+        cis = dict(
+            (ci_id, (name, object_id)) for ci_id, name, object_id
+            in CI.objects.filter(
+                id__in=set(sum(children.values(), [])) - seen,
+                type=CI_TYPES.DEVICE.id,
+            ).values_list('id', 'name', 'object_id'))
+        displayed = set(Device.admin_objects.filter(
+            id__in=[object_id for name, object_id in cis.itervalues()],
+            model__in=models_to_display,
+        ).values_list('id', flat=True))
+        next_level = {}
+        for ci_id in sorted(level):
+            for child in children[ci_id]:
+                if child not in cis or child in seen:
+                    continue
+                name, object_id = cis[child]
+                if object_id not in displayed:
+                    continue
+                seen.add(child)
+                new = dict(name=name, children=[])
+                level[ci_id]['children'].append(new)
+                next_level[child] = new
+        level = next_level
     return tree
 
 
 class ImpactCalculator(object):
 
     def __init__(self, relation_types=[]):
-        default_relation_types = [
-            CI_RELATION_TYPES.CONTAINS.id,
-            CI_RELATION_TYPES.REQUIRES.id,
-            CI_RELATION_TYPES.HASROLE.id,
-        ]
         if not relation_types:
-            self.relation_types = default_relation_types
+            self.relation_types = list(IMPACT_RELATION_TYPES)
         else:
             self.relation_types = relation_types
-        self.build_graph()
 
     def find_affected_nodes(self, ci_id):
-        try:
-            st, pre = breadth_first_search(self.graph, ci_id)
-        except KeyError:
-            return []
-        return (st, pre)
-
-    def build_graph(self):
-        allci = CI.objects.all().values('pk')
-        relations = CIRelation.objects.filter(
-            type__in=self.relation_types
-        ).values('parent_id', 'child_id', 'type')
-        self.graph = pygraph.classes.digraph.digraph()
-        self.graph.add_nodes([ci['pk'] for ci in allci])
-        for relation in relations:
-            if relation['type'] == CI_RELATION_TYPES.CONTAINS.id:
-                # the only relation which we can traverse going straight
-                parent = relation['parent_id']
-                child = relation['child_id']
-            else:
-                # opposite direction for graph traversal.
-                parent = relation['child_id']
-                child = relation['parent_id']
-            try:
-                self.graph.add_edge((parent, child), attrs=(relation['type'],))
-            except AdditionError:
-                # ignore duplicated relations(types) in graph
-                pass
-
+        return relation_graph.impact(ci_id, self.relation_types)
 
+    def edge_type(self, start, end):
+        """Return the type of the relation that ``end`` is affected by
+        ``start`` through."""
+        return relation_graph.impact_type(start, end, self.relation_types)
@@ -53,9 +53,34 @@ import ralph.discovery.models_network as ndb
 import ralph.business.models as bdb
 import ralph.cmdb.models as cdb
 from django.db import IntegrityError
+from django.db.models import Q
 from lck.django.common import nested_commit_on_success
 
 
+CONTENT_TO_IMPORT = {
+    db.Device: cdb.CI_TYPES.DEVICE.id,
+    bdb.Venture: cdb.CI_TYPES.VENTURE.id,
+    bdb.VentureRole: cdb.CI_TYPES.VENTUREROLE.id,
+    ndb.Network: cdb.CI_TYPES.NETWORK.id,
+    ndb.NetworkTerminator: cdb.CI_TYPES.NETWORKTERMINATOR.id,
+    db.DataCenter: cdb.CI_TYPES.DATACENTER.id,
+    bdb.Service: cdb.CI_TYPES.SERVICE.id,
+    bdb.BusinessLine: cdb.CI_TYPES.BUSINESSLINE.id,
+}
+LAYERS = {
+    db.Device: 5,
+    bdb.Venture: 4,
+    bdb.VentureRole: 8,
+    ndb.Network:  6,
+    ndb.NetworkTerminator: 6,
+    db.DataCenter: 5,
+    bdb.BusinessLine: 7,
+    bdb.Service: 7,
+}
+# statements run in one transaction by the bulk importer
+BULK_BATCH_SIZE = 500
+
+
 class UnknownCTException(Exception):
     def __init__(self, value):
         Exception.__init__(self, value)
@@ -65,6 +90,14 @@ class UnknownCTException(Exception):
         return repr("Unknown content type : %s" % self.parameter)
 
 
+def _ci_name(asset):
+    return '%s' % asset.name or unicode(asset)
+
+
+def _log_progress(stage, done, total):
+    logger.info('%s: %d/%d' % (stage, done, total))
+
+
 class CIImporter(object):
     @nested_commit_on_success
     def store_asset(self, asset, type_, layer_id, uid_prefix):
@@ -76,7 +109,7 @@ class CIImporter(object):
         ci.content_object = asset
         ci.type_id = type_
         ci.barcode = getattr(asset, 'barcode', None)
-        ci.name = '%s' % asset.name or unicode(asset)
+        ci.name = _ci_name(asset)
         try:
             # new CI
             ci.save()
@@ -88,11 +121,7 @@ class CIImporter(object):
         ci.save()
         return ci
 
-    def import_assets_by_contenttype(self, asset_class, _type, layer_id,
-                                     asset_id=None):
-        ret = []
-        logger.info('Importing devices.')
-        asset_content_type = ContentType.objects.get_for_model(asset_class)
+    def get_uid_prefix(self, asset_content_type):
         prefix = cdb.CIContentTypePrefix.objects.filter(
             content_type_name=asset_content_type.app_label + '.'
             + asset_content_type.model.replace(' ', '')
@@ -102,7 +131,14 @@ class CIImporter(object):
                 'Unknown prefix for Content Type %s'
                 % asset_content_type.app_label + '.' + asset_content_type.model
             )
-        uid_prefix = prefix[0].prefix
+        return prefix[0].prefix
+
+    def import_assets_by_contenttype(self, asset_class, _type, layer_id,
+                                     asset_id=None):
+        ret = []
+        logger.info('Importing devices.')
+        asset_content_type = ContentType.objects.get_for_model(asset_class)
+        uid_prefix = self.get_uid_prefix(asset_content_type)
         if asset_id:
             all_devices = asset_class.objects.filter(
                 id=asset_id).order_by('id').all()
@@ -115,29 +151,34 @@ class CIImporter(object):
 
     def purge_all_ci(self, content_type=None):
         logger.info('Purging CIs')
-        if content_type:
-            for x in cdb.CI.objects.filter(
-                    content_type__in=content_type).all().iterator():
-                        x.delete()
-        else:
-            # very very slow.
-            for x in cdb.CI.objects.all().iterator():
-                x.delete()
+        with cdb.relation_graph_batch():
+            if content_type:
+                for x in cdb.CI.objects.filter(
+                        content_type__in=content_type).all().iterator():
+                    x.delete()
+            else:
+                # very very slow.
+                for x in cdb.CI.objects.all().iterator():
+                    x.delete()
 
     def purge_all_relations(self):
         logger.info('Puring Relations')
-        for x in cdb.CIRelation.objects.all().iterator():
-            x.delete()
+        with cdb.relation_graph_batch():
+            for x in cdb.CIRelation.objects.all().iterator():
+                x.delete()
 
     def purge_system_relations(self):
         logger.info('Purging relations')
-        for x in cdb.CIRelation.objects.filter(readonly=True).iterator():
-            x.delete()
+        with cdb.relation_graph_batch():
+            for x in cdb.CIRelation.objects.filter(readonly=True).iterator():
+                x.delete()
 
     def purge_user_relations(self):
         logger.info('Purging relations')
-        for x in cdb.CIRelation.objects.filter(readonly=False).iterator():
-            x.delete()
+        with cdb.relation_graph_batch():
+            for x in cdb.CIRelation.objects.filter(
+                    readonly=False).iterator():
+                x.delete()
 
     def cache_content_types(self):
         self.venture_content_type = ContentType.objects.get(
@@ -171,6 +212,10 @@ class CIImporter(object):
 
     def import_relations(self, content_type, asset_id=None):
         """ Importing relations parent/child from Ralph  """
+        with cdb.relation_graph_batch():
+            self._import_relations(content_type, asset_id)
+
+    def _import_relations(self, content_type, asset_id=None):
         content_id = content_type.id
         self.cache_content_types()
         if asset_id is not None:
@@ -366,34 +411,263 @@ class CIImporter(object):
 
     def import_all_ci(self, content_types, asset_id=None):
         ret = []
-        content_to_import = {
-            db.Device: cdb.CI_TYPES.DEVICE.id,
-            bdb.Venture: cdb.CI_TYPES.VENTURE.id,
-            bdb.VentureRole: cdb.CI_TYPES.VENTUREROLE.id,
-            ndb.Network: cdb.CI_TYPES.NETWORK.id,
-            ndb.NetworkTerminator: cdb.CI_TYPES.NETWORKTERMINATOR.id,
-            db.DataCenter: cdb.CI_TYPES.DATACENTER.id,
-            bdb.Service: cdb.CI_TYPES.SERVICE.id,
-            bdb.BusinessLine: cdb.CI_TYPES.BUSINESSLINE.id,
-        }
-        layers = {
-            db.Device: 5,
-            bdb.Venture: 4,
-            bdb.VentureRole: 8,
-            ndb.Network:  6,
-            ndb.NetworkTerminator: 6,
-            db.DataCenter: 5,
-            bdb.BusinessLine: 7,
-            bdb.Service: 7,
-        }
         for i in content_types:
             assetClass = i.model_class()
             assetContentType = i
             logger.info('Importing content type : %s' % assetContentType)
-            type_ = content_to_import[assetClass]
-            layer = layers[assetClass]
+            type_ = CONTENT_TO_IMPORT[assetClass]
+            layer = LAYERS[assetClass]
             ret.extend(self.import_assets_by_contenttype(
                 assetClass, type_, layer, asset_id)
             )
         return ret
 
+
+class BulkCIImporter(CIImporter):
+    """
+    Synchronizes the CIs and the system relations of whole content types at
+    once. The existing CIs and relations are loaded in one pass, the
+    differences are computed in memory and applied in batches of at most
+    ``batch_size`` statements, each in its own transaction. After every
+    batch ``progress`` is called with the name of the stage and the numbers
+    of the applied and of all the changes of that stage.
+
+    The CIs are saved without the signals, so no history of the changes is
+    recorded.
+    """
+
+    def __init__(self, batch_size=BULK_BATCH_SIZE, progress=_log_progress):
+        self.batch_size = batch_size
+        self.progress = progress
+
+    def _apply(self, stage, items, func):
+        items = list(items)
+        with cdb.relation_graph_batch():
+            for start in xrange(0, len(items), self.batch_size):
+                batch = items[start:start + self.batch_size]
+                nested_commit_on_success(func)(batch)
+                self.progress(stage, start + len(batch), len(items))
+
+    def _delete_cis(self, batch):
+        cdb.CI.objects.filter(id__in=batch).delete()
+
+    def _delete_relations(self, batch):
+        cdb.CIRelation.objects.filter(id__in=batch).delete()
+
+    def _update_cis(self, batch):
+        for ci_id, changes in batch:
+            cdb.CI.objects.filter(id=ci_id).update(**changes)
+
+    def _insert_cis(self, batch):
+        cdb.CI.objects.bulk_create(ci for ci, layer_id in batch)
+        layers = dict((ci.uid, layer_id) for ci, layer_id in batch)
+        Layers = cdb.CI.layers.through
+        Layers.objects.bulk_create(
+            Layers(ci_id=ci_id, cilayer_id=layers[uid])
+            for ci_id, uid in cdb.CI.objects.filter(
+                uid__in=layers.keys()).values_list('id', 'uid')
+        )
+
+    def _insert_relations(self, batch):
+        cdb.CIRelation.objects.bulk_create(
+            cdb.CIRelation(parent_id=parent_id, child_id=child_id, type=type_,
+                           readonly=True)
+            for parent_id, child_id, type_ in batch
+        )
+        # the bulk inserts send no signals to update the relation graph
+        cdb.invalidate_relation_graph()
+
+    def purge_all_ci(self, content_type=None):
+        cis = cdb.CI.objects.all()
+        if content_type:
+            cis = cis.filter(content_type__in=content_type)
+        self._apply('Purging CIs', cis.values_list('id', flat=True),
+                    self._delete_cis)
+
+    def purge_all_relations(self):
+        self._apply('Purging relations',
+                    cdb.CIRelation.objects.values_list('id', flat=True),
+                    self._delete_relations)
+
+    def purge_system_relations(self):
+        self._apply('Purging relations', cdb.CIRelation.objects.filter(
+            readonly=True).values_list('id', flat=True),
+            self._delete_relations)
+
+    def purge_user_relations(self):
+        self._apply('Purging relations', cdb.CIRelation.objects.filter(
+            readonly=False).values_list('id', flat=True),
+            self._delete_relations)
+
+    def sync_ci(self, content_types):
+        """
+        Create the missing CIs of all the objects of ``content_types``,
+        update the names and barcodes of the existing ones and delete the
+        imported CIs whose objects no longer exist.
+        """
+        barcodes = set(cdb.CI.objects.exclude(barcode=None).values_list(
+            'barcode', flat=True))
+        new = []
+        updates = []
+        stale = []
+        for content_type in content_types:
+            model = content_type.model_class()
+            uid_prefix = self.get_uid_prefix(content_type)
+            existing = dict(
+                (object_id, (ci_id, name, barcode))
+                for ci_id, object_id, name, barcode in cdb.CI.objects.filter(
+                    content_type=content_type,
+                ).values_list('id', 'object_id', 'name', 'barcode')
+            )
+            # CIs made by hand for the objects, but not bound to them
+            unbound = dict(cdb.CI.objects.filter(
+                uid__startswith=uid_prefix + '-', content_type=None,
+            ).values_list('uid', 'id'))
+            for asset in model.objects.order_by('id').iterator():
+                name = _ci_name(asset)
+                barcode = getattr(asset, 'barcode', None)
+                uid = '%s-%s' % (uid_prefix, asset.id)
+                if asset.id in existing:
+                    ci_id, old_name, old_barcode = existing.pop(asset.id)
+                    changes = {}
+                    if name != old_name:
+                        changes['name'] = name
+                    if barcode != old_barcode and barcode not in barcodes:
+                        changes['barcode'] = barcode
+                    if changes:
+                        updates.append((ci_id, changes))
+                elif uid in unbound:
+                    updates.append((unbound[uid], {
+                        'content_type': content_type,
+                        'object_id': asset.id,
+                        'name': name,
+                    }))
+                else:
+                    if barcode in barcodes:
+                        barcode = None
+                    ci = cdb.CI(uid=uid, content_type=content_type,
+                                object_id=asset.id, name=name,
+                                type_id=CONTENT_TO_IMPORT[model],
+                                barcode=barcode)
+                    new.append((ci, LAYERS[model]))
+                if barcode:
+                    barcodes.add(barcode)
+            stale.extend(ci_id for ci_id, name, barcode
+                         in existing.itervalues())
+        stale = cdb.CI.objects.filter(
+            id__in=stale, added_manually=False).values_list('id', flat=True)
+        self._apply('Deleting CIs', stale, self._delete_cis)
+        self._apply('Updating CIs', updates, self._update_cis)
+        self._apply('Creating CIs', new, self._insert_cis)
+
+    def _system_relations(self, content_type):
+        """Yield the (parent, child, type) triples of the relations that
+        the CIs of ``content_type`` should have, with the ids of the CIs."""
+        cis = {}
+
+        def ci(ct, object_id):
+            if ct.id not in cis:
+                cis[ct.id] = dict(cdb.CI.objects.filter(
+                    content_type=ct).values_list('object_id', 'id'))
+            return cis[ct.id].get(object_id)
+
+        types = cdb.CI_RELATION_TYPES
+        if content_type == self.device_content_type:
+            for device_id, venture_id, role_id, parent_id in \
+                    db.Device.objects.values_list(
+                        'id', 'venture', 'venture_role', 'parent'):
+                child = ci(content_type, device_id)
+                yield (ci(self.venture_content_type, venture_id), child,
+                       types.CONTAINS.id)
+                yield (ci(self.venture_role_content_type, role_id), child,
+                       types.HASROLE.id)
+                yield ci(content_type, parent_id), child, types.CONTAINS.id
+        elif content_type == self.venture_content_type:
+            for venture_id, data_center_id, parent_id in \
+                    bdb.Venture.objects.values_list(
+                        'id', 'data_center', 'parent'):
+                child = ci(content_type, venture_id)
+                yield (ci(self.datacenter_content_type, data_center_id),
+                       child, types.REQUIRES.id)
+                yield ci(content_type, parent_id), child, types.CONTAINS.id
+        elif content_type == self.venture_role_content_type:
+            for role_id, venture_id, parent_id in \
+                    bdb.VentureRole.objects.values_list(
+                        'id', 'venture', 'parent'):
+                child = ci(content_type, role_id)
+                yield (ci(self.venture_content_type, venture_id), child,
+                       types.HASROLE.id)
+                yield ci(content_type, parent_id), child, types.CONTAINS.id
+        elif content_type == self.network_content_type:
+            for network_id, device_id in ndb.IPAddress.objects.filter(
+                    device__isnull=False, network__isnull=False,
+            ).values_list('network', 'device'):
+                yield (ci(content_type, network_id),
+                       ci(self.device_content_type, device_id),
+                       types.CONTAINS.id)
+        elif content_type == self.service_content_type:
+            business_lines = dict(cdb.CI.objects.filter(
+                content_type=self.business_line_content_type,
+            ).values_list('name', 'id'))
+            for service_id, business_line in bdb.Service.objects.values_list(
+                    'id', 'business_line'):
+                yield (business_lines.get(business_line),
+                       ci(content_type, service_id), types.CONTAINS.id)
+        elif content_type != self.datacenter_content_type:
+            # data centers are top level CIs without parent relations
+            raise UnknownCTException(content_type)
+
+    def _system_relation_content_types(self, content_type):
+        """Return the (parent, child) content type pairs of the relations
+        that ``_system_relations`` yields for ``content_type``."""
+        if content_type == self.device_content_type:
+            return [(self.venture_content_type, content_type),
+                    (self.venture_role_content_type, content_type),
+                    (content_type, content_type)]
+        elif content_type == self.venture_content_type:
+            return [(self.datacenter_content_type, content_type),
+                    (content_type, content_type)]
+        elif content_type == self.venture_role_content_type:
+            return [(self.venture_content_type, content_type),
+                    (content_type, content_type)]
+        elif content_type == self.network_content_type:
+            return [(content_type, self.device_content_type)]
+        elif content_type == self.service_content_type:
+            return [(self.business_line_content_type, content_type)]
+        return []
+
+    def sync_relations(self, content_types):
+        """
+        Create the missing system relations of the CIs of
+        ``content_types`` and delete the system relations they should no
+        longer have.
+        """
+        self.cache_content_types()
+        wanted = set()
+        for content_type in content_types:
+            wanted.update(
+                (parent, child, type_)
+                for parent, child, type_ in self._system_relations(
+                    content_type)
+                if parent and child and parent != child
+            )
+        # the network relations lead to devices, so the relations are told
+        # apart by the content types at both of their ends
+        pairs = Q()
+        for content_type in content_types:
+            for parent_type, child_type in \
+                    self._system_relation_content_types(content_type):
+                pairs |= Q(parent__content_type=parent_type,
+                           child__content_type=child_type)
+        existing = {}
+        if pairs:
+            for relation_id, parent, child, type_, readonly in \
+                    cdb.CIRelation.objects.filter(pairs).values_list(
+                        'id', 'parent', 'child', 'type', 'readonly'):
+                existing[parent, child, type_] = relation_id, readonly
+        stale = [relation_id
+                 for key, (relation_id, readonly) in existing.iteritems()
+                 if readonly and key not in wanted]
+        self._apply('Deleting relations', stale, self._delete_relations)
+        self._apply('Creating relations', wanted - set(existing),
+                    self._insert_relations)
@@ -8,7 +8,7 @@ import logging
 
 from django.core.management.base import BaseCommand
 from optparse import make_option
-from ralph.cmdb.importer import CIImporter
+from ralph.cmdb.importer import BulkCIImporter, CIImporter
 from django.contrib.contenttypes.models import ContentType
 
 
@@ -55,13 +55,21 @@ class Command(BaseCommand):
                 '--content-types', dest='content_types',
                 help="Type of content to reimport.",
                 default=[],
-            )
+            ),
+            make_option(
+                '--bulk', dest='bulk', action='store_true', default=False,
+                help="Synchronize whole content types in bulk, deleting "
+                     "the CIs and system relations that are gone.",
+            ),
         ])
 
+    def print_progress(self, stage, done, total):
+        print('%s: %d/%d' % (stage, done, total))
+
     def handle(self, *args, **options):
         usage = "usage: %prog --action=[purge|import] \
             --kind=[ci/user-relations/all-relations/system-relations] \
-            --content-types"
+            --content-types [--bulk]"
         if not options.get('action') or options.get(
                 'action') not in self.actions:
             print(usage)
@@ -88,7 +96,13 @@ class Command(BaseCommand):
                         content_types_names.get(ct, None))
         else:
             content_types_to_import = self.content_types
-        cimp = CIImporter()
+        if options.get('bulk'):
+            if id_to_import is not None:
+                print("Bulk synchronization can't import single objects.")
+                return
+            cimp = BulkCIImporter(progress=self.print_progress)
+        else:
+            cimp = CIImporter()
         if options.get('action') == 'purge':
             if options.get('kind') == 'ci':
                 cimp.purge_all_ci(content_types_to_import)
@@ -98,6 +112,14 @@ class Command(BaseCommand):
                 cimp.purge_user_relations()
             elif options.get('kind') == 'system-relations':
                 cimp.purge_system_relations()
+        elif options.get('action') == 'import' and options.get('bulk'):
+            if options.get('kind') == 'ci':
+                cimp.sync_ci(content_types_to_import)
+            elif options.get('kind') == 'all-relations':
+                cimp.sync_relations(content_types_to_import)
+            else:
+                print("Invalid kind for this action")
+                return
         elif options.get('action') == 'import':
             if options.get('kind') == 'ci':
                 cimp.import_all_ci(content_types_to_import, id_to_import)
@@ -61,6 +61,12 @@ from ralph.cmdb.models_audits import (
     AuditStatus,
 )
 
+from ralph.cmdb.models_graph import (
+    invalidate_relation_graph,
+    relation_graph,
+    relation_graph_batch,
+)
+
 __all__ = [
     # constants
     CI_RELATION_TYPES,
@@ -108,6 +114,11 @@ __all__ = [
     #audit
     Auditable,
     AuditStatus,
+
+    #relation graph
+    invalidate_relation_graph,
+    relation_graph,
+    relation_graph_batch,
 ]
 
 # hook signals, don't remove this.
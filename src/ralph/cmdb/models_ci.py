@@ -344,12 +344,8 @@ class CI(TimeTrackable):
 
     @classmethod
     def get_cycle(cls):
-        allci = CI.objects.all().values('pk')
-        relations = CIRelation.objects.all().values('parent_id', 'child_id')
-        cis = [x['pk'] for x in allci]
-        rel = [(x['parent_id'], x['child_id']) for x in relations]
-        cycle = cls.has_cycle(cis, rel)
-        return cycle
+        from ralph.cmdb.models_graph import relation_graph
+        return relation_graph.find_cycle()
 
     @classmethod
     def has_cycle(cls, nodes, edges):
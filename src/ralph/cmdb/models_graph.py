@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+An in-memory graph of all the relations between the CIs.
+
+Every process loads the relations once, with a single query, and answers the
+impact, ancestor, descendant and cycle queries by walking only the part of
+the graph they need. The graph remembers the version of the relations table
+it was loaded at, read from the database itself, and it is reloaded on next
+use when the table is found at another version, which includes the changes
+committed by the other processes and the rolled back ones. The changes saved
+by a process are applied to its own graph by the signal receivers below,
+together with the version of the table they lead to, except for the bulk
+changes made within ``relation_graph_batch``.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import deque
+from contextlib import contextmanager
+import threading
+
+from django.db.models.signals import (post_save, post_delete, pre_save,
+                                      pre_delete)
+from django.dispatch import receiver
+
+from ralph.cmdb.models_ci import CIRelation, CI_RELATION_TYPES
+from ralph.util.tableversion import TableVersion
+
+
+IMPACT_RELATION_TYPES = (
+    CI_RELATION_TYPES.CONTAINS.id,
+    CI_RELATION_TYPES.REQUIRES.id,
+    CI_RELATION_TYPES.HASROLE.id,
+)
+
+
+class RelationGraph(object):
+    """
+    The relations as adjacency maps keyed by CI ids. ``children`` maps the
+    id of every parent to a map of the ids of its children to the sets of
+    types of their relations, and ``parents`` is the same the other way.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.tables = TableVersion([CIRelation])
+        self.children = {}
+        self.parents = {}
+        self.lock = threading.RLock()
+
+    def _add(self, parent, child, type_):
+        self.children.setdefault(parent, {}).setdefault(child, set()).add(
+            type_)
+        self.parents.setdefault(child, {}).setdefault(parent, set()).add(
+            type_)
+
+    def _remove(self, parent, child, type_):
+        for edges, start, end in ((self.children, parent, child),
+                                  (self.parents, child, parent)):
+            types = edges.get(start, {}).get(end)
+            if types is None:
+                continue
+            types.discard(type_)
+            if not types:
+                del edges[start][end]
+                if not edges[start]:
+                    del edges[start]
+
+    def load(self):
+        """Load all the relations from the database."""
+        with self.lock:
+            version = self.tables.get()
+            self.children = {}
+            self.parents = {}
+            for parent, child, type_ in CIRelation.objects.values_list(
+                    'parent', 'child', 'type'):
+                self._add(parent, child, type_)
+            self.version = version
+
+    def _current(self):
+        with self.lock:
+            if self.version is None or self.version != self.tables.get():
+                self.load()
+        return self
+
+    def before_change(self):
+        """Check that the graph is still current before this process changes
+        a relation, so that the changes of the others are not taken for its
+        own."""
+        with self.lock:
+            self.tables.expire()
+            if self.version is not None and self.version != self.tables.get():
+                self.version = None
+
+    def changed(self, removed=None, added=None):
+        """
+        Apply a change of a relation saved by this process, given as the
+        (parent, child, type) of the removed and of the added relation, and
+        remember the version of the table with the change. If the change is
+        rolled back, the table goes back to the previous version and the
+        graph is reloaded.
+        """
+        with self.lock:
+            if self.version is None:
+                return
+            if removed:
+                self._remove(*removed)
+            if added:
+                self._add(*added)
+            self.version = self.tables.get()
+
+    def invalidate(self):
+        """Reload the graph on next use."""
+        with self.lock:
+            self.version = None
+            self.tables.expire()
+
+    def _impact_edges(self, ci_id, relation_types):
+        # only the containment is followed from the parent to the child,
+        # the other relations are followed the opposite way
+        ends = set()
+        if CI_RELATION_TYPES.CONTAINS.id in relation_types:
+            ends.update(
+                child for child, types in self.children.get(ci_id, {}).items()
+                if CI_RELATION_TYPES.CONTAINS.id in types)
+        ends.update(
+            parent for parent, types in self.parents.get(ci_id, {}).items()
+            if (types & relation_types) - {CI_RELATION_TYPES.CONTAINS.id})
+        return sorted(ends)
+
+    def _walk(self, ci_id, edges, relation_types=None):
+        tree = {ci_id: None}
+        order = [ci_id]
+        queue = deque(order)
+        while queue:
+            node = queue.popleft()
+            for end in edges(node, relation_types):
+                if end not in tree:
+                    tree[end] = node
+                    order.append(end)
+                    queue.append(end)
+        return tree, order
+
+    def impact(self, ci_id, relation_types=IMPACT_RELATION_TYPES):
+        """
+        Return the CIs affected by the CI with ``ci_id``, in breadth-first
+        order, as a map of their ids to the ids of the CIs they are affected
+        through and as a list of the ids.
+        """
+        with self.lock:
+            return self._current()._walk(
+                ci_id, self._impact_edges, set(relation_types))
+
+    def impact_type(self, start, end, relation_types=IMPACT_RELATION_TYPES):
+        """Return the type of the relation that ``end`` is affected by
+        ``start`` through."""
+        with self.lock:
+            self._current()
+            if (CI_RELATION_TYPES.CONTAINS.id in relation_types and
+                    CI_RELATION_TYPES.CONTAINS.id in self.children.get(
+                        start, {}).get(end, ())):
+                return CI_RELATION_TYPES.CONTAINS.id
+            types = (self.parents.get(start, {}).get(end, set()) &
+                     set(relation_types)) - {CI_RELATION_TYPES.CONTAINS.id}
+            return min(types) if types else None
+
+    def children_of(self, ci_id):
+        """Return the ids of the CIs directly below the CI with ``ci_id``."""
+        with self.lock:
+            return sorted(self._current().children.get(ci_id, ()))
+
+    def _edges(self, edges):
+        def ends(ci_id, relation_types):
+            return sorted(
+                end for end, types in edges.get(ci_id, {}).items()
+                if relation_types is None or types & relation_types)
+        return ends
+
+    def descendants(self, ci_id, relation_types=None):
+        """Return the ids of all the CIs below the CI with ``ci_id``, in
+        breadth-first order."""
+        with self.lock:
+            self._current()
+            return self._walk(
+                ci_id, self._edges(self.children),
+                set(relation_types) if relation_types else None,
+            )[1][1:]
+
+    def ancestors(self, ci_id, relation_types=None):
+        """Return the ids of all the CIs above the CI with ``ci_id``, in
+        breadth-first order."""
+        with self.lock:
+            self._current()
+            return self._walk(
+                ci_id, self._edges(self.parents),
+                set(relation_types) if relation_types else None,
+            )[1][1:]
+
+    def cycle_with(self, parent_id, child_id):
+        """
+        Return the cycle that a new relation from the CI with ``parent_id``
+        to the one with ``child_id`` would close, as a list of the ids of
+        the CIs on it starting with the parent, or None.
+        """
+        with self.lock:
+            self._current()
+            tree = {child_id: None}
+            stack = [child_id]
+            while stack and parent_id not in tree:
+                node = stack.pop()
+                for child in self.children.get(node, ()):
+                    if child not in tree:
+                        tree[child] = node
+                        stack.append(child)
+            if parent_id not in tree:
+                return None
+            path = []
+            node = tree[parent_id] if parent_id != child_id else None
+            while node is not None:
+                path.append(node)
+                node = tree[node]
+            return [parent_id] + path[::-1]
+
+    def find_cycle(self):
+        """Return the ids of the CIs on any cycle of relations, or an empty
+        list."""
+        with self.lock:
+            self._current()
+            done = set()
+            for start in sorted(self.children):
+                if start in done:
+                    continue
+                path = [start]
+                on_path = {start}
+                iters = [iter(sorted(self.children.get(start, ())))]
+                while iters:
+                    for child in iters[-1]:
+                        if child in on_path:
+                            return path[path.index(child):]
+                        if child not in done:
+                            path.append(child)
+                            on_path.add(child)
+                            iters.append(iter(sorted(
+                                self.children.get(child, ()))))
+                            break
+                    else:
+                        iters.pop()
+                        on_path.discard(path[-1])
+                        done.add(path.pop())
+            return []
+
+
+relation_graph = RelationGraph()
+
+_batch = threading.local()
+
+
+def invalidate_relation_graph():
+    """Reload the relation graph on next use, after the relations were
+    changed without the signals. The other processes notice the change by
+    the version of the table. Inside of ``relation_graph_batch`` it only
+    happens when the outermost block ends."""
+    if getattr(_batch, 'changed', None) is not None:
+        _batch.changed = True
+    else:
+        relation_graph.invalidate()
+
+
+@contextmanager
+def relation_graph_batch():
+    """
+    Don't apply the relations saved or deleted within the block to the
+    graph one by one, which reads the version of the table for every row.
+    The graph is reloaded on next use instead, if any relation was changed,
+    when the outermost block ends.
+    """
+    outermost = getattr(_batch, 'changed', None) is None
+    if outermost:
+        _batch.changed = False
+    try:
+        yield
+    finally:
+        if outermost:
+            changed = _batch.changed
+            _batch.changed = None
+            if changed:
+                relation_graph.invalidate()
+
+
+def _batched():
+    if getattr(_batch, 'changed', None) is None:
+        return False
+    _batch.changed = True
+    return True
+
+
+@receiver(pre_save, sender=CIRelation, dispatch_uid='ralph.cmdb.graph')
+@receiver(pre_delete, sender=CIRelation, dispatch_uid='ralph.cmdb.graph')
+def relation_pre_change(sender, instance, **kwargs):
+    if not _batched():
+        relation_graph.before_change()
+
+
+@receiver(post_save, sender=CIRelation, dispatch_uid='ralph.cmdb.graph')
+def relation_post_save(sender, instance, created, **kwargs):
+    if _batched():
+        return
+    old = dict(parent_id=instance.parent_id, child_id=instance.child_id,
+               type=instance.type)
+    old.update((field, value) for field, value
+               in instance.dirty_fields.iteritems() if field in old)
+    old = old['parent_id'], old['child_id'], old['type']
+    new = instance.parent_id, instance.child_id, instance.type
+    if created:
+        relation_graph.changed(added=new)
+    elif old != new:
+        relation_graph.changed(removed=old, added=new)
+    else:
+        # the table version changes on any save
+        relation_graph.changed()
+
+
+@receiver(post_delete, sender=CIRelation, dispatch_uid='ralph.cmdb.graph')
+def relation_post_delete(sender, instance, **kwargs):
+    if _batched():
+        return
+    relation_graph.changed(
+        removed=(instance.parent_id, instance.child_id, instance.type))
+
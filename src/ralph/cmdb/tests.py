@@ -14,6 +14,7 @@ from lxml import objectify
 from mock import patch
 from os.path import join as djoin
 
+from django.db import connection
 from django.db.utils import IntegrityError
 from django.conf import settings
 from django.contrib.auth.models import User
@@ -26,17 +27,18 @@ from tastypie.models import ApiKey
 from ralph.cmdb.api import (
     CIChangePuppetResource, CIChangeGitResource, CIChangeCMDBHistoryResource
 )
-from ralph.cmdb.importer import CIImporter
+from ralph.cmdb.importer import BulkCIImporter, CIImporter
 from ralph.cmdb.models import (
     CI, CIRelation, CI_RELATION_TYPES, CIChange, CI_TYPES, CILayer, CIType,
     CIValueFloat, CIValueDate, CIValueString, CIChangePuppet, CIChangeGit,
     CI_CHANGE_TYPES, CI_CHANGE_REGISTRATION_TYPES, CIOwner,
-    CIOwnershipType, CIChangeCMDBHistory
+    CIOwnershipType, CIChangeCMDBHistory, invalidate_relation_graph,
+    relation_graph, relation_graph_batch,
 )
 from ralph.cmdb.models_ci import CIOwnership
 
 from ralph.discovery.models import (Device, DeviceType, DeviceModel,
-                                    DataCenter, Network)
+                                    DataCenter, IPAddress, Network)
 from ralph.business.models import Venture, VentureRole, Service, BusinessLine
 from ralph.cmdb.integration.puppet import PuppetAgentsImporter
 from ralph.cmdb.models import PuppetLog
@@ -80,6 +82,9 @@ class CIImporterTest(TestCase):
     ]
 
     def setUp(self):
+        # the relations of the earlier tests were rolled back without any
+        # signals
+        invalidate_relation_graph()
         self.top_venture = Venture(name='top_venture')
         self.top_venture.save()
 
@@ -295,6 +300,77 @@ class CIImporterTest(TestCase):
             ({1: None, 2: 1, 4: 7, 6: 2, 7: 2}, [1, 2, 6, 7, 4])
         )
 
+    def test_bulk_sync(self):
+        content_types = [ContentType.objects.get_for_model(model)
+                         for model in (Venture, VentureRole, Device)]
+        progress = []
+        importer = BulkCIImporter(
+            batch_size=2, progress=lambda *args: progress.append(args))
+        # a CI made by hand for the rack is bound to it
+        rack_ci = CI(name='rack ci', uid='dd-%s' % self.rack.id,
+                     type_id=CI_TYPES.DEVICE.id)
+        rack_ci.save()
+        importer.sync_ci(content_types)
+        importer.sync_relations(content_types)
+        self.assertEqual(CI.objects.get(name='rack').id, rack_ci.id)
+        self.assertEqual(
+            CI.objects.get(name='blade').layers.get().name, 'Hardware')
+        self.assertIn(('Creating CIs', 6, 6), progress)
+
+        def relations():
+            return set((r.parent.name, r.child.name, r.type)
+                       for r in CIRelation.objects.all())
+
+        # the same relations as made by the regular importer
+        self.assertEqual(relations(), set([
+            ('top_venture', 'child_venture', 1),
+            ('child_venture', 'role', 3),
+            ('child_venture', 'child_role', 3),
+            ('role', 'child_role', 1),
+            ('child_venture', 'rack', 1),
+            ('dc', 'rack', 1),
+            ('child_venture', 'blade', 1),
+            ('child_role', 'blade', 3),
+            ('rack', 'blade', 1),
+        ]))
+        gone = CI(name='gone', uid='dd-9999', type_id=CI_TYPES.DEVICE.id,
+                  content_type=content_types[2], object_id=9999)
+        gone.save()
+        self.blade.name = 'blade2'
+        self.blade.parent = self.dc
+        self.blade.save()
+        importer.sync_ci(content_types)
+        importer.sync_relations(content_types)
+        self.assertFalse(CI.objects.filter(id=gone.id).exists())
+        self.assertEqual(CI.objects.count(), 7)
+        changed = relations() - set([('child_venture', 'blade2', 1),
+                                     ('child_role', 'blade2', 3)])
+        self.assertIn(('dc', 'blade2', 1), changed)
+        self.assertNotIn(('rack', 'blade2', 1), changed)
+        self.assertEqual(len(changed), 7)
+
+    def test_bulk_sync_subsets(self):
+        dc = DataCenter(name='dc')
+        dc.save()
+        net = Network(name='net', address='10.0.0.0/24', data_center=dc)
+        net.save()
+        IPAddress(address='10.0.0.1', device=self.blade, network=net).save()
+        device, network = [ContentType.objects.get_for_model(model)
+                           for model in (Device, Network)]
+        importer = BulkCIImporter()
+        importer.sync_ci([device, network])
+
+        def relations():
+            return set((r.parent.name, r.child.name, r.type)
+                       for r in CIRelation.objects.all())
+
+        for content_types in ([network], [network], [device], [device]):
+            importer.sync_relations(content_types)
+            self.assertIn(('net', 'blade', CI_RELATION_TYPES.CONTAINS.id),
+                          relations())
+        self.assertIn(('rack', 'blade', CI_RELATION_TYPES.CONTAINS.id),
+                      relations())
+
 
 class AutoCIRemoveTest(TestCase):
     fixtures = [
@@ -632,6 +708,9 @@ class CIFormsTest(TestCase):
     ]
 
     def setUp(self):
+        # the relations of the earlier tests were rolled back without any
+        # signals
+        invalidate_relation_graph()
         login = 'ralph'
         password = 'ralph'
         user = User.objects.create_user(login, 'ralph@ralph.local', password)
@@ -963,6 +1042,139 @@ class CIFormsTest(TestCase):
         self.assertListEqual(val, ['http://doc.local', 'name-test'])
 
 
+class RelationGraphTest(TestCase):
+    fixtures = ['0_types.yaml']
+
+    def setUp(self):
+        # the relations of the earlier tests were rolled back without any
+        # signals
+        invalidate_relation_graph()
+        self.cis = [CI.objects.create(name='ci%d' % i, uid='uid-%d' % i,
+                                      type_id=CI_TYPES.APPLICATION.id)
+                    for i in xrange(5)]
+        self.relate(0, 1, CI_RELATION_TYPES.CONTAINS)
+        self.relate(1, 2, CI_RELATION_TYPES.CONTAINS)
+        self.relate(3, 1, CI_RELATION_TYPES.REQUIRES)
+        relation_graph.load()
+
+    def relate(self, parent, child, type_):
+        return CIRelation.objects.create(
+            parent=self.cis[parent], child=self.cis[child], type=type_.id)
+
+    def ids(self, *indexes):
+        return [self.cis[i].id for i in indexes]
+
+    def test_incremental_updates(self):
+        with mock.patch.object(relation_graph, 'load') as load:
+            self.assertEqual(relation_graph.descendants(self.cis[0].id),
+                             self.ids(1, 2))
+            relation = self.relate(2, 4, CI_RELATION_TYPES.CONTAINS)
+            self.assertEqual(relation_graph.descendants(self.cis[0].id),
+                             self.ids(1, 2, 4))
+            self.assertEqual(relation_graph.ancestors(self.cis[4].id),
+                             self.ids(2, 1, 0, 3))
+            relation.parent = self.cis[3]
+            relation.save()
+            relation = CIRelation.objects.get(id=relation.id)
+            self.assertEqual(relation_graph.ancestors(self.cis[4].id),
+                             self.ids(3))
+            relation.delete()
+            self.assertEqual(relation_graph.ancestors(self.cis[4].id), [])
+            self.assertFalse(load.called)
+
+    def test_steady_state(self):
+        relation_graph.descendants(self.cis[0].id)
+        later = time.time() + 2 * relation_graph.tables.interval
+        with mock.patch('time.time', lambda: later):
+            relation_graph.descendants(self.cis[0].id)
+            with self.assertNumQueries(0):
+                self.assertEqual(relation_graph.descendants(self.cis[0].id),
+                                 self.ids(1, 2))
+
+    def test_other_process_changes(self):
+        # the changes of another process are not taken for our own
+        CIRelation.objects.bulk_create([CIRelation(
+            parent=self.cis[3], child=self.cis[4],
+            type=CI_RELATION_TYPES.CONTAINS.id,
+        )])
+        self.relate(2, 4, CI_RELATION_TYPES.CONTAINS)
+        self.assertIsNone(relation_graph.version)
+        self.assertEqual(relation_graph.ancestors(self.cis[4].id),
+                         self.ids(2, 3, 1, 0))
+        self.assertIsNotNone(relation_graph.version)
+
+    def test_bulk_changes(self):
+        relation_graph.descendants(self.cis[2].id)
+        CIRelation.objects.bulk_create([CIRelation(
+            parent=self.cis[2], child=self.cis[4],
+            type=CI_RELATION_TYPES.CONTAINS.id,
+        )])
+        later = time.time() + 2 * relation_graph.tables.interval
+        with mock.patch('time.time', lambda: later):
+            self.assertEqual(relation_graph.descendants(self.cis[2].id),
+                             self.ids(4))
+
+    def test_batch(self):
+        relation_graph.descendants(self.cis[2].id)
+        with mock.patch.object(relation_graph.tables, 'get') as get:
+            with relation_graph_batch():
+                self.relate(2, 4, CI_RELATION_TYPES.CONTAINS)
+                with relation_graph_batch():
+                    self.relate(2, 3, CI_RELATION_TYPES.CONTAINS).delete()
+                self.assertIsNotNone(relation_graph.version)
+            # the version of the table isn't read for every relation
+            self.assertFalse(get.called)
+        self.assertIsNone(relation_graph.version)
+        self.assertEqual(relation_graph.descendants(self.cis[2].id),
+                         self.ids(4))
+
+    def test_rollback(self):
+        relation = self.relate(2, 4, CI_RELATION_TYPES.CONTAINS)
+        self.assertEqual(relation_graph.descendants(self.cis[2].id),
+                         self.ids(4))
+        # what a rollback leaves in the table, without any signals
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM cmdb_cirelation WHERE id = %s',
+                       [relation.id])
+        self.assertEqual(relation_graph.descendants(self.cis[2].id), [])
+
+    def test_impact(self):
+        tree, order = relation_graph.impact(self.cis[1].id)
+        self.assertEqual(order, self.ids(1, 2, 3))
+        self.assertEqual(tree, {
+            self.cis[1].id: None,
+            self.cis[2].id: self.cis[1].id,
+            self.cis[3].id: self.cis[1].id,
+        })
+        self.assertEqual(
+            relation_graph.impact_type(self.cis[1].id, self.cis[3].id),
+            CI_RELATION_TYPES.REQUIRES.id,
+        )
+        self.assertIsNone(
+            relation_graph.impact_type(self.cis[1].id, self.cis[0].id))
+        self.assertEqual(
+            relation_graph.descendants(
+                self.cis[3].id, [CI_RELATION_TYPES.CONTAINS.id]),
+            [],
+        )
+
+    def test_cycles(self):
+        self.assertEqual(relation_graph.find_cycle(), [])
+        self.assertIsNone(
+            relation_graph.cycle_with(self.cis[2].id, self.cis[4].id))
+        self.assertEqual(
+            relation_graph.cycle_with(self.cis[2].id, self.cis[3].id),
+            self.ids(2, 3, 1),
+        )
+        self.assertEqual(
+            relation_graph.cycle_with(self.cis[4].id, self.cis[4].id),
+            self.ids(4),
+        )
+        self.relate(2, 3, CI_RELATION_TYPES.HASROLE)
+        self.assertEqual(relation_graph.find_cycle(), self.ids(1, 2, 3))
+        self.assertEqual(CI.get_cycle(), self.ids(1, 2, 3))
+
+
 class CMDBApiTest(TestCase):
     def setUp(self):
         self.creatre_user()
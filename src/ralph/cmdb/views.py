@@ -1239,24 +1239,29 @@ class Graphs(BaseCMDBView):
         ci_id = self.request.GET.get('ci')
         self.rows = []
         if ci_id:
-            ci_names = dict([(x.id, x.name) for x in CI.objects.all()])
             i = ImpactCalculator()
             st, pre = i.find_affected_nodes(int(ci_id))
+            cis = CI.objects.in_bulk(st.keys())
+            # the graph can still hold the CIs deleted in the meantime
+            st = dict((key, parent) for key, parent in st.iteritems()
+                      if key in cis and (parent is None or parent in cis))
+            pre = [x for x in pre if x in st]
+            ci_names = dict((x.id, x.name) for x in cis.itervalues())
             nodes = [(
                 key, ci_names[key],
-                get_icon_for(CI.objects.get(pk=key))) for key in st.keys()]
+                get_icon_for(cis[key])) for key in st.keys()]
             relations = [dict(
                 child=x,
                 parent=st.get(x),
                 parent_name=ci_names[x],
-                type=i.graph.edge_attributes((st.get(x), x))[0],
+                type=i.edge_type(st.get(x), x),
                 child_name=ci_names[st.get(x)])
                 for x in st.keys() if x and st.get(x)]
             self.graph_data = dict(
                 nodes=nodes, relations=relations)
             self.rows = [dict(
-                icon=get_icon_for(CI.objects.get(pk=x)),
-                ci=CI.objects.get(pk=x)) for x in pre]
+                icon=get_icon_for(cis[x]),
+                ci=cis[x]) for x in pre]
         return super(BaseCMDBView, self).get(*args, **kwargs)
 
 
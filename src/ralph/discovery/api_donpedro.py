@@ -16,15 +16,18 @@ from tastypie.cache import SimpleCache
 from tastypie.resources import ModelResource as MResource
 from tastypie.throttle import CacheThrottle
 from django.conf import settings
+from django.db.models import Q
 from lck.django.common.models import MACAddressField
 from lck.django.common import remote_addr
 
 from ralph.discovery.models import (Device, DeviceType, IPAddress, Memory,
-                                    Processor, ComponentModel, ComponentType,
+                                    Processor, ComponentType,
                                     OperatingSystem, Storage, DiskShare,
                                     DiskShareMount, FibreChannel,
                                     MAC_PREFIX_BLACKLIST, EthernetSpeed)
 from ralph.util import Eth
+from ralph.discovery import result_cache
+from ralph.discovery.reconcile import get_models, reconcile, update
 from ralph.discovery.models_history import DiscoveryWarning
 
 
@@ -42,7 +45,9 @@ class NoRequiredDataError(Exception):
 
 
 def save_processors(processors, dev):
-    indexes = []
+    rows = []
+    lookups = []
+    names = []
     for p in processors:
         cpuname = p.get('label')
         try:
@@ -51,12 +56,12 @@ def save_processors(processors, dev):
             cores = int(p.get('cores'))
         except ValueError:
             continue
-        indexes.append(index)
-        cpu, created = Processor.concurrent_get_or_create(
-            device=dev, index=index)
-        cpu.label = cpuname
-        cpu.speed = speed
-        cpu.cores = cores
+        rows.append({
+            'index': index,
+            'label': cpuname,
+            'speed': speed,
+            'cores': cores,
+        })
         is64bit = p.get('is64bit') == 'true'
         extra = '%s %s %s ' % (
             p.get('manufacturer'), p.get('version'),
@@ -65,18 +70,29 @@ def save_processors(processors, dev):
             '64bit ' if is64bit else '',
             cpuname, '%dMhz' % speed if speed else '',
             ' multicore' if cores > 1 else '')
-        cpu.model, c = ComponentModel.concurrent_get_or_create(
+        lookups.append(dict(
             speed=speed, type=ComponentType.processor.id,
             family=cpuname, size=cores,
             cores=cores,
-            extra_hash=hashlib.md5(extra.encode('utf-8')).hexdigest())
+            extra_hash=hashlib.md5(extra.encode('utf-8')).hexdigest()))
+        names.append((extra, name))
+    models = get_models(lookups)
+    for row, (model, c), (extra, name) in zip(rows, models, names):
         if c:
-            cpu.model.extra = extra
-            cpu.model.name = name
-            cpu.model.save(priority=SAVE_PRIORITY)
-        cpu.save(priority=SAVE_PRIORITY)
-    for cpu in dev.processor_set.exclude(index__in=indexes):
-        cpu.delete()
+            update(model, SAVE_PRIORITY, extra=extra, name=name)
+        row['model'] = model
+    reconcile(dev, Processor, ('index',), rows, SAVE_PRIORITY)
+
+
+def known_shares(shares):
+    query = Q()
+    for s in shares:
+        if s.get('sn'):
+            query |= Q(wwn__endswith=s['sn'].upper())
+    if not query:
+        return []
+    return sorted(DiskShare.objects.filter(query).values_list('wwn',
+                                                               flat=True))
 
 
 def save_shares(shares, dev, ip):
@@ -100,79 +116,85 @@ def save_shares(shares, dev, ip):
 
 
 def save_storage(storage, dev):
-    mount_points = []
+    rows = []
+    lookups = []
     for s in storage:
         if not s.get('sn'):
             continue
-        stor, created = Storage.concurrent_get_or_create(device=dev,
-                                                         sn=s.get('sn'))
+        row = {'sn': s.get('sn')}
         try:
-            stor.size = int(s.get('size'))
+            row['size'] = int(s.get('size'))
         except ValueError:
             pass
-        stor.label = s.get('label')
-        model = '{} {}MiB'.format(stor.label, stor.size)
-        stor.mount_point = s.get('mountpoint')
-        mount_points.append(stor.mount_point)
+        row['label'] = s.get('label')
+        row['mount_point'] = s.get('mountpoint')
+        rows.append(row)
         extra = ''
-        stor.model, c = ComponentModel.concurrent_get_or_create(
-            size=stor.size, type=ComponentType.disk.id, speed=0, cores=0,
-            extra=extra, extra_hash=hashlib.md5(extra).hexdigest(),
-            family=model)
-        stor.model.name = model
-        stor.model.save(priority=SAVE_PRIORITY)
-        stor.save(priority=SAVE_PRIORITY)
-    dev.storage_set.exclude(mount_point__in=mount_points).delete()
+        lookups.append(dict(
+            size=row.get('size'), type=ComponentType.disk.id, speed=0,
+            cores=0, extra=extra, extra_hash=hashlib.md5(extra).hexdigest(),
+            family='{} {}MiB'.format(row['label'], row.get('size'))))
+    for row, (model, c) in zip(rows, get_models(lookups)):
+        update(model, SAVE_PRIORITY, name=model.family)
+        row['model'] = model
+    mount_points = {row['mount_point'] for row in rows}
+    reconcile(dev, Storage, ('sn',), rows, SAVE_PRIORITY,
+              prune=lambda stor: stor.mount_point not in mount_points)
 
 
 def save_memory(memory, dev):
-    indexes = []
+    rows = []
+    lookups = []
+    extras = []
     index = 0
     for row in memory:
         index += 1
-        indexes.append(index)
         try:
             size = int(row.get('size'))
             speed = int(row.get('speed')) if row.get('speed') else 0
         except ValueError:
             pass
         label = row.get('label')
-        mem, created = Memory.concurrent_get_or_create(device=dev, index=index)
-        mem.size = size
-        mem.label = 'RAM %dMiB' % size
-        mem.speed = speed
+        rows.append({
+            'index': index,
+            'size': size,
+            'label': 'RAM %dMiB' % size,
+            'speed': speed,
+        })
         family = 'Virtual' if 'Virtual' in label else ''
         extra = '%s %dMiB %s %s' % (label, size, speed, row.get('caption'))
-        mem.model, c = ComponentModel.concurrent_get_or_create(
+        lookups.append(dict(
             family=family, size=size, speed=speed,
             type=ComponentType.memory.id,
-            extra_hash=hashlib.md5(extra.encode('utf-8')).hexdigest())
-        mem.model.extra = extra
-        mem.model.name = 'RAM Windows %dMiB' % size
-        mem.model.save()
-        mem.save(priority=SAVE_PRIORITY)
-    dev.memory_set.exclude(index__in=indexes).delete()
+            extra_hash=hashlib.md5(extra.encode('utf-8')).hexdigest()))
+        extras.append(extra)
+    models = get_models(lookups)
+    for row, (model, c), extra in zip(rows, models, extras):
+        update(model, extra=extra, name='RAM Windows %dMiB' % row['size'])
+        row['model'] = model
+    reconcile(dev, Memory, ('index',), rows, SAVE_PRIORITY)
 
 
 def save_fibre_channel(fcs, dev):
-    detected_fc_cards = []
+    rows = []
+    lookups = []
+    names = []
     for f in fcs:
         pid = f.get('physicalid')
         model = f.get('model')
         manufacturer = f.get('manufacturer')
-        fib, created = FibreChannel.concurrent_get_or_create(device=dev,
-                                                             physical_id=pid)
-        fib.label = f.get('label')
-        extra = '%s %s %s %s' % (fib.label, pid, manufacturer, model)
-        fib.model, c = ComponentModel.concurrent_get_or_create(
-            type=ComponentType.fibre.id, family=fib.label,
-            extra_hash=hashlib.md5(extra.encode('utf-8')).hexdigest())
-        fib.model.extra = extra
-        fib.model.name = model if model else fib.label
-        fib.model.save(priority=SAVE_PRIORITY)
-        fib.save(priority=SAVE_PRIORITY)
-        detected_fc_cards.append(fib.pk)
-    dev.fibrechannel_set.exclude(pk__in=detected_fc_cards).delete()
+        label = f.get('label')
+        rows.append({'physical_id': pid, 'label': label})
+        extra = '%s %s %s %s' % (label, pid, manufacturer, model)
+        lookups.append(dict(
+            type=ComponentType.fibre.id, family=label,
+            extra_hash=hashlib.md5(extra.encode('utf-8')).hexdigest()))
+        names.append((extra, model if model else label))
+    models = get_models(lookups)
+    for row, (model, c), (extra, name) in zip(rows, models, names):
+        update(model, SAVE_PRIORITY, extra=extra, name=name)
+        row['model'] = model
+    reconcile(dev, FibreChannel, ('physical_id',), rows, SAVE_PRIORITY)
 
 
 def str_to_ethspeed(str_value):
@@ -198,6 +220,12 @@ def save_device_data(data, remote_ip):
     sn = device.get('sn')
     if not ethernets and not sn:
         raise NoRequiredDataError('No MAC addresses and no device SN.')
+    # the mounts also depend on which of the shares are known already
+    digest = result_cache.payload_digest([data,
+                                          known_shares(data['shares'])])
+    cached = result_cache.unchanged('donpedro', remote_ip, digest)
+    if cached:
+        return Device.objects.get(id=cached[0])
     try:
         dev = Device.create(
             sn=sn,
@@ -231,6 +259,7 @@ def save_device_data(data, remote_ip):
     save_storage(data['storage'], dev)
     save_shares(data['shares'], dev, ip_address)
     save_fibre_channel(data['fcs'], dev)
+    result_cache.remember('donpedro', remote_ip, digest, dev, dev.name)
     return dev
 
 
@@ -10,10 +10,10 @@ import hashlib
 import re
 
 from ralph.util import units, parse
-from ralph.discovery.models import (Memory, Processor, ComponentModel,
-    ComponentType, Storage, DISK_VENDOR_BLACKLIST, DISK_PRODUCT_BLACKLIST,
-    Device, DeviceType
+from ralph.discovery.models import (Memory, Processor, ComponentType,
+    Storage, DISK_VENDOR_BLACKLIST, DISK_PRODUCT_BLACKLIST, Device, DeviceType
 )
+from ralph.discovery.reconcile import get_models, reconcile, update
 
 
 SMBIOS_BANNER = 'ID    SIZE TYPE'
@@ -114,6 +114,9 @@ def parse_smbios(as_string):
 
 def handle_smbios(dev, smbios, is_virtual=False, priority=0):
     # memory
+    rows = []
+    lookups = []
+    family = 'Virtual' if is_virtual else ''
     for memory in smbios.get('MEMDEVICE', ()):
         try:
             size, size_units = memory.get('Size', '').split(' ', 1)
@@ -131,27 +134,24 @@ def handle_smbios(dev, smbios, is_virtual=False, priority=0):
                 bank = None  # unknown bank
         if bank is None:
             continue
-        mem, created = Memory.concurrent_get_or_create(device=dev, index=bank)
-        if created:
-            mem.speed = 0
-        mem.label = "{} {}".format(
+        label = "{} {}".format(
             memory.get('Device Locator', memory.get('Location Tag', 'DIMM')),
             memory.get('Part Number', '')
         )
-        mem.size = size
         manufacturer = memory.get('Manufacturer', 'Manufacturer')
         if not manufacturer.startswith('Manufacturer'):
-            mem.label = manufacturer + ' ' + mem.label
-        family = 'Virtual' if is_virtual else ''
-        mem.model, c = ComponentModel.concurrent_get_or_create(
-            size=mem.size, speed=0, type=ComponentType.memory.id,
-            family=family, extra_hash='')
-        name = 'RAM %dMiB' % mem.size
+            label = manufacturer + ' ' + label
+        rows.append({'index': bank, 'label': label, 'size': size, 'speed': 0})
+        lookups.append(dict(size=size, speed=0, type=ComponentType.memory.id,
+                            family=family, extra_hash=''))
+    for row, (model, c) in zip(rows, get_models(lookups)):
+        name = 'RAM %dMiB' % row['size']
         if family:
             name = '%s %s' % (family, name)
-        mem.model.name = name
-        mem.model.save(priority=priority)
-        mem.save(priority=priority)
+        update(model, priority, name=name)
+        row['model'] = model
+    reconcile(dev, Memory, ('index',), rows, priority, prune=False,
+              initial=('speed',))
     # CPUs
     detected_cpus = {}
     for cpu in smbios.get('PROCESSOR', ()):
@@ -176,27 +176,30 @@ def handle_smbios(dev, smbios, is_virtual=False, priority=0):
                 continue
         index = reduce(lambda x, y: x * y, index_parts)
         extra = "CPUID: {}".format(cpu['CPUID'])
-        model, c = ComponentModel.concurrent_get_or_create(
+        lookup = dict(
             speed=speed, type=ComponentType.processor.id, extra=extra,
             extra_hash=hashlib.md5(extra).hexdigest(), family=family,
             cores=0)
-        model.name = " ".join(cpu.get('Version', family).split())
-        model.save(priority=priority)
-        detected_cpus[index] = label, model
-    for cpu in dev.processor_set.all():
-        label, model = detected_cpus.get(cpu.index, (None, None))
-        if cpu.label != label or cpu.model != model:
-            cpu.delete()
-    for index, (label, model) in detected_cpus.iteritems():
-        cpu, created = Processor.concurrent_get_or_create(
-            device=dev, index=index)
-        cpu.label = label
-        cpu.model = model
-        cpu.save(priority=priority)
+        name = " ".join(cpu.get('Version', family).split())
+        detected_cpus[index] = label, lookup, name
+    indexes = sorted(detected_cpus)
+    models = get_models(detected_cpus[index][1] for index in indexes)
+    rows = []
+    for index, (model, c) in zip(indexes, models):
+        label, lookup, name = detected_cpus[index]
+        update(model, priority, name=name)
+        rows.append({'index': index, 'label': label, 'model': model})
+    reconcile(dev, Processor, ('index',), rows, priority)
+
+
+MULTIPATH_COMMAND = "multipath -l"
+PVS_COMMAND = "pvs --noheadings --units M --separator '|'"
+LVS_COMMAND = "lvs --noheadings --units M"
+DISK_SHARES_COMMANDS = (MULTIPATH_COMMAND, PVS_COMMAND, LVS_COMMAND)
 
 
 def get_disk_shares(ssh):
-    stdin, stdout, stderr = ssh.exec_command("multipath -l")
+    stdin, stdout, stderr = ssh.exec_command(MULTIPATH_COMMAND)
     pvs = {}
     for line in stdout.readlines():
         line = line.strip()
@@ -216,8 +219,7 @@ def get_disk_shares(ssh):
         pvs['/dev/%s' % pv] = wwn
         if path:
             pvs['/dev/mapper/%s' % path] = wwn
-    stdin, stdout, stderr = ssh.exec_command(
-        "pvs --noheadings --units M --separator '|'")
+    stdin, stdout, stderr = ssh.exec_command(PVS_COMMAND)
     vgs = {}
     for line in stdout.readlines():
         pv, vg, rest = line.split('|', 2)
@@ -226,7 +228,7 @@ def get_disk_shares(ssh):
         if not vg:
             continue
         vgs[vg] = pv
-    stdin, stdout, stderr = ssh.exec_command("lvs --noheadings --units M")
+    stdin, stdout, stderr = ssh.exec_command(LVS_COMMAND)
     storage = {}
     for line in stdout.readlines():
         lv, vg, attr, size, rest = (line + ' x').strip().split(None, 4)
@@ -239,7 +241,23 @@ def get_disk_shares(ssh):
     return storage
 
 
+def _disk_model_lookup(row, extra):
+    return dict(size=row['size'], speed=row['speed'],
+                type=ComponentType.disk.id, family='',
+                extra_hash=hashlib.md5(extra).hexdigest(), extra=extra)
+
+
+def _save_disks(dev, rows, lookups, priority):
+    for row, (model, c) in zip(rows, get_models(lookups)):
+        update(model, priority,
+               name='{} {}MiB'.format(row['label'], row['size']))
+        row['model'] = model
+    reconcile(dev, Storage, ('sn',), rows, priority, prune=False)
+
+
 def handle_smartctl(dev, disks, priority=0):
+    rows = []
+    lookups = []
     for disk_handle, disk in disks.iteritems():
         if not disk.get('serial_number') or disk.get('device_type') != 'disk':
             continue
@@ -251,18 +269,17 @@ def handle_smartctl(dev, disks, priority=0):
             continue
         if disk['product'].lower() in DISK_PRODUCT_BLACKLIST:
             continue
-        stor, created = Storage.concurrent_get_or_create(
-            device=dev, sn=disk['serial_number']
-        )
-        stor.device = dev
         size_value, size_unit, rest = disk['user_capacity'].split(' ', 2)
         size_value = size_value.replace(',', '')
-        stor.size = int(int(size_value) / units.size_divisor[size_unit])
-        stor.speed = int(disk.get('rotational_speed', 0))
         label_meta = [' '.join(disk['vendor'].split()), disk['product']]
         if 'transport_protocol' in disk:
             label_meta.append(disk['transport_protocol'])
-        stor.label = ' '.join(label_meta)
+        row = {
+            'sn': disk['serial_number'],
+            'size': int(int(size_value) / units.size_divisor[size_unit]),
+            'speed': int(disk.get('rotational_speed', 0)),
+            'label': ' '.join(label_meta),
+        }
         disk_default = dict(
             vendor='unknown',
             product='unknown',
@@ -276,12 +293,9 @@ Firmware Revision: {revision}
 Interface: {transport_protocol}
 Size: {user_capacity}
 """.format(**disk_default)
-        stor.model, c = ComponentModel.concurrent_get_or_create(
-            size=stor.size, speed=stor.speed, type=ComponentType.disk.id,
-            family='', extra_hash=hashlib.md5(extra).hexdigest(), extra=extra)
-        stor.model.name = '{} {}MiB'.format(stor.label, stor.size)
-        stor.model.save(priority=priority)
-        stor.save(priority=priority)
+        rows.append(row)
+        lookups.append(_disk_model_lookup(row, extra))
+    _save_disks(dev, rows, lookups, priority)
 
 
 def _handle_inquiry_data(raw, controller, disk):
@@ -297,6 +311,8 @@ def _handle_inquiry_data(raw, controller, disk):
 
 
 def handle_megaraid(dev, disks, priority=0):
+    rows = []
+    lookups = []
     for (controller_handle, disk_handle), disk in disks.iteritems():
         disk['vendor'], disk['product'], disk['serial_number'] = \
             _handle_inquiry_data(
@@ -315,17 +331,17 @@ def handle_megaraid(dev, disks, priority=0):
             continue
         if disk['product'].lower() in DISK_PRODUCT_BLACKLIST:
             continue
-        stor, created = Storage.concurrent_get_or_create(
-            device=dev, sn=disk['serial_number'])
-        stor.device = dev
         size_value, size_unit, rest = disk['coerced_size'].split(' ', 2)
         size_value = size_value.replace(',', '')
-        stor.size = int(float(size_value) / units.size_divisor[size_unit])
-        stor.speed = int(disk.get('rotational_speed', 0))
         label_meta = [' '.join(disk['vendor'].split()), disk['product']]
         if 'pd_type' in disk:
             label_meta.append(disk['pd_type'])
-        stor.label = ' '.join(label_meta)
+        row = {
+            'sn': disk['serial_number'],
+            'size': int(float(size_value) / units.size_divisor[size_unit]),
+            'speed': int(disk.get('rotational_speed', 0)),
+            'label': ' '.join(label_meta),
+        }
         disk_default = dict(
             vendor='unknown',
             product='unknown',
@@ -339,26 +355,25 @@ Firmware Revision: {device_firmware_level}
 Interface: {pd_type}
 Size: {coerced_size}
 """.format(**disk_default)
-        stor.model, c = ComponentModel.concurrent_get_or_create(
-            size=stor.size, speed=stor.speed, type=ComponentType.disk.id,
-            family='', extra_hash=hashlib.md5(extra).hexdigest(), extra=extra)
-        stor.model.name = '{} {}MiB'.format(stor.label, stor.size)
-        stor.model.save(priority=priority)
-        stor.save(priority=priority)
+        rows.append(row)
+        lookups.append(_disk_model_lookup(row, extra))
+    _save_disks(dev, rows, lookups, priority)
 
 
 def handle_hpacu(dev, disks, priority=0):
+    rows = []
+    lookups = []
     for disk_handle, disk in disks.iteritems():
         if not disk.get('serial_number'):
             continue
-        stor, created = Storage.concurrent_get_or_create(
-            device=dev, sn=disk['serial_number'])
-        stor.device = dev
         size_value, size_unit = disk['size'].split()
-        stor.size = int(float(size_value) / units.size_divisor[size_unit])
-        stor.speed = int(disk.get('rotational_speed', 0))
-        stor.label = '{} {}'.format(' '.join(disk['model'].split()),
-                                    disk['interface_type'])
+        row = {
+            'sn': disk['serial_number'],
+            'size': int(float(size_value) / units.size_divisor[size_unit]),
+            'speed': int(disk.get('rotational_speed', 0)),
+            'label': '{} {}'.format(' '.join(disk['model'].split()),
+                                    disk['interface_type']),
+        }
         disk_default = dict(
             model='unknown',
             firmware_revision='unknown',
@@ -374,12 +389,9 @@ Interface: {interface_type}
 Size: {size}
 Rotational Speed: {rotational_speed}
 Status: {status}""".format(**disk_default)
-        stor.model, c = ComponentModel.concurrent_get_or_create(
-            size=stor.size, speed=stor.speed, type=ComponentType.disk.id,
-            family='', extra_hash=hashlib.md5(extra).hexdigest(), extra=extra)
-        stor.model.name = '{} {}MiB'.format(stor.label, stor.size)
-        stor.model.save(priority=priority)
-        stor.save(priority=priority)
+        rows.append(row)
+        lookups.append(_disk_model_lookup(row, extra))
+    _save_disks(dev, rows, lookups, priority)
 
 
 def parse_dmidecode(data):
@@ -438,45 +450,44 @@ def handle_dmidecode(info, ethernets=(), save_priority=0):
         model_name='DMI '+info['model'], model_type=DeviceType.unknown,
         priority=save_priority
     )
-    for i, cpu_info in enumerate(info['cpu']):
+    lookups = []
+    extras = []
+    for cpu_info in info['cpu']:
         extra = ',\n'.join(cpu_info['flags'])
         extra = ('threads: %d\n' % cpu_info['threads']
                  if cpu_info['threads'] else '') + extra
         if cpu_info['64bit']:
             extra = '64bit\n' + extra
-        model, created = ComponentModel.concurrent_get_or_create(
+        lookups.append(dict(
             speed=cpu_info['speed'] or 0,
             cores=cpu_info['cores'] or 0,
             family=cpu_info['family'],
             extra_hash=hashlib.md5(extra).hexdigest(),
             type=ComponentType.processor.id,
-        )
-        if created:
-            model.name = cpu_info['model']
-            model.extra = extra
-            model.save()
-        cpu, created = Processor.concurrent_get_or_create(device=dev,
-                                                          index=i + 1)
-        if created:
-            cpu.label = cpu_info['label']
-            cpu.model = model
-            cpu.save()
-    for cpu in dev.processor_set.filter(index__gt=i + 1):
-        cpu.delete()
-    for i, mem_info in enumerate(info['mem']):
-        model, created = ComponentModel.concurrent_get_or_create(
-            speed=mem_info['speed'] or 0,
-            size=mem_info['size'] or 0,
-            type=ComponentType.memory.id,
-        )
+        ))
+        extras.append(extra)
+    rows = []
+    models = get_models(lookups)
+    for i, (cpu_info, extra, (model, created)) in enumerate(
+            zip(info['cpu'], extras, models)):
         if created:
-            model.name = 'RAM %s %dMiB' % (mem_info['type'], mem_info['size'])
-            model.save()
-        mem, created = Memory.concurrent_get_or_create(device=dev, index=i + 1)
+            update(model, name=cpu_info['model'], extra=extra)
+        rows.append({'index': i + 1, 'label': cpu_info['label'],
+                     'model': model})
+    reconcile(dev, Processor, ('index',), rows, initial=('label', 'model'))
+    lookups = [dict(
+        speed=mem_info['speed'] or 0,
+        size=mem_info['size'] or 0,
+        type=ComponentType.memory.id,
+    ) for mem_info in info['mem']]
+    rows = []
+    models = get_models(lookups)
+    for i, (mem_info, (model, created)) in enumerate(
+            zip(info['mem'], models)):
         if created:
-            mem.label = mem_info['label']
-            mem.model = model
-            mem.save()
-    for mem in dev.memory_set.filter(index__gt=i + 1):
-        mem.delete()
+            update(model, name='RAM %s %dMiB' % (mem_info['type'],
+                                                 mem_info['size']))
+        rows.append({'index': i + 1, 'label': mem_info['label'],
+                     'model': model})
+    reconcile(dev, Memory, ('index',), rows, initial=('label', 'model'))
     return dev
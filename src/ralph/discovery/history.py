@@ -6,12 +6,71 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import datetime
+import threading
+from contextlib import contextmanager
+
+from django.db.models.signals import pre_delete, pre_save
+from django.dispatch import receiver
+
+
+_batch = threading.local()
+_deferred = threading.local()
+
+
+class _Reference(object):
+    """A foreign key value that will be resolved when the batch is flushed,
+    or before the object it refers to is changed, whichever comes first."""
+
+    __slots__ = ('model', 'pk', 'text')
+
+    def __init__(self, model, pk):
+        self.model = model
+        self.pk = pk
+        self.text = None
+        _batch.references.setdefault(pk, []).append(self)
+
+
+def batching():
+    """Return True if history entries are currently being buffered."""
+    return getattr(_batch, 'depth', 0) > 0
+
+
+def core_count_deferred(device_id):
+    """
+    Return True if the core count history of the device is updated only
+    when the current ``defer_core_count`` block ends.
+    """
+    return device_id in getattr(_deferred, 'devices', ())
+
+
+@contextmanager
+def defer_core_count(device_id):
+    """
+    Don't update the core count history of the device for every processor
+    saved or deleted within the block. The caller updates it once when the
+    block ends.
+    """
+    if not hasattr(_deferred, 'devices'):
+        _deferred.devices = set()
+    if device_id in _deferred.devices:
+        yield
+        return
+    _deferred.devices.add(device_id)
+    try:
+        yield
+    finally:
+        _deferred.devices.discard(device_id)
+
 
 def field_changes(instance, ignore=('last_seen',)):
     """
     Yield the name, original value and new value for each changed field. Skip
-    all insignificant fields and those passed in ``ignore``.
+    all insignificant fields and those passed in ``ignore``. Inside of
+    ``history_batch`` the original values of foreign keys are not fetched
+    immediately, but only when the batch is flushed.
     """
+    resolve = not batching()
     for field, orig in instance.dirty_fields.iteritems():
         if field in ignore:
             continue
@@ -22,19 +81,146 @@ def field_changes(instance, ignore=('last_seen',)):
             parent_model = instance._meta.get_field_by_name(
                 field
             )[0].related.parent_model
-            try:
+            if not resolve:
                 if orig is not None:
-                    orig = parent_model.objects.get(pk=orig)
-                # instance -> parent_model
-                # example: IPAddress -> Device
-                # Sometimes `parent_model` is being set to None, e.g. when
-                # a `Device` is disconnected from an `IPAddress`. In this case
-                # the instance won't find the child.
-            except parent_model.DoesNotExist:
-                orig = None
+                    orig = _Reference(parent_model, orig)
+            else:
+                try:
+                    if orig is not None:
+                        orig = parent_model.objects.get(pk=orig)
+                    # instance -> parent_model
+                    # example: IPAddress -> Device
+                    # Sometimes `parent_model` is being set to None, e.g. when
+                    # a `Device` is disconnected from an `IPAddress`. In this
+                    # case the instance won't find the child.
+                except parent_model.DoesNotExist:
+                    orig = None
         try:
             new = getattr(instance, field)
         except AttributeError:
             continue
         yield field, orig, new
 
+
+def _text(value):
+    if isinstance(value, (_Reference, basestring)):
+        return value
+    return unicode(value)
+
+
+def record(model, **kwargs):
+    """
+    Save a new history entry of ``model``. The ``old_value`` and
+    ``new_value`` are converted to text. Inside of ``history_batch`` the entry
+    is only buffered and saved when the batch ends, with the date of the
+    change.
+    """
+    for key in ('old_value', 'new_value'):
+        if key in kwargs:
+            kwargs[key] = _text(kwargs[key])
+    if batching():
+        if 'date' in model._meta.get_all_field_names():
+            kwargs.setdefault('date', datetime.datetime.now())
+        _batch.entries.append((model, kwargs))
+    else:
+        model(**kwargs).save()
+
+
+@contextmanager
+def history_batch():
+    """
+    Buffer all history entries created within the block and save them with
+    one ``bulk_create`` per model when the outermost block ends. The original
+    values of changed foreign keys are fetched with one ``in_bulk`` query per
+    related model, unless the referenced object is saved or deleted earlier
+    in the batch, in which case it is fetched just before. The entries of a
+    block that raised an exception are discarded, as its changes were rolled
+    back.
+
+    The entries are written when the outermost block ends, not when the
+    transaction is committed, so a block that wraps a whole transaction, as
+    the discovery of a plugin does, writes them right after the commit. Use
+    it to wrap a whole device update::
+
+        with history_batch():
+            dev = Device.create(...)
+            for memory in ...:
+                memory.save()
+    """
+    if not batching():
+        _batch.depth = 0
+        _batch.entries = []
+        _batch.references = {}
+    start = len(_batch.entries)
+    _batch.depth += 1
+    try:
+        yield
+    except:
+        del _batch.entries[start:]
+        raise
+    finally:
+        _batch.depth -= 1
+        if not _batch.depth:
+            entries = _batch.entries
+            _batch.entries = []
+            _batch.references = {}
+            _flush(entries)
+
+
+@receiver(pre_save, dispatch_uid='ralph.history.references')
+@receiver(pre_delete, dispatch_uid='ralph.history.references')
+def _resolve_references(sender, instance, **kwargs):
+    """Take the text of the old values that refer to ``instance`` before it
+    changes."""
+    if not batching() or instance.pk not in _batch.references:
+        return
+    pending = []
+    texts = {}
+    for reference in _batch.references.pop(instance.pk):
+        if not isinstance(instance, reference.model):
+            pending.append(reference)
+            continue
+        if reference.model not in texts:
+            texts[reference.model] = unicode(reference.model.objects.in_bulk(
+                [reference.pk]).get(reference.pk))
+        reference.text = texts[reference.model]
+    if pending:
+        _batch.references[instance.pk] = pending
+
+
+def _flush(entries):
+    if not entries:
+        return
+    from ralph.discovery.models_device import Device
+    references = {}
+    device_ids = set()
+    for model, kwargs in entries:
+        for key in ('old_value', 'new_value'):
+            value = kwargs.get(key)
+            if isinstance(value, _Reference) and value.text is None:
+                references.setdefault(value.model, set()).add(value.pk)
+        device = kwargs.get('device')
+        if device is not None:
+            device_ids.add(device.id)
+    resolved = dict((model, model.objects.in_bulk(list(pks)))
+                    for model, pks in references.iteritems())
+    # devices deleted later in the same batch can't be referenced anymore
+    existing = set()
+    if device_ids:
+        existing.update(Device.admin_objects.filter(
+            id__in=device_ids).values_list('id', flat=True))
+    by_model = {}
+    for model, kwargs in entries:
+        for key in ('old_value', 'new_value'):
+            value = kwargs.get(key)
+            if isinstance(value, _Reference):
+                if value.text is None:
+                    value.text = unicode(
+                        resolved[value.model].get(value.pk))
+                kwargs[key] = value.text
+        device = kwargs.get('device')
+        if device is not None and device.id not in existing:
+            kwargs['device'] = None
+        by_model.setdefault(model, []).append(model(**kwargs))
+    for model, items in by_model.iteritems():
+        model.objects.bulk_create(items)
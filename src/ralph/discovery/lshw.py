@@ -17,8 +17,9 @@ import lck.xml.converters
 from lxml import etree as ET
 
 from ralph.util import units, Eth, untangle
+from ralph.discovery.reconcile import get_models, reconcile, update
 from ralph.discovery.models import (EthernetSpeed, Memory, Processor,
-                                    ComponentModel, ComponentType, Storage,
+                                    ComponentType, Storage,
                                     DISK_VENDOR_BLACKLIST,
                                     DISK_PRODUCT_BLACKLIST, FibreChannel,
                                     DeviceType, Device)
@@ -159,7 +160,9 @@ def handle_lshw_memory(dev, bus_memory, is_virtual=False, priority=0):
     index = 0
     if isinstance(memory_banks, dict):
         memory_banks = [memory_banks]
-    detected_memory = {}
+    rows = []
+    lookups = []
+    family = 'Virtual' if is_virtual else ''
     for memory in memory_banks:
         if 'size' not in memory:
             # empty slot
@@ -168,40 +171,28 @@ def handle_lshw_memory(dev, bus_memory, is_virtual=False, priority=0):
         size = int(memory['size']['value'] or 0)
         size /= units.size_divisor[memory['size']['units']]
         size = int(size)
-        label = memory['slot']
-        family = 'Virtual' if is_virtual else ''
-        model, created = ComponentModel.concurrent_get_or_create(
-            size=size, speed=0, type=ComponentType.memory.id,
-            family=family, extra_hash='')
+        rows.append({'index': index, 'label': memory['slot']})
+        lookups.append(dict(size=size, speed=0, type=ComponentType.memory.id,
+                            family=family, extra_hash=''))
+    for row, (model, created) in zip(rows, get_models(lookups)):
         if created:
-            name = 'RAM %dMiB' % size
+            name = 'RAM %dMiB' % model.size
             if family:
                 name = '%s %s' % (family, name)
-            model.name = name
-            model.save(priority=priority)
-        detected_memory[index] = label, model
-    for mem in dev.memory_set.all():
-        label, model = detected_memory.get(mem.index, (None, None))
-        if mem.label != label or mem.model != model:
-            mem.delete()
-    for index, (label, model) in detected_memory.iteritems():
-        mem, created = Memory.concurrent_get_or_create(device=dev, index=index)
-        if created:
-            mem.model = model
-            mem.size = model.size
-            mem.speed = model.speed
-            mem.label = label
-            mem.save(priority=priority)
+            update(model, priority, name=name)
+        row.update(model=model, size=model.size, speed=model.speed)
+    reconcile(dev, Memory, ('index',), rows, priority)
 
 
 def handle_lshw_processors(dev, processors, is_virtual=False, priority=0):
     if isinstance(processors, dict):
         processors = [processors]
-    detected_cpus = {}
+    rows = []
+    lookups = []
+    names = []
     for i, processor in enumerate(processors):
         if processor['disabled'] == 'true' or not processor['size']:
             continue
-        label = 'CPU {}'.format(i + 1)
         speed = int(processor['size']['value'] or 0)   # 'size', sic!
         speed /= units.speed_divisor[processor['size']['units']]
         speed = int(speed)
@@ -211,25 +202,18 @@ def handle_lshw_processors(dev, processors, is_virtual=False, priority=0):
             [": ".join(
                 (key, ' '.join(e for e in untangle(caps[key]) if e) or ''))
                 for key in sorted(caps.keys())])
-        model, c = ComponentModel.concurrent_get_or_create(
+        rows.append({'index': i + 1, 'label': 'CPU {}'.format(i + 1)})
+        lookups.append(dict(
             speed=speed, type=ComponentType.processor.id,
             extra_hash=hashlib.md5(extra).hexdigest(), family=family,
-            cores=0)
-        model.extra = extra
-        model.name = processor['product'] or 'CPU {} {}MHz'.format(family,
-                                                                   speed)
-        model.save(priority=priority)
-        detected_cpus[i + 1] = label, model
-    for cpu in dev.processor_set.all():
-        label, model = detected_cpus.get(cpu.index, (None, None))
-        if cpu.label != label or cpu.model != model:
-            cpu.delete()
-    for index, (label, model) in detected_cpus.iteritems():
-        cpu, created = Processor.concurrent_get_or_create(
-            device=dev, index=index)
-        cpu.label = label
-        cpu.model = model
-        cpu.save(priority=priority)
+            cores=0))
+        names.append((extra, processor['product'] or
+                      'CPU {} {}MHz'.format(family, speed)))
+    models = get_models(lookups)
+    for row, (model, c), (extra, name) in zip(rows, models, names):
+        update(model, priority, extra=extra, name=name)
+        row['model'] = model
+    reconcile(dev, Processor, ('index',), rows, priority)
 
 
 def get_storage_from_lshw(lshw, no_ignore=False):
@@ -297,25 +281,36 @@ def get_storage_from_lshw(lshw, no_ignore=False):
 
 def handle_lshw_storage(dev, lshw, is_virtual=False, priority=0):
     mount_points, storages = get_storage_from_lshw(lshw)
-    dev.storage_set.filter(mount_point__in=mount_points).delete()
+    rows = []
+    lookups = []
     for storage in storages:
-        if storage['sn']:
-            stor, created = Storage.concurrent_get_or_create(sn=storage['sn'],
-                                                             device=dev)
-            stor.mount_point = storage['mount_point']
-        else:
-            stor, created = Storage.concurrent_get_or_create(
-                sn=None, device=dev, mount_point=storage['mount_point'])
-        stor.size = storage['size']
-        stor.speed = storage['speed']
-        stor.label = storage['label']
-        stor.model, c = ComponentModel.concurrent_get_or_create(
-            size=stor.size, speed=stor.speed, type=ComponentType.disk.id,
-            family='', extra_hash=hashlib.md5(storage['extra']).hexdigest())
-        stor.model.extra = storage['extra']
-        stor.model.name = '{} {}MiB'.format(stor.label, stor.size)
-        stor.model.save(priority=priority)
-        stor.save(priority=priority)
+        rows.append({
+            'sn': storage['sn'],
+            'mount_point': storage['mount_point'],
+            'size': storage['size'],
+            'speed': storage['speed'],
+            'label': storage['label'],
+        })
+        lookups.append(dict(
+            size=storage['size'], speed=storage['speed'],
+            type=ComponentType.disk.id, family='',
+            extra_hash=hashlib.md5(storage['extra']).hexdigest()))
+    models = get_models(lookups)
+    for row, storage, (model, c) in zip(rows, storages, models):
+        update(model, priority, extra=storage['extra'],
+               name='{} {}MiB'.format(row['label'], row['size']))
+        row['model'] = model
+    mount_points = set(mount_points)
+    # all the disks lshw saw earlier at its current mount points are gone;
+    # the disks without serial numbers go first, so that their mount points
+    # are free when a disk gets a serial number
+    reconcile(dev, Storage, ('sn', 'mount_point'),
+              [row for row in rows if not row['sn']], priority,
+              prune=lambda stor: (not stor.sn and
+                                  stor.mount_point in mount_points))
+    reconcile(dev, Storage, ('sn',), [row for row in rows if row['sn']],
+              priority, prune=lambda stor: (stor.sn and
+                                            stor.mount_point in mount_points))
 
 
 def handle_lshw_fibre_cards(dev, lshw, is_virtual=False, priority=0):
@@ -329,8 +324,10 @@ def handle_lshw_fibre_cards(dev, lshw, is_virtual=False, priority=0):
             buses.append(bus)
     buses = filter(lambda item: item['id'].startswith('fiber'), buses)
     buses.sort(key=lambda item: item['handle'])
+    rows = []
+    lookups = []
+    products = []
     handled_buses = set()
-    detected_fc_cards = set()
     for bus in buses:
         handle = unicode(bus['handle'])
         m = re.search(r"([1-9][0-9]*)", handle)
@@ -339,18 +336,15 @@ def handle_lshw_fibre_cards(dev, lshw, is_virtual=False, priority=0):
         physid = m.group(1)
         if physid in handled_buses:
             continue
-        fib, created = FibreChannel.concurrent_get_or_create(
-            device=dev, physical_id=physid)
-        fib.label = "{} {}".format(bus['vendor'], bus['product'])
-        extra = fib.label
-        fib.model, c = ComponentModel.concurrent_get_or_create(
-            type=ComponentType.fibre.id, family=bus['vendor'],
-            extra_hash=hashlib.md5(extra).hexdigest())
-        fib.model.extra = extra
-        fib.model.name = bus['product']
-        fib.model.save(priority=priority)
-        fib.save(priority=priority)
         handled_buses.add(physid)
-        detected_fc_cards.add(fib.pk)
-    dev.fibrechannel_set.exclude(pk__in=detected_fc_cards).delete()
-
+        label = "{} {}".format(bus['vendor'], bus['product'])
+        rows.append({'physical_id': physid, 'label': label})
+        lookups.append(dict(
+            type=ComponentType.fibre.id, family=bus['vendor'],
+            extra_hash=hashlib.md5(label).hexdigest()))
+        products.append(bus['product'])
+    models = get_models(lookups)
+    for row, product, (model, c) in zip(rows, products, models):
+        update(model, priority, extra=row['label'], name=product)
+        row['model'] = model
+    reconcile(dev, FibreChannel, ('physical_id',), rows, priority)
@@ -8,21 +8,89 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from optparse import make_option
 import textwrap
+import time
 
 from django.core.management.base import BaseCommand
 
 from ralph.util import plugin
 
+
+def _scan_next(chain, done_reqs):
+    """The original, uncompiled lookup, kept for the benchmark."""
+    ret = set()
+    if chain not in plugin.BY_REQUIREMENTS:
+        return ret
+    done_reqs = set(done_reqs)
+    for needed_reqs, plugins in plugin.BY_REQUIREMENTS[chain].iteritems():
+        if needed_reqs <= done_reqs:
+            ret |= set(plugins)
+    return ret
+
+
+def _scan_highest_priority(chain, plugins):
+    return max(plugins,
+               key=lambda p: plugin.PRIORITIES.get(chain, {}).get(p, 100))
+
+
+def _walk_scan(chain):
+    done = set()
+    while True:
+        to_run = _scan_next(chain, done) - done
+        if not to_run:
+            return
+        done.add(_scan_highest_priority(chain, to_run))
+
+
+def _walk_compiled(chain):
+    done = set()
+    while True:
+        to_run = plugin.next(chain, done) - done
+        if not to_run:
+            return
+        done.add(plugin.highest_priority(chain, to_run))
+
+
+def _walk_schedule(chain):
+    schedule = plugin.Schedule(chain)
+    while True:
+        to_run = schedule.ready()
+        if not to_run:
+            return
+        schedule.complete(to_run[0], True)
+
+
+def _timed(walk, chain, rounds):
+    start = time.time()
+    for i in xrange(rounds):
+        walk(chain)
+    return time.time() - start
+
+
 class Command(BaseCommand):
     """Lists all plugin chains available."""
     help = textwrap.dedent(__doc__).strip()
     requires_model_validation = True
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--benchmark',
+            dest='benchmark',
+            type='int',
+            default=0,
+            metavar='ROUNDS',
+            help='Instead of listing the chains, time ROUNDS full walks '
+                 'of every chain with the uncompiled requirement scan, '
+                 'the compiled lookup and the incremental schedule.'),
+    )
 
     def handle(self, *args, **options):
         """Dispatches the request to either direct, interactive execution
         or to asynchronous processing using Rabbit."""
         chains = sorted(plugin.BY_REQUIREMENTS.keys())
+        if options['benchmark']:
+            self.benchmark(chains, options['benchmark'])
+            return
         for chain in chains:
             print(chain, "chain:")
             reqs = sorted("{} -> {}".format(", ".join(sorted(k)) or 'START',
@@ -30,3 +98,13 @@ class Command(BaseCommand):
                 plugin.BY_REQUIREMENTS[chain].iteritems())
             for req in reqs:
                 print("-", req)
+
+    def benchmark(self, chains, rounds):
+        print("{:<20} {:>8} {:>10} {:>10} {:>10}".format(
+            "chain", "plugins", "scan", "compiled", "schedule"))
+        for chain in chains:
+            plugin.compiled(chain)
+            times = [_timed(walk, chain, rounds) for walk in
+                     (_walk_scan, _walk_compiled, _walk_schedule)]
+            print("{:<20} {:>8} {:>9.3f}s {:>9.3f}s {:>9.3f}s".format(
+                chain, len(plugin.compiled(chain).order), *times))
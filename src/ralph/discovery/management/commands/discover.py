@@ -17,6 +17,7 @@ from django.core.exceptions import ImproperlyConfigured
 from django.core.management.base import BaseCommand
 from ipaddr import IPNetwork
 
+from ralph.discovery import result_cache
 from ralph.discovery.models import Network
 from ralph.discovery.tasks import discover_single, discover_network, \
     discover_all
@@ -61,6 +62,20 @@ class Command(BaseCommand):
             default=None,
             help='Run only the discovery on networks on the specified '
                  'Celery queues.'),
+        make_option(
+            '--force-refresh',
+            action='store_true',
+            dest='force_refresh',
+            default=False,
+            help='Make the plugins save all the data they find, even if it '
+                 'did not change since they last saved it.'),
+        make_option(
+            '--all-hosts',
+            action='store_true',
+            dest='all_hosts',
+            default=False,
+            help='Scan all the known addresses, even those that are not due '
+                 'to be scanned yet.'),
     )
 
     requires_model_validation = False
@@ -69,23 +84,36 @@ class Command(BaseCommand):
         """Dispatches the request to either direct, interactive execution
         or to asynchronous processing using Rabbit."""
         discover = OptionBag()
+        if options['force_refresh']:
+            result_cache.force_refresh()
+        prioritize = not options['all_hosts']
         if options['remote']:
-            discover.all = discover_all.delay
-            discover.network = discover_network.delay
+            discover.all = partial(discover_all.delay, prioritize=prioritize)
+            discover.network = partial(discover_network.delay,
+                                       prioritize=prioritize)
             discover.single = discover_single.delay
         else:
             if options['plugins']:
                 plugin.purge(set(options['plugins'].split(',')))
-            discover.all = partial(discover_all, interactive=True)
-            discover.network = partial(discover_network, interactive=True)
+            discover.all = partial(discover_all, interactive=True,
+                                   prioritize=prioritize)
+            discover.network = partial(discover_network, interactive=True,
+                                       prioritize=prioritize)
             discover.single = partial(
                 discover_single, interactive=True, clear_down=False,
             )
+        before = result_cache.stats()
         try:
             self._handle(*args, discover=discover, **options)
         except ImproperlyConfigured, e:
             print(e.message, file=sys.stderr)
             sys.exit(1)
+        finally:
+            if not options['remote']:
+                after = result_cache.stats()
+                print('Result cache: {} unchanged, {} saved.'.format(
+                    after['hits'] - before['hits'],
+                    after['misses'] - before['misses']))
 
     def _handle(self, *args, **options):
         """Actual handling of the request."""
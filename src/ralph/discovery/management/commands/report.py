@@ -15,7 +15,7 @@ from django.core.management.base import BaseCommand
 from django.db.models import Q
 import xlwt
 
-from ralph.util.csvutil import UnicodeWriter
+from ralph.util.export import iter_chunks, write_csv, write_xls
 from ralph.util import pricing
 from ralph.business.models import Venture
 from ralph.discovery.models import DeviceType, ReadOnlyDevice
@@ -126,34 +126,28 @@ class Command(BaseCommand):
             query = query.filter(venture=v)
         if dc:
             query = query.filter(dc_iexact=dc)
+        query = query.select_related(depth=2)
+        def get_rows(query, report):
+            yield [title for (title, func) in report]
+            for devices in iter_chunks(query):
+                for dev in devices:
+                    yield [func(dev) for (title, func) in report]
         if format == 'csv':
             if output:
                 f = open(output, 'wb')
             else:
                 f = sys.stdout
-            writer = UnicodeWriter(f)
-            writer.writerow([title for (title, func) in report])
-            def get_rows(query, report):
-                for dev in query.select_related(depth=2):
-                    yield [func(dev) for (title, func) in report]
-            writer.writerows(get_rows(query, report))
+            write_csv(f, get_rows(query, report))
         elif format == 'xls':
             if not output:
                 sys.stderr.write('Output file name is required for xls format.\n')
                 sys.exit(1)
-            workbook = xlwt.Workbook()
-            def one_venture(v, workbook, query, report):
-                worksheet = workbook.add_sheet(v.symbol.encode('ascii', 'ignore').replace('/', ' '))
-                for i, (title, func) in enumerate(report):
-                    worksheet.write(0, i, title)
-                for i, dev in enumerate(query.filter(venture=v).select_related(depth=2)):
-                    for j, (title, func) in enumerate(report):
-                        value = func(dev)
-                        worksheet.write(i+1, j, value)
             if venture:
-                one_venture(v, workbook, query, report)
+                ventures = [v]
             else:
-                for v in Venture.objects.filter(show_in_ralph=True):
-                    one_venture(v, workbook, query, report)
-            workbook.save(output)
-
+                ventures = Venture.objects.filter(show_in_ralph=True)
+            write_xls(output, (
+                (v.symbol.encode('ascii', 'ignore').replace('/', ' '),
+                 get_rows(query.filter(venture=v), report))
+                for v in ventures
+            ))
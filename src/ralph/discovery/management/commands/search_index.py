@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import textwrap
+
+from django.core.management.base import BaseCommand
+
+from ralph.discovery.models import Device
+from ralph.discovery.models_search import (CHUNK_SIZE,
+                                           update_search_index_bulk)
+
+
+class Command(BaseCommand):
+    """Rebuild the search documents of all the devices. They are kept up to
+    date when the devices change, so this is only needed after the upgrade
+    that adds them and after the data was changed directly in the
+    database."""
+
+    help = textwrap.dedent(__doc__).strip()
+    requires_model_validation = False
+    option_list = BaseCommand.option_list
+
+    def handle(self, **options):
+        device_ids = list(Device.admin_objects.values_list('id', flat=True))
+        # one transaction per chunk, so that the tables are not locked for
+        # the whole run
+        for start in xrange(0, len(device_ids), CHUNK_SIZE):
+            update_search_index_bulk(device_ids[start:start + CHUNK_SIZE])
+        print('Indexed {} devices.'.format(len(device_ids)))
@@ -9,28 +9,27 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 from optparse import make_option
-from functools import partial
 import sys
 import textwrap
 
+from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.core.management.base import BaseCommand
 
-from ralph.discovery.models import Network
-from ralph.discovery.tasks import discover_single, discover_network, \
-    discover_all
+from ralph.discovery.models import Network, UpdateRun
+from ralph.discovery.tasks import run_update, update_progress
 from ralph.util import plugin
 
 
-class OptionBag(object):
-    pass
-
-
 class Command(BaseCommand):
     """Runs discovery update on existing machines in the network. Accepts an
     optional list of network names (as defined in the database). If run without
     arguments, performs full update based on the configuration from the
     database.
+
+    The known addresses are split into units and the completion of every
+    unit is recorded, so that an interrupted update can be continued with
+    --resume.
     """
     help = textwrap.dedent(__doc__).strip()
     option_list = BaseCommand.option_list + (
@@ -59,6 +58,27 @@ class Command(BaseCommand):
             default=None,
             help='Run only the discovery on networks on the specified '
                  'Celery queues.'),
+        make_option(
+            '--resume',
+            action='store_true',
+            dest='resume',
+            default=False,
+            help='Continue the last update that did not finish instead of '
+                 'starting a new one.'),
+        make_option(
+            '--status',
+            action='store_true',
+            dest='status',
+            default=False,
+            help='Show the progress of the last update and its estimated '
+                 'time of completion.'),
+        make_option(
+            '--concurrency',
+            dest='concurrency',
+            type='int',
+            default=settings.DISCOVERY_UPDATE_CONCURRENCY,
+            help='How many units of addresses of every queue to update at '
+                 'once in the remote mode.'),
     )
 
     requires_model_validation = False
@@ -66,29 +86,16 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         """Dispatches the request to either direct, interactive execution
         or to asynchronous processing using Rabbit."""
-        discover = OptionBag()
-        if options['remote']:
-            discover.all = discover_all.delay
-            discover.network = discover_network.delay
-            discover.single = discover_single.delay
-        else:
-            if options['plugins']:
-                plugin.purge(set(options['plugins'].split(',')))
-            discover.all = partial(discover_all, interactive=True)
-            discover.network = partial(discover_network, interactive=True)
-            discover.single = partial(
-                discover_single, interactive=True, clear_down=False,
-            )
+        if options['plugins'] and not options['remote']:
+            plugin.purge(set(options['plugins'].split(',')))
         try:
-            self._handle(*args, discover=discover, **options)
+            self._handle(*args, **options)
         except ImproperlyConfigured, e:
             print(e.message, file=sys.stderr)
             sys.exit(1)
 
-    def _handle(self, *args, **options):
-        """Actual handling of the request."""
+    def _networks(self, args, options):
         args = list(args)
-        discover = options['discover']
         new_networks = set()
         if options['dc']:
             for dc in options['dc'].split(','):
@@ -103,16 +110,38 @@ class Command(BaseCommand):
         if new_networks:
             args.extend(new_networks)
         if not args:
-            discover.all(update_existing=True)
-            return
-        try:
-            for arg in args:
+            return Network.objects.exclude(queue=None).exclude(queue__name='')
+        networks = []
+        for arg in args:
+            try:
+                networks.append(Network.objects.get(address=arg))
+            except Network.DoesNotExist:
                 try:
-                    Network.objects.get(address=arg)
+                    networks.append(Network.objects.get(name=arg))
                 except Network.DoesNotExist:
-                    Network.objects.get(name=arg)
-                discover.network(arg, update_existing=True)
-        except Network.DoesNotExist:
-            print('Network {} is not known.'.format(arg))
-            sys.exit(2)
+                    print('Network {} is not known.'.format(arg))
+                    sys.exit(2)
+        return networks
+
+    def _handle(self, *args, **options):
+        """Actual handling of the request."""
+        concurrency = options['concurrency']
+        if options['status']:
+            runs = UpdateRun.objects.all()[:1]
+            if not runs:
+                print('No update has been run yet.')
+                sys.exit(2)
+            print(update_progress(runs[0], concurrency))
+            return
+        if options['resume']:
+            runs = UpdateRun.objects.filter(finished=None)[:1]
+            if not runs:
+                print('There is no unfinished update to resume.')
+                sys.exit(2)
+            run = runs[0]
+        else:
+            run = UpdateRun.create(self._networks(args, options),
+                                   settings.DISCOVERY_UPDATE_UNIT_SIZE)
+        run_update(run, interactive=not options['remote'],
+                   concurrency=concurrency)
         print()
@@ -25,6 +25,9 @@ from ralph.discovery.models_component import (
     SplunkUsage, Storage,
 )
 from ralph.discovery.models_history import HistoryChange, HistoryCost
+from ralph.discovery.models_update import UpdateRun, UpdateUnit
+from ralph.discovery.models_search import DeviceSearch
+from ralph.discovery.models_result import DiscoveryResult
 
 __all__ = [
     DataCenter,
@@ -69,6 +72,13 @@ __all__ = [
 
     HistoryChange,
     HistoryCost,
+
+    UpdateRun,
+    UpdateUnit,
+
+    DeviceSearch,
+
+    DiscoveryResult,
 ]
 
 # Load the plugins code
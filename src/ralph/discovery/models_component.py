@@ -10,14 +10,17 @@ from __future__ import unicode_literals
 
 import hashlib
 
+from django.conf import settings
 from django.db import models as db
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 from lck.django.common.models import (TimeTrackable, Named,
     WithConcurrentGetOrCreate, MACAddressField, SavePrioritized)
 from lck.django.choices import Choices
 from django.utils.html import escape
 
-from ralph.discovery.models_util import SavingUser
+from ralph.discovery.models_util import (IdentityMap, SavingUser,
+                                         WithIdentityMap)
 
 
 MAC_PREFIX_BLACKLIST = set([
@@ -136,7 +139,7 @@ class ComponentModelGroup(Named, TimeTrackable, SavingUser):
                 GenericComponent, Software))
 
 
-class ComponentModel(Named.NonUnique, SavePrioritized,
+class ComponentModel(Named.NonUnique, SavePrioritized, WithIdentityMap,
                      WithConcurrentGetOrCreate, SavingUser):
     speed = db.PositiveIntegerField(verbose_name=_("speed (MHz)"),
         default=0, blank=True)
@@ -159,8 +162,8 @@ class ComponentModel(Named.NonUnique, SavePrioritized,
         verbose_name_plural = _("component models")
 
     @classmethod
-    def concurrent_get_or_create(cls, *args, **kwargs):
-        # Make sure the cores are filled correctly
+    def normalize_kwargs(cls, kwargs):
+        """Make sure the cores are filled correctly."""
         if (kwargs.get('type') == ComponentType.processor and
             'cores' in kwargs):
                 kwargs['cores'] = max(
@@ -169,6 +172,11 @@ class ComponentModel(Named.NonUnique, SavePrioritized,
                     cores_from_model(kwargs.get('name', '')),
                 )
                 kwargs['size'] = kwargs['cores']
+        return kwargs
+
+    @classmethod
+    def concurrent_get_or_create(cls, *args, **kwargs):
+        cls.normalize_kwargs(kwargs)
         return super(ComponentModel,
                      cls).concurrent_get_or_create(*args, **kwargs)
 
@@ -210,6 +218,22 @@ class ComponentModel(Named.NonUnique, SavePrioritized,
     def is_software(self):
         return True if self.type == ComponentType.software else False
 
+
+ComponentModel.identity_map = IdentityMap(
+    ComponentModel, ComponentModel._meta.unique_together[0],
+    settings.DISCOVERY_MODEL_CACHE_SIZE,
+)
+
+
+@receiver(db.signals.post_save, sender=ComponentModel,
+          dispatch_uid='ralph.identity_map')
+@receiver(db.signals.post_delete, sender=ComponentModel,
+          dispatch_uid='ralph.identity_map')
+def component_model_changed(sender, instance, created=False, **kwargs):
+    if not created:
+        sender.identity_map.changed(instance.pk)
+
+
 class Component(SavePrioritized, WithConcurrentGetOrCreate):
     device = db.ForeignKey('Device', verbose_name=_("device"))
     model = db.ForeignKey(ComponentModel, verbose_name=_("model"), null=True,
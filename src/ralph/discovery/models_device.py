@@ -14,8 +14,10 @@ import re
 import sys
 import os
 
+from django.conf import settings
 from django.db import models as db
 from django.db import IntegrityError, transaction
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 from lck.django.common.models import (Named, WithConcurrentGetOrCreate,
                                       MACAddressField, SavePrioritized,
@@ -26,7 +28,8 @@ from lck.django.tags.models import Taggable
 from django.utils.html import escape
 
 from ralph.discovery.models_component import is_mac_valid, Ethernet
-from ralph.discovery.models_util import LastSeen, SavingUser
+from ralph.discovery.models_util import (IdentityMap, LastSeen, SavingUser,
+                                         WithIdentityMap)
 from ralph.util import Eth
 
 
@@ -131,7 +134,8 @@ class DeviceModelGroup(Named, TimeTrackable, SavingUser):
         return Device.objects.filter(model__group=self).count()
 
 
-class DeviceModel(SavePrioritized, WithConcurrentGetOrCreate, SavingUser):
+class DeviceModel(SavePrioritized, WithIdentityMap, WithConcurrentGetOrCreate,
+                  SavingUser):
     name = db.CharField(verbose_name=_("name"), max_length=255, unique=True)
     type = db.PositiveIntegerField(verbose_name=_("device type"),
         choices=DeviceType(), default=DeviceType.unknown.id)
@@ -164,6 +168,20 @@ class DeviceModel(SavePrioritized, WithConcurrentGetOrCreate, SavingUser):
         }
 
 
+DeviceModel.identity_map = IdentityMap(
+    DeviceModel, ('name',), settings.DISCOVERY_MODEL_CACHE_SIZE,
+)
+
+
+@receiver(db.signals.post_save, sender=DeviceModel,
+          dispatch_uid='ralph.identity_map')
+@receiver(db.signals.post_delete, sender=DeviceModel,
+          dispatch_uid='ralph.identity_map')
+def device_model_changed(sender, instance, created=False, **kwargs):
+    if not created:
+        sender.identity_map.changed(instance.pk)
+
+
 class UptimeSupport(db.Model):
     """Adds an `uptime` attribute to the model. This attribute is shifted
     by the current time on each get. Returns a timedelta object, accepts
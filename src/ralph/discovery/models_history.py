@@ -27,6 +27,8 @@ from ralph.discovery.models_component import (
 from ralph.discovery.models_network import IPAddress
 from ralph.dnsedit.util import update_txt_records
 from ralph.discovery.history import field_changes as _field_changes
+from ralph.discovery.history import record as _record
+from ralph.discovery.history import core_count_deferred
 
 
 FOREVER = '2199-1-1'  # not all DB backends will accept '9999-1-1'
@@ -75,15 +77,16 @@ def device_post_save(sender, instance, raw, using, **kwargs):
             'last_seen', 'cached_cost', 'cached_price', 'raw',
             'uptime_seconds', 'uptime_timestamp'}):
         dirty.add(field)
-        HistoryChange(
+        _record(
+            HistoryChange,
             device=instance,
             field_name=field,
-            old_value=unicode(orig),
-            new_value=unicode(new),
+            old_value=orig,
+            new_value=new,
             user=instance.saving_user,
             comment=instance.save_comment,
             plugin=instance.saving_plugin,
-        ).save()
+        )
     if {'venture', 'venture_role', 'position', 'chassis_position',
         'parent', 'model'} & dirty:
         update_txt_records(instance)
@@ -96,7 +99,8 @@ def device_pre_delete(sender, instance, using, **kwargs):
     """
 
     instance.being_deleted = True
-    HistoryChange(
+    _record(
+        HistoryChange,
         device=None,
         component=unicode(instance),
         field_name='',
@@ -104,9 +108,10 @@ def device_pre_delete(sender, instance, using, **kwargs):
         new_value='',
         user=instance.saving_user,
         plugin=instance.saving_plugin,
-    ).save()
+    )
     for ip in instance.ipaddress_set.all():
-        HistoryChange(
+        _record(
+            HistoryChange,
             device=None,
             field_name='device',
             component=unicode(ip),
@@ -115,7 +120,7 @@ def device_pre_delete(sender, instance, using, **kwargs):
             new_value='None',
             user=instance.saving_user,
             plugin=instance.saving_plugin,
-        ).save()
+        )
 
 
 @receiver(post_save, sender=IPAddress, dispatch_uid='ralph.history.dns')
@@ -160,16 +165,17 @@ def device_related_pre_save(sender, instance, raw, using, **kwargs):
     for field, orig, new in _field_changes(instance, ignore={
             'last_seen', 'network_id', 'number', 'hostname', 'last_puppet',
             'dns_info'}):
-        HistoryChange(
+        _record(
+            HistoryChange,
             device=device,
             field_name=field,
-            old_value=unicode(orig),
-            new_value=unicode(new),
+            old_value=orig,
+            new_value=new,
             user=device.saving_user if device else None,
             component=unicode(instance),
             component_id=instance.id,
             plugin=device.saving_plugin if device else '',
-        ).save()
+        )
 
 
 @receiver(pre_delete, sender=Memory, dispatch_uid='ralph.history')
@@ -191,7 +197,8 @@ def device_related_pre_delete(sender, instance, using, **kwargs):
     A hook for creating ``HistoryChange`` entry when a component is deleted.
     """
 
-    HistoryChange(
+    _record(
+        HistoryChange,
         device=None,
         field_name='',
         old_value=unicode(instance.device),
@@ -199,7 +206,7 @@ def device_related_pre_delete(sender, instance, using, **kwargs):
         component=unicode(instance),
         component_id=instance.id,
         plugin=instance.device.saving_plugin if instance.device else '',
-    ).save()
+    )
 
 
 @receiver(pre_save, sender=DeprecationKind, dispatch_uid='ralph.history')
@@ -290,16 +297,14 @@ class HistoryCost(db.Model):
 
         if query is None:
             query = cls.objects
-
-        query = query.extra(
-            where=[
-                "DATEDIFF(LEAST(end, DATE(%s)),GREATEST(start, DATE(%s))) > 0",
-            ],
-            params=[
-                end, start,
-            ],
+        if end <= start:
+            return query.none()
+        return query.filter(
+            start__lt=end,
+            end__gt=start,
+        ).filter(
+            end__gt=db.F('start'),
         )
-        return query
 
 
 def update_core_count(device):
@@ -316,7 +321,8 @@ def cores_post_save(sender, instance, raw, using, **kwargs):
     """
     A hook for updating the historical processor core count.
     """
-    update_core_count(instance.device)
+    if not core_count_deferred(instance.device_id):
+        update_core_count(instance.device)
 
 
 @receiver(post_delete, sender=Processor, dispatch_uid='ralph.cores')
@@ -325,7 +331,8 @@ def cores_post_delete(sender, instance, using, **kwargs):
     """
     A hook for updating the historical processor core count.
     """
-    update_core_count(instance.device)
+    if not core_count_deferred(instance.device_id):
+        update_core_count(instance.device)
 
 
 @receiver(post_save, sender=Device, dispatch_uid='ralph.costhistory')
@@ -395,14 +402,15 @@ def device_model_pre_save(sender, instance, raw, using, **kwargs):
     """
 
     for field, orig, new in _field_changes(instance):
-        HistoryModelChange(
+        _record(
+            HistoryModelChange,
             device_model=instance,
             device_model_group=instance.group,
             field_name=field,
-            old_value=unicode(orig),
-            new_value=unicode(new),
+            old_value=orig,
+            new_value=new,
             user=instance.saving_user,
-        ).save()
+        )
 
 
 @receiver(pre_save, sender=ComponentModel, dispatch_uid='ralph.history')
@@ -413,14 +421,15 @@ def component_model_pre_save(sender, instance, raw, using, **kwargs):
     """
 
     for field, orig, new in _field_changes(instance):
-        HistoryModelChange(
+        _record(
+            HistoryModelChange,
             component_model=instance,
             component_model_group=instance.group,
             field_name=field,
-            old_value=unicode(orig),
-            new_value=unicode(new),
+            old_value=orig,
+            new_value=new,
             user=instance.saving_user,
-        ).save()
+        )
 
 
 @receiver(pre_save, sender=DeviceModelGroup, dispatch_uid='ralph.history')
@@ -431,13 +440,14 @@ def device_model_pre_save(sender, instance, raw, using, **kwargs):
     """
 
     for field, orig, new in _field_changes(instance):
-        HistoryModelChange(
+        _record(
+            HistoryModelChange,
             device_model_group=instance,
             field_name=field,
-            old_value=unicode(orig),
-            new_value=unicode(new),
+            old_value=orig,
+            new_value=new,
             user=instance.saving_user,
-        ).save()
+        )
 
 
 @receiver(pre_save, sender=ComponentModelGroup, dispatch_uid='ralph.history')
@@ -448,13 +458,14 @@ def component_model_pre_save(sender, instance, raw, using, **kwargs):
     """
 
     for field, orig, new in _field_changes(instance):
-        HistoryModelChange(
+        _record(
+            HistoryModelChange,
             component_model_group=instance,
             field_name=field,
-            old_value=unicode(orig),
-            new_value=unicode(new),
+            old_value=orig,
+            new_value=new,
             user=instance.saving_user,
-        ).save()
+        )
 
 
 class DiscoveryWarning(db.Model):
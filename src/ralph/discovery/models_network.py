@@ -8,9 +8,13 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import bisect
+import copy
+
 from django.core.exceptions import ValidationError
 from django.db import models as db
 from django.db import IntegrityError
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 import ipaddr
 from lck.django.common.models import (
@@ -18,9 +22,60 @@ from lck.django.common.models import (
 )
 
 from ralph.util import network
+from ralph.util.tableversion import TableVersion
 from ralph.discovery.models_util import LastSeen
 
 
+class NetworkIndex(object):
+    """
+    An in-memory index of all the networks of a model, answering which
+    network contains an IP with a binary search instead of a query.
+
+    The networks are sorted by ``min_ip`` ascending and ``max_ip`` descending
+    and ``reach`` holds the running maximum of ``max_ip`` in that order. The
+    first network in that order that contains an IP is then the first one
+    whose ``reach`` gets to the IP, provided it starts at or before the IP.
+    """
+
+    def __init__(self, model, version):
+        self.version = version
+        self.networks = list(model.objects.select_related(
+            'data_center', 'queue'
+        ).exclude(min_ip=None).exclude(max_ip=None).order_by(
+            'min_ip', '-max_ip', 'id'))
+        self.starts = [net.min_ip for net in self.networks]
+        self.reach = []
+        reach = -1
+        for net in self.networks:
+            reach = max(reach, net.max_ip)
+            self.reach.append(reach)
+
+    def find(self, ip_int):
+        """Return the network for `ip_int` or raise IndexError."""
+        end = bisect.bisect_right(self.starts, ip_int)
+        i = bisect.bisect_left(self.reach, ip_int, 0, end)
+        if i >= end:
+            raise IndexError(ip_int)
+        return copy.copy(self.networks[i])
+
+
+def _network_index(model):
+    if model._network_version is None:
+        model._network_version = TableVersion([model])
+    version = model._network_version.get()
+    index = model._network_index
+    if index is None or index.version != version:
+        index = model._network_index = NetworkIndex(model, version)
+    return index
+
+
+def invalidate_network_index(model):
+    """Make this process rebuild its network index of ``model`` if the
+    networks changed, e.g. after a bulk update."""
+    if model._network_version is not None:
+        model._network_version.expire()
+
+
 class NetworkKind(Named):
     icon = db.CharField(
         _("icon"), max_length=32, null=True, blank=True, default=None,
@@ -70,6 +125,9 @@ class AbstractNetwork(db.Model):
         _("rack"), max_length=16, null=True, blank=True, default=None,
     )
 
+    _network_index = None
+    _network_version = None
+
     class Meta:
         abstract = True
 
@@ -98,14 +156,13 @@ class AbstractNetwork(db.Model):
 
     @classmethod
     def from_ip(cls, ip):
-        """Find the smallest network containing that IP."""
+        """Find the smallest network containing that IP. Raises IndexError
+        if there is none. Served from an in-memory index that is rebuilt
+        whenever the version of the networks table in the database
+        changes."""
 
         ip_int = int(ipaddr.IPAddress(ip))
-        net = cls.objects.filter(
-            min_ip__lte=ip_int,
-            max_ip__gte=ip_int
-        ).order_by('min_ip', '-max_ip')[0]
-        return net
+        return _network_index(cls).find(ip_int)
 
     @property
     def network(self):
@@ -157,6 +214,14 @@ def validate_network_address(sender, instance, **kwargs):
 db.signals.pre_save.connect(validate_network_address, sender=Network)
 
 
+@receiver(db.signals.post_save, sender=Network,
+          dispatch_uid='ralph.network_index')
+@receiver(db.signals.post_delete, sender=Network,
+          dispatch_uid='ralph.network_index')
+def network_index_invalidate(sender, instance, **kwargs):
+    invalidate_network_index(sender)
+
+
 class IPAddress(LastSeen, TimeTrackable, WithConcurrentGetOrCreate):
     address = db.IPAddressField(
         _("IP address"), help_text=_("Presented as string."), unique=True,
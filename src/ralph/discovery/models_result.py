@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""The results of the last runs of the discovery plugins."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from datetime import datetime
+
+from django.db import models as db
+from django.utils.translation import ugettext_lazy as _
+
+from ralph.discovery.models_device import Device
+
+
+class DiscoveryResult(db.Model):
+    """
+    A digest of the data that a discovery plugin got from an address the
+    last time it saved them, with the devices and addresses saved along the
+    way. See ``ralph.discovery.result_cache``.
+    """
+
+    plugin = db.CharField(verbose_name=_("plugin"), max_length=64)
+    address = db.CharField(verbose_name=_("IP address"), max_length=64)
+    digest = db.CharField(verbose_name=_("digest"), max_length=40)
+    device = db.ForeignKey(Device, verbose_name=_("device"))
+    message = db.TextField(verbose_name=_("message"), blank=True, default='')
+    devices = db.TextField(
+        verbose_name=_("other devices"), blank=True, default='',
+        help_text=_("JSON list of the ids of the other devices saved."))
+    addresses = db.TextField(
+        verbose_name=_("other addresses"), blank=True, default='',
+        help_text=_("JSON list of the other addresses saved."))
+    saved = db.DateTimeField(verbose_name=_("saved"), default=datetime.now)
+    hits = db.PositiveIntegerField(
+        verbose_name=_("unchanged runs"), default=0)
+    misses = db.PositiveIntegerField(verbose_name=_("saved runs"), default=0)
+
+    class Meta:
+        verbose_name = _("discovery result")
+        verbose_name_plural = _("discovery results")
+        unique_together = ('plugin', 'address')
+
+    def __unicode__(self):
+        return "{} {} ({})".format(self.plugin, self.address, self.saved)
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+A denormalised search document of every device.
+
+The names, addresses, serial numbers and component descriptions of a device
+are spread over a dozen tables, so searching them directly needs a join with
+all of them. Instead, they are copied into one ``DeviceSearch`` row per
+device whenever any of them changes, and the device search only looks at
+that row.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from contextlib import contextmanager
+import threading
+
+from django.db import models as db
+from django.db.models.signals import (post_save, pre_save, pre_delete,
+                                      post_delete)
+from django.dispatch import receiver
+from django.utils.translation import ugettext_lazy as _
+from lck.django.common import nested_commit_on_success
+from powerdns.models import Record
+
+from ralph.discovery.models_component import (
+    ComponentModel, ComponentModelGroup, DiskShare, DiskShareMount, Ethernet,
+    FibreChannel, GenericComponent, Memory, OperatingSystem, Processor,
+    Software, Storage,
+)
+from ralph.discovery.models_device import Device
+from ralph.discovery.models_network import IPAddress
+
+
+# the components whose label and model are searched for
+LABELED_COMPONENTS = (GenericComponent, Software, FibreChannel, Storage,
+                      Memory, Processor, OperatingSystem)
+# the fields of the searched objects that end up in the documents
+SEARCHED_FIELDS = {
+    Device: {'name', 'sn'},
+    IPAddress: {'address', 'hostname', 'device_id'},
+    Ethernet: {'mac', 'device_id'},
+    DiskShare: {'label', 'wwn', 'model_id', 'device_id'},
+    DiskShareMount: {'share_id', 'device_id'},
+    ComponentModel: {'name', 'group_id'},
+    ComponentModelGroup: {'name'},
+}
+for _component in LABELED_COMPONENTS:
+    SEARCHED_FIELDS[_component] = {'label', 'model_id', 'device_id'}
+SEARCHED_FIELDS[GenericComponent] |= {'sn'}
+CHUNK_SIZE = 500
+
+
+class DeviceSearch(db.Model):
+    """The text of a device and its components that the search looks at."""
+
+    device = db.OneToOneField(Device, verbose_name=_("device"),
+                              primary_key=True, related_name='search')
+    name = db.TextField(
+        verbose_name=_("names"), blank=True, default='',
+        help_text=_("The name, host names and DNS names of the device."))
+    address = db.TextField(verbose_name=_("IP addresses"), blank=True,
+                           default='')
+    serial = db.TextField(
+        verbose_name=_("serial numbers"), blank=True, default='',
+        help_text=_("Serial numbers, MAC addresses and WWNs."))
+    component = db.TextField(
+        verbose_name=_("components"), blank=True, default='',
+        help_text=_("Labels, models and model groups of the components."))
+
+    class Meta:
+        verbose_name = _("device search document")
+        verbose_name_plural = _("device search documents")
+
+    def __unicode__(self):
+        return unicode(self.device_id)
+
+
+def _join(values):
+    return '\n'.join(sorted(set(unicode(v) for v in values if v)))
+
+
+_deleting = threading.local()
+
+
+def _documents(device_ids):
+    texts = {}
+
+    def add(device_id, field, *values):
+        if device_id in texts:
+            texts[device_id][field].update(values)
+
+    # the components of a device are deleted before the device itself
+    device_ids = set(device_ids) - getattr(_deleting, 'devices', set())
+    for device_id, name, sn in Device.admin_objects.filter(
+            id__in=device_ids).values_list('id', 'name', 'sn'):
+        texts[device_id] = {'name': {name}, 'address': set(),
+                            'serial': {sn}, 'component': set()}
+    if not texts:
+        return {}
+    by_address = {}
+    by_name = {}
+    for device_id, address, hostname in IPAddress.objects.filter(
+            device__in=texts.keys()).values_list(
+                'device', 'address', 'hostname'):
+        add(device_id, 'address', address)
+        add(device_id, 'name', hostname)
+        by_address.setdefault(address, set()).add(device_id)
+        if hostname:
+            by_name.setdefault(hostname, set()).add(device_id)
+    if by_address:
+        for name, content in Record.objects.filter(
+                type='A', content__in=by_address.keys(),
+        ).values_list('name', 'content'):
+            for device_id in by_address[content]:
+                add(device_id, 'name', name)
+                by_name.setdefault(name, set()).add(device_id)
+    if by_name:
+        contents = set(by_name) | set(name + '.' for name in by_name)
+        for name, content in Record.objects.filter(
+                type='CNAME', content__in=contents,
+        ).values_list('name', 'content'):
+            for device_id in by_name[content.strip('.')]:
+                add(device_id, 'name', name)
+    for component in LABELED_COMPONENTS:
+        for row in component.objects.filter(
+                device__in=texts.keys()).values_list(
+                    'device', 'label', 'model__name', 'model__group__name'):
+            add(row[0], 'component', *row[1:])
+    for device_id, sn in GenericComponent.objects.filter(
+            device__in=texts.keys()).values_list('device', 'sn'):
+        add(device_id, 'serial', sn)
+    for device_id, mac in Ethernet.objects.filter(
+            device__in=texts.keys()).values_list('device', 'mac'):
+        add(device_id, 'serial', mac)
+        add(device_id, 'component', mac)
+    for device_id, wwn in DiskShare.objects.filter(
+            device__in=texts.keys()).values_list('device', 'wwn'):
+        add(device_id, 'serial', wwn)
+    for row in DiskShareMount.objects.filter(
+            device__in=texts.keys()).values_list(
+                'device', 'share__wwn', 'share__label', 'share__model__name'):
+        add(row[0], 'serial', row[1])
+        add(row[0], 'component', *row[1:])
+    return dict(
+        (device_id, dict((field, _join(values))
+                         for field, values in fields.iteritems()))
+        for device_id, fields in texts.iteritems()
+    )
+
+
+@nested_commit_on_success
+def update_search_index_bulk(device_ids):
+    """
+    Rebuild the search documents of all the devices with the given ids.
+    Everything is fetched with one query per table and only the documents
+    that changed are saved.
+    """
+    device_ids = list(set(device_ids))
+    for start in xrange(0, len(device_ids), CHUNK_SIZE):
+        chunk = device_ids[start:start + CHUNK_SIZE]
+        documents = _documents(chunk)
+        existing = DeviceSearch.objects.in_bulk(documents.keys())
+        new = []
+        for device_id, fields in documents.iteritems():
+            doc = existing.get(device_id)
+            if doc is None:
+                new.append(DeviceSearch(device_id=device_id, **fields))
+            elif any(getattr(doc, field) != value
+                     for field, value in fields.iteritems()):
+                DeviceSearch.objects.filter(device=device_id).update(**fields)
+        DeviceSearch.objects.bulk_create(new)
+
+
+_pending = threading.local()
+
+
+@contextmanager
+def search_index_batch():
+    """
+    Defer all the ``update_search_index`` calls made within the block. Every
+    device is updated only once, together with all the others, when the
+    outermost block ends.
+    """
+    outermost = getattr(_pending, 'devices', None) is None
+    if outermost:
+        _pending.devices = set()
+    try:
+        yield
+    finally:
+        if outermost:
+            device_ids = _pending.devices
+            _pending.devices = None
+            update_search_index_bulk(device_ids)
+
+
+def update_search_index(*device_ids):
+    """
+    Update the search documents of the devices with the given ids. Inside of
+    ``search_index_batch`` the update is only queued.
+    """
+    device_ids = set(device_ids) - {None}
+    if not device_ids:
+        return
+    if getattr(_pending, 'devices', None) is not None:
+        _pending.devices.update(device_ids)
+    else:
+        update_search_index_bulk(device_ids)
+
+
+def _changed(sender, instance, created):
+    return created or bool(
+        set(instance.dirty_fields) & SEARCHED_FIELDS[sender])
+
+
+def _devices_of_models(model_ids):
+    device_ids = set()
+    for component in LABELED_COMPONENTS + (DiskShare,):
+        device_ids.update(component.objects.filter(
+            model__in=model_ids).values_list('device', flat=True))
+    device_ids.update(DiskShareMount.objects.filter(
+        share__model__in=model_ids).values_list('device', flat=True))
+    return device_ids
+
+
+@receiver(post_save, sender=Device, dispatch_uid='ralph.search')
+def device_post_save(sender, instance, created, **kwargs):
+    if _changed(sender, instance, created):
+        update_search_index(instance.id)
+
+
+@receiver(pre_delete, sender=Device, dispatch_uid='ralph.search')
+def device_pre_delete(sender, instance, **kwargs):
+    if not hasattr(_deleting, 'devices'):
+        _deleting.devices = set()
+    _deleting.devices.add(instance.id)
+
+
+@receiver(post_delete, sender=Device, dispatch_uid='ralph.search')
+def device_post_delete(sender, instance, **kwargs):
+    _deleting.devices.discard(instance.id)
+
+
+@receiver(post_save, sender=IPAddress, dispatch_uid='ralph.search')
+@receiver(post_save, sender=Ethernet, dispatch_uid='ralph.search')
+@receiver(post_save, sender=DiskShareMount, dispatch_uid='ralph.search')
+@receiver(post_save, sender=GenericComponent, dispatch_uid='ralph.search')
+@receiver(post_save, sender=Software, dispatch_uid='ralph.search')
+@receiver(post_save, sender=FibreChannel, dispatch_uid='ralph.search')
+@receiver(post_save, sender=Storage, dispatch_uid='ralph.search')
+@receiver(post_save, sender=Memory, dispatch_uid='ralph.search')
+@receiver(post_save, sender=Processor, dispatch_uid='ralph.search')
+@receiver(post_save, sender=OperatingSystem, dispatch_uid='ralph.search')
+def device_related_post_save(sender, instance, created, **kwargs):
+    if _changed(sender, instance, created):
+        update_search_index(instance.device_id,
+                            instance.dirty_fields.get('device_id'))
+
+
+@receiver(post_delete, sender=IPAddress, dispatch_uid='ralph.search')
+@receiver(post_delete, sender=Ethernet, dispatch_uid='ralph.search')
+@receiver(post_delete, sender=DiskShare, dispatch_uid='ralph.search')
+@receiver(post_delete, sender=DiskShareMount, dispatch_uid='ralph.search')
+@receiver(post_delete, sender=GenericComponent, dispatch_uid='ralph.search')
+@receiver(post_delete, sender=Software, dispatch_uid='ralph.search')
+@receiver(post_delete, sender=FibreChannel, dispatch_uid='ralph.search')
+@receiver(post_delete, sender=Storage, dispatch_uid='ralph.search')
+@receiver(post_delete, sender=Memory, dispatch_uid='ralph.search')
+@receiver(post_delete, sender=Processor, dispatch_uid='ralph.search')
+@receiver(post_delete, sender=OperatingSystem, dispatch_uid='ralph.search')
+def device_related_post_delete(sender, instance, **kwargs):
+    update_search_index(instance.device_id)
+
+
+@receiver(post_save, sender=DiskShare, dispatch_uid='ralph.search')
+def disk_share_post_save(sender, instance, created, **kwargs):
+    if _changed(sender, instance, created):
+        update_search_index(
+            instance.device_id, instance.dirty_fields.get('device_id'),
+            *instance.disksharemount_set.values_list('device', flat=True))
+
+
+@receiver(post_save, sender=ComponentModel, dispatch_uid='ralph.search')
+def component_model_post_save(sender, instance, created, **kwargs):
+    if not created and _changed(sender, instance, created):
+        update_search_index(*_devices_of_models([instance.id]))
+
+
+@receiver(post_save, sender=ComponentModelGroup, dispatch_uid='ralph.search')
+def component_model_group_post_save(sender, instance, created, **kwargs):
+    if not created and _changed(sender, instance, created):
+        update_search_index(*_devices_of_models(
+            instance.componentmodel_set.values_list('id', flat=True)))
+
+
+def _devices_of_record(type, name, content):
+    if type == 'A':
+        query = db.Q(address=content) | db.Q(hostname=name)
+    elif type == 'CNAME':
+        query = db.Q(hostname=(content or '').strip('.'))
+    else:
+        return []
+    return IPAddress.objects.filter(query).exclude(
+        device=None).values_list('device', flat=True)
+
+
+@receiver(pre_save, sender=Record, dispatch_uid='ralph.search')
+def record_pre_save(sender, instance, **kwargs):
+    # the devices the record pointed to before need to lose its name
+    instance._search_old = []
+    if instance.id:
+        instance._search_old = list(Record.objects.filter(
+            id=instance.id).values_list('type', 'name', 'content'))
+
+
+@receiver(post_save, sender=Record, dispatch_uid='ralph.search')
+@receiver(post_delete, sender=Record, dispatch_uid='ralph.search')
+def record_post_save(sender, instance, **kwargs):
+    device_ids = set(_devices_of_record(
+        instance.type, instance.name, instance.content))
+    for old in getattr(instance, '_search_old', ()):
+        device_ids.update(_devices_of_record(*old))
+    update_search_index(*device_ids)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Progress of the updates of already discovered machines."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from datetime import datetime
+import json
+
+from django.db import models as db
+from django.utils.translation import ugettext_lazy as _
+
+from ralph.discovery.models_network import IPAddress, Network
+
+
+class UpdateRun(db.Model):
+    """
+    A single update of the known addresses of many networks, split into
+    ``UpdateUnit`` chunks whose completion is recorded separately, so that
+    an interrupted run can be resumed.
+    """
+
+    created = db.DateTimeField(verbose_name=_("created"),
+                               default=datetime.now)
+    finished = db.DateTimeField(verbose_name=_("finished"), null=True,
+                                blank=True, default=None)
+
+    class Meta:
+        verbose_name = _("update run")
+        verbose_name_plural = _("update runs")
+        ordering = ('-created',)
+
+    def __unicode__(self):
+        return "{} ({})".format(self.created, self.id)
+
+    @classmethod
+    def create(cls, networks, unit_size):
+        """
+        Start a new run over the known addresses of ``networks``, with at
+        most ``unit_size`` addresses in every unit.
+        """
+        run = cls()
+        run.save()
+        for net in networks:
+            ip_net = net.network
+            numbers = list(IPAddress.objects.filter(
+                number__gt=int(ip_net.ip), number__lt=int(ip_net.broadcast),
+            ).order_by('number').values_list('number', flat=True))
+            queue = net.queue.name if net.queue else ''
+            UpdateUnit.objects.bulk_create([
+                UpdateUnit(run=run, network=net, queue=queue,
+                           min_number=chunk[0], max_number=chunk[-1],
+                           address_count=len(chunk))
+                for chunk in (numbers[i:i + unit_size]
+                              for i in xrange(0, len(numbers), unit_size))
+            ])
+        return run
+
+    def latencies(self):
+        """
+        Return a dict of plugin name -> ``[runs, seconds]`` summed over all
+        the finished units of this run.
+        """
+        totals = {}
+        for times in self.updateunit_set.exclude(finished=None).values_list(
+                'plugin_times', flat=True):
+            for name, (runs, seconds) in json.loads(times or '{}').iteritems():
+                total = totals.setdefault(name, [0, 0])
+                total[0] += runs
+                total[1] += seconds
+        return totals
+
+    def progress(self, concurrency=1):
+        """
+        Return the number of updated addresses, the number of all the
+        addresses and the estimated number of seconds left, with
+        ``concurrency`` units of every queue running at once.
+
+        The estimate assumes that the remaining addresses need the plugins
+        as often as the updated ones did, each with its mean latency
+        measured so far. It is None until the first unit is finished.
+        """
+        done = total = 0
+        remaining = {}
+        for queue, count, finished in self.updateunit_set.values_list(
+                'queue', 'address_count', 'finished'):
+            total += count
+            if finished:
+                done += count
+            else:
+                remaining[queue] = remaining.get(queue, 0) + count
+        if not done:
+            return done, total, None
+        per_address = sum(
+            seconds for runs, seconds in self.latencies().itervalues()
+        ) / done
+        eta = max([count * per_address / concurrency
+                   for count in remaining.itervalues()] or [0])
+        return done, total, eta
+
+    def check_finished(self):
+        """Mark the run as finished if all its units are."""
+        if not self.updateunit_set.filter(finished=None).exists():
+            UpdateRun.objects.filter(id=self.id, finished=None).update(
+                finished=datetime.now())
+
+
+class UpdateUnit(db.Model):
+    """A range of known addresses of a network, updated in one go."""
+
+    run = db.ForeignKey(UpdateRun, verbose_name=_("update run"))
+    network = db.ForeignKey(Network, verbose_name=_("network"), null=True,
+                            blank=True, default=None, on_delete=db.SET_NULL)
+    queue = db.CharField(verbose_name=_("discovery queue"), max_length=64,
+                         blank=True, default='')
+    min_number = db.BigIntegerField(verbose_name=_("smallest IP number"))
+    max_number = db.BigIntegerField(verbose_name=_("largest IP number"))
+    address_count = db.PositiveIntegerField(
+        verbose_name=_("number of addresses"), default=0)
+    started = db.DateTimeField(verbose_name=_("started"), null=True,
+                               blank=True, default=None)
+    finished = db.DateTimeField(verbose_name=_("finished"), null=True,
+                                blank=True, default=None)
+    plugin_times = db.TextField(
+        verbose_name=_("plugin latencies"), blank=True, default='',
+        help_text=_("JSON object of plugin name -> [runs, seconds]."))
+    error = db.TextField(
+        verbose_name=_("error"), blank=True, default='',
+        help_text=_("Traceback of the error that ended the unit early."))
+    last_number = db.BigIntegerField(
+        verbose_name=_("last updated IP number"), null=True, blank=True,
+        default=None)
+    pending = db.PositiveIntegerField(
+        verbose_name=_("addresses being updated"), default=0)
+
+    class Meta:
+        verbose_name = _("update unit")
+        verbose_name_plural = _("update units")
+        ordering = ('id',)
+
+    def __unicode__(self):
+        return "{} ({}-{})".format(self.network, self.min_number,
+                                   self.max_number)
+
+    @classmethod
+    def claim(cls, run, queue):
+        """
+        Mark the next unit of ``run`` for ``queue`` that hasn't been started
+        yet as started and return it, or None if there is none left. Safe
+        to call from many processes at once.
+        """
+        while True:
+            pending = list(cls.objects.filter(
+                run=run, queue=queue, started=None,
+            ).values_list('id', flat=True)[:1])
+            if not pending:
+                return None
+            if cls.objects.filter(id=pending[0], started=None).update(
+                    started=datetime.now()):
+                return cls.objects.get(id=pending[0])
+
+    def addresses(self):
+        """Return the addresses of this unit that were not updated yet."""
+        addresses = IPAddress.objects.filter(
+            number__gte=self.min_number, number__lte=self.max_number)
+        if self.last_number is not None:
+            addresses = addresses.filter(number__gt=self.last_number)
+        return list(addresses.order_by('number').values_list(
+            'address', flat=True))
+
+    def add_plugin_times(self, times):
+        """Add ``times``, a dict of plugin name -> ``[runs, seconds]``, to
+        the latencies of the plugins recorded for this unit."""
+        totals = json.loads(self.plugin_times or '{}')
+        for name, (runs, seconds) in times.iteritems():
+            total = totals.setdefault(name, [0, 0])
+            total[0] += runs
+            total[1] += seconds
+        self.plugin_times = json.dumps(totals)
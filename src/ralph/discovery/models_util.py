@@ -8,11 +8,17 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import copy
+import threading
+from collections import OrderedDict
 from datetime import datetime
 
 from django.db import models as db
+from django.db import transaction
 from django.utils.translation import ugettext_lazy as _
 
+from ralph.util.tableversion import TableVersion
+
 
 class LastSeen(db.Model):
     last_seen = db.DateTimeField(verbose_name=_("last seen"),
@@ -34,3 +40,144 @@ class SavingUser(db.Model):
     def save(self, user=None, *args, **kwargs):
         self.saving_user = user
         return super(SavingUser, self).save(*args, **kwargs)
+
+
+def _copy(obj):
+    clone = copy.copy(obj)
+    clone._state = copy.copy(obj._state)
+    if hasattr(obj, '_field_state'):
+        clone._field_state = dict(obj._field_state)
+    return clone
+
+
+class IdentityMap(object):
+    """
+    A process-wide cache of the instances of ``model`` by their natural key,
+    the values of the fields named in ``key``. At most ``size`` of the most
+    recently used instances are kept, each lookup gets its own copy.
+
+    Instances changed or deleted in this process are dropped at once, the
+    other processes notice it by the version of the table, read from the
+    database at most every ``TABLE_VERSION_CHECK_INTERVAL`` seconds. Instances
+    seen in a transaction with uncommitted changes are only cached after it
+    ends, if they are still in the database then.
+    """
+
+    def __init__(self, model, key, size):
+        self.model = model
+        self.key = tuple(key)
+        self.size = size
+        self.tables = TableVersion([model])
+        self._lock = threading.Lock()
+        self._objects = OrderedDict()
+        self._keys = {}
+        self._version = None
+        self._local = threading.local()
+
+    def _lookup_key(self, lookup):
+        values = []
+        for name in self.key:
+            if name in lookup:
+                values.append(lookup[name])
+            else:
+                values.append(
+                    self.model._meta.get_field(name).get_default())
+        return tuple(values)
+
+    def _check_version(self):
+        version = self.tables.get()
+        if version != self._version:
+            self.clear()
+            self._version = version
+
+    def _store(self, obj):
+        key = tuple(getattr(obj, name) for name in self.key)
+        with self._lock:
+            self._discard(obj.pk)
+            old = self._objects.pop(key, None)
+            if old is not None:
+                del self._keys[old.pk]
+            self._objects[key] = _copy(obj)
+            self._keys[obj.pk] = key
+            while len(self._objects) > self.size:
+                key, old = self._objects.popitem(last=False)
+                del self._keys[old.pk]
+
+    def _discard(self, pk):
+        key = self._keys.pop(pk, None)
+        if key is not None:
+            del self._objects[key]
+
+    def _promote(self):
+        pending = getattr(self._local, 'pending', None)
+        if not pending or transaction.is_dirty():
+            return
+        self._local.pending = None
+        for obj in self.model.objects.filter(pk__in=pending):
+            self._store(obj)
+
+    def get(self, **lookup):
+        """
+        Return a copy of the cached instance with the natural key given in
+        ``lookup``, or None. The other fields in ``lookup`` have to match
+        too.
+        """
+        if not self.size:
+            return None
+        self._check_version()
+        self._promote()
+        key = self._lookup_key(lookup)
+        with self._lock:
+            obj = self._objects.pop(key, None)
+            if obj is None:
+                return None
+            self._objects[key] = obj
+        for name, value in lookup.iteritems():
+            if getattr(obj, name) != value:
+                return None
+        return _copy(obj)
+
+    def add(self, obj):
+        """Cache ``obj``, which has just been read from the database."""
+        if not self.size or obj.pk is None:
+            return
+        if transaction.is_dirty():
+            # it might still be rolled back
+            pending = getattr(self._local, 'pending', None)
+            if pending is None:
+                pending = self._local.pending = set()
+            if len(pending) < self.size:
+                pending.add(obj.pk)
+            return
+        self._store(obj)
+
+    def changed(self, pk):
+        """Forget the instance with ``pk``. The other processes notice the
+        change by the version of the table."""
+        with self._lock:
+            self._discard(pk)
+
+    def clear(self):
+        """Forget all the instances cached in this process."""
+        with self._lock:
+            self._objects.clear()
+            self._keys.clear()
+        self._local.pending = None
+
+
+class WithIdentityMap(object):
+    """
+    Answers ``concurrent_get_or_create`` from the ``identity_map`` of the
+    model when possible, without a round trip to the database.
+    """
+
+    @classmethod
+    def concurrent_get_or_create(cls, **kwargs):
+        if 'defaults' not in kwargs:
+            obj = cls.identity_map.get(**kwargs)
+            if obj is not None:
+                return obj, False
+        obj, created = super(WithIdentityMap,
+                             cls).concurrent_get_or_create(**kwargs)
+        cls.identity_map.add(obj)
+        return obj, created
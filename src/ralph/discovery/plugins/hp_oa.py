@@ -17,8 +17,10 @@ from lck.xml import etree_to_dict
 import lck.xml.converters
 from lxml import etree as ET
 
+from ralph.discovery import result_cache
 from ralph.discovery.models import (IPAddress, Device, DeviceType,
         SERIAL_BLACKLIST, ComponentType, GenericComponent, ComponentModel)
+from ralph.discovery.reconcile import update
 from ralph.util import network, plugin, Eth
 
 
@@ -78,7 +80,10 @@ def _get_ethernets(data):
 
 
 @nested_commit_on_success
-def _add_hp_oa_devices(devices, device_type, parent=None):
+def _add_hp_oa_devices(devices, device_type, parent=None, saved=None):
+    """Save the ``devices`` of an enclosure, adding the ids of the devices
+    and the addresses saved to the ``saved`` list of pairs."""
+    saved = [] if saved is None else saved
     if devices and not isinstance(devices, list):
         devices = [devices]
     for i, device in enumerate(devices):
@@ -115,8 +120,7 @@ def _add_hp_oa_devices(devices, device_type, parent=None):
             model, mcreated = ComponentModel.concurrent_get_or_create(
                     type=ComponentType.management.id,
                     extra_hash=hashlib.md5(extra).hexdigest(), extra=extra)
-            model.name = name
-            model.save(priority=SAVE_PRIORITY)
+            update(model, SAVE_PRIORITY, name=name)
             component, created = GenericComponent.concurrent_get_or_create(
                     device=parent, sn=sn)
             component.model = model
@@ -127,7 +131,8 @@ def _add_hp_oa_devices(devices, device_type, parent=None):
                 ip_address.is_management = True
                 ip_address.device = parent
                 ip_address.save() # no priorities for IP addresses
-
+            if parent:
+                saved.append((parent.id, ip_address.address))
             continue
 
         if device_type == DeviceType.switch and 'SAN' in name:
@@ -169,6 +174,7 @@ def _add_hp_oa_devices(devices, device_type, parent=None):
         dev.save(update_last_seen=True, priority=SAVE_PRIORITY)
         ip_address.device = dev
         ip_address.save(update_last_seen=True) # no priorities for IP addresses
+        saved.append((dev.id, ip_address.address))
 
 def make_encl(data):
     encl_name = data['INFRA2']['PN'].strip()
@@ -204,11 +210,18 @@ def hp_oa_xml(**kwargs):
     encl_sn = unicode(data['INFRA2']['ENCL_SN']).strip()
     if not (name and sn and rack_name and encl_name and encl_sn):
         return False, 'incompatible answer.', kwargs
+    digest = result_cache.payload_digest(data)
+    if result_cache.unchanged('hp_oa_xml', ip, digest):
+        return True, name, kwargs
     encl = make_encl(data)
+    saved = []
     _add_hp_oa_devices(data['INFRA2']['MANAGERS']['MANAGER'],
-        DeviceType.management, parent=encl)
+        DeviceType.management, parent=encl, saved=saved)
     _add_hp_oa_devices(data['INFRA2']['SWITCHES']['SWITCH'],
-        DeviceType.switch, parent=encl)
+        DeviceType.switch, parent=encl, saved=saved)
     _add_hp_oa_devices(data['INFRA2']['BLADES']['BLADE'],
-        DeviceType.blade_server, parent=encl)
+        DeviceType.blade_server, parent=encl, saved=saved)
+    result_cache.remember('hp_oa_xml', ip, digest, encl, name,
+                          devices=[device_id for device_id, a in saved],
+                          addresses=[address for d, address in saved])
     return True, name, kwargs
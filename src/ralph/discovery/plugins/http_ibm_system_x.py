@@ -14,8 +14,10 @@ from lck.django.common import nested_commit_on_success
 
 from ralph.util import network
 from ralph.util import plugin, Eth
+from ralph.discovery import result_cache
 from ralph.discovery.models import (DeviceType, Device, Processor, IPAddress,
-                                    ComponentModel, ComponentType, Memory)
+                                    ComponentType, Memory)
+from ralph.discovery.reconcile import get_models, reconcile
 from ralph.discovery.plugins.http import guess_family, get_http_info
 
 
@@ -204,6 +206,12 @@ def run_http_ibm_system_x(ip):
     model_name = get_model_name(management_url, session_id)
     sn = get_sn(management_url, session_id)
     macs = get_mac_addresses(management_url, session_id)
+    detected_memory = get_memory(management_url, session_id)
+    detected_processors = get_processors(management_url, session_id)
+    digest = result_cache.payload_digest([model_name, sn, macs,
+                                          detected_memory, detected_processors])
+    if result_cache.unchanged('http_ibm_system_x', ip, digest):
+        return model_name
     ethernets = [Eth(label=label, mac=mac, speed=0)
                  for (label, mac) in macs]
     ipaddr, ip_created = IPAddress.concurrent_get_or_create(address=ip)
@@ -219,43 +227,22 @@ def run_http_ibm_system_x(ip):
     dev.save(priority=SAVE_PRIORITY)
     ipaddr.device = dev
     ipaddr.save()
-    detected_memory = get_memory(management_url, session_id)
-    detected_memory_indexes = [x.get('index') for x in detected_memory]
-    for m in dev.memory_set.exclude(index__in=detected_memory_indexes):
-        m.delete()
-    for m in detected_memory:
-        index = m['index']
-        mem, _ = Memory.concurrent_get_or_create(index=index, device=dev)
-        mem.label = m['label']
-        mem.size = m['size']
-        mem.save(priority=SAVE_PRIORITY)
-        mem.model, c = ComponentModel.concurrent_get_or_create(
-            name='RAM %s %dMiB' % (mem.label, mem.size), size=mem.size,
-            type=ComponentType.memory.id,
-            family=mem.label, cores=0
-        )
-        mem.save(priority=SAVE_PRIORITY)
-    detected_processors = get_processors(management_url, session_id)
-    detected_processors_keys = [x.get('index') for x in detected_processors]
-    for cpu in dev.processor_set.exclude(index__in=detected_processors_keys):
-        cpu.delete()
-    # add new
-    for p in detected_processors:
-        processor_model, _ = ComponentModel.concurrent_get_or_create(
-            name=p.get('label'),
-            speed=p.get('speed'),
-            type=ComponentType.processor.id,
-            family=p.get('family'),
-            cores=p.get('cores')
-        )
-        processor, _ = Processor.concurrent_get_or_create(
-            device=dev,
-            index=p.get('index'),
-        )
-        processor.label = p.get('label')
-        processor.model = processor_model
-        processor.speed = p.get('speed')
-        processor.save()
+    lookups = [dict(name='RAM %s %dMiB' % (m['label'], m['size']),
+                    size=m['size'], type=ComponentType.memory.id,
+                    family=m['label'], cores=0) for m in detected_memory]
+    rows = [{'index': m['index'], 'label': m['label'], 'size': m['size'],
+             'model': model}
+            for m, (model, c) in zip(detected_memory, get_models(lookups))]
+    reconcile(dev, Memory, ('index',), rows, SAVE_PRIORITY)
+    lookups = [dict(name=p.get('label'), speed=p.get('speed'),
+                    type=ComponentType.processor.id, family=p.get('family'),
+                    cores=p.get('cores')) for p in detected_processors]
+    rows = [{'index': p.get('index'), 'label': p.get('label'),
+             'speed': p.get('speed'), 'model': model}
+            for p, (model, c) in zip(detected_processors,
+                                     get_models(lookups))]
+    reconcile(dev, Processor, ('index',), rows)
+    result_cache.remember('http_ibm_system_x', ip, digest, dev, model_name)
     return model_name
 
 
@@ -14,9 +14,10 @@ from django.conf import settings
 from lck.django.common import nested_commit_on_success
 
 from ralph.util import plugin, Eth
-from ralph.discovery import hp_ilo
+from ralph.discovery import hp_ilo, result_cache
 from ralph.discovery.models import (Device, Processor, Memory,
-        IPAddress, ComponentModel, ComponentType, DeviceType)
+        IPAddress, ComponentType, DeviceType)
+from ralph.discovery.reconcile import get_models, reconcile, update
 
 
 ILO_USER, ILO_PASSWORD = settings.ILO_USER, settings.ILO_PASSWORD
@@ -53,39 +54,45 @@ def make_device(ilo, ip):
     return dev
 
 def make_components(ilo, dev):
-    for i, (label, size, speed) in enumerate(ilo.memories):
-        mem, created = Memory.concurrent_get_or_create(device=dev, index=i + 1)
-        mem.size = size
-        mem.speed = speed
-        mem.label = label
-        mem.model, c = ComponentModel.concurrent_get_or_create(
-            size=mem.size, speed=mem.speed, type=ComponentType.memory.id,
-            family='', extra_hash='')
+    lookups = [dict(size=size, speed=speed, type=ComponentType.memory.id,
+                    family='', extra_hash='')
+               for label, size, speed in ilo.memories]
+    rows = []
+    models = get_models(lookups)
+    for i, ((label, size, speed), (model, c)) in enumerate(
+            zip(ilo.memories, models)):
         if c:
-            mem.model.name = 'RAM %dMiB, %dMHz' % (mem.size, mem.speed)
-            mem.model.save()
-        mem.save()
-
-    for i, (label, speed, cores, extra, family) in enumerate(ilo.cpus):
-        cpu, created = Processor.concurrent_get_or_create(device=dev,
-                                                          index=i + 1)
-        family = family or ''
-        cpu.label = label
-        cpu.model, c = ComponentModel.concurrent_get_or_create(
-            speed=speed, type=ComponentType.processor.id, extra=extra,
-            extra_hash=hashlib.md5(extra).hexdigest(), cores=cores,
-            family=family)
+            update(model, name='RAM %dMiB, %dMHz' % (size, speed))
+        rows.append({'index': i + 1, 'size': size, 'speed': speed,
+                     'label': label, 'model': model})
+    reconcile(dev, Memory, ('index',), rows, prune=False)
+
+    lookups = [dict(speed=speed, type=ComponentType.processor.id,
+                    extra=extra, extra_hash=hashlib.md5(extra).hexdigest(),
+                    cores=cores, family=family or '')
+               for label, speed, cores, extra, family in ilo.cpus]
+    rows = []
+    models = get_models(lookups)
+    for i, ((label, speed, cores, extra, family), (model, c)) in enumerate(
+            zip(ilo.cpus, models)):
         if c:
-            cpu.model.name = 'CPU %s %dMHz, %s-core' % (family, speed, cores)
-            cpu.model.save()
-        cpu.save()
+            update(model, name='CPU %s %dMHz, %s-core' % (family or '',
+                                                          speed, cores))
+        rows.append({'index': i + 1, 'label': label, 'model': model})
+    reconcile(dev, Processor, ('index',), rows, prune=False)
 
 @nested_commit_on_success
 def _run_ilo(ip):
     ilo = hp_ilo.IloHost(ip, ILO_USER, ILO_PASSWORD)
     ilo.update()
+    digest = result_cache.payload_digest([ilo.model, ilo.sn, ilo.name,
+        ilo.firmware, ilo.ethernets, ilo.memories, ilo.cpus])
+    cached = result_cache.unchanged('ilo_hp', ip, digest)
+    if cached:
+        return cached[1]
     dev = make_device(ilo, ip)
     make_components(ilo, dev)
+    result_cache.remember('ilo_hp', ip, digest, dev, dev.name)
     return dev.name
 
 @plugin.register(chain='discovery', requires=['ping', 'http'])
@@ -6,6 +6,8 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 import re
 import subprocess
 
@@ -27,6 +29,9 @@ IPMI_SECTION_REGEX = re.compile(r'FRU Device Description : (?P<value>[^(]+) '
 IPMI_OPTION_REGEX = re.compile(r' (?P<key>[^:]+) : (?P<value>.*)')
 IPMI_USER = settings.IPMI_USER
 IPMI_PASSWORD = settings.IPMI_PASSWORD
+# printed by ipmitool after the output of every command run in one session
+SEPARATOR = '--- ralph ipmi end of output ---'
+QUERY_THREADS = 8
 
 SAVE_PRIORITY = 55
 
@@ -57,34 +62,62 @@ def _clean(raw):
     return raw, False
 
 
+Records = namedtuple('Records', 'fru lan mc')
+
+
 class IPMI(object):
+    executable = 'ipmitool'
+
     def __init__(self, host, user=IPMI_USER, password=IPMI_PASSWORD):
         self.host = host
         self.user = user
         self.password = password
 
-    def tool(self, command, subcommand, param=None):
-        command = ["ipmitool", "-H", self.host, "-U", self.user,
-                   "-P", self.password, command, subcommand]
-        if param:
-            command.append(param)
-        proc = subprocess.Popen(command, stdout=subprocess.PIPE,
+    def _run(self, args, script=None):
+        command = [self.executable, "-H", self.host, "-U", self.user,
+                   "-P", self.password] + list(args)
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
                                 stderr=subprocess.PIPE)
-        out, err = proc.communicate()
+        out, err = proc.communicate(script)
         if proc.returncode and err:
             if err.startswith('Invalid user name'):
                 raise AuthError('Invalid user name')
             else:
                 raise IPMIToolError('Error calling ipmitool: %s' % err)
-        return unicode(out, 'utf-8', 'replace')
+        return unicode(out, 'utf-8', 'replace'), err
+
+    def tool(self, command, subcommand, param=None):
+        args = [command, subcommand]
+        if param:
+            args.append(param)
+        return self._run(args)[0]
+
+    def tools(self, commands):
+        """
+        Run all the ``commands``, tuples of arguments for ipmitool, within
+        a single ipmitool process and a single session with the BMC. Return
+        the output of every command.
+        """
+        script = ''.join('{}\necho {}\n'.format(' '.join(command), SEPARATOR)
+                         for command in commands)
+        out, err = self._run(['exec', '/dev/stdin'], script.encode('utf-8'))
+        # the errors of single commands don't stop the others
+        if err.startswith('Invalid user name'):
+            raise AuthError('Invalid user name')
+        outputs = out.split(SEPARATOR + '\n')
+        if len(outputs) <= len(commands):
+            raise IPMIToolError('Incomplete answer from ipmitool.')
+        return outputs[:len(commands)]
+
+    def query(self):
+        """Return the FRU, LAN and MC records, read in one session."""
+        fru, lan, mc = self.tools([('fru', 'print'), ('lan', 'print'),
+                                   ('mc', 'info')])
+        return Records(_parse_fru(fru), parse.pairs(lan), parse.pairs(mc))
 
     def get_fru(self):
-        out = self.tool('fru', 'print')
-        ipmi = parse.pairs(out)
-        # remove (ID XX) from the top-level keys
-        ipmi = dict((re.sub(r'\s*[(][^)]*[)]', '', k), v)
-                    for (k, v) in ipmi.iteritems())
-        return nullify(ipmi)
+        return _parse_fru(self.tool('fru', 'print'))
 
     def get_lan(self):
         out = self.tool('lan', 'print')
@@ -100,6 +133,41 @@ class IPMI(object):
         return mac
 
 
+def _parse_fru(out):
+    ipmi = parse.pairs(out)
+    # remove (ID XX) from the top-level keys
+    ipmi = dict((re.sub(r'\s*[(][^)]*[)]', '', k), v)
+                for (k, v) in ipmi.iteritems())
+    return nullify(ipmi)
+
+
+def _query(args):
+    host, user, password = args
+    try:
+        return host, IPMI(host, user, password).query()
+    except Error as e:
+        return host, e
+
+
+def query_many(hosts, user=IPMI_USER, password=IPMI_PASSWORD,
+               threads=QUERY_THREADS):
+    """
+    Query the BMCs at all the ``hosts``, at most ``threads`` of them at
+    once. Return a dict of host -> ``Records``, or the ``Error`` raised for
+    that host.
+    """
+    hosts = list(hosts)
+    if not hosts:
+        return {}
+    pool = ThreadPool(min(threads, len(hosts)))
+    try:
+        return dict(pool.map(_query, [(host, user, password)
+                                      for host in hosts]))
+    finally:
+        pool.close()
+        pool.join()
+
+
 def _add_ipmi_lan(device, mac):
     eth, created = Ethernet.concurrent_get_or_create(
         device=device, mac=MACAddressField.normalize(mac))
@@ -195,26 +263,26 @@ def _get_base_device_info(fru_part):
     return name, sn, model_type
 
 
-@nested_commit_on_success
-def _run_ipmi(ip):
+def _query_records(ip):
     try:
-        ipmi = IPMI(ip)
-        fru = ipmi.get_fru()
+        return IPMI(ip).query()
     except AuthError:
         try:
-            ipmi = IPMI(ip, 'ADMIN')
-            fru = ipmi.get_fru()
+            return IPMI(ip, 'ADMIN').query()
         except AuthError:
-            ipmi = IPMI(ip, 'ADMIN', 'ADMIN')
-            fru = ipmi.get_fru()
-    mc = ipmi.get_mc()
+            return IPMI(ip, 'ADMIN', 'ADMIN').query()
+
+
+@nested_commit_on_success
+def _run_ipmi(ip):
+    fru, lan, mc = _query_records(ip)
     top = fru['/SYS']
     if not top:
         top = fru['Builtin FRU Device']
     if not top:
         raise AnswerError('Incompatible answer.')
     name, sn, model_type = _get_base_device_info(top)
-    mac = ipmi.get_mac()
+    mac = lan.get('MAC Address')
     if mac:
         ethernets = [Eth(label='IPMI MAC', mac=mac, speed=0)]
     else:
@@ -19,10 +19,11 @@ from django.conf import settings
 
 from ralph.util import network, plugin
 from ralph.discovery.models import IPAddress, DiskShare, DiskShareMount
-from ralph.discovery import hardware
+from ralph.discovery import hardware, result_cache
 
 from .facts import parse_facts, handle_facts_os, handle_facts_packages
 from .lshw import parse_lshw
+from .snapshot import snapshot
 from .util import connect_db, get_ip_hostname_sets
 
 
@@ -36,11 +37,23 @@ def puppet(**kwargs):
     ip = str(kwargs['ip'])
     ip_set, hostname_set = get_ip_hostname_sets(ip)
     db = connect_db()
-    facts = get_all_facts_by_ip_set(db, ip_set)
-    if not facts and hostname_set:
-        facts = get_all_facts_by_hostname_set(db, hostname_set)
-    if not facts:
+    host = snapshot.find(db, ip_set, hostname_set)
+    if not host:
         return False, "host config not found.", kwargs
+    # the facts of the host didn't change since they were last saved
+    stamp = result_cache.payload_digest(host)
+    cached = result_cache.unchanged('puppet.snapshot', ip, stamp,
+                                    last_puppet=datetime.datetime.now())
+    if cached:
+        return True, cached[1], kwargs
+    facts = snapshot.facts(db, *host)
+    # the mounts also depend on which of the shares are known already
+    digest = result_cache.payload_digest([facts, known_shares(facts)])
+    cached = result_cache.unchanged('puppet', ip, digest,
+                                    last_puppet=datetime.datetime.now())
+    if cached:
+        result_cache.remember('puppet.snapshot', ip, stamp, *cached)
+        return True, cached[1], kwargs
 
     try:
         is_virtual = is_host_virtual(facts)
@@ -73,42 +86,10 @@ def puppet(**kwargs):
 
     handle_facts_os(dev, facts, is_virtual)
     handle_facts_packages(dev, facts.get('packages'))
+    result_cache.remember('puppet', ip, digest, dev, message)
+    result_cache.remember('puppet.snapshot', ip, stamp, dev, message)
     return True, message, kwargs
 
-def get_all_facts_by_ip_set(db, ip_set):
-    facts = None
-    for ip in ip_set:
-        rows = db.execute("""SELECT fn.name, fv.value
-                            FROM hosts h, fact_values fv, fact_names fn
-                            WHERE h.ip=%s AND fv.host_id=h.id
-                            AND fv.fact_name_id=fn.id""", ip)
-        _facts = dict(rows.fetchall())
-        if _facts:
-            if _facts['virtual'] == 'zone':
-                continue
-            if not facts:
-                facts = _facts
-            else:
-                raise ValueError("more than 1 machine reported by Puppet for "
-                    "this IP set: {}".format(ip_set))
-    return facts
-
-def get_all_facts_by_hostname_set(db, hostname_set):
-    facts = None
-    for hostname in hostname_set:
-        rows = db.execute("""SELECT fn.name, fv.value
-                            FROM hosts h, fact_values fv, fact_names fn
-                            WHERE h.name=%s AND fv.host_id=h.id
-                            AND fv.fact_name_id=fn.id""", hostname)
-        _facts = dict(rows.fetchall())
-        if _facts:
-            if not facts:
-                facts = _facts
-            else:
-                raise ValueError("more than 1 machine reported by Puppet for "
-                    "this hostname set: {}".format(hostname_set))
-    return facts
-
 def is_host_virtual(facts):
     is_virtual = facts.get('virtual', 'physical') not in ('physical',
         'openvz', 'openvzhn')
@@ -117,6 +98,14 @@ def is_host_virtual(facts):
         is_virtual = True
     return is_virtual
 
+def known_shares(facts):
+    wwns = [hardware.normalize_wwn(wwn) for key, wwn in facts.iteritems()
+            if key.startswith('wwn_mpath')]
+    if not wwns:
+        return []
+    return sorted(DiskShare.objects.filter(
+        wwn__in=wwns).values_list('wwn', flat=True))
+
 @nested_commit_on_success
 def parse_wwn(facts, dev):
     def make_mount(wwn):
@@ -20,6 +20,7 @@ from ralph.discovery.models import (DeviceType, Device, OperatingSystem,
     ComponentModel, ComponentType, Software, Storage, SERIAL_BLACKLIST,
     DISK_VENDOR_BLACKLIST, DISK_PRODUCT_BLACKLIST)
 from ralph.discovery.plugins.puppet.util import get_default_mac, assign_ips
+from ralph.discovery.reconcile import update
 from ralph.util import network, Eth, uncompress_base64_data
 
 
@@ -172,8 +173,8 @@ Size: {size}""".format(**disk)
             size=stor.size, speed=0, type=ComponentType.disk.id,
             family=disk['vendor'].strip(),
             extra_hash=hashlib.md5(extra).hexdigest(), extra=extra)
-        stor.model.name = '{} {}MiB'.format(stor.label, stor.size)
-        stor.model.save(priority=SAVE_PRIORITY)
+        update(stor.model, SAVE_PRIORITY,
+               name='{} {}MiB'.format(stor.label, stor.size))
         stor.save(priority=SAVE_PRIORITY)
 
 
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+A snapshot of the hosts known to the Puppet database and their facts.
+
+Instead of querying the Puppet database for every discovered address, every
+process keeps an index of all the Puppet hosts with the time their facts
+were last updated, refreshed with one query every ``PUPPET_SNAPSHOT_INTERVAL``
+seconds.
+
+When the processes share the cache, e.g. memcached, the facts of the hosts
+updated since the last refresh are loaded by one of them in a single
+streaming query and kept in the cache, where the plugin finds them. A cache
+private to every process, like the default ``LocMemCache``, would make each
+of them load the facts of all the hosts, so then the facts are only ever
+queried host by host, when they changed.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import datetime
+import itertools
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+import sqlalchemy as sqla
+
+
+SNAPSHOT_INTERVAL = settings.PUPPET_SNAPSHOT_INTERVAL
+FACTS_TIMEOUT = settings.PUPPET_FACTS_CACHE_TIMEOUT
+FACTS_KEY = 'ralph.discovery.puppet.facts.%s'
+WATERMARK_KEY = 'ralph.discovery.puppet.watermark'
+LOAD_LOCK_KEY = 'ralph.discovery.puppet.loading'
+
+HOSTS_QUERY = sqla.text("""
+    SELECT h.id, h.name, h.ip, MAX(fv.updated_at),
+           MAX(CASE WHEN fn.name = 'virtual' THEN fv.value END)
+    FROM hosts h
+    JOIN fact_values fv ON fv.host_id = h.id
+    JOIN fact_names fn ON fn.id = fv.fact_name_id
+    GROUP BY h.id, h.name, h.ip
+""")
+CHANGED_FACTS_QUERY = sqla.text("""
+    SELECT fv.host_id, fn.name, fv.value
+    FROM fact_values fv
+    JOIN fact_names fn ON fn.id = fv.fact_name_id
+    JOIN (SELECT DISTINCT host_id FROM fact_values WHERE updated_at > :since
+    ) changed ON changed.host_id = fv.host_id
+    ORDER BY fv.host_id
+""")
+HOST_FACTS_QUERY = sqla.text("""
+    SELECT fn.name, fv.value
+    FROM fact_values fv
+    JOIN fact_names fn ON fn.id = fv.fact_name_id
+    WHERE fv.host_id = :host_id
+""")
+
+
+def _shared_cache():
+    backend = settings.CACHES['default']['BACKEND']
+    return not backend.endswith(('.LocMemCache', '.DummyCache'))
+
+
+class FactsSnapshot(object):
+    def __init__(self):
+        self.refreshed = None
+        self.hosts = {}
+        self.by_ip = {}
+        self.by_name = {}
+        self.lock = threading.Lock()
+
+    def refresh(self, db):
+        """Reload the index of hosts and load the facts that changed."""
+        hosts = {}
+        by_ip = {}
+        by_name = {}
+        for host_id, name, ip, updated, virtual in db.execute(HOSTS_QUERY):
+            hosts[host_id] = updated, virtual
+            if ip:
+                by_ip.setdefault(ip, []).append(host_id)
+            if name:
+                by_name.setdefault(name, []).append(host_id)
+        self.hosts, self.by_ip, self.by_name = hosts, by_ip, by_name
+        self.refreshed = time.time()
+        if _shared_cache() and cache.add(LOAD_LOCK_KEY, True,
+                                         SNAPSHOT_INTERVAL or 60):
+            try:
+                self._load_changed(db)
+            finally:
+                cache.delete(LOAD_LOCK_KEY)
+
+    def _load_changed(self, db):
+        since = cache.get(WATERMARK_KEY) or datetime.datetime(1970, 1, 1)
+        if self.hosts:
+            watermark = max(updated for updated, virtual
+                            in self.hosts.itervalues())
+        else:
+            watermark = since
+        rows = db.execution_options(stream_results=True).execute(
+            CHANGED_FACTS_QUERY, since=since)
+        for host_id, host_rows in itertools.groupby(rows, lambda r: r[0]):
+            if host_id not in self.hosts:
+                continue
+            facts = dict((name, value) for _, name, value in host_rows)
+            cache.set(FACTS_KEY % host_id, (self.hosts[host_id][0], facts),
+                      FACTS_TIMEOUT)
+        cache.set(WATERMARK_KEY, watermark, FACTS_TIMEOUT)
+
+    def _refresh_if_stale(self, db):
+        with self.lock:
+            if (self.refreshed is None or
+                    time.time() - self.refreshed >= SNAPSHOT_INTERVAL):
+                self.refresh(db)
+
+    def _single(self, host_ids, skip_zones, description):
+        found = set(
+            host_id for host_id in host_ids
+            if not skip_zones or self.hosts[host_id][1] != 'zone'
+        )
+        if len(found) > 1:
+            raise ValueError("more than 1 machine reported by Puppet for "
+                             "this {}".format(description))
+        return found.pop() if found else None
+
+    def find(self, db, ip_set, hostname_set):
+        """
+        Return the id of the Puppet host with an address from ``ip_set``,
+        or else with a name from ``hostname_set``, and the time its facts
+        were last updated. Return None if there is no such host.
+        """
+        self._refresh_if_stale(db)
+        host_id = self._single(
+            itertools.chain(*(self.by_ip.get(ip, ()) for ip in ip_set)),
+            True, "IP set: {}".format(ip_set),
+        )
+        if host_id is None:
+            host_id = self._single(
+                itertools.chain(*(self.by_name.get(name, ())
+                                  for name in hostname_set)),
+                False, "hostname set: {}".format(hostname_set),
+            )
+        if host_id is None:
+            return None
+        return host_id, self.hosts[host_id][0]
+
+    def facts(self, db, host_id, updated):
+        """
+        Return the facts of the host, from the cache if they were loaded
+        since they were last updated.
+        """
+        cached = cache.get(FACTS_KEY % host_id)
+        if cached is not None and cached[0] == updated:
+            return cached[1]
+        facts = dict(db.execute(HOST_FACTS_QUERY, host_id=host_id).fetchall())
+        cache.set(FACTS_KEY % host_id, (updated, facts), FACTS_TIMEOUT)
+        return facts
+
+
+snapshot = FactsSnapshot()
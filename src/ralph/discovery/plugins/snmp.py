@@ -14,7 +14,8 @@ from ralph.util import plugin, Eth
 from ralph.discovery.models import (DeviceType, Device, IPAddress,
     OperatingSystem)
 from ralph.discovery.models import MAC_PREFIX_BLACKLIST
-from ralph.discovery.snmp import snmp_command, snmp_macs, check_snmp_port
+from ralph.discovery.snmp import (check_snmp_port, snmp_command, snmp_macs,
+                                  snmp_macs_many, snmp_probe)
 
 
 SAVE_PRIORITY = 1
@@ -57,25 +58,23 @@ class Error(Exception):
     pass
 
 
+def _snmp_found(ip, community, message):
+    try:
+        ip_address = IPAddress.objects.get(address=str(ip))
+    except IPAddress.DoesNotExist:
+        return False, "IP address not present in DB."
+    ip_address.snmp_name = message
+    ip_address.snmp_community = unicode(community)
+    ip_address.save()
+    return True, message
+
+
 def _snmp(ip, community, oid, attempts=2, timeout=3, snmp_version='2c'):
-    is_up = False
     result = snmp_command(str(ip), community, oid, attempts=attempts,
         timeout=timeout, snmp_version=snmp_version)
     if result is None:
-        message = 'silent.'
-    else:
-        message = unicode(result[0][1])
-        try:
-            ip_address = IPAddress.objects.get(address=str(ip))
-        except IPAddress.DoesNotExist:
-            message = "IP address not present in DB."
-            pass
-        else:
-            ip_address.snmp_name = message
-            ip_address.snmp_community = unicode(community)
-            ip_address.save()
-            is_up = True
-    return is_up, message
+        return False, 'silent.'
+    return _snmp_found(ip, community, unicode(result[0][1]))
 
 @plugin.register(chain='discovery', requires=['ping', 'http'])
 def snmp(**kwargs):
@@ -84,19 +83,16 @@ def snmp(**kwargs):
         return False, 'no match.', kwargs
     ip = str(kwargs['ip'])
     if http_family not in ('Microsoft-IIS', 'Unspecified', 'RomPager'):
-        # Windows hosts always say that the port is closed, even when it's open
+        # Windows hosts always say that the port is closed, even when it's
+        # open. For the others this is the cheapest way to skip a silent
+        # host, with a single request and a single timeout.
         if not check_snmp_port(ip):
             return False, 'port closed.', kwargs
     community = kwargs.get('community')
     version = kwargs.get('snmp_version')
-    oids = [
-        ('2c', (1,3,6,1,2,1,1,1,0)), # sysDescr
-        # Blade centers answer only to their own OIDs and to SNMP version 1
-        #  ('1', (1,3,6,1,4,1,2,3,51,2,2,21,1,1,5,0)),
-        # bladeCenterManufacturingId
-    ]
-    if http_family in ('RomPager',):
-        oids.append(('1', (1,3,6,1,2,1,1,1,0))) # sysDescr, snmp version 1
+    oid = (1,3,6,1,2,1,1,1,0) # sysDescr
+    # Blade centers answer only to their own OIDs and to SNMP version 1
+    #  (1,3,6,1,4,1,2,3,51,2,2,21,1,1,5,0) # bladeCenterManufacturingId
     if version != '3':
         # Don't try SNMP v2 if v3 worked on this host.
         communities = SNMP_PLUGIN_COMMUNITIES[:]
@@ -104,38 +100,25 @@ def snmp(**kwargs):
             if community in communities:
                 communities.remove(community)
             communities.insert(0, community)
-        for community in communities:
-            for ver, oid in oids:
-                version = ver
-                is_up, message = _snmp(
-                    ip,
-                    community,
-                    oid,
-                    attempts=2,
-                    timeout=0.2,
-                    snmp_version=version,
-                )
-                if message == '' and ver != '1':
-                    version = '1'
-                    is_up, message = _snmp(
-                        ip,
-                        community,
-                        oid,
-                        attempts=2,
-                        timeout=0.2,
-                        snmp_version=version,
-                    )
-                if is_up:
-                    kwargs['community'] = community
-                    kwargs['snmp_version'] = version
-                    kwargs['snmp_name'] = message
-                    return is_up, message, kwargs
+        # all the communities and versions are tried at once, version 1
+        # only wins when no community works with version 2c
+        credentials = ([(c, '2c') for c in communities] +
+                       [(c, '1') for c in communities])
+        found = snmp_probe([ip], credentials, oid, timeout=1, attempts=2)
+        if ip in found:
+            community, version, value = found[ip]
+            is_up, message = _snmp_found(ip, community, unicode(value))
+            if is_up:
+                kwargs['community'] = community
+                kwargs['snmp_version'] = version
+                kwargs['snmp_name'] = message
+                return is_up, message, kwargs
     if SNMP_V3_AUTH and version not in ('1', '2', '2c'):
         is_up, message = _snmp(
             ip, SNMP_V3_AUTH,
             oid,
             attempts=2,
-            timeout=0.2,
+            timeout=1,
             snmp_version='3',
         )
         if is_up:
@@ -152,11 +135,18 @@ def _snmp_modular(ip, community, parent):
     oid = (1, 3, 6, 1, 4, 1, 343, 2, 19, 1, 2, 10, 12, 0) # Max blades
     message = snmp_command(ip, community, oid, attempts=1, timeout=0.5)
     max_blades = int(message[0][1])
-    blades_macs = {}
-    for blade_no in range(1, max_blades + 1):
+    blade_numbers = range(1, max_blades + 1)
+    requests = []
+    for blade_no in blade_numbers:
         oid = (1, 3, 6, 1, 4, 1, 343, 2, 19, 1, 2, 10, 202, 3, 1, 1, blade_no)
-        blades_macs[blade_no] =  set(snmp_macs(ip, community, oid,
-                                                       attempts=1, timeout=0.5))
+        requests.append((ip, community, oid, '2c'))
+    # the tables of all the blades are walked at once
+    blades_macs = dict(
+        (blade_no, set(macs)) for blade_no, macs in zip(
+            blade_numbers,
+            snmp_macs_many(requests, attempts=1, timeout=0.5),
+        )
+    )
     for i, macs in blades_macs.iteritems():
         unique_macs = macs
         for j, other_macs in blades_macs.iteritems():
@@ -27,7 +27,7 @@ class Error(Exception):
 
 
 def _connect_ssh(ip):
-    return network.connect_ssh(ip, SSH_3PAR_USER, SSH_3PAR_PASSWORD)
+    return network.pooled_ssh(ip, SSH_3PAR_USER, SSH_3PAR_PASSWORD)
 
 @nested_commit_on_success
 def _save_shares(dev, shares):
@@ -21,6 +21,7 @@ from ralph.discovery.models import (
     ComponentType, ComponentModel, Storage,
     Processor, Memory, IPAddress, OperatingSystem
 )
+from ralph.discovery.reconcile import update
 
 
 AIX_USER = settings.AIX_USER
@@ -39,7 +40,7 @@ class Error(Exception):
 
 
 def _connect_ssh(ip):
-    return network.connect_ssh(ip, AIX_USER, AIX_PASSWORD, key=AIX_KEY)
+    return network.pooled_ssh(ip, AIX_USER, AIX_PASSWORD, key=AIX_KEY)
 
 
 def _ssh_lines(ssh, command):
@@ -132,8 +133,7 @@ def run_ssh_aix(ip):
     for disk, model_name, sn in stors:
         model, mcreated = ComponentModel.concurrent_get_or_create(
             type=ComponentType.disk.id, family=model_name, extra_hash='')
-        model.name = model_name
-        model.save()
+        update(model, name=model_name)
         stor, created = Storage.concurrent_get_or_create(device=dev, sn=sn)
         stor.model = model
         stor.label = disk
@@ -144,16 +144,14 @@ def run_ssh_aix(ip):
     mem.model, c = ComponentModel.concurrent_get_or_create(
         size=0, speed=0, type=ComponentType.memory.id, family='pSeries',
         extra_hash='')
-    mem.model.name = 'pSeries Memory'
-    mem.model.save()
+    update(mem.model, name='pSeries Memory')
     mem.save()
     cpu, created = Processor.concurrent_get_or_create(device=dev, index=0)
     cpu.label = 'CPU'
     cpu.model, c = ComponentModel.concurrent_get_or_create(
         speed=0, cores=0, type=ComponentType.processor.id, extra_hash='',
         family='pSeries CPU')
-    cpu.model.name = 'pSeries CPU'
-    cpu.model.save()
+    update(cpu.model, name='pSeries CPU')
     cpu.save()
     os = OperatingSystem.create(dev=dev, os_name='AIX', version=os_version,
                                 family='AIX')
@@ -10,7 +10,6 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import paramiko
-import time
 
 from django.conf import settings
 from lck.django.common import nested_commit_on_success
@@ -39,35 +38,14 @@ class CiscoSSHClient(paramiko.SSHClient):
 
     def _auth(self, username, password, pkey, key_filenames, allow_agent, look_for_keys):
         self._transport.auth_password(username, password)
-        self._asa_chan = self._transport.open_session()
-        self._asa_chan.invoke_shell()
-        self._asa_chan.sendall('\r\n')
-        time.sleep(0.125)
-        chunk = self._asa_chan.recv(1024)
-        if not '> ' in chunk and not chunk.strip().startswith('asa'):
-            raise ConsoleError('Expected system prompt, got %r.' % chunk)
+        # XXX Work around random characters appearing at the beginning of the command.
+        self._asa_shell = network.open_shell(self, r'> ', prefix=b'\b')
 
     def asa_command(self, command):
-        # XXX Work around random characters appearing at the beginning of the command.
-        self._asa_chan.sendall('\b')
-        time.sleep(0.125)
-        self._asa_chan.sendall(command)
-        buffer = ''
-        end = command[-32:]
-        while not buffer.strip('\b ').endswith(end):
-            chunk = self._asa_chan.recv(1024)
-            buffer += chunk
-        self._asa_chan.sendall('\r\n')
-        buffer = ['']
-        while True:
-            chunk = self._asa_chan.recv(1024)
-            lines = chunk.split('\n')
-            buffer[-1] += lines[0]
-            buffer.extend(lines[1:])
-            if '% Invalid input' in buffer:
-                raise ConsoleError('Invalid input %r.' % buffer)
-            if '> ' in buffer[-1]:
-                return buffer[1:-1]
+        lines = self._asa_shell.command(command)
+        if any('% Invalid input' in line for line in lines):
+            raise ConsoleError('Invalid input %r.' % lines)
+        return lines
 
 def _connect_ssh(ip, username='root', password=''):
     return network.connect_ssh(ip, SSH_USER, SSH_PASS, client=CiscoSSHClient)
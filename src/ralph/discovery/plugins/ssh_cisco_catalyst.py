@@ -7,7 +7,6 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import paramiko
-import time
 
 from django.conf import settings
 from lck.django.common import nested_commit_on_success
@@ -38,35 +37,14 @@ class CiscoSSHClient(paramiko.SSHClient):
 
     def _auth(self, username, password, pkey, key_filenames, allow_agent, look_for_keys):
         self._transport.auth_password(username, password)
-        self._cisco_chan = self._transport.open_session()
-        self._cisco_chan.invoke_shell()
-        self._cisco_chan.sendall('\r\n')
-        time.sleep(0.125)
-        chunk = self._cisco_chan.recv(1024)
-        if not chunk.endswith('#'):
-            raise ConsoleError('Expected system prompt, got %r.' % chunk)
+        # XXX Work around random characters appearing at the beginning of the command.
+        self._cisco_shell = network.open_shell(self, r'#$', prefix=b'\b')
 
     def cisco_command(self, command):
-        # XXX Work around random characters appearing at the beginning of the command.
-        self._cisco_chan.sendall('\b')
-        time.sleep(0.125)
-        self._cisco_chan.sendall(command)
-        buffer = ''
-        end = command[-32:]
-        while not buffer.strip('\b ').endswith(end):
-            chunk = self._cisco_chan.recv(1024)
-            buffer += chunk
-        self._cisco_chan.sendall('\r\n')
-        buffer = ['']
-        while True:
-            chunk = self._cisco_chan.recv(1024)
-            lines = chunk.split('\n')
-            buffer[-1] += lines[0]
-            buffer.extend(lines[1:])
-            if '% Invalid input' in buffer:
-                raise ConsoleError('Invalid input %r.' % buffer)
-            if buffer[-1].endswith('#'):
-                return buffer[1:-1]
+        lines = self._cisco_shell.command(command)
+        if any('% Invalid input' in line for line in lines):
+            raise ConsoleError('Invalid input %r.' % lines)
+        return lines
 
 def _connect_ssh(ip):
     return network.connect_ssh(ip, SSH_USER, SSH_PASSWORD, client=CiscoSSHClient)
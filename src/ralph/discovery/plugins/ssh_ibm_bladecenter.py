@@ -10,7 +10,6 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import hashlib
-import time
 import socket
 
 from django.conf import settings
@@ -23,9 +22,13 @@ from ralph.discovery.models import (DeviceType,
         Device, Processor, Memory, Ethernet, IPAddress,
         ComponentModel, ComponentType, SERIAL_BLACKLIST, GenericComponent)
 from ralph.discovery.models_history import DiscoveryWarning
+from ralph.discovery.reconcile import update
 
 
 SAVE_PRIORITY = 5
+PROMPT = r'^system> '
+# interactive shells opened at once on a management module
+MAX_SHELLS = 4
 
 
 class Error(Exception):
@@ -53,6 +56,7 @@ class IBMSSHClient(paramiko.SSHClient):
     def __init__(self, *args, **kwargs):
         super(IBMSSHClient, self).__init__(*args, **kwargs)
         self.set_log_channel('critical_only')
+        self._ibm_shells = []
 
     def _auth(self, username, password, pkey, key_filenames, allow_agent,
               look_for_keys):
@@ -64,33 +68,29 @@ class IBMSSHClient(paramiko.SSHClient):
         except paramiko.BadAuthenticationType:
             self._transport.auth_interactive(username,
                 lambda t, i, p: password)
-        self._ibm_chan = self._transport.open_session()
-        self._ibm_chan.invoke_shell()
-        self._ibm_chan.sendall('\r\n')
-        time.sleep(0.125)
-        chunk = self._ibm_chan.recv(1024)
-        if not chunk.strip().startswith('system>'):
-            raise ConsoleError('Expected a system prompt, got "%s".' % chunk)
+        self._ibm_shells = [network.open_shell(self, PROMPT)]
 
     def ibm_command(self, command):
         """
-        IBM's ssh has broken channel handling, so do everything in one
-        big channel.
+        IBM's ssh doesn't run commands on their own channels, so run them in
+        an interactive shell.
         """
 
-        self._ibm_chan.sendall(command)
-        buffer = ''
-        while command not in buffer:
-            buffer += self._ibm_chan.recv(1024)
-        self._ibm_chan.sendall('\r\n')
-        buffer = ['']
-        while True:
-            chunk = self._ibm_chan.recv(1024)
-            lines = chunk.split('\n')
-            buffer[-1] += lines[0]
-            buffer.extend(lines[1:])
-            if buffer[-1].startswith('system> '):
-                return buffer[:-1]
+        return self._ibm_shells[0].command(command)
+
+    def ibm_commands(self, commands):
+        """
+        Run all the commands, each in the first shell that is free, on up to
+        MAX_SHELLS shells opened at once. Return their outputs in order.
+        """
+
+        try:
+            while len(self._ibm_shells) < MAX_SHELLS:
+                self._ibm_shells.append(network.open_shell(self, PROMPT))
+        except (network.ConsoleError, paramiko.SSHException):
+            # the older management modules refuse more sessions
+            pass
+        return network.run_commands(self._ibm_shells, commands)
 
 
 def _connect_ssh(ip):
@@ -134,8 +134,7 @@ def _component(model_type, pairs, parent, raw):
     model, mcreated = ComponentModel.concurrent_get_or_create(
             type=model_type.id,
             extra_hash=hashlib.md5(extra).hexdigest(), extra=extra)
-    model.name = model_name
-    model.save(priority=SAVE_PRIORITY)
+    update(model, SAVE_PRIORITY, name=model_name)
     component, created = GenericComponent.concurrent_get_or_create(device=parent,
             sn=sn)
     component.model = model
@@ -270,8 +269,8 @@ def _add_dev_cpu(pairs, parent, raw, counts, dev_id):
         cores=cores, speed=speed, type=ComponentType.processor.id,
         extra_hash=hashlib.md5(extra).hexdigest(), extra=extra,
         family=family)
-    cpu.model.name = 'CPU %s %d MHz, %s-core' % (family, speed, cores)
-    cpu.model.save(priority=SAVE_PRIORITY)
+    update(cpu.model, SAVE_PRIORITY,
+           name='CPU %s %d MHz, %s-core' % (family, speed, cores))
     cpu.save(priority=SAVE_PRIORITY)
 
 def _add_dev_memory(pairs, parent, raw, counts, dev_id):
@@ -297,8 +296,8 @@ def _add_dev_memory(pairs, parent, raw, counts, dev_id):
     mem.model, c = ComponentModel.concurrent_get_or_create(
         family=family, size=size, speed=speed, type=ComponentType.memory.id,
         extra_hash='')
-    mem.model.name = 'RAM %s %dMiB %dMHz' % (family, size, speed)
-    mem.model.save(priority=SAVE_PRIORITY)
+    update(mem.model, SAVE_PRIORITY,
+           name='RAM %s %dMiB %dMHz' % (family, size, speed))
     mem.save(priority=SAVE_PRIORITY)
 
 
@@ -365,7 +364,18 @@ ADD_DEV = {
     'switch': _add_dev_switch,
 }
 
-def _recursive_add_dev(ssh, ip, dev_path, dev_id, components, parent=None, counts=None):
+def _device_paths(dev_path, components):
+    for dev_info, components in components.iteritems():
+        dev_id = dev_info.split(None, 1)[0]
+        if dev_id.split('[', 1)[0] not in ADD_DEV:
+            continue
+        full_path = '{}:{}'.format(dev_path, dev_id)
+        yield full_path
+        for path in _device_paths(full_path, components):
+            yield path
+
+def _recursive_add_dev(infos, ip, dev_path, dev_id, components, parent=None,
+                       counts=None):
     if dev_path:
         full_path = '{}:{}'.format(dev_path, dev_id)
     else:
@@ -378,7 +388,7 @@ def _recursive_add_dev(ssh, ip, dev_path, dev_id, components, parent=None, count
         add_func = ADD_DEV[dev_type]
     except KeyError:
         return None
-    lines = ssh.ibm_command('info -T {}'.format(full_path))
+    lines = infos[full_path]
     raw = '\n'.join(lines)
     pairs = parse.pairs(lines=lines)
     try:
@@ -393,7 +403,7 @@ def _recursive_add_dev(ssh, ip, dev_path, dev_id, components, parent=None, count
             if counts is None:
                 counts = Counts()
             dev_id = dev_info.split(None, 1)[0]
-            _recursive_add_dev(ssh, ip, full_path, dev_id, components, dev,
+            _recursive_add_dev(infos, ip, full_path, dev_id, components, dev,
                                counts)
         return dev
 
@@ -404,7 +414,11 @@ def run_ssh_bladecenter(ip):
     tree = parse.tree(lines=lines)
     if 'system' not in tree:
         raise TreeError('"system" not found in the device tree')
-    dev = _recursive_add_dev(ssh, ip, '', 'system', tree['system'])
+    # the blades are queried all at once, before anything is saved
+    paths = ['system'] + list(_device_paths('system', tree['system']))
+    infos = dict(zip(paths, ssh.ibm_commands(
+        ['info -T {}'.format(path) for path in paths])))
+    dev = _recursive_add_dev(infos, ip, '', 'system', tree['system'])
     return dev.name
 
 
@@ -440,4 +454,4 @@ def ssh_ibm_reboot(ip, bay):
     ssh = _connect_ssh(ip)
     command = "power -cycle -T system:blade[%s]" % bay
     result = ssh.ibm_command(command)
-    return len(result) > 1 and result[1] and result[1].strip().lower() == 'ok'
+    return bool(result) and result[0].strip().lower() == 'ok'
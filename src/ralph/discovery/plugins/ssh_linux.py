@@ -6,6 +6,8 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import cStringIO as StringIO
+
 import paramiko
 
 from django.conf import settings
@@ -16,18 +18,37 @@ from ralph.discovery.models import (DeviceType, Device, DiskShare,
                                     DiskShareMount, IPAddress,
                                     OperatingSystem)
 from ralph.discovery.hardware import (get_disk_shares, parse_dmidecode,
-                                      handle_dmidecode, DMIDecodeError)
-from ralph.discovery import guessmodel
+                                      handle_dmidecode, DMIDecodeError,
+                                      DISK_SHARES_COMMANDS)
+from ralph.discovery import guessmodel, result_cache
 
 
 SAVE_PRIORITY=5
+ETHERNETS_COMMAND = "/sbin/ip addr show | /bin/grep 'link/ether'"
+DMIDECODE_COMMAND = "/usr/bin/sudo /usr/sbin/dmidecode"
+MEMORY_COMMAND = "/bin/grep 'MemTotal:' '/proc/meminfo'"
+CORES_COMMAND = "/bin/grep '^processor' '/proc/cpuinfo'"
+DISK_COMMAND = ("/bin/df -P -x tmpfs -x devtmpfs -x ecryptfs -x iso9660 -BM "
+                "| /bin/grep '^/'")
+SYSTEM_COMMAND = "/bin/uname -a"
+COMMANDS = (ETHERNETS_COMMAND, DMIDECODE_COMMAND, MEMORY_COMMAND,
+            CORES_COMMAND, DISK_COMMAND, SYSTEM_COMMAND) + DISK_SHARES_COMMANDS
+
+
+class CommandOutputs(object):
+    """Answers `exec_command` with outputs fetched beforehand."""
+
+    def __init__(self, outputs):
+        self.outputs = outputs
+
+    def exec_command(self, command):
+        return None, StringIO.StringIO(self.outputs[command]), None
 
 
 def get_ethernets(ssh):
     """Get the MAC addresses"""
 
-    stdin, stdout, stderr = ssh.exec_command(
-            "/sbin/ip addr show | /bin/grep 'link/ether'")
+    stdin, stdout, stderr = ssh.exec_command(ETHERNETS_COMMAND)
     ethernets = [
         Eth(label='', mac=line.split(None, 3)[1], speed=0)
         for line in stdout
@@ -38,8 +59,7 @@ def get_ethernets(ssh):
 def run_dmidecode(ssh, ethernets):
     """Handle dmidecode data"""
 
-    stdin, stdout, stderr = ssh.exec_command(
-            "/usr/bin/sudo /usr/sbin/dmidecode")
+    stdin, stdout, stderr = ssh.exec_command(DMIDECODE_COMMAND)
     try:
         info = parse_dmidecode(stdout.read())
     except (DMIDecodeError, IOError):
@@ -85,8 +105,7 @@ def update_shares(ssh, dev):
 def get_memory(ssh):
     """System-visible memory in MIB"""
 
-    stdin, stdout, stderr = ssh.exec_command(
-            "/bin/grep 'MemTotal:' '/proc/meminfo'")
+    stdin, stdout, stderr = ssh.exec_command(MEMORY_COMMAND)
     label, memory, unit = stdout.read().strip().split(None, 2)
     return int(int(memory)/1024)
 
@@ -94,17 +113,14 @@ def get_memory(ssh):
 def get_cores(ssh):
     """System-visible core count"""
 
-    stdin, stdout, stderr = ssh.exec_command(
-            "/bin/grep '^processor' '/proc/cpuinfo'")
+    stdin, stdout, stderr = ssh.exec_command(CORES_COMMAND)
     return len(stdout.readlines())
 
 
 def get_disk(ssh):
     """System-visible disk space in MiB"""
 
-    stdin, stdout, stderr = ssh.exec_command(
-        "/bin/df -P -x tmpfs -x devtmpfs -x ecryptfs -x iso9660 -BM "
-        "| /bin/grep '^/'")
+    stdin, stdout, stderr = ssh.exec_command(DISK_COMMAND)
     total = 0
     for line in stdout:
         path, size, rest = line.split(None, 2)
@@ -115,7 +131,7 @@ def get_disk(ssh):
 def make_system(ssh, dev):
     """Create the OperatingSystem component. Also update the hostname."""
 
-    stdin, stdout, stderr = ssh.exec_command("/bin/uname -a")
+    stdin, stdout, stderr = ssh.exec_command(SYSTEM_COMMAND)
     family, host, version, release, rest = stdout.read().strip().split(None, 4)
     os = OperatingSystem.create(dev=dev, os_name=release, version=version,
                                 family=family)
@@ -135,12 +151,21 @@ def update_os(ssh, dev):
 
 
 def run_ssh_linux(ssh, ip):
+    # all the commands run at once, and if their outputs are the same as
+    # the last time, there is nothing to save
+    outputs = dict(zip(COMMANDS, ssh.exec_commands(COMMANDS)))
+    digest = result_cache.payload_digest(outputs)
+    cached = result_cache.unchanged('ssh_linux', ip, digest)
+    if cached:
+        return cached[1]
+    ssh = CommandOutputs(outputs)
     ethernets = get_ethernets(ssh)
     dev = run_dmidecode(ssh, ethernets)
     if dev:
         attach_ip(dev, ip)
         update_shares(ssh, dev)
         update_os(ssh, dev)
+        result_cache.remember('ssh_linux', ip, digest, dev, dev.name)
     return dev.name if dev else ''
 
 
@@ -164,14 +189,17 @@ def ssh_linux(**kwargs):
             if user is None or password is None:
                 continue
             try:
-                ssh = network.connect_ssh(ip, user, password)
+                ssh = network.pooled_ssh(ip, user, password)
             except network.AuthError:
                 pass
             else:
                 break
         else:
             return False, 'Authorization failed', kwargs
-        name = run_ssh_linux(ssh, ip)
+        try:
+            name = run_ssh_linux(ssh, ip)
+        finally:
+            ssh.close()
     except (network.Error, paramiko.SSHException) as e:
         return False, str(e), kwargs
     return True, name, kwargs
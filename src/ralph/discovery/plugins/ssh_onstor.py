@@ -22,6 +22,7 @@ from ralph.discovery.models_history import DiscoveryWarning
 
 SSH_ONSTOR_USER = settings.SSH_ONSTOR_USER
 SSH_ONSTOR_PASSWORD = settings.SSH_ONSTOR_PASSWORD
+PROMPT = r'> $'
 
 
 class Error(Exception):
@@ -32,7 +33,7 @@ class SkipError(Error):
 
 
 def _connect_ssh(ip):
-    return network.connect_ssh(ip, SSH_ONSTOR_USER, SSH_ONSTOR_PASSWORD)
+    return network.pooled_ssh(ip, SSH_ONSTOR_USER, SSH_ONSTOR_PASSWORD)
 
 
 def _save_shares(dev, luns, mounts):
@@ -79,28 +80,23 @@ def _save_device(ip, name, model_name, sn, mac):
     return dev
 
 
-def _command(channel, command):
-        #print('command', repr(command))
-        buffer = ''
-        channel.sendall('\r\n')
-        while not buffer.endswith('> '):
-            buffer += channel.recv(1024)
-            #print('waiting for prompt', repr(buffer))
-        channel.sendall(command)
-        buffer = ''
-        while command not in buffer:
-            buffer += channel.recv(1024)
-            #print('waiting for command', repr(buffer))
-        channel.sendall('\r\n')
-        buffer = ['']
-        while not buffer[-1].endswith('> '):
-            chunk = channel.recv(1024)
-            #print('chunk', repr(chunk))
-            lines = chunk.split('\n')
-            buffer[-1] += lines[0]
-            buffer.extend(lines[1:])
-        #print('command done')
-        return buffer[1:-1]
+def _parse_mounts(lines):
+    mounts = []
+    for line in lines:
+        if line.startswith('No Mount information'):
+            break
+        if line.strip().endswith('>') or not line.strip():
+            continue
+        try:
+            CLIENT, IP, ipaddr, SHARE, PATH, path = line.split(None, 6)
+        except ValueError:
+            continue
+        if '/' in path:
+            volume = path.split('/', 1)[1]
+        else:
+            volume = path
+        mounts.append((volume, ipaddr))
+    return mounts
 
 def _run_ssh_onstor(ip):
     ssh = _connect_ssh(ip)
@@ -144,27 +140,22 @@ def _run_ssh_onstor(ip):
                 server_list.append(server)
 
         mounts = collections.defaultdict(list)
-        for server in server_list:
-            channel = ssh.invoke_shell()
-            _command(channel, 'vsvr set %s' % server)
-            lines = _command(channel, 'nfs cache show mounts')
-            channel.close()
-            if not lines:
-                continue
-            if lines[0].startswith('No Mount information'):
-                continue
-            for line in lines:
-                if line.strip().endswith('>') or not line.strip():
-                    continue
-                try:
-                    CLIENT, IP, ipaddr, SHARE, PATH, path = line.split(None, 6)
-                except ValueError:
-                    continue
-                if '/' in path:
-                    volume = path.split('/', 1)[1]
-                else:
-                    volume = path
-                mounts[volume].append(ipaddr)
+        for start in xrange(0, len(server_list), network.SSH_MAX_CHANNELS):
+            servers = server_list[start:start + network.SSH_MAX_CHANNELS]
+            # every virtual server is set in a shell of its own
+            shells = [network.open_shell(ssh, PROMPT, pty=True)
+                      for _ in servers]
+            try:
+                network.run_commands(
+                    shells, ['vsvr set %s' % vs for vs in servers])
+                for server_mounts in network.run_commands(
+                        shells, ['nfs cache show mounts'] * len(shells),
+                        parse=_parse_mounts):
+                    for volume, ipaddr in server_mounts:
+                        mounts[volume].append(ipaddr)
+            finally:
+                for shell in shells:
+                    shell.close()
     finally:
         ssh.close()
     _save_shares(dev, luns, mounts)
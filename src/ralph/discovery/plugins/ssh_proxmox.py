@@ -37,24 +37,27 @@ class NotProxmoxError(Error):
 
 
 def _connect_ssh(ip, username='root', password=''):
-    return network.connect_ssh(ip, 'root', settings.SSH_PASSWORD)
+    return network.pooled_ssh(ip, 'root', settings.SSH_PASSWORD)
 
 
-def _get_local_disk_size(ssh, disk, prent):
-    """Return the size of a disk image file, in bytes"""
+def _get_local_disk_sizes(ssh, disks, parent):
+    """Return the sizes of the disk image files, in megabytes"""
 
-    path = os.path.join('/var/lib/vz/images', disk)
-    stdin, stdout, stderr = ssh.exec_command("du -m '%s'" % path)
-    line = stdout.read().strip()
-    if not line:
-        DiscoveryWarning(
-            message="Local disk fiel %r does not exist." % path,
-            plugin=__name__,
-            device=parent,
-        ).save()
-        return 0
-    size = int(line.split(None, 1)[0])
-    return size
+    paths = [os.path.join('/var/lib/vz/images', disk) for disk in disks]
+    sizes = {}
+    outputs = ssh.exec_commands("du -m '%s'" % path for path in paths)
+    for disk, path, output in zip(disks, paths, outputs):
+        line = output.strip()
+        if not line:
+            DiscoveryWarning(
+                message="Local disk fiel %r does not exist." % path,
+                plugin=__name__,
+                device=parent,
+            ).save()
+            sizes[disk] = 0
+            continue
+        sizes[disk] = int(line.split(None, 1)[0])
+    return sizes
 
 
 def _add_virtual_machine(ssh, vmid, parent, master, storages):
@@ -102,6 +105,7 @@ def _add_virtual_machine(ssh, vmid, parent, master, storages):
             name=name
         )
     wwns = []
+    volumes = []
     for slot, disk in disks.iteritems():
         params = {}
         if ',' in disk:
@@ -116,8 +120,13 @@ def _add_virtual_machine(ssh, vmid, parent, master, storages):
         else:
             vg = ''
             lv = disk
+        volumes.append((slot, vg, lv))
+    local_sizes = _get_local_disk_sizes(
+        ssh, [volume for _, group, volume in volumes if group == 'local'],
+        parent)
+    for slot, vg, lv in volumes:
         if vg == 'local':
-            size = _get_local_disk_size(ssh, lv, parent)
+            size = local_sizes[lv]
             if not size > 0:
                 continue
             model, created = ComponentModel.concurrent_get_or_create(
@@ -10,7 +10,6 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import paramiko
-import time
 
 from django.conf import settings
 from lck.django.common import nested_commit_on_success
@@ -41,36 +40,10 @@ class SSGSSHClient(paramiko.SSHClient):
 
     def _auth(self, username, password, pkey, key_filenames, allow_agent, look_for_keys):
         self._transport.auth_password(username, password)
-        self._ssg_chan = self._transport.open_session()
-        self._ssg_chan.invoke_shell()
-        self._ssg_chan.sendall('\r\n')
-        time.sleep(0.125)
-        chunk = self._ssg_chan.recv(1024)
-        if not '->' in chunk:
-            raise ConsoleError('Expected system prompt, got "%s".' % chunk)
+        self._ssg_shell = network.open_shell(self, r'->', pager=r'--- more --- $')
 
     def ssg_command(self, command):
-        """
-        IBM's ssh has broken channel handling, so do everything in one
-        big channel.
-        """
-
-        self._ssg_chan.sendall(command)
-        buffer = ''
-        while not buffer.endswith(command):
-            buffer += self._ssg_chan.recv(1024)
-        self._ssg_chan.sendall('\r\n')
-        buffer = ['']
-        while True:
-            chunk = self._ssg_chan.recv(1024)
-            lines = chunk.split('\n')
-            buffer[-1] += lines[0]
-            buffer.extend(lines[1:])
-            if '->' in buffer[-1]:
-                return buffer[:-1]
-            if chunk.endswith('--- more --- '):
-                self._ssg_chan.sendall('\n')
-
+        return self._ssg_shell.command(command)
 
 def _connect_ssh(ip):
     return network.connect_ssh(ip, settings.SSH_SSG_USER,
@@ -32,7 +32,7 @@ class Error(Exception):
 
 
 def _connect_ssh(ip):
-    return network.connect_ssh(ip, XEN_USER, XEN_PASSWORD)
+    return network.pooled_ssh(ip, XEN_USER, XEN_PASSWORD)
 
 
 def _ssh_lines(ssh, command):
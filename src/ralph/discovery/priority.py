@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Decides how often the known addresses are scanned by the discovery.
+
+Addresses that appeared, changed or got discovery warnings recently are
+scanned every day. The others are scanned every 2, 4, 8... days, the longer
+they haven't answered or haven't changed, up to
+``DISCOVERY_MAX_SCAN_INTERVAL`` days. An address is due on the days whose
+ordinal plus the number of the address is divisible by its interval, so that
+the scans of a network are spread evenly over the days, and an address that
+backs off further is still due on a subset of the days it was due before.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db.models import Max
+
+from ralph.discovery.models import HistoryChange, IPAddress
+from ralph.discovery.models_history import DiscoveryWarning
+
+
+ACTIVE_DAYS = settings.DISCOVERY_ACTIVE_DAYS
+MAX_SCAN_INTERVAL = settings.DISCOVERY_MAX_SCAN_INTERVAL
+
+
+def _backoff(days):
+    interval = 1
+    while interval * 2 <= min(days, MAX_SCAN_INTERVAL):
+        interval *= 2
+    return interval
+
+
+def scan_interval(now, created, last_seen, last_puppet=None,
+                  last_change=None, warned=False):
+    """
+    Return the number of days between the scans of an address created on
+    ``created``, last answering on ``last_seen`` or reporting to Puppet on
+    ``last_puppet``, whose device last changed on ``last_change`` and that
+    got a discovery warning recently if ``warned``.
+    """
+    active_since = now - timedelta(days=ACTIVE_DAYS)
+    if warned or created >= active_since or (
+            last_change is not None and last_change >= active_since):
+        return 1
+    alive = max(last_seen, last_puppet or last_seen)
+    unchanged = now - max(last_change or created, created)
+    return max(
+        # an address scanned every n days is never seen more than n days ago
+        # while it answers, so only the dead ones back off this way
+        _backoff((now - alive).days),
+        _backoff(unchanged.days // ACTIVE_DAYS),
+    )
+
+
+def is_due(number, interval, day):
+    """
+    Check whether the address with ``number`` and ``interval`` should be
+    scanned on the ``day``, the proleptic Gregorian ordinal of a date.
+    """
+    return (day + number) % interval == 0
+
+
+def postponed(network, now=None):
+    """
+    Return the set of the known addresses of the ``ipaddr`` ``network`` that
+    don't need to be scanned ``now``.
+    """
+    if MAX_SCAN_INTERVAL <= 1:
+        return set()
+    now = now or datetime.now()
+    active_since = now - timedelta(days=ACTIVE_DAYS)
+    low, high = int(network.ip), int(network.broadcast)
+    warned = set(DiscoveryWarning.objects.filter(
+        date__gte=active_since,
+    ).values_list('ip', flat=True))
+    last_changes = dict(HistoryChange.objects.filter(
+        device__ipaddress__number__gt=low,
+        device__ipaddress__number__lt=high,
+    ).values('device').annotate(last=Max('date')).values_list(
+        'device', 'last'))
+    result = set()
+    for (address, number, device_id, created, last_seen,
+            last_puppet) in IPAddress.objects.filter(
+                number__gt=low, number__lt=high,
+            ).values_list('address', 'number', 'device', 'created',
+                          'last_seen', 'last_puppet'):
+        interval = scan_interval(now, created, last_seen, last_puppet,
+                                 last_changes.get(device_id),
+                                 address in warned)
+        if not is_due(number, interval, now.toordinal()):
+            result.add(address)
+    return result
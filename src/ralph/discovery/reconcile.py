@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Bring the components of a device in line with what a plugin detected.
+
+Instead of calling ``concurrent_get_or_create`` and ``save`` for every single
+processor, memory bank or disk, the existing components and component models
+are loaded with one query each and compared in memory. Only the rows that
+actually change are saved, so that the priorities and the history hooks keep
+working. The history entries are written in one batch and the search
+document of the device is rebuilt once, after all the rows.
+
+The cached prices are not touched here. Discovery leaves them to the
+``cache_price`` plugin, which prices every device once per run, after all
+of its components were saved.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import namedtuple
+
+from django.db.models import Q
+from lck.django.common import nested_commit_on_success
+
+from ralph.discovery.history import history_batch, defer_core_count
+from ralph.discovery.models import ComponentModel, Processor
+from ralph.discovery.models_history import update_core_count
+from ralph.discovery.models_search import search_index_batch
+
+
+MODEL_KEY = ('speed', 'cores', 'size', 'type', 'family', 'extra_hash')
+
+
+Changes = namedtuple('Changes', 'created updated deleted')
+
+
+def _model_key(get):
+    return tuple(get(name) for name in MODEL_KEY)
+
+
+def _lookup_getter(lookup):
+    def get(name):
+        if name in lookup:
+            return lookup[name]
+        return ComponentModel._meta.get_field(name).get_default()
+    return get
+
+
+def get_models(lookups):
+    """
+    Return a ``(model, created)`` pair for every dict of keyword arguments
+    in ``lookups``, just like ``ComponentModel.concurrent_get_or_create``
+    would. The models not in the identity map are fetched with one query,
+    only the missing ones are created.
+    """
+    lookups = [ComponentModel.normalize_kwargs(dict(lookup))
+               for lookup in lookups]
+    keys = [_model_key(_lookup_getter(lookup)) for lookup in lookups]
+    found = {}
+    for lookup, key in zip(lookups, keys):
+        if key not in found:
+            model = ComponentModel.identity_map.get(**lookup)
+            if model is not None:
+                found[key] = model
+    missing = set(keys) - set(found)
+    if missing:
+        query = Q()
+        for key in missing:
+            query |= Q(**dict(zip(MODEL_KEY, key)))
+        for model in ComponentModel.objects.filter(query):
+            ComponentModel.identity_map.add(model)
+            found[_model_key(lambda name: getattr(model, name))] = model
+    result = []
+    for lookup, key in zip(lookups, keys):
+        model = found.get(key)
+        created = False
+        if model is None:
+            model, created = ComponentModel.concurrent_get_or_create(**lookup)
+            found[key] = model
+        result.append((model, created))
+    return result
+
+
+def update(obj, priority=0, **values):
+    """
+    Set the ``values`` on ``obj`` and save it with ``priority``, but only if
+    it is new or any of its fields changed. Return True if it was saved.
+    """
+    for name, value in values.iteritems():
+        setattr(obj, name, value)
+    if obj.pk and not obj.dirty_fields:
+        return False
+    obj.save(priority=priority)
+    return True
+
+
+@nested_commit_on_success
+def reconcile(device, component, key, rows, priority=0, prune=True,
+              initial=()):
+    """
+    Make the ``component`` rows of ``device`` match ``rows``, the dicts of
+    their desired field values. The fields named in ``key`` identify a row.
+
+    Rows of the device that match none of the ``rows`` are deleted, unless
+    ``prune`` is False or a function that returns False for them. The fields
+    named in ``initial`` are only set on newly created rows.
+
+    Return the created, updated and deleted components.
+    """
+    rows = list(rows)
+    existing = {}
+    query = component.objects.filter(device=device).select_related('model')
+    for obj in query:
+        existing.setdefault(tuple(getattr(obj, name) for name in key), obj)
+    row_keys = [tuple(row[name] for name in key) for row in rows]
+    changes = Changes([], [], [])
+    with history_batch(), search_index_batch(), defer_core_count(device.id):
+        if prune:
+            wanted = set(row_keys)
+            changes.deleted.extend(
+                obj for obj_key, obj in existing.iteritems()
+                if obj_key not in wanted and (prune is True or prune(obj))
+            )
+        if changes.deleted:
+            # before the updates, which may take over their unique values
+            component.objects.filter(
+                id__in=[obj.id for obj in changes.deleted]).delete()
+        for row, row_key in zip(rows, row_keys):
+            obj = existing.get(row_key)
+            created = obj is None
+            if created:
+                obj, created = component.concurrent_get_or_create(
+                    device=device, **dict(zip(key, row_key)))
+                existing[row_key] = obj
+            values = dict(row)
+            if not created:
+                for name in initial:
+                    values.pop(name, None)
+            if update(obj, priority, **values):
+                (changes.created if created else changes.updated).append(obj)
+    if component is Processor and any(changes):
+        update_core_count(device)
+    return changes
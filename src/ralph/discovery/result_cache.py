@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Remembers a digest of the data every discovery plugin got from every
+address, together with the devices and addresses it was saved to. When a
+plugin gets the same data again, it only marks them as seen instead of
+saving all of their components again. The digests are kept in the database,
+so that all the workers share them and ``force_refresh`` reaches them all.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import datetime
+import hashlib
+import json
+
+from django.conf import settings
+from django.db.models import F, Sum
+
+from ralph.discovery.models import Device, DiscoveryResult, IPAddress
+
+
+RESULT_TIMEOUT = settings.DISCOVERY_RESULT_CACHE_TIMEOUT
+
+
+def _update(digest, value):
+    if isinstance(value, dict):
+        digest.update(b'{')
+        for key in sorted(value):
+            _update(digest, key)
+            _update(digest, value[key])
+        digest.update(b'}')
+    elif isinstance(value, (list, tuple)):
+        digest.update(b'[')
+        for item in value:
+            _update(digest, item)
+        digest.update(b']')
+    else:
+        if isinstance(value, bytes):
+            data = value
+        else:
+            data = unicode(value).encode('utf-8')
+        digest.update(b'%d:' % len(data))
+        digest.update(data)
+
+
+def payload_digest(payload):
+    """
+    Return a digest of the ``payload``, which may consist of dicts, lists,
+    tuples and anything that can be converted to text. Dicts with the same
+    items give the same digest regardless of their order.
+    """
+    digest = hashlib.sha1()
+    _update(digest, payload)
+    return digest.hexdigest()
+
+
+def unchanged(plugin_name, address, digest, **updates):
+    """
+    Check whether ``plugin_name`` got the data with the same ``digest`` from
+    ``address`` the last time. If so, update the last seen time of all the
+    devices and addresses saved in that run, set the fields in ``updates``
+    on ``address`` and return the id of the device and the message of that
+    run, otherwise return None.
+    """
+    if not RESULT_TIMEOUT:
+        return None
+    since = datetime.datetime.now() - datetime.timedelta(
+        seconds=RESULT_TIMEOUT)
+    try:
+        stored = DiscoveryResult.objects.get(
+            plugin=plugin_name, address=address, saved__gte=since)
+    except DiscoveryResult.DoesNotExist:
+        return None
+    if stored.digest != digest:
+        return None
+    now = datetime.datetime.now()
+    if not Device.objects.filter(id=stored.device_id).update(last_seen=now):
+        return None
+    Device.objects.filter(
+        id__in=json.loads(stored.devices or '[]')).update(last_seen=now)
+    IPAddress.objects.filter(
+        address__in=json.loads(stored.addresses or '[]')).update(
+            last_seen=now)
+    IPAddress.objects.filter(address=address).update(
+        last_seen=now, **updates)
+    DiscoveryResult.objects.filter(id=stored.id).update(hits=F('hits') + 1)
+    return stored.device_id, stored.message
+
+
+def remember(plugin_name, address, digest, device, message, devices=(),
+             addresses=()):
+    """
+    Remember that ``plugin_name`` saved the data with the ``digest`` from
+    ``address`` to ``device``, a device or its id, and reported ``message``.
+    ``devices`` and ``addresses`` are the ids of the other devices and the
+    other addresses saved along the way.
+    """
+    if not RESULT_TIMEOUT or device is None:
+        return
+    values = dict(
+        digest=digest,
+        device=getattr(device, 'id', device),
+        message=message or '',
+        devices=json.dumps(list(devices)),
+        addresses=json.dumps(list(addresses)),
+        saved=datetime.datetime.now(),
+    )
+    if not DiscoveryResult.objects.filter(
+            plugin=plugin_name, address=address).update(
+                misses=F('misses') + 1, **values):
+        values['device_id'] = values.pop('device')
+        DiscoveryResult.objects.create(
+            plugin=plugin_name, address=address, misses=1, **values)
+
+
+def force_refresh():
+    """Make all the plugins save their data again on their next run."""
+    DiscoveryResult.objects.all().delete()
+
+
+def stats():
+    """Return the numbers of runs that skipped and didn't skip saving."""
+    totals = DiscoveryResult.objects.aggregate(
+        hits=Sum('hits'), misses=Sum('misses'))
+    return {
+        'hits': totals['hits'] or 0,
+        'misses': totals['misses'] or 0,
+    }
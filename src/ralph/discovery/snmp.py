@@ -8,10 +8,16 @@ from __future__ import unicode_literals
 
 import socket
 
+from django.core.cache import cache
+from pyasn1.type import univ
 from pysnmp.entity.rfc3413.oneliner import cmdgen
 from pysnmp.proto.rfc1902 import OctetString
 
 
+CREDENTIALS_KEY = 'ralph.discovery.snmp.credentials.%s'
+CREDENTIALS_TIMEOUT = 30 * 24 * 3600
+
+
 def check_snmp_port(ip, port=161, timeout=1):
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.settimeout(timeout)
@@ -29,10 +35,10 @@ def check_snmp_port(ip, port=161, timeout=1):
     return bool(reply)
 
 
-def user_data(auth, snmp_version):
+def user_data(auth, snmp_version, security_name='ralph'):
     if snmp_version == '2c':
         community = auth
-        data = cmdgen.CommunityData('ralph', community, 1)
+        data = cmdgen.CommunityData(security_name, community, 1)
     elif snmp_version in ('3', 3):
         # For snmpv3, auth is a tuple of password and encryption key
         snmp_v3_auth, snmp_v3_priv = auth
@@ -44,38 +50,201 @@ def user_data(auth, snmp_version):
             privProtocol=cmdgen.usmDESPrivProtocol,
         )
     else:
-        data = cmdgen.CommunityData('ralph', community, 0)
+        data = cmdgen.CommunityData(security_name, auth, 0)
     return data
 
 
-def snmp_command(hostname, community, oid, snmp_version='2c', timeout=1, attempts=3):
-    transport = cmdgen.UdpTransportTarget((hostname, 161), attempts, timeout)
-    data = user_data(community, snmp_version)
-    gen = cmdgen.CommandGenerator()
-    error, status, index, vars = gen.getCmd(data, transport, oid)
+def _get_callback(handle, error, status, index, var_binds, context):
+    results, i = context
+    if not error:
+        results[i] = var_binds
+
+
+def _walk_callback(handle, error, status, index, var_bind_table, context):
+    results, i, head = context
     if error:
-        return None
-    else:
-        return vars
+        results[i] = {}
+        return
+    if status:
+        return
+    for row in var_bind_table:
+        if not row:
+            continue
+        name, value = row[0]
+        if isinstance(value, univ.Null) or not head.isPrefixOf(name):
+            return
+        results[i][name] = value
+    if var_bind_table:
+        return 1 # continue with the next part of the table
+
+
+class SnmpProber(object):
+    """
+    Sends SNMP requests to many hosts at once. All the requests of a batch
+    are multiplexed over the sockets of a single pysnmp engine and answered
+    by a single run of its dispatcher, so a batch takes as long as its
+    slowest request instead of the sum of them all.
+
+    Requests are ``(hostname, auth, oid, snmp_version)`` tuples, where
+    ``auth`` is the community, or the pair of keys for SNMP version 3.
+    """
+
+    def __init__(self, timeout=1, attempts=3):
+        self.timeout = timeout
+        self.attempts = attempts
+        self.generator = cmdgen.AsynCommandGenerator()
+        self.user_data = {}
+
+    def _user_data(self, auth, snmp_version):
+        # pysnmp identifies the communities by their security names
+        key = auth, unicode(snmp_version)
+        try:
+            return self.user_data[key]
+        except KeyError:
+            data = user_data(auth, snmp_version,
+                             'ralph-%d' % len(self.user_data))
+            self.user_data[key] = data
+            return data
+
+    def _target(self, hostname):
+        return cmdgen.UdpTransportTarget((hostname, 161),
+                                         timeout=self.timeout,
+                                         retries=max(self.attempts - 1, 0))
+
+    def _run(self):
+        self.generator.snmpEngine.transportDispatcher.runDispatcher()
+
+    def get(self, requests):
+        """
+        Send a GET for every request and return the list of the received
+        variable bindings, or None for requests that failed, in the order of
+        the requests.
+        """
+        results = [None] * len(requests)
+        for i, (hostname, auth, oid, snmp_version) in enumerate(requests):
+            self.generator.asyncGetCmd(
+                self._user_data(auth, snmp_version),
+                self._target(hostname),
+                (oid,),
+                (_get_callback, (results, i)),
+            )
+        if requests:
+            self._run()
+        return results
+
+    def walk(self, requests):
+        """
+        Walk the subtree of every request and return the list of dicts with
+        the values of the subtrees by their OIDs, in the order of the
+        requests. Failed walks give empty dicts.
+        """
+        results = [{} for request in requests]
+        for i, (hostname, auth, oid, snmp_version) in enumerate(requests):
+            context = _walk_callback, (results, i, univ.ObjectIdentifier(oid))
+            data = self._user_data(auth, snmp_version)
+            if snmp_version in ('2c', '3', 3):
+                self.generator.asyncBulkCmd(data, self._target(hostname),
+                                            0, 25, (oid,), context)
+            else:
+                self.generator.asyncNextCmd(data, self._target(hostname),
+                                            (oid,), context)
+        if requests:
+            self._run()
+        return results
+
+
+def remembered_credentials(ip):
+    """
+    Return the ``(community, snmp_version)`` that last worked for ``ip``, or
+    None.
+    """
+    return cache.get(CREDENTIALS_KEY % ip)
+
+
+def remember_credentials(ip, community, snmp_version):
+    cache.set(CREDENTIALS_KEY % ip, (community, snmp_version),
+              CREDENTIALS_TIMEOUT)
+
+
+def snmp_probe(hosts, credentials, oid, timeout=1, attempts=2):
+    """
+    Find the first of the ``credentials``, a list of ``(community,
+    snmp_version)`` pairs, that gets a non-empty answer for ``oid`` from
+    each of the ``hosts``. Returns a dict mapping the hosts that answered to
+    ``(community, snmp_version, value)``.
+
+    The credentials that last worked for a host are tried first, for all
+    the hosts at once. The remaining credentials are then tried together
+    for all the hosts that didn't answer, so the whole probe takes at most
+    two timeouts, however many hosts and credentials there are.
+    """
+    hosts = [str(host) for host in hosts]
+    credentials = [tuple(c) for c in credentials]
+    found = {}
+    tried = {}
+    requests = []
+    for host in hosts:
+        remembered = remembered_credentials(host)
+        if remembered and tuple(remembered) in credentials:
+            tried[host] = tuple(remembered)
+            requests.append((host,) + tuple(remembered))
+    prober = SnmpProber(timeout, attempts)
+    for (host, community, version), var_binds in zip(requests, prober.get(
+            [(h, c, oid, v) for h, c, v in requests])):
+        if var_binds and unicode(var_binds[0][1]):
+            found[host] = community, version, var_binds[0][1]
+    requests = [(host, community, version) for host in hosts
+                if host not in found for community, version in credentials
+                if tried.get(host) != (community, version)]
+    for (host, community, version), var_binds in zip(requests, prober.get(
+            [(h, c, oid, v) for h, c, v in requests])):
+        if not var_binds or not unicode(var_binds[0][1]):
+            continue
+        # the earlier credentials take precedence
+        if host not in found or credentials.index(
+                (community, version)) < credentials.index(found[host][:2]):
+            found[host] = community, version, var_binds[0][1]
+    for host, (community, version, value) in found.iteritems():
+        if tried.get(host) != (community, version):
+            remember_credentials(host, community, version)
+    return found
+
+
+def snmp_command(hostname, community, oid, snmp_version='2c', timeout=1, attempts=3):
+    return SnmpProber(timeout, attempts).get(
+        [(hostname, community, oid, snmp_version)])[0]
 
 
 def snmp_bulk(hostname, community, oid, snmp_version='2c', timeout=1, attempts=3):
-    transport = cmdgen.UdpTransportTarget((hostname, 161), attempts, timeout)
-    data = user_data(community, snmp_version)
-    gen = cmdgen.CommandGenerator()
-    if snmp_version in ('2c', '3', 3):
-        error, status, index, vars = gen.bulkCmd(data, transport, 0, 25, oid)
-    else:
-        error, status, index, vars = gen.nextCmd(data, transport, oid)
-    if error:
-        return {}
-    return dict(i for i, in vars)
+    return SnmpProber(timeout, attempts).walk(
+        [(hostname, community, oid, snmp_version)])[0]
 
 
-def snmp_macs(hostname, community, oid, snmp_version='2c', timeout=1, attempts=3):
-    for oid, value in snmp_bulk(hostname, community, oid, snmp_version,
-            timeout, attempts).iteritems():
+def snmp_bulk_many(requests, timeout=1, attempts=3):
+    """
+    Walk many ``(hostname, community, oid, snmp_version)`` subtrees at once,
+    see ``SnmpProber.walk``.
+    """
+    return SnmpProber(timeout, attempts).walk(requests)
+
+
+def _macs(values):
+    for oid, value in values.iteritems():
         if isinstance(value, OctetString):
             mac = ''.join('%02x' % ord(c) for c in  value).upper()
             if len(mac) == 12:
                 yield mac
+
+
+def snmp_macs(hostname, community, oid, snmp_version='2c', timeout=1, attempts=3):
+    return _macs(snmp_bulk(hostname, community, oid, snmp_version, timeout,
+                           attempts))
+
+
+def snmp_macs_many(requests, timeout=1, attempts=3):
+    """
+    Return the lists of MAC addresses found in many ``(hostname, community,
+    oid, snmp_version)`` subtrees, walked all at once.
+    """
+    return [list(_macs(values)) for values in
+            snmp_bulk_many(requests, timeout, attempts)]
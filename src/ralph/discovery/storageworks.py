@@ -5,13 +5,12 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import time
 import paramiko
 
 from lck.django.common import nested_commit_on_success
 from lxml import etree as ET
 
-from ralph.util import Eth
+from ralph.util import Eth, network
 from ralph.discovery.models import (DeviceType, Device, IPAddress,
                                     DiskShare, ComponentModel, ComponentType)
 from ralph.discovery.hardware import normalize_wwn
@@ -32,35 +31,12 @@ class HPSSHClient(paramiko.SSHClient):
 
     def _auth(self, username, password, pkey, key_filenames, allow_agent, look_for_keys):
         self._transport.auth_password(username, password)
-        self._hp_chan = self._transport.open_session()
-        self._hp_chan.invoke_shell()
-        chunk = self._hp_chan.recv(1024)
-        self._hp_chan.sendall('\r\n')
-        time.sleep(0.25)
-        chunk = self._hp_chan.recv(1024)
-        if not chunk.endswith('# '):
-            raise ConsoleError('Expected system prompt, got %r.' % chunk)
+        # XXX Work around random characters appearing at the beginning of the command.
+        self._hp_shell = network.open_shell(self, r'# $', prefix=b'\b')
 
     def hp_command(self, command):
-        # XXX Work around random characters appearing at the beginning of the command.
-        self._hp_chan.sendall(b'\b')
-        time.sleep(0.125)
-        self._hp_chan.sendall(command)
-        buffer = b'# '
-        end = command[-32:]
-        while not buffer.strip(b'\b ').endswith(end):
-            chunk = self._hp_chan.recv(1024)
-            buffer += chunk
-        self._hp_chan.sendall(b'\r\n')
-        buffer = [b'']
-        while True:
-            chunk = self._hp_chan.recv(1024)
-            lines = chunk.split(b'\n')
-            buffer[-1] += lines[0]
-            buffer.extend(lines[1:])
-            if buffer[-1].endswith(b'# '):
-                break
-        text = b''.join(line for line in buffer if not line.startswith(b'# '))
+        lines = self._hp_shell.command(command)
+        text = b'\n'.join(line for line in lines if not line.startswith(b'# '))
         return ET.fromstring(text.strip())
 
 
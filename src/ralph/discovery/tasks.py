@@ -8,17 +8,28 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from datetime import datetime, timedelta
 import re
+import socket
 import textwrap
+import threading
+import time
 import traceback
+from multiprocessing.pool import ThreadPool
 
 from celery.task import task
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, connections, transaction, DEFAULT_DB_ALIAS
+import ipaddr
 from ipaddr import IPv4Network, IPv6Network
 
-from ralph.discovery.models import Network, IPAddress
-from ralph.util.network import ping
+from ralph.discovery import priority
+from ralph.discovery.history import history_batch
+from ralph.discovery.models import Network, IPAddress, UpdateUnit
+from ralph.discovery.models_search import search_index_batch
+from ralph.dnsedit.util import txt_records_batch
+from ralph.util.network import ping, ping_sweep
 from ralph.util import output, plugin
 
 
@@ -27,14 +38,26 @@ MAX_RESTARTS = 3
 SANITY_CHECK_PING_ADDRESS = settings.SANITY_CHECK_PING_ADDRESS
 NETWORK_TASK_DELEGATION_TIMEOUT = settings.NETWORK_TASK_DELEGATION_TIMEOUT
 SINGLE_DISCOVERY_TIMEOUT = settings.SINGLE_DISCOVERY_TIMEOUT
+DISCOVERY_PLUGIN_THREADS = settings.DISCOVERY_PLUGIN_THREADS
+DISCOVERY_PLUGIN_TIMEOUT = settings.DISCOVERY_PLUGIN_TIMEOUT
+DISCOVERY_UPDATE_UNIT_SIZE = settings.DISCOVERY_UPDATE_UNIT_SIZE
+DISCOVERY_UPDATE_CONCURRENCY = settings.DISCOVERY_UPDATE_CONCURRENCY
+DISCOVERY_UPDATE_UNIT_TIMEOUT = settings.DISCOVERY_UPDATE_UNIT_TIMEOUT
+
+# plugin name -> [runs, seconds] of all the plugins run in this process
+_plugin_latencies = {}
+_plugin_latencies_lock = threading.Lock()
 
 class DCRouter(object):
     """Route the discovery tasks to the right data center for them.
        Use the default queue if no network matches the IP address."""
 
     def route_for_task(self, task, args=None, kwargs=None):
-        if task == 'ralph.discovery.tasks.run_chain':
+        if task in ('ralph.discovery.tasks.run_chain',
+                    'ralph.discovery.tasks.update_unit'):
             return args[1] or 'celery'
+        if task == 'ralph.discovery.tasks.update_host':
+            return args[2] or 'celery'
         if task != 'ralph.discovery.tasks.discover_single':
             return 'celery'
         try:
@@ -67,6 +90,28 @@ def sanity_check(perform_network_checks=True):
              * are you using setuid bin/python""").strip().format(
                  SANITY_CHECK_PING_ADDRESS))
 
+def _record_latency(plugin_name, seconds):
+    with _plugin_latencies_lock:
+        latency = _plugin_latencies.setdefault(plugin_name, [0, 0])
+        latency[0] += 1
+        latency[1] += seconds
+
+def _latencies_since(before):
+    """Returns the runs and seconds of the plugins since the `before`
+    snapshot of the latencies."""
+    result = {}
+    with _plugin_latencies_lock:
+        for name, (runs, seconds) in _plugin_latencies.iteritems():
+            old_runs, old_seconds = before.get(name, (0, 0))
+            if runs != old_runs:
+                result[name] = [runs - old_runs, seconds - old_seconds]
+    return result
+
+def _latencies_snapshot():
+    with _plugin_latencies_lock:
+        return dict((name, list(latency))
+                    for name, latency in _plugin_latencies.iteritems())
+
 def _run_plugin(context, chain, plugin_name, requirements, interactive,
                 clear_down, done_requirements, outputs=None):
     if outputs:
@@ -79,10 +124,12 @@ def _run_plugin(context, chain, plugin_name, requirements, interactive,
     message = "[{}] {}... ".format(plugin_name, context.get('ip', ''))
     pad = output.WIDTH - len(message)
     stdout(message, end='')
+    started = time.time()
     try:
         new_context = {}
-        is_up, message, new_context = plugin.run(chain, plugin_name,
-                                                 **context)
+        with history_batch(), txt_records_batch(), search_index_batch():
+            is_up, message, new_context = plugin.run(chain, plugin_name,
+                                                     **context)
         if is_up:
             requirements.add(plugin_name)
     except plugin.Restart as e:
@@ -109,10 +156,246 @@ def _run_plugin(context, chain, plugin_name, requirements, interactive,
             stdout_verbose(message, end=end)
     finally:
         done_requirements.add(plugin_name)
+        _record_latency(plugin_name, time.time() - started)
     context.update(new_context)
 
+class PluginAbandoned(Exception):
+    """Raised on a query of a plugin whose wave is already over."""
+
+
+class _Wave(object):
+    """The plugins of a single host run at once. Only one of them at a time
+    may use the database: a plugin takes the lock of the wave when it starts
+    a transaction and releases it when the transaction ends, so the plugins
+    never save the same device and components concurrently, while the
+    network I/O between their transactions still overlaps. When the wave is
+    over, the plugins still running are abandoned and any further query of
+    theirs fails."""
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.lock = threading.Lock()
+        self.over = False
+
+    def acquire(self):
+        while not self.over and time.time() < self.deadline:
+            if self.lock.acquire(False):
+                return
+            time.sleep(0.01)
+        raise PluginAbandoned("the discovery of this host moved on")
+
+    def check(self):
+        if self.over:
+            raise PluginAbandoned("the discovery of this host moved on")
+
+
+class _WaveCursor(object):
+    """A database cursor that holds the lock of the wave for the duration
+    of the transaction its statements belong to."""
+
+    def __init__(self, cursor, state):
+        self.cursor = cursor
+        self.state = state
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, sql, *args, **kwargs):
+        self.state.begin(sql)
+        try:
+            return self.cursor.execute(sql, *args, **kwargs)
+        finally:
+            self.state.statement_done()
+
+    def executemany(self, sql, *args, **kwargs):
+        self.state.begin(sql)
+        try:
+            return self.cursor.executemany(sql, *args, **kwargs)
+        finally:
+            self.state.statement_done()
+
+
+class _WaveTransactions(object):
+    """Takes the lock of `wave` on the first statement of a transaction of
+    the database connection `db` and releases it when the transaction is
+    committed or rolled back. A read outside of a managed transaction is a
+    transaction of its own, so a plugin that reads something and then goes
+    on with its network I/O doesn't keep the others waiting."""
+
+    def __init__(self, wave, db):
+        self.wave = wave
+        self.db = db
+        self.locked = False
+        self.writing = False
+
+    def begin(self, sql):
+        self.wave.check()
+        if not self.locked:
+            self.wave.acquire()
+            self.locked = True
+        if not sql.lstrip().upper().startswith('SELECT'):
+            self.writing = True
+
+    def statement_done(self):
+        if not self.writing and not self.db.is_managed():
+            self.release()
+
+    def end(self):
+        self.writing = False
+        self.release()
+
+    def left_managed(self):
+        if not self.writing and not self.db.is_managed():
+            self.release()
+
+    def release(self):
+        if self.locked:
+            self.locked = False
+            self.wave.lock.release()
+
+
+def _serialized_queries(wave):
+    """Makes the transactions of the database connection of this thread
+    wait for the lock of `wave` and check that the wave is not over on every
+    query. Returns a function that restores the connection."""
+    db = connections[DEFAULT_DB_ALIAS]
+    state = _WaveTransactions(wave, db)
+    def cursor():
+        wave.check()
+        return _WaveCursor(type(db).cursor(db), state)
+    def ending(method):
+        def end():
+            try:
+                return method(db)
+            finally:
+                state.end()
+        return end
+    def leave_transaction_management():
+        try:
+            return type(db).leave_transaction_management(db)
+        finally:
+            state.left_managed()
+    db.cursor = cursor
+    db._commit = ending(type(db)._commit)
+    db._rollback = ending(type(db)._rollback)
+    db.leave_transaction_management = leave_transaction_management
+    def restore():
+        del db.cursor
+        del db._commit
+        del db._rollback
+        del db.leave_transaction_management
+        state.release()
+    return restore
+
+def _run_plugin_isolated(context, chain, plugin_name, interactive,
+                         clear_down, wave):
+    """Runs a single plugin in a worker thread. The plugin gets its own copy
+    of `context` and its output is buffered, so that the results can be
+    merged and printed in a deterministic order afterwards. Returns only the
+    part of the context that the plugin changed."""
+    original = dict(context)
+    messages = []
+    def buffered(index):
+        def out(*args, **kwargs):
+            messages.append((index, args, kwargs))
+        return out
+    outputs = (buffered(0), buffered(1), buffered(2))
+    requirements = set()
+    restart = None
+    restore = _serialized_queries(wave)
+    try:
+        _run_plugin(context, chain, plugin_name, requirements, interactive,
+                    clear_down, set(), outputs)
+    except plugin.Restart as e:
+        restart = e
+    finally:
+        connection.close()
+        restore()
+    changes = dict((key, value) for key, value in context.iteritems()
+                   if key not in original or original[key] != value)
+    return plugin_name in requirements, changes, messages, restart
+
+def run_plugins_parallel(context, chain, requirements, interactive=False,
+                         clear_down=True, done_requirements=None,
+                         outputs=None, threads=DISCOVERY_PLUGIN_THREADS,
+                         timeout=DISCOVERY_PLUGIN_TIMEOUT):
+    """Runs all the plugins of `chain` that can be run, walking the graph of
+    their requirements in waves. All the plugins whose requirements are
+    satisfied are run at once in a new pool of at most `threads` threads,
+    each on its own copy of `context`, with their database queries
+    serialized. When the whole wave finishes, the resulting contexts are
+    merged and the output is printed in priority order, exactly as if the
+    plugins were run one by one, which keeps the outcome independent of
+    thread scheduling. The plugins not finished `timeout` seconds after
+    their wave was started, including the time they waited for a thread,
+    are abandoned and treated as failed."""
+    if outputs:
+        stdout, stdout_verbose, stderr = outputs
+    else:
+        stdout = output.get(interactive)
+        stdout_verbose = output.get(interactive, verbose=True)
+        stderr = output.get(interactive, err=True)
+    streams = (stdout, stdout_verbose, stderr)
+    if done_requirements is None:
+        done_requirements = set()
+    schedule = plugin.Schedule(chain, requirements, done_requirements)
+    restarts = {}
+    while True:
+        to_run = schedule.ready()
+        if not to_run:
+            break
+        wave = _Wave(time.time() + timeout)
+        # A new pool for every wave, so that the threads of the abandoned
+        # plugins, which cannot be killed, never hold up the next wave. They
+        # exit as soon as their plugin returns or queries the database.
+        pool = ThreadPool(min(threads, len(to_run)))
+        try:
+            results = [
+                (plugin_name, pool.apply_async(_run_plugin_isolated, (
+                    dict(context), chain, plugin_name, interactive,
+                    clear_down, wave,
+                ))) for plugin_name in to_run
+            ]
+            for plugin_name, result in results:
+                result.wait(max(wave.deadline - time.time(), 0))
+        finally:
+            wave.over = True
+            pool.terminate()
+        merged = {}
+        for plugin_name, result in results:
+            if not result.ready():
+                stderr("Plugin '{}' for '{}' timed out after {}s.".format(
+                    plugin_name, context.get('ip', 'none'), timeout),
+                    end='\n')
+                done_requirements.add(plugin_name)
+                schedule.complete(plugin_name, False)
+                continue
+            is_up, changes, messages, restart = result.get()
+            for index, args, kwargs in messages:
+                streams[index](*args, **kwargs)
+            if restart is not None:
+                restarts[plugin_name] = restarts.get(plugin_name, 0) + 1
+                if restarts[plugin_name] <= MAX_RESTARTS:
+                    continue
+                stderr("Exceeded allowed number of restarts in plugin "
+                       "'{}' for '{}': {}".format(plugin_name,
+                       context.get('ip', 'none'), unicode(restart)),
+                       end='\n')
+            done_requirements.add(plugin_name)
+            if is_up:
+                requirements.add(plugin_name)
+            schedule.complete(plugin_name, is_up)
+            merged.update(changes)
+        context.update(merged)
+
 def run_next_plugin(context, requirements=None, interactive=False,
                     clear_down=True, done_requirements=None, outputs=None):
+    if DISCOVERY_PLUGIN_THREADS > 1:
+        run_plugins_parallel(context, 'discovery', requirements, interactive,
+                             clear_down, done_requirements, outputs)
     discover = discover_single
     if not interactive:
         discover = discover.delay
@@ -239,21 +522,52 @@ def discover_single_synchro(ip):
     yield 'Finished.\n'
 
 
+def _alive_hosts(hosts, stderr):
+    """Filters the IPv4 `hosts` down to the ones answering to ping, probing
+    all of them at once with a single ICMP sweep. The IPv6 hosts, which the
+    sweep can't reach, are passed through unchanged, and so are all hosts if
+    raw sockets are not available to this process. The `ping` plugin then
+    decides per host."""
+    hosts = list(hosts)
+    swept = [host for host in hosts if ipaddr.IPAddress(host).version == 4]
+    found = False
+    try:
+        for host, delay in ping_sweep(swept):
+            found = True
+            yield host
+    except socket.error as e:
+        if found:
+            raise
+        stderr("ICMP sweep unavailable ({}), pinging hosts one by one."
+               "".format(unicode(e)), end='\n')
+        for host in swept:
+            yield host
+    for host in hosts:
+        if ipaddr.IPAddress(host).version != 4:
+            yield host
+
+
 @task(ignore_result=True, time_limit=NETWORK_TASK_DELEGATION_TIMEOUT)
 def discover_network(network, plugin_name='ping', requirements=None,
-    interactive=False, update_existing=False, outputs=None):
+    interactive=False, update_existing=False, outputs=None, prioritize=True):
     """Runs discovery for a single `network`. The argument may be
     an IPv[46]Network instance, a Network instance or a string
     holding a network address or a network name defined in the database.
     If `interactive` is False all output is omitted and discovery is done
     asynchronously by pushing tasks to Rabbit.
     If `update_existing` is True, only existing IPs from the specified
-    network are updated."""
+    network are updated.
+    If `prioritize` is True, the known addresses that are not due according
+    to `ralph.discovery.priority` are skipped.
+    For IPv4 networks, when the chain starts with the `ping` plugin, all
+    addresses are pinged first in one sweep and only hosts which are up are
+    passed on to the rest of the discovery chain."""
     sanity_check()
     if outputs:
         stdout, stdout_verbose, stderr = outputs
     else:
         stdout = output.get(interactive)
+        stderr = output.get(interactive, err=True)
     dbnet = None
     if isinstance(network, (IPv4Network, IPv6Network)):
         net = network
@@ -280,6 +594,13 @@ def discover_network(network, plugin_name='ping', requirements=None,
         hosts = (i.address for i in ip_address_queryset)
     else:
         hosts = net.iterhosts()
+    if prioritize:
+        postponed = priority.postponed(net)
+        if postponed:
+            stdout("Postponing {} known addresses.".format(len(postponed)))
+            hosts = (host for host in hosts if str(host) not in postponed)
+    if isinstance(net, IPv4Network) and plugin_name == 'ping':
+        hosts = _alive_hosts(hosts, stderr)
     for index, host in enumerate(hosts):
         context = {'ip': host}
         if dbnet:
@@ -297,8 +618,11 @@ def discover_network(network, plugin_name='ping', requirements=None,
         stdout('Scanning network {} finished.'.format(net))
 
 @task(ignore_result=True)
-def discover_all(interactive=False, update_existing=False, outputs=None):
-    """Runs discovery on all networks defined in the database."""
+def discover_all(interactive=False, update_existing=False, outputs=None,
+                 prioritize=True):
+    """Runs discovery on all networks defined in the database. If
+    `prioritize` is True, the known addresses are only scanned when they are
+    due."""
     sanity_check()
     if outputs:
         stdout, stdout_verbose, stderr = outputs
@@ -308,8 +632,157 @@ def discover_all(interactive=False, update_existing=False, outputs=None):
     for net in nets:
         if interactive:
             discover_network(net.network, interactive=True,
-                update_existing=True)
+                update_existing=True, prioritize=prioritize)
         else:
             discover_network.delay(net.network,
-                update_existing=update_existing)
+                update_existing=update_existing, prioritize=prioritize)
     stdout()
+
+
+def _start_next_unit(unit, queue):
+    next_unit = UpdateUnit.claim(unit.run_id, queue)
+    if next_unit:
+        update_unit.delay(next_unit.id, queue)
+    else:
+        unit.run.check_finished()
+
+
+def _host_number(host):
+    return int(ipaddr.IPAddress(host))
+
+
+@task(ignore_result=True, soft_time_limit=DISCOVERY_UPDATE_UNIT_TIMEOUT,
+      time_limit=DISCOVERY_UPDATE_UNIT_TIMEOUT + 60)
+def update_unit(unit_id, queue, interactive=False, outputs=None):
+    """Runs the discovery on the known addresses of a single `UpdateUnit`
+    of `queue` that were not updated yet.
+
+    If `interactive`, the hosts are discovered one by one and the last of
+    them is recorded after each, together with the time the plugins took.
+    A unit ended early by an error stays unfinished, with the error
+    recorded, so that resuming the run continues it where it stopped.
+
+    Otherwise an `update_host` task is queued for every host answering to
+    ping, so that the workers discover all of them at once, and the last of
+    those tasks to end finishes the unit and starts the next unit of the
+    same run and queue. That keeps the number of units of a queue running
+    at once the same until all of them are done, also after errors."""
+    if outputs:
+        stdout, stdout_verbose, stderr = outputs
+    else:
+        stderr = output.get(interactive, err=True)
+    unit = UpdateUnit.objects.get(id=unit_id)
+    unit.error = ''
+    try:
+        hosts = sorted(_alive_hosts(unit.addresses(), stderr),
+                       key=_host_number)
+    except Exception:
+        unit.error = traceback.format_exc()
+        unit.save()
+        if not interactive:
+            _start_next_unit(unit, queue)
+        raise
+    if not interactive:
+        unit.pending = len(hosts)
+        if not hosts:
+            unit.finished = datetime.now()
+        unit.save()
+        for host in hosts:
+            update_host.delay(unit.id, host, queue)
+        if not hosts:
+            _start_next_unit(unit, queue)
+        return
+    before = _latencies_snapshot()
+    try:
+        for host in hosts:
+            context = {'ip': host}
+            if queue:
+                context['queue'] = queue
+            discover_single(context, interactive=True, outputs=outputs)
+            unit.last_number = _host_number(host)
+            UpdateUnit.objects.filter(id=unit.id).update(
+                last_number=unit.last_number)
+    except Exception:
+        unit.error = traceback.format_exc()
+        raise
+    else:
+        unit.finished = datetime.now()
+    finally:
+        unit.add_plugin_times(_latencies_since(before))
+        unit.save()
+
+
+@task(ignore_result=True, soft_time_limit=DISCOVERY_UPDATE_UNIT_TIMEOUT,
+      time_limit=DISCOVERY_UPDATE_UNIT_TIMEOUT + 60)
+def update_host(unit_id, host, queue, outputs=None):
+    """Runs the discovery on a single `host` of the `UpdateUnit` for
+    `update_unit` and records the time its plugins took and the error that
+    ended it early, if any. The last host of the unit to end finishes the
+    unit, unless any of its hosts failed, and starts the next unit."""
+    before = _latencies_snapshot()
+    error = ''
+    try:
+        context = {'ip': host}
+        if queue:
+            context['queue'] = queue
+        discover_single(context, clear_down=False, outputs=outputs)
+    except Exception:
+        error = traceback.format_exc()
+        raise
+    finally:
+        with transaction.commit_on_success():
+            unit = UpdateUnit.objects.select_for_update().get(id=unit_id)
+            unit.add_plugin_times(_latencies_since(before))
+            unit.error = unit.error or error
+            unit.pending = max(unit.pending - 1, 0)
+            if not unit.pending and not unit.error:
+                unit.finished = datetime.now()
+            unit.save()
+        if not unit.pending:
+            _start_next_unit(unit, queue)
+
+
+def run_update(run, interactive=False,
+               concurrency=DISCOVERY_UPDATE_CONCURRENCY, outputs=None):
+    """Runs the units of the `UpdateRun` that are not finished yet. Units
+    that were started but never finished, e.g. because the worker running
+    them died, are run again. In the interactive mode the units are run
+    one by one, with the progress printed after each of them. Otherwise
+    `concurrency` units of every queue are started on the workers, all the
+    hosts of a unit at once, and each unit starts the next one when it is
+    done."""
+    sanity_check()
+    if outputs:
+        stdout, stdout_verbose, stderr = outputs
+    else:
+        stdout = output.get(interactive)
+    run.updateunit_set.filter(finished=None).update(started=None)
+    queues = sorted(set(run.updateunit_set.filter(
+        finished=None).values_list('queue', flat=True)))
+    if not interactive:
+        for queue in queues:
+            for i in xrange(concurrency):
+                unit = UpdateUnit.claim(run, queue)
+                if not unit:
+                    break
+                update_unit.delay(unit.id, queue)
+        stdout('Update {} started on {} queues.'.format(run.id, len(queues)))
+        return
+    for queue in queues:
+        while True:
+            unit = UpdateUnit.claim(run, queue)
+            if not unit:
+                break
+            update_unit(unit.id, queue, interactive=True, outputs=outputs)
+            stdout(update_progress(run))
+    run.check_finished()
+
+
+def update_progress(run, concurrency=1):
+    """Describes how far the `UpdateRun` got and how long it will take."""
+    done, total, eta = run.progress(concurrency)
+    message = 'Update {}: {} of {} addresses updated'.format(
+        run.id, done, total)
+    if eta is not None:
+        message += ', ETA {}'.format(timedelta(seconds=int(eta)))
+    return message + '.'
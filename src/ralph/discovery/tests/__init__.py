@@ -3,3 +3,10 @@
 from ralph.discovery.tests.plugins import *
 from ralph.discovery.tests.model_tests import ModelsTest
 from ralph.discovery.tests.dmidecode_tests import DMIDecodeTest
+from ralph.discovery.tests.tasks_tests import ParallelPluginsTest
+from ralph.discovery.tests.tasks_tests import AliveHostsTest
+from ralph.discovery.tests.reconcile_tests import ReconcileTest
+from ralph.discovery.tests.reconcile_tests import IdentityMapTest
+from ralph.discovery.tests.update_tests import UpdateSchedulerTest
+from ralph.discovery.tests.priority_tests import PriorityTest
+from ralph.discovery.tests.search_tests import SearchIndexTest
@@ -5,11 +5,19 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import datetime
+import time
 
+from django.db import connection
 from django.test import TestCase
+import ipaddr
+import mock
 
-from ralph.discovery.models import DeviceType, Device
+from ralph.discovery.history import history_batch
+from ralph.discovery.models import DeviceType, Device, DeviceModel
+from ralph.discovery.models import DataCenter, Network
 from ralph.discovery.models_history import HistoryChange
+from ralph.discovery.result_cache import payload_digest
 
 
 class ModelsTest(TestCase):
@@ -61,3 +69,136 @@ class ModelsTest(TestCase):
         self.assertEqual(dev_db.name, 'dev1')
         self.assertEqual(dev_db.sn, 'xaxaxa')
 
+
+    def test_device_history_batch(self):
+        dev = Device.create(
+            model_name='xxx',
+            model_type=DeviceType.unknown,
+            sn='xaxaxa',
+        )
+        dev.name = 'dev0'
+        dev.save()
+        old_model = dev.model
+        model = DeviceModel(name='yyy', type=DeviceType.rack_server)
+        model.save()
+        last_id = HistoryChange.objects.order_by('-id')[0].id
+        with history_batch():
+            dev.name = 'dev1'
+            dev.save()
+            dev.model = model
+            dev.save()
+            with history_batch():
+                dev.name = 'dev2'
+                dev.save()
+            self.assertFalse(HistoryChange.objects.filter(id__gt=last_id))
+        history = HistoryChange.objects.filter(
+            id__gt=last_id, field_name__in=('name', 'model')).order_by('id')
+        self.assertEqual(
+            [(h.device_id, h.field_name, h.old_value, h.new_value)
+             for h in history],
+            [
+                (dev.id, 'name', 'dev0', 'dev1'),
+                (dev.id, 'model', unicode(old_model), unicode(model)),
+                (dev.id, 'name', 'dev1', 'dev2'),
+            ],
+        )
+        last_id = history[len(history) - 1].id
+        with history_batch():
+            dev.name = 'dev3'
+            dev.save()
+            try:
+                with history_batch():
+                    dev.name = 'dev4'
+                    dev.save()
+                    raise ValueError()
+            except ValueError:
+                pass
+        # only the entries of the inner block that failed are discarded
+        self.assertEqual(
+            list(HistoryChange.objects.filter(
+                id__gt=last_id, field_name='name',
+            ).values_list('new_value', flat=True)),
+            ['dev3'],
+        )
+        with self.assertRaises(ValueError):
+            with history_batch():
+                dev.name = 'dev5'
+                dev.save()
+                raise ValueError()
+        self.assertFalse(HistoryChange.objects.filter(
+            field_name='name', new_value='dev5'))
+
+    def test_device_history_batch_at_change(self):
+        dev = Device.create(
+            model_name='xxx',
+            model_type=DeviceType.unknown,
+            sn='xaxaxa',
+        )
+        old_model = dev.model
+        model = DeviceModel(name='yyy', type=DeviceType.rack_server)
+        model.save()
+        with history_batch():
+            dev.model = model
+            dev.save()
+            changed = datetime.datetime.now()
+            old_model.name = 'zzz'
+            old_model.save()
+            time.sleep(0.01)
+        entry = HistoryChange.objects.get(device=dev, field_name='model')
+        # the entry shows the old model as it was when the device changed
+        self.assertEqual(entry.old_value, '[unknown] xxx')
+        self.assertLessEqual(entry.date, changed)
+
+    def test_network_from_ip(self):
+        dc = DataCenter(name='dc')
+        dc.save()
+        for name, address in [
+                ('big', '10.0.0.0/8'),
+                ('medium', '10.1.0.0/16'),
+                ('small', '10.1.2.0/24'),
+                ('other', '192.168.0.0/24'),
+                ('inside', '192.168.0.128/25')]:
+            Network(name=name, address=address, data_center=dc).save()
+        for ip in ['10.0.0.1', '10.1.2.3', '10.255.255.255', '192.168.0.1',
+                   '192.168.0.200', '8.8.8.8', '192.168.1.0']:
+            expected = list(Network.objects.filter(
+                min_ip__lte=int(ipaddr.IPAddress(ip)),
+                max_ip__gte=int(ipaddr.IPAddress(ip)),
+            ).order_by('min_ip', '-max_ip')[:1])
+            if expected:
+                self.assertEqual(Network.from_ip(ip), expected[0])
+            else:
+                with self.assertRaises(IndexError):
+                    Network.from_ip(ip)
+        big = Network.objects.get(name='big')
+        big.address = '11.0.0.0/8'
+        big.save()
+        self.assertEqual(Network.from_ip('10.1.2.3').name, 'medium')
+        with self.assertRaises(IndexError):
+            Network.from_ip('10.0.0.1')
+        # a network gone without any signals, as after a rollback, is gone
+        # from the index too
+        Network(name='new', address='10.0.0.0/8', data_center=dc).save()
+        self.assertEqual(Network.from_ip('10.0.0.1').name, 'new')
+        connection.cursor().execute(
+            "DELETE FROM discovery_network WHERE name = 'new'")
+        with self.assertRaises(IndexError):
+            Network.from_ip('10.0.0.1')
+        # the networks created by other processes are found in the next check
+        Network.objects.bulk_create([Network(
+            name='other process', address='10.0.0.0/8', data_center=dc,
+            min_ip=int(ipaddr.IPAddress('10.0.0.0')),
+            max_ip=int(ipaddr.IPAddress('10.255.255.255')),
+        )])
+        with mock.patch('time.time', return_value=time.time() + 3600):
+            self.assertEqual(Network.from_ip('10.0.0.1').name,
+                             'other process')
+
+    def test_payload_digest(self):
+        self.assertEqual(
+            payload_digest({'a': [1, 'b'], 'c': {'d': None, 'e': 'f'}}),
+            payload_digest({'c': {'e': 'f', 'd': None}, 'a': [1, 'b']}),
+        )
+        self.assertNotEqual(payload_digest(['ab', 'c']),
+                            payload_digest(['a', 'bc']))
+        self.assertNotEqual(payload_digest([1, 'b']), payload_digest(['b', 1]))
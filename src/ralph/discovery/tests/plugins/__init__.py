@@ -2,7 +2,8 @@ from ralph.discovery.tests.plugins.ipmi_tests import IpmiPluginTest
 from ralph.discovery.tests.plugins.http_tests import HttpPluginTest, HttpSupermicroPluginTest
 from ralph.discovery.tests.plugins.ilohp_tests import IloHpPluginTest
 from ralph.discovery.tests.plugins.hpoa_tests import HpOaPluginTest
-from ralph.discovery.tests.plugins.snmp_tests import SnmpPluginTest, SnmpMacPluginTest
+from ralph.discovery.tests.plugins.snmp_tests import (SnmpPluginTest,
+    SnmpMacPluginTest, SnmpProbeTest)
 from ralph.discovery.tests.plugins.ssg_tests import SshSsgPluginTest
 from ralph.discovery.tests.plugins.aix_tests import SshAixPluginTest
 from ralph.discovery.tests.plugins.xen_tests import SshXENPluginTest
@@ -10,5 +11,8 @@ from ralph.discovery.tests.plugins.openstack_tests import OpenStackPluginTest
 from ralph.discovery.tests.plugins.ssh_linux_tests import SshLinuxPluginTest
 from ralph.discovery.tests.plugins.system_x_tests import SystemXPluginTest
 from ralph.discovery.tests.plugins.donpedro_tests import DonPedroPluginTest
-from ralph.discovery.tests.plugins.puppet import PuppetPluginTest
+from ralph.discovery.tests.plugins.puppet import (PuppetPluginTest,
+    PuppetSnapshotTest)
 from ralph.discovery.tests.plugins.ssh_proxmox_tests import SshProxmoxTest
+from ralph.discovery.tests.plugins.ibm_bladecenter_tests import (
+    SshIbmBladecenterPluginTest)
@@ -8,6 +8,7 @@ from __future__ import unicode_literals
 import json
 from django.test import TestCase
 
+from ralph.discovery import result_cache
 from ralph.discovery.models import Device, DiskShare, DiskShareMount
 from ralph.discovery.tests.plugins.samples.donpedro import (data,
                                                             incomplete_data,
@@ -104,6 +105,22 @@ class DonPedroPluginTest(TestCase):
         self.assertEqual(DiskShareMount.objects.count(), 1)
         self.assertEqual(DiskShareMount.objects.all()[0].share.wwn, '25D304C1')
 
+    def test_unchanged_data(self):
+        DiskShareMount.objects.all().delete()
+        dev = save_device_data(json.loads(data).get('data'), '10.10.10.10')
+        self.assertEqual(dev, self.dev)
+        self.assertEqual(DiskShareMount.objects.count(), 0)
+        result_cache.force_refresh()
+        save_device_data(json.loads(data).get('data'), '10.10.10.10')
+        self.assertEqual(DiskShareMount.objects.count(), 1)
+
+    def test_result_stats(self):
+        self.assertEqual(result_cache.stats(), {'hits': 0, 'misses': 2})
+        save_device_data(json.loads(data).get('data'), '10.10.10.10')
+        self.assertEqual(result_cache.stats(), {'hits': 1, 'misses': 2})
+        result_cache.force_refresh()
+        self.assertEqual(result_cache.stats(), {'hits': 0, 'misses': 0})
+
     def test_incomplete_data_handling(self):
         with self.assertRaises(NoRequiredDataError) as cm:
             save_device_data(json.loads(incomplete_data).get('data'),
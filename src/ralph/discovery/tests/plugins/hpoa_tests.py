@@ -8,9 +8,10 @@ from __future__ import unicode_literals
 from django.test import TestCase
 import datetime
 from lck.lang import Null, nullify
+import mock
 
 from ralph.discovery.plugins import hp_oa
-from ralph.discovery.models import DeviceType
+from ralph.discovery.models import Device, DeviceType, IPAddress
 
 
 class HpOaPluginTest(TestCase):
@@ -2894,4 +2895,16 @@ class HpOaPluginTest(TestCase):
         self.assertEqual(positions, ['1', '2', '3', '4', '1', '2', '3', '4',
             '5', '6', '7', '8', '9', '10', '11', '12', '13', '14', '15', '16'])
 
-
+    def test_unchanged(self):
+        data = nullify(self.DATA)
+        with mock.patch.object(hp_oa, 'hp_xmldata', return_value=data):
+            hp_oa.hp_oa_xml(ip='10.0.0.1', http_family='HP')
+            long_ago = datetime.datetime(2000, 1, 1)
+            Device.objects.update(last_seen=long_ago)
+            IPAddress.objects.update(last_seen=long_ago)
+            with mock.patch.object(hp_oa, 'make_encl') as make_encl:
+                hp_oa.hp_oa_xml(ip='10.0.0.1', http_family='HP')
+        self.assertFalse(make_encl.called)
+        self.assertFalse(Device.objects.filter(last_seen=long_ago).exists())
+        self.assertFalse(
+            IPAddress.objects.filter(last_seen=long_ago).exists())
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from django.test import TestCase
+import mock
+
+from ralph.discovery.models import Device, DeviceType, Processor
+from ralph.discovery.plugins import ssh_ibm_bladecenter
+from ralph.discovery.tests.util import FakeShellDevice
+from ralph.util import network
+
+
+COMMANDS = {
+    b'list -l a': b"""\
+system
+        mm[1]       primary
+        ncc[1]
+        blade[1]    SN#YK1111
+                cpu[1]
+        blade[2]    SN#YK2222
+""",
+    b'info -T system': b"""\
+Mach type/model: BladeCenter H
+Mach serial number: KQ12345
+Part no.: 00Y1234
+FRU serial no.: YK0000
+""",
+    b'info -T system:mm[1]': b"""\
+Name: Advanced Management Module
+""",
+    b'info -T system:blade[1]': b"""\
+Name: blade1
+Mach type/model: HS22
+Mach serial number: 06ABC11
+Part no.: 46M1111
+MAC Address 1: 00:1A:64:00:00:01
+MAC Address 2: Not Available
+""",
+    b'info -T system:blade[1]:cpu[1]': b"""\
+Mach type/model: Processor 1
+Processor family: Xeon
+Speed: 2.53 GHz
+Processor cores: 4
+""",
+    b'info -T system:blade[2]': b"""\
+Name: blade2
+Mach type/model: HS22
+Mach serial number: 06ABC22
+Part no.: 46M1111
+""",
+}
+
+
+class SshIbmBladecenterPluginTest(TestCase):
+    def test_bladecenter(self):
+        device = FakeShellDevice(b'system> ', COMMANDS)
+        ssh = ssh_ibm_bladecenter.IBMSSHClient()
+        ssh._transport = device
+        ssh._ibm_shells = [
+            network.open_shell(ssh, ssh_ibm_bladecenter.PROMPT)]
+        with mock.patch.object(ssh_ibm_bladecenter, '_connect_ssh',
+                               return_value=ssh):
+            with mock.patch.object(network, 'hostname', return_value=None):
+                name = ssh_ibm_bladecenter.run_ssh_bladecenter('10.0.0.1')
+        system = Device.objects.get(sn='KQ12345')
+        self.assertEqual(name, system.name)
+        self.assertEqual(system.model.type, DeviceType.blade_system)
+        blades = system.child_set.order_by('chassis_position')
+        self.assertEqual([(b.sn, b.position) for b in blades], [
+            ('06ABC11', '01'),
+            ('06ABC22', '02'),
+        ])
+        self.assertEqual(
+            list(blades[0].ethernet_set.values_list('mac', flat=True)),
+            ['001A64000001'],
+        )
+        self.assertEqual(Processor.objects.get(device=blades[0]).index, 1)
+        # the devices were queried on all the shells at once
+        commands = [command for channel, command in device.log]
+        self.assertNotIn(b'info -T system:ncc[1]', commands)
+        self.assertEqual(
+            set(channel for channel, command in device.log
+                if command.startswith(b'info')),
+            set(xrange(ssh_ibm_bladecenter.MAX_SHELLS)),
+        )
@@ -5,6 +5,13 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import os
+import shutil
+import sys
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+import mock
 from django.test import TestCase
 
 from ralph.discovery.plugins import ipmi
@@ -647,11 +654,12 @@ FRU Device Description : Builtin FRU Device (ID 0)
         self.assertEquals(labels, ['4GB DDR3 SDRAM 666'] * 6)
 
     def test_run_ipmi(self):
-        ipmi.IPMI.tool = lambda o, c, s: self.DATA_SUN.get((c, s))
-        ipmi.IPMI.get_mc = lambda o: {'Firmware Revision': '123'}
-        ipmi.IPMI.get_mac = lambda o: 'ff:aa:cc:01:10:33'
-
-        result = ipmi._run_ipmi('127.0.0.1')
+        outputs = [self.DATA_SUN[('fru', 'print')],
+                   'MAC Address : ff:aa:cc:01:10:33\n',
+                   'Firmware Revision : 123\n']
+        with mock.patch.object(ipmi.IPMI, 'tools',
+                               lambda o, commands: outputs):
+            result = ipmi._run_ipmi('127.0.0.1')
         self.assertEquals(result, 'SUN FIRE X4270 SERVER')
 
         dev = None
@@ -663,3 +671,61 @@ FRU Device Description : Builtin FRU Device (ID 0)
         self.assertEqual(
             dev.ipaddress_set.filter(is_management=True).count(), 1)
 
+
+    def test_query_many(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            executable = os.path.join(tmp, 'ipmitool')
+            log = os.path.join(tmp, 'calls')
+            with open(executable, 'w') as f:
+                f.write(FAKE_IPMITOOL.format(
+                    python=sys.executable, log=log,
+                    fru=self.DATA_KRENN[('fru', 'print')]))
+            os.chmod(executable, 0o755)
+            with mock.patch.object(ipmi.IPMI, 'executable', executable), \
+                    mock.patch('ralph.discovery.plugins.ipmi.ThreadPool',
+                               wraps=ThreadPool) as pool:
+                results = ipmi.query_many(
+                    ['127.0.0.1', '127.0.0.2', '127.0.0.4'], 'ADMIN', 'ADMIN',
+                    threads=2)
+                failed = ipmi.query_many(['127.0.0.3'], 'root', 'secret')
+            with open(log) as f:
+                calls = sorted(f.read().split())
+        finally:
+            shutil.rmtree(tmp)
+        # every BMC is read in a single session, by a bounded pool
+        self.assertEqual(calls, ['127.0.0.1', '127.0.0.2', '127.0.0.3',
+                                 '127.0.0.4'])
+        self.assertEqual(pool.call_args_list, [mock.call(2), mock.call(1)])
+        fru, lan, mc = results['127.0.0.2']
+        self.assertEqual(fru['Builtin FRU Device']['Product Serial'],
+                         '9000078907')
+        self.assertEqual(lan, {'MAC Address': '00:11:22:33:44:02'})
+        self.assertEqual(mc, {'Firmware Revision': '1.0'})
+        self.assertEqual(sorted(results),
+                         ['127.0.0.1', '127.0.0.2', '127.0.0.4'])
+        self.assertIsInstance(failed['127.0.0.3'], ipmi.AuthError)
+
+
+# answers like a BMC accepting only the ADMIN user, logs every session
+FAKE_IPMITOOL = '''#!{python}
+import sys
+args = sys.argv[1:]
+options = dict(zip(args[:6:2], args[1:6:2]))
+with open({log!r}, 'a') as f:
+    f.write(options['-H'] + '\\n')
+if options['-U'] != 'ADMIN':
+    sys.stderr.write('Invalid user name\\n')
+    sys.exit(1)
+answers = {{
+    'fru print': {fru!r},
+    'lan print': 'MAC Address : 00:11:22:33:44:0%s\\n' % options['-H'][-1],
+    'mc info': 'Firmware Revision : 1.0\\n',
+}}
+for line in open(args[7]):
+    line = line.strip()
+    if line.startswith('echo '):
+        sys.stdout.write(line[5:] + '\\n')
+    else:
+        sys.stdout.write(answers[line])
+'''
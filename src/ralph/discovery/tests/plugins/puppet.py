@@ -5,14 +5,21 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from django.core.cache import cache
 from django.test import TestCase
+from django.test.utils import override_settings
+import mock
+import sqlalchemy as sqla
 
-from ralph.discovery.models import (Device, DeviceType, OperatingSystem)
+from ralph.discovery.models import (Device, DeviceType, IPAddress,
+                                    OperatingSystem)
 from ralph.discovery.tests.plugins.samples.puppet import (
     data, data_second, data_not_encoded)
 
 from ralph.discovery.plugins.puppet.facts import (
     handle_facts_os, handle_facts_packages)
+from ralph.discovery.plugins.puppet.snapshot import (FactsSnapshot,
+                                                     WATERMARK_KEY)
 
 
 class PuppetPluginTest(TestCase):
@@ -77,3 +84,58 @@ class PuppetPluginTest(TestCase):
              ('sed', '4.1.1-9'),
              ('sed', '4.3.1-9')]
         )
+
+
+class PuppetSnapshotTest(TestCase):
+    def setUp(self):
+        self.db = sqla.create_engine('sqlite://').connect()
+        self.db.execute('CREATE TABLE hosts (id INTEGER, name TEXT, ip TEXT)')
+        self.db.execute('CREATE TABLE fact_names (id INTEGER, name TEXT)')
+        self.db.execute('CREATE TABLE fact_values (id INTEGER, value TEXT, '
+                        'fact_name_id INTEGER, host_id INTEGER, '
+                        'updated_at DATETIME)')
+        for host in ((1, 'h1', '10.0.0.1'), (2, 'h2', '10.0.0.2'),
+                     (3, 'h3', None)):
+            self.db.execute('INSERT INTO hosts VALUES (?, ?, ?)', host)
+        self.db.execute("INSERT INTO fact_names VALUES (1, 'virtual')")
+        self.db.execute("INSERT INTO fact_names VALUES (2, 'fqdn')")
+        for row in ((1, 'physical', 1, 1), (2, 'h1.local', 2, 1),
+                    (3, 'zone', 1, 2), (4, 'physical', 1, 3)):
+            self.db.execute('INSERT INTO fact_values VALUES '
+                            "(?, ?, ?, ?, '2013-01-01 00:00:00')", row)
+        cache.delete(WATERMARK_KEY)
+        IPAddress(address='10.0.0.1', hostname='h1').save()
+
+    # as if the processes shared the cache
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache'}})
+    def test_snapshot(self):
+        snapshot = FactsSnapshot()
+        host = snapshot.find(self.db, {'10.0.0.1'}, set())
+        self.assertEqual(host, (1, '2013-01-01 00:00:00'))
+        # only the plugin marks the addresses it discovered
+        self.assertIsNone(
+            IPAddress.objects.get(address='10.0.0.1').last_puppet)
+        # loaded in bulk already
+        self.assertEqual(snapshot.facts(None, *host),
+                         {'virtual': 'physical', 'fqdn': 'h1.local'})
+        self.assertEqual(snapshot.find(self.db, {'10.0.0.2'}, {'h3'})[0], 3)
+        self.assertIsNone(snapshot.find(self.db, {'10.0.0.3'}, {'h4'}))
+        self.db.execute("UPDATE fact_values SET value = 'h1.example.com', "
+                        "updated_at = '2013-01-02 00:00:00' WHERE id = 2")
+        snapshot.refresh(self.db)
+        host = snapshot.find(self.db, {'10.0.0.1'}, set())
+        self.assertEqual(snapshot.facts(None, *host)['fqdn'],
+                         'h1.example.com')
+
+    def test_private_cache(self):
+        snapshot = FactsSnapshot()
+        host = snapshot.find(self.db, {'10.0.0.1'}, set())
+        self.assertIsNone(cache.get(WATERMARK_KEY))
+        with mock.patch.object(self.db, 'execute',
+                               wraps=self.db.execute) as execute:
+            self.assertEqual(snapshot.facts(self.db, *host),
+                             {'virtual': 'physical', 'fqdn': 'h1.local'})
+            self.assertEqual(snapshot.facts(self.db, *host)['fqdn'],
+                             'h1.local')
+        self.assertEqual(execute.call_count, 1)
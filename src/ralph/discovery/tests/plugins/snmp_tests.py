@@ -5,11 +5,13 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from django.core.cache import cache
 from django.test import TestCase
 import mock
 
 from ralph.discovery.plugins import snmp
 from ralph.discovery.models import DeviceType, IPAddress
+from ralph.discovery.snmp import snmp_probe, remembered_credentials
 
 
 class SnmpPluginTest(TestCase):
@@ -37,6 +39,15 @@ class SnmpPluginTest(TestCase):
         self.assertEqual(is_up, False)
 
 
+    def test_port_closed(self):
+        with mock.patch('ralph.discovery.plugins.snmp.check_snmp_port',
+                        return_value=False), \
+                mock.patch('ralph.discovery.plugins.snmp.snmp_probe') as probe:
+            is_up, message, kwargs = snmp.snmp(ip='127.0.0.1')
+        self.assertEqual((is_up, message), (False, 'port closed.'))
+        self.assertFalse(probe.called)
+
+
 class SnmpMacPluginTest(TestCase):
     def setUp(self):
         ip = IPAddress(address='127.0.0.1')
@@ -157,12 +168,19 @@ class SnmpMacPluginTest(TestCase):
                     6: set([u'001E670C5960', u'001E670C5961'])
                 }[oid[-1]]
             return ['001E6712C2E6', '001E6712C2E7']
-        with mock.patch('ralph.discovery.plugins.snmp.snmp_macs') as snmp_macs:
+        def macs_many_side(requests, *args, **kwargs):
+            return [macs_side(*request[:3]) for request in requests]
+        with mock.patch('ralph.discovery.plugins.snmp.snmp_macs') as snmp_macs, \
+                mock.patch('ralph.discovery.plugins.snmp.snmp_macs_many') as snmp_macs_many:
             snmp_macs.side_effect = macs_side
+            snmp_macs_many.side_effect = macs_many_side
             with mock.patch('ralph.discovery.plugins.snmp.snmp_command') as snmp_command:
                 snmp_command.return_value = [[None, 6]]
                 snmp.do_snmp_mac(self.ip.snmp_name, self.ip.snmp_community,
                              self.ip.snmp_version, self.ip.address, self.kwargs)
+        # the blades are walked in a single batch
+        self.assertEqual(snmp_macs_many.call_count, 1)
+        self.assertEqual(len(snmp_macs_many.call_args[0][0]), 6)
         self.maxDiff = None
         ip = IPAddress.objects.get(address=self.ip.address)
         dev = ip.device
@@ -179,3 +197,47 @@ class SnmpMacPluginTest(TestCase):
             [u'001E670C5960', u'001E670C5961']
         ])
 
+
+
+class SnmpProbeTest(TestCase):
+    def setUp(self):
+        self.answers = {
+            ('10.0.0.1', 'private', '2c'): 'Linux a',
+            ('10.0.0.1', 'public', '1'): 'Linux a, version 1',
+            ('10.0.0.2', 'public', '2c'): 'Linux b',
+            ('10.0.0.2', 'private', '2c'): '',
+        }
+        self.batches = []
+
+    def tearDown(self):
+        cache.clear()
+
+    def get(self, requests):
+        self.batches.append(requests)
+        results = []
+        for host, community, oid, version in requests:
+            answer = self.answers.get((host, community, version))
+            results.append(None if answer is None else [[None, answer]])
+        return results
+
+    def test_probe(self):
+        credentials = [('public', '2c'), ('private', '2c'), ('public', '1')]
+        hosts = ['10.0.0.1', '10.0.0.2', '10.0.0.3']
+        with mock.patch('ralph.discovery.snmp.SnmpProber') as prober:
+            prober.return_value.get.side_effect = self.get
+            found = snmp_probe(hosts, credentials, (1,3,6,1,2,1,1,1,0))
+        self.assertEqual(found, {
+            '10.0.0.1': ('private', '2c', 'Linux a'),
+            '10.0.0.2': ('public', '2c', 'Linux b'),
+        })
+        self.assertEqual(len(self.batches[1]), 9)
+        self.assertEqual(remembered_credentials('10.0.0.1'),
+                         ('private', '2c'))
+        self.batches = []
+        with mock.patch('ralph.discovery.snmp.SnmpProber') as prober:
+            prober.return_value.get.side_effect = self.get
+            found = snmp_probe(hosts, credentials, (1,3,6,1,2,1,1,1,0))
+        self.assertEqual(found['10.0.0.1'], ('private', '2c', 'Linux a'))
+        self.assertEqual([r[:2] for r in self.batches[0]],
+                         [('10.0.0.1', 'private'), ('10.0.0.2', 'public')])
+        self.assertEqual([r[0] for r in self.batches[1]], ['10.0.0.3'] * 3)
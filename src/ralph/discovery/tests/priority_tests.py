@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from datetime import datetime, timedelta
+
+from django.test import TestCase
+from ipaddr import IPNetwork
+
+from ralph.discovery.models import (Device, DeviceType, HistoryChange,
+                                    IPAddress)
+from ralph.discovery.models_history import DiscoveryWarning
+from ralph.discovery.priority import is_due, postponed, scan_interval
+
+
+class PriorityTest(TestCase):
+    def test_scan_interval(self):
+        now = datetime(2013, 1, 1)
+        days = lambda n: now - timedelta(days=n)
+        self.assertEqual(scan_interval(now, days(1), now), 1)
+        self.assertEqual(scan_interval(now, days(365), days(365),
+                                       warned=True), 1)
+        self.assertEqual(scan_interval(now, days(365), now,
+                                       last_change=days(2)), 1)
+        self.assertEqual(scan_interval(now, days(30), now), 4)
+        self.assertEqual(scan_interval(now, days(30), days(10)), 8)
+        self.assertEqual(scan_interval(now, days(30), days(10), now), 4)
+        self.assertEqual(scan_interval(now, days(365), days(365)), 32)
+        self.assertTrue(all(is_due(3, 8, day)
+                            for day in xrange(1, 100) if is_due(3, 16, day)))
+
+    def test_postponed(self):
+        now = datetime.now()
+        while any(is_due(number, 32, now.toordinal())
+                  for number in (167772162, 167772164)):
+            now += timedelta(days=1)
+        old = now - timedelta(days=365)
+        dev = Device.create(sn='sn-priority', model_name='server',
+                            model_type=DeviceType.rack_server)
+        for i in xrange(1, 5):
+            IPAddress(address='10.0.0.%d' % i, hostname='host%d' % i,
+                      device=dev if i == 4 else None).save()
+        IPAddress.objects.exclude(address='10.0.0.1').update(
+            created=old, last_seen=old)
+        HistoryChange.objects.all().delete()
+        DiscoveryWarning(ip='10.0.0.3', plugin='ping').save()
+        self.assertEqual(postponed(IPNetwork('10.0.0.0/24'), now),
+                         {'10.0.0.2', '10.0.0.4'})
+        HistoryChange(device=dev, field_name='name', date=now).save()
+        self.assertEqual(postponed(IPNetwork('10.0.0.0/24'), now),
+                         {'10.0.0.2'})
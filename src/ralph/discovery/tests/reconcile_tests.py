@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import time
+
+import mock
+from django.db import transaction
+from django.db.models import F
+from django.test import TestCase, TransactionTestCase
+
+from ralph.discovery.models import (ComponentModel, ComponentType, Device,
+                                    DeviceModel, DeviceType, Memory, Storage)
+from ralph.discovery.models_history import HistoryChange
+from ralph.discovery.reconcile import get_models, reconcile, update
+
+
+class ReconcileTest(TestCase):
+    def setUp(self):
+        self.dev = Device.create(sn='sn-reconcile', model_name='server',
+                                 model_type=DeviceType.rack_server)
+
+    def _memory_rows(self, sizes):
+        lookups = [dict(size=size, speed=0, type=ComponentType.memory.id,
+                        family='', extra_hash='') for size in sizes]
+        return [{'index': i + 1, 'label': 'DIMM %d' % (i + 1), 'size': size,
+                 'model': model}
+                for i, (size, (model, c)) in enumerate(
+                    zip(sizes, get_models(lookups)))]
+
+    def test_get_models(self):
+        existing = ComponentModel.concurrent_get_or_create(
+            size=1024, speed=0, type=ComponentType.memory.id, family='',
+            extra_hash='')[0]
+        lookups = [dict(size=size, type=ComponentType.memory.id)
+                   for size in (1024, 2048, 2048)]
+        with self.assertNumQueries(1):
+            get_models(lookups[:1])
+        models = get_models(lookups)
+        self.assertEqual(models[0], (existing, False))
+        self.assertTrue(models[1][1])
+        self.assertEqual(models[2], (models[1][0], False))
+
+    def test_reconcile(self):
+        changes = reconcile(self.dev, Memory, ('index',),
+                            self._memory_rows([1024, 2048, 2048]))
+        self.assertEqual([len(c) for c in changes], [3, 0, 0])
+        rows = self._memory_rows([1024, 2048, 2048])
+        history = HistoryChange.objects.count()
+        changes = reconcile(self.dev, Memory, ('index',), rows)
+        self.assertEqual([len(c) for c in changes], [0, 0, 0])
+        self.assertEqual(HistoryChange.objects.count(), history)
+        changes = reconcile(self.dev, Memory, ('index',),
+                            self._memory_rows([1024, 4096]))
+        self.assertEqual([len(c) for c in changes], [0, 1, 1])
+        self.assertEqual(
+            [(m.index, m.size, m.model.size)
+             for m in self.dev.memory_set.order_by('index')],
+            [(1, 1024, 1024), (2, 4096, 4096)],
+        )
+
+    def test_search_index_once(self):
+        rows = self._memory_rows([1024, 2048, 4096])
+        with mock.patch('ralph.discovery.models_search.'
+                        'update_search_index_bulk') as update_bulk:
+            reconcile(self.dev, Memory, ('index',), rows)
+        update_bulk.assert_called_once_with({self.dev.id})
+
+    def test_prune_and_initial(self):
+        Storage(device=self.dev, sn='kept', label='other plugin').save()
+        rows = [{'sn': 'new', 'label': 'Disk', 'mount_point': '/dev/sda'}]
+        reconcile(self.dev, Storage, ('sn',), rows, initial=('label',),
+                  prune=lambda stor: stor.mount_point is not None)
+        rows[0]['label'] = 'Renamed'
+        reconcile(self.dev, Storage, ('sn',), rows, initial=('label',),
+                  prune=lambda stor: stor.mount_point is not None)
+        self.assertEqual(
+            sorted(self.dev.storage_set.values_list('sn', 'label')),
+            [('kept', 'other plugin'), ('new', 'Disk')],
+        )
+
+
+class IdentityMapTest(TransactionTestCase):
+    def tearDown(self):
+        # the tables are flushed without any signals
+        ComponentModel.identity_map.clear()
+        DeviceModel.identity_map.clear()
+
+    def test_component_models(self):
+        lookup = dict(size=1024, speed=0, type=ComponentType.memory.id,
+                      family='', extra_hash='')
+        model, created = ComponentModel.concurrent_get_or_create(**lookup)
+        self.assertTrue(created)
+        with self.assertNumQueries(0):
+            cached, created = ComponentModel.concurrent_get_or_create(
+                **lookup)
+            self.assertEqual(get_models([lookup]), [(model, False)])
+        self.assertFalse(created)
+        self.assertEqual(cached, model)
+        self.assertIsNot(cached, model)
+        self.assertTrue(update(cached, name='RAM 1024MiB'))
+        cached = ComponentModel.concurrent_get_or_create(**lookup)[0]
+        self.assertEqual(cached.name, 'RAM 1024MiB')
+        with self.assertNumQueries(0):
+            cached = ComponentModel.concurrent_get_or_create(**lookup)[0]
+            self.assertFalse(update(cached, name='RAM 1024MiB'))
+        # another process changes it, without the signals of this one
+        ComponentModel.objects.filter(pk=model.pk).update(
+            cache_version=F('cache_version') + 1)
+        with mock.patch('time.time', return_value=time.time() + 60):
+            self.assertNotEqual(ComponentModel.identity_map.get(**lookup),
+                                model)
+
+    def test_rolled_back(self):
+        lookup = dict(size=2048, type=ComponentType.memory.id)
+        with self.assertRaises(ValueError):
+            with transaction.commit_on_success():
+                Device.create(sn='sn-rolled-back', model_name='server',
+                              model_type=DeviceType.rack_server)
+                ComponentModel.concurrent_get_or_create(**lookup)
+                raise ValueError()
+        self.assertTrue(ComponentModel.concurrent_get_or_create(**lookup)[1])
+
+    def test_device_models(self):
+        model = DeviceModel.concurrent_get_or_create(
+            name='server', type=DeviceType.rack_server.id)[0]
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                DeviceModel.concurrent_get_or_create(
+                    name='server', type=DeviceType.rack_server.id),
+                (model, False),
+            )
+        self.assertIsNone(DeviceModel.identity_map.get(
+            name='server', type=DeviceType.blade_server.id))
+        model.delete()
+        self.assertIsNone(DeviceModel.identity_map.get(name='server'))
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from django.test import TestCase
+from powerdns.models import Domain, Record
+
+from ralph.discovery.models import (ComponentModel, ComponentType, Device,
+                                    DeviceSearch, DeviceType, IPAddress,
+                                    Memory)
+from ralph.discovery.models_search import search_index_batch
+
+
+class SearchIndexTest(TestCase):
+    def setUp(self):
+        self.dev = Device.create(sn='sn-search', model_name='server',
+                                 model_type=DeviceType.rack_server)
+        self.dev.name = 'search.example.com'
+        self.dev.save()
+
+    def document(self):
+        return DeviceSearch.objects.get(device=self.dev)
+
+    def test_components(self):
+        self.assertEqual(self.document().serial, 'sn-search')
+        model, created = ComponentModel.concurrent_get_or_create(
+            size=1024, type=ComponentType.memory.id, family='')
+        model.name = 'RAM 1024MiB'
+        model.save()
+        memory = Memory(device=self.dev, model=model, label='DIMM 1')
+        with search_index_batch():
+            memory.save()
+            self.assertEqual(self.document().component, '')
+        self.assertEqual(self.document().component, 'DIMM 1\nRAM 1024MiB')
+        model.name = 'RAM 1GiB'
+        model.save()
+        self.assertEqual(self.document().component, 'DIMM 1\nRAM 1GiB')
+        memory.delete()
+        self.assertEqual(self.document().component, '')
+
+    def test_names(self):
+        ip = IPAddress(address='10.0.0.1', hostname='search.example.com',
+                       device=self.dev)
+        ip.save()
+        self.assertEqual(self.document().address, '10.0.0.1')
+        domain = Domain(name='example.com')
+        domain.save()
+        Record(domain=domain, type='CNAME', name='alias.example.com',
+               content='search.example.com').save()
+        self.assertEqual(self.document().name,
+                         'alias.example.com\nsearch.example.com')
+        ip.device = None
+        ip.save()
+        self.assertEqual(self.document().address, '')
+
+    def test_record_moved(self):
+        IPAddress(address='10.0.0.1', hostname='search.example.com',
+                  device=self.dev).save()
+        domain = Domain(name='example.com')
+        domain.save()
+        record = Record(domain=domain, type='CNAME', name='alias.example.com',
+                        content='search.example.com')
+        record.save()
+        self.assertIn('alias.example.com', self.document().name)
+        record.content = 'other.example.com'
+        record.save()
+        self.assertEqual(self.document().name, 'search.example.com')
+
+    def test_deleted(self):
+        IPAddress(address='10.0.0.1', device=self.dev,
+                  hostname='search.example.com').save()
+        DeviceSearch.objects.all().delete()
+        self.dev.delete()
+        self.assertFalse(Device.admin_objects.filter(id=self.dev.id).exists())
+        self.assertFalse(DeviceSearch.objects.exists())
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import socket
+import threading
+import time
+
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+from ipaddr import IPv4Network
+import mock
+
+from ralph.discovery import tasks
+from ralph.discovery.tasks import run_plugins_parallel
+from ralph.util import plugin
+
+
+CHAIN = 'tasks_tests'
+
+
+@plugin.register(chain=CHAIN, priority=200)
+def first(**kwargs):
+    kwargs['x'] = 'first'
+    return True, 'first', kwargs
+
+
+@plugin.register(chain=CHAIN, priority=100)
+def second(**kwargs):
+    kwargs['x'] = 'second'
+    kwargs['y'] = 'second'
+    return True, 'second', kwargs
+
+
+@plugin.register(chain=CHAIN, priority=150)
+def unchanged(**kwargs):
+    return True, 'unchanged', kwargs
+
+
+@plugin.register(chain=CHAIN, priority=100)
+def down(**kwargs):
+    return False, 'down', kwargs
+
+
+@plugin.register(chain=CHAIN, priority=100)
+def slow(**kwargs):
+    time.sleep(1)
+    return True, 'slow', kwargs
+
+
+@plugin.register(chain=CHAIN, requires=['first', 'second'])
+def joined(**kwargs):
+    kwargs['z'] = kwargs['x']
+    return True, 'joined', kwargs
+
+
+@plugin.register(chain=CHAIN, requires=['down'])
+def never(**kwargs):
+    kwargs['never'] = True
+    return True, 'never', kwargs
+
+
+QUERIES_CHAIN = 'tasks_tests_queries'
+_queries = []
+
+
+def _query(name):
+    with transaction.commit_on_success():
+        connection.cursor().execute('SELECT 1')
+        _queries.append((name, 'start'))
+        time.sleep(0.05)
+        _queries.append((name, 'end'))
+
+
+@plugin.register(chain=QUERIES_CHAIN)
+def query_one(**kwargs):
+    _query('one')
+    return True, 'one', kwargs
+
+
+@plugin.register(chain=QUERIES_CHAIN)
+def query_two(**kwargs):
+    _query('two')
+    return True, 'two', kwargs
+
+
+@plugin.register(chain=QUERIES_CHAIN)
+def query_late(**kwargs):
+    time.sleep(1)
+    try:
+        connection.cursor()
+    except tasks.PluginAbandoned:
+        _queries.append(('late', 'abandoned'))
+    return True, 'late', kwargs
+
+
+READS_CHAIN = 'tasks_tests_reads'
+_reads = []
+
+
+def _read(name):
+    connection.cursor().execute('SELECT 1')
+    _reads.append((name, 'read'))
+    time.sleep(0.1)
+    _reads.append((name, 'done'))
+
+
+@plugin.register(chain=READS_CHAIN)
+def read_one(**kwargs):
+    _read('one')
+    return True, 'one', kwargs
+
+
+@plugin.register(chain=READS_CHAIN)
+def read_two(**kwargs):
+    _read('two')
+    return True, 'two', kwargs
+
+
+QUEUE_CHAIN = 'tasks_tests_queue'
+
+
+@plugin.register(chain=QUEUE_CHAIN, priority=200)
+def blocking(**kwargs):
+    time.sleep(1)
+    return True, 'blocking', kwargs
+
+
+@plugin.register(chain=QUEUE_CHAIN, priority=100)
+def queued(**kwargs):
+    return True, 'queued', kwargs
+
+
+class ParallelPluginsTest(TransactionTestCase):
+    # the transactions of the plugins must not be disabled by the test
+    def test_parallel_waves(self):
+        messages = []
+        def out(*args, **kwargs):
+            messages.append(''.join(args))
+        context = {'ip': '127.0.0.1', 'x': 'initial'}
+        requirements = set()
+        done_requirements = set()
+        run_plugins_parallel(context, CHAIN, requirements,
+                             done_requirements=done_requirements,
+                             outputs=(out, out, out), threads=4, timeout=0.2)
+        self.assertEqual(requirements, {'first', 'second', 'unchanged',
+                                        'joined'})
+        self.assertEqual(done_requirements, {'first', 'second', 'unchanged',
+                                             'down', 'slow', 'joined'})
+        # changes are applied in priority order, as if run one by one
+        self.assertEqual(context['x'], 'second')
+        self.assertEqual(context['y'], 'second')
+        self.assertEqual(context['z'], 'second')
+        self.assertNotIn('never', context)
+        self.assertTrue(any('timed out' in m for m in messages))
+        self.assertEqual(plugin.ready(CHAIN, requirements, done_requirements),
+                         [])
+
+    def test_serialized_queries(self):
+        del _queries[:]
+        threads = threading.active_count()
+        requirements = set()
+        started = time.time()
+        run_plugins_parallel({'ip': '127.0.0.1'}, QUERIES_CHAIN, requirements,
+                             outputs=(lambda *args, **kwargs: None,) * 3,
+                             threads=3, timeout=0.3)
+        # the wave did not wait for the plugin still running
+        self.assertLess(time.time() - started, 0.9)
+        self.assertEqual(requirements, {'query_one', 'query_two'})
+        time.sleep(1.2)
+        # the plugins never queried the database at the same time, and the
+        # abandoned plugin could not query it afterwards
+        self.assertIn(_queries[:4], (
+            [('one', 'start'), ('one', 'end'), ('two', 'start'),
+             ('two', 'end')],
+            [('two', 'start'), ('two', 'end'), ('one', 'start'),
+             ('one', 'end')],
+        ))
+        self.assertEqual(_queries[4:], [('late', 'abandoned')])
+        # the threads of the pool are all gone
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_reads_outside_transactions(self):
+        del _reads[:]
+        run_plugins_parallel({'ip': '127.0.0.1'}, READS_CHAIN, set(),
+                             outputs=(lambda *args, **kwargs: None,) * 3,
+                             threads=2, timeout=1)
+        # a plugin doesn't keep the lock after a read
+        self.assertEqual([event for name, event in _reads[:2]],
+                         ['read', 'read'])
+
+    def test_queued_plugins_time_out(self):
+        messages = []
+        def out(*args, **kwargs):
+            messages.append(''.join(args))
+        started = time.time()
+        run_plugins_parallel({'ip': '127.0.0.1'}, QUEUE_CHAIN, set(),
+                             outputs=(out, out, out), threads=1, timeout=0.2)
+        # `queued` waited for the only thread until the wave was over
+        self.assertLess(time.time() - started, 0.9)
+        self.assertEqual(
+            len([m for m in messages if 'timed out' in m]), 2)
+
+    def test_schedule(self):
+        schedule = plugin.Schedule(CHAIN)
+        self.assertEqual(schedule.ready(),
+                         ['first', 'unchanged', 'down', 'second', 'slow'])
+        schedule.complete('first', True)
+        schedule.complete('down', False)
+        self.assertEqual(schedule.ready(),
+                         ['unchanged', 'second', 'slow'])
+        schedule.complete('second', True)
+        self.assertEqual(schedule.ready(), ['unchanged', 'joined', 'slow'])
+        self.assertEqual(plugin.next(CHAIN, ['first', 'second']),
+                         {'first', 'second', 'unchanged', 'down', 'slow',
+                          'joined'})
+        self.assertEqual(plugin.highest_priority(CHAIN, ['slow', 'down']),
+                         'down')
+
+
+class AliveHostsTest(TestCase):
+    def test_sweep(self):
+        with mock.patch.object(tasks, 'ping_sweep', return_value=iter([
+                ('10.0.0.2', 0.01)])) as ping_sweep:
+            self.assertEqual(
+                list(tasks._alive_hosts(['10.0.0.1', '10.0.0.2'], None)),
+                ['10.0.0.2'])
+        ping_sweep.assert_called_once_with(['10.0.0.1', '10.0.0.2'])
+
+    def test_ipv6_passed_through(self):
+        with mock.patch.object(tasks, 'ping_sweep',
+                               return_value=iter([])) as ping_sweep:
+            self.assertEqual(
+                list(tasks._alive_hosts(['10.0.0.1', '2001:db8::1'], None)),
+                ['2001:db8::1'])
+        ping_sweep.assert_called_once_with(['10.0.0.1'])
+
+    def test_fallback(self):
+        messages = []
+        def out(*args, **kwargs):
+            messages.append(''.join(args))
+        with mock.patch.object(tasks, 'ping_sweep',
+                               side_effect=socket.error('not permitted')):
+            self.assertEqual(
+                list(tasks._alive_hosts(['10.0.0.1', '10.0.0.2'], out)),
+                ['10.0.0.1', '10.0.0.2'])
+        self.assertTrue(any('not permitted' in m for m in messages))
+
+    def test_network_sweep(self):
+        network = IPv4Network('10.0.0.0/30')
+        with mock.patch.object(tasks, 'sanity_check'):
+            with mock.patch.object(tasks, 'discover_single') as discover:
+                with mock.patch.object(tasks, '_alive_hosts',
+                                       return_value=[]) as alive:
+                    tasks.discover_network(network, prioritize=False)
+                    self.assertEqual(alive.call_count, 1)
+                    self.assertFalse(discover.delay.called)
+                    # the hosts blocking ICMP are not skipped by the other
+                    # plugins
+                    tasks.discover_network(network, plugin_name='snmp',
+                                           prioritize=False)
+                    self.assertEqual(alive.call_count, 1)
+                    self.assertEqual(discover.delay.call_count, 2)
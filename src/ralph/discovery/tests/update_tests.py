@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+
+import mock
+from django.test import TestCase
+
+from ralph.discovery import tasks
+from ralph.discovery.models import (DataCenter, DiscoveryQueue, IPAddress,
+                                    Network, UpdateRun, UpdateUnit)
+
+
+def _quiet(*args, **kwargs):
+    pass
+
+
+class UpdateSchedulerTest(TestCase):
+    def setUp(self):
+        dc = DataCenter(name='dc')
+        dc.save()
+        queue = DiscoveryQueue(name='dc')
+        queue.save()
+        self.net = Network(name='net', address='10.0.0.0/24',
+                           data_center=dc, queue=queue)
+        self.net.save()
+        for i in xrange(1, 6):
+            IPAddress(address='10.0.0.%d' % i, hostname='host%d' % i).save()
+        IPAddress(address='10.0.1.1', hostname='outside').save()
+
+    def test_units(self):
+        run = UpdateRun.create([self.net], 2)
+        self.assertEqual(
+            list(run.updateunit_set.values_list('address_count', flat=True)),
+            [2, 2, 1],
+        )
+        unit = UpdateUnit.claim(run, 'dc')
+        self.assertEqual(unit.addresses(), ['10.0.0.1', '10.0.0.2'])
+        self.assertEqual(UpdateUnit.claim(run, 'dc').min_number,
+                         167772163)
+        self.assertIsNone(UpdateUnit.claim(run, 'other'))
+        self.assertEqual(run.progress(), (0, 5, None))
+
+    def test_resume(self):
+        run = UpdateRun.create([self.net], 2)
+        seen = []
+
+        def discover_single(context, **kwargs):
+            seen.append(context['ip'])
+            tasks._record_latency('ping', 0.5)
+
+        outputs = (_quiet, _quiet, _quiet)
+        with mock.patch('ralph.discovery.tasks.discover_single',
+                        discover_single), \
+                mock.patch('ralph.discovery.tasks.sanity_check'), \
+                mock.patch('ralph.discovery.tasks._alive_hosts',
+                           lambda hosts, stderr: hosts):
+            tasks.update_unit(UpdateUnit.claim(run, 'dc').id, 'dc',
+                              interactive=True, outputs=outputs)
+            # the worker running the second unit dies
+            UpdateUnit.claim(run, 'dc')
+            self.assertEqual(run.progress(), (2, 5, 1.5))
+            self.assertEqual(run.latencies(), {'ping': [2, 1.0]})
+            tasks.run_update(run, interactive=True, outputs=outputs)
+        self.assertEqual(seen, ['10.0.0.%d' % i for i in xrange(1, 6)])
+        self.assertEqual(run.progress(), (5, 5, 0))
+        self.assertIsNotNone(UpdateRun.objects.get(id=run.id).finished)
+
+    def test_failed_unit(self):
+        run = UpdateRun.create([self.net], 2)
+        seen = []
+        crashing = ['10.0.0.2']
+
+        def discover_single(context, **kwargs):
+            seen.append(context['ip'])
+            if context['ip'] in crashing:
+                crashing.remove(context['ip'])
+                raise RuntimeError('plugin crashed')
+
+        outputs = (_quiet, _quiet, _quiet)
+        with mock.patch('ralph.discovery.tasks.discover_single',
+                        discover_single), \
+                mock.patch('ralph.discovery.tasks.sanity_check'), \
+                mock.patch('ralph.discovery.tasks._alive_hosts',
+                           lambda hosts, stderr: hosts):
+            with self.assertRaises(RuntimeError):
+                tasks.run_update(run, interactive=True, outputs=outputs)
+            failed = run.updateunit_set.get(min_number=167772161)
+            self.assertIsNone(failed.finished)
+            self.assertIn('plugin crashed', failed.error)
+            self.assertEqual(failed.last_number, 167772161)
+            # the resumed run continues with the failed host
+            del seen[:]
+            tasks.run_update(run, interactive=True, outputs=outputs)
+        self.assertEqual(seen, ['10.0.0.%d' % i for i in xrange(2, 6)])
+
+    def test_remote_unit(self):
+        run = UpdateRun.create([self.net], 2)
+
+        def discover_single(context, **kwargs):
+            if context['ip'] == '10.0.0.1':
+                raise RuntimeError('plugin crashed')
+            tasks._record_latency('ping', 0.5)
+
+        with mock.patch('ralph.discovery.tasks.discover_single',
+                        discover_single), \
+                mock.patch('ralph.discovery.tasks._alive_hosts',
+                           lambda hosts, stderr: reversed(hosts)), \
+                mock.patch.object(tasks.update_host, 'delay') as host_delay, \
+                mock.patch.object(tasks.update_unit, 'delay') as unit_delay:
+            unit = UpdateUnit.claim(run, 'dc')
+            tasks.update_unit(unit.id, 'dc', outputs=(_quiet, _quiet, _quiet))
+            # all the hosts of the unit are queued at once
+            self.assertEqual(host_delay.call_args_list, [
+                mock.call(unit.id, '10.0.0.1', 'dc'),
+                mock.call(unit.id, '10.0.0.2', 'dc'),
+            ])
+            self.assertEqual(UpdateUnit.objects.get(id=unit.id).pending, 2)
+            tasks.update_host(unit.id, '10.0.0.2', 'dc')
+            self.assertFalse(unit_delay.called)
+            with self.assertRaises(RuntimeError):
+                tasks.update_host(unit.id, '10.0.0.1', 'dc')
+        failed = UpdateUnit.objects.get(id=unit.id)
+        self.assertIsNone(failed.finished)
+        self.assertIn('plugin crashed', failed.error)
+        self.assertEqual(json.loads(failed.plugin_times), {'ping': [1, 0.5]})
+        # the slot of the queue is passed on to the next unit
+        next_unit = run.updateunit_set.get(min_number=167772163)
+        self.assertIsNotNone(next_unit.started)
+        unit_delay.assert_called_once_with(next_unit.id, 'dc')
@@ -5,9 +5,12 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import mock
+import socket
 import StringIO
 
+import mock
+import paramiko
+
 
 class MockSSH(object):
     """Utility for mocking the SSHClient objects."""
@@ -27,6 +30,9 @@ class MockSSH(object):
             raise self.Error("Expected command %r but got %r" % (cmd, command))
         return None, StringIO.StringIO(data), None
 
+    def exec_commands(self, commands):
+        return [self.exec_command(command)[1].read() for command in commands]
+
     def ssg_command(self, command):
         stdin, stdout, stderr = self.exec_command(command)
         return stdout.readlines()
@@ -34,3 +40,106 @@ class MockSSH(object):
     def __getattr__(self, name):
         return mock.Mock()
 
+
+class FakeShellDevice(object):
+    """A device with an interactive console for testing the plugins that
+    talk to it through `network.Shell`.
+
+    `commands` maps the commands to their outputs. Every channel echoes what
+    it gets, prints `prompt` after every command and sends its output in
+    chunks of `chunk_size` bytes. With `page_size`, the output is paged and
+    the rest of it waits after `pager` until a key is pressed. At most
+    `max_channels` channels can be opened at once. The commands run are
+    logged in `log`, with the numbers of their channels."""
+
+    def __init__(self, prompt, commands, banner=b'', chunk_size=7,
+                 page_size=None, pager=b'--- more --- ', max_channels=8):
+        self.prompt = prompt
+        self.commands = commands
+        self.banner = banner
+        self.chunk_size = chunk_size
+        self.page_size = page_size
+        self.pager = pager
+        self.max_channels = max_channels
+        self.channels = []
+        self.log = []
+
+    def get_transport(self):
+        return self
+
+    def open_session(self):
+        if len([c for c in self.channels if not c.closed]) >= self.max_channels:
+            raise paramiko.ChannelException(1, 'Administratively prohibited')
+        channel = FakeShellChannel(self, len(self.channels))
+        self.channels.append(channel)
+        return channel
+
+    def close(self):
+        pass
+
+
+class FakeShellChannel(object):
+    def __init__(self, device, number):
+        self.device = device
+        self.number = number
+        self.output = b''
+        self.held = []
+        self.line = b''
+        self.last = b''
+        self.closed = False
+
+    def settimeout(self, timeout):
+        pass
+
+    def get_pty(self):
+        pass
+
+    def invoke_shell(self):
+        self.output += self.device.banner + self.device.prompt
+
+    def _run(self, command):
+        self.device.log.append((self.number, command))
+        if command not in self.device.commands:
+            text = b'% Invalid input\n' if command.strip() else b''
+        else:
+            text = self.device.commands[command]
+        text = text.replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+        lines = text.splitlines(True)
+        size = self.device.page_size or len(lines) or 1
+        pages = [b''.join(lines[start:start + size])
+                 for start in xrange(0, len(lines), size)] or [b'']
+        pages[-1] += self.device.prompt
+        self.output += b'\r\n' + pages[0]
+        self.held = pages[1:]
+        if self.held:
+            self.output += self.device.pager
+
+    def sendall(self, data):
+        for char in data:
+            last, self.last = self.last, char
+            if char == b'\n' and last == b'\r':
+                continue
+            if self.held:
+                # any key shows the next page
+                self.output += self.held.pop(0)
+                if self.held:
+                    self.output += self.device.pager
+            elif char in b'\r\n':
+                command, self.line = self.line, b''
+                self._run(command)
+            elif char == b'\b':
+                self.line = self.line[:-1]
+                self.output += b'\b \b'
+            else:
+                self.line += char
+                self.output += char
+
+    def recv(self, size):
+        if not self.output:
+            raise socket.timeout()
+        chunk = self.output[:min(size, self.device.chunk_size)]
+        self.output = self.output[len(chunk):]
+        return chunk
+
+    def close(self):
+        self.closed = True
@@ -13,7 +13,7 @@ from powerdns.models import Record
 from django.db.models.signals import post_save, pre_delete
 from django.dispatch import receiver
 
-from ralph.discovery.history import field_changes
+from ralph.discovery.history import field_changes, record
 
 
 class DHCPEntry(TimeTrackable):
@@ -54,20 +54,22 @@ class DNSHistory(db.Model):
 def record_post_save(sender, instance, raw, using, **kwargs):
     for field, orig, new in field_changes(instance, ignore={
         'last_seen', 'change_date', 'id'}):
-        DNSHistory(
+        record(
+            DNSHistory,
             record_name=instance.name,
             record_type=instance.type,
             field_name=field,
-            old_value=unicode(orig),
-            new_value=unicode(new),
+            old_value=orig,
+            new_value=new,
             user=getattr(instance, 'saving_user', None),
             device=getattr(instance, 'saving_device', None),
-        ).save()
+        )
 
 
 @receiver(pre_delete, sender=Record, dispatch_uid='ralph.history.dns')
 def record_pre_delete(sender, instance, using, **kwargs):
-    DNSHistory(
+    record(
+        DNSHistory,
         record_name=instance.name,
         record_type=instance.type,
         field_name='deleted',
@@ -75,5 +77,5 @@ def record_pre_delete(sender, instance, using, **kwargs):
         new_value='',
         user=getattr(instance, 'saving_user', None),
         device=getattr(instance, 'saving_device', None),
-    ).save()
+    )
 
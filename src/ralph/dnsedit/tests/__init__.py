@@ -1 +1,2 @@
 from ralph.dnsedit.tests.dns_history_tests import DNSHistoryTest
+from ralph.dnsedit.tests.txt_records_tests import TxtRecordsTest
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from django.test import TestCase
+from powerdns.models import Record, Domain
+
+from ralph.business.models import Venture
+from ralph.discovery.models import Device, DeviceType, IPAddress
+from ralph.dnsedit.util import txt_records_batch, update_txt_records
+
+
+class TxtRecordsTest(TestCase):
+    def setUp(self):
+        self.domain = Domain(name='example.com')
+        self.domain.save()
+        self.venture = Venture(name='Venture', symbol='venture')
+        self.venture.save()
+        self.devices = []
+        for i in (1, 2):
+            name = 'host%d.example.com' % i
+            address = '127.0.0.%d' % i
+            Record(name=name, type='A', content=address,
+                   domain=self.domain).save()
+            Record(name='%d.0.0.127.in-addr.arpa' % i, type='PTR',
+                   content=name, domain=self.domain).save()
+            dev = Device.create(sn='sn%d' % i, model_name='xxx',
+                                model_type=DeviceType.rack_server)
+            dev.name = name
+            dev.save()
+            IPAddress(address=address, hostname=name, device=dev).save()
+            self.devices.append(dev)
+
+    def txt_records(self):
+        return dict(
+            ((r.name, r.content.split(': ', 1)[0]), r.content)
+            for r in Record.objects.filter(type='TXT')
+        )
+
+    def test_batch(self):
+        before = self.txt_records()
+        with txt_records_batch():
+            for dev in self.devices:
+                dev.venture = self.venture
+                dev.save()
+                update_txt_records(dev)
+            self.assertEqual(self.txt_records(), before)
+        records = self.txt_records()
+        self.assertEqual(records['host1.example.com', 'VENTURE'],
+                         'VENTURE: Venture')
+        self.assertEqual(records['host2.example.com', 'VENTURE'],
+                         'VENTURE: Venture')
+        self.assertEqual(records['host2.example.com', 'LOCATION'],
+                         'LOCATION: host2.example.com')
+        self.assertEqual(Record.objects.filter(type='TXT').count(), 8)
+        update_txt_records(self.devices[0])
+        self.assertEqual(Record.objects.filter(type='TXT').count(), 8)
@@ -7,6 +7,8 @@ from __future__ import unicode_literals
 
 import re
 import datetime
+import threading
+from contextlib import contextmanager
 
 from django.template import loader, Context
 from powerdns.models import Domain, Record
@@ -211,28 +213,112 @@ def get_model(device):
     return model
 
 
-@nested_commit_on_success
+_pending = threading.local()
+
+
+@contextmanager
+def txt_records_batch():
+    """
+    Defer all the ``update_txt_records`` calls made within the block. Every
+    device is updated only once, together with all the others, when the
+    outermost block ends.
+    """
+    outermost = getattr(_pending, 'devices', None) is None
+    if outermost:
+        _pending.devices = set()
+    try:
+        yield
+    finally:
+        if outermost:
+            device_ids = _pending.devices
+            _pending.devices = None
+            update_txt_records_bulk(device_ids)
+
+
 def update_txt_records(device):
-    """Update the TXT records for the given device."""
-    hostnames = set()
-    addresses = set()
-    for ipaddress in device.ipaddress_set.all():
-        if ipaddress.hostname:
-            hostnames.add(ipaddress.hostname)
-        addresses.add(ipaddress.address)
-    record_names = set()
-    for record in Record.objects.filter(
-        db.Q(name__in=hostnames) | db.Q(content__in=addresses),
-        type='A',
-    ):
-        if get_revdns_records(record.content).filter(content=record.name).exists():
-            # Only update those host names, that have both A and PTR records.
-            record_names.add(record.name)
-    for name in record_names:
-        set_txt_record(record.domain, name, 'VENTURE',
-               device.venture.name if device.venture else '')
-        set_txt_record(record.domain, name, 'ROLE',
-               device.venture_role.full_name if device.venture_role else '')
-        set_txt_record(record.domain, name, 'MODEL', get_model(device))
-        set_txt_record(record.domain, name, 'LOCATION', get_location(device))
+    """
+    Update the TXT records for the given device. Inside of
+    ``txt_records_batch`` the update is only queued.
+    """
+    device_id = getattr(device, 'id', device)
+    if device_id is None:
+        return
+    if getattr(_pending, 'devices', None) is not None:
+        _pending.devices.add(device_id)
+    else:
+        update_txt_records_bulk([device_id])
+
+
+def _txt_values(device):
+    return [
+        ('VENTURE', device.venture.name if device.venture else ''),
+        ('ROLE', device.venture_role.full_name if device.venture_role else ''),
+        ('MODEL', get_model(device)),
+        ('LOCATION', get_location(device)),
+    ]
+
 
+@nested_commit_on_success
+def update_txt_records_bulk(device_ids):
+    """
+    Update the TXT records for all the devices with the given ids. The A, PTR
+    and TXT records of all the devices are fetched at once and only the TXT
+    records whose content changed are saved.
+    """
+    from ralph.discovery.models import Device, IPAddress
+    device_ids = set(device_ids)
+    if not device_ids:
+        return
+    devices = Device.admin_objects.filter(id__in=device_ids).select_related(
+        'venture', 'venture_role', 'model', 'model__group')
+    devices = dict((device.id, device) for device in devices)
+    if not devices:
+        return
+    hostnames = {}
+    addresses = {}
+    for device_id, hostname, address in IPAddress.objects.filter(
+            device__in=devices.keys()).values_list(
+                'device', 'hostname', 'address'):
+        if hostname:
+            hostnames.setdefault(hostname, set()).add(device_id)
+        addresses.setdefault(address, set()).add(device_id)
+    if not addresses:
+        return
+    a_records = list(Record.objects.filter(
+        db.Q(name__in=hostnames.keys()) | db.Q(content__in=addresses.keys()),
+        type='A',
+    ))
+    revnames = set('.'.join(reversed(record.content.split('.'))) +
+                   '.in-addr.arpa' for record in a_records)
+    ptrs = set(Record.objects.filter(
+        name__in=revnames, type='PTR').values_list('name', 'content'))
+    # Only update those host names, that have both A and PTR records.
+    targets = {}
+    for record in a_records:
+        revname = '.'.join(reversed(record.content.split('.'))
+                           ) + '.in-addr.arpa'
+        if (revname, record.name) not in ptrs:
+            continue
+        for device_id in (hostnames.get(record.name, set()) |
+                          addresses.get(record.content, set())):
+            targets[record.name, record.domain_id] = devices[device_id]
+    if not targets:
+        return
+    existing = {}
+    for record in Record.objects.filter(
+            type='TXT', name__in=set(name for name, domain in targets)):
+        title = record.content.split(': ', 1)[0]
+        existing.setdefault((record.name, record.domain_id, title), record)
+    values = {}
+    for (name, domain_id), device in targets.iteritems():
+        if device.id not in values:
+            values[device.id] = _txt_values(device)
+        for title, value in values[device.id]:
+            content = '%s: %s' % (title, value)
+            record = existing.get((name, domain_id, title))
+            if record is None:
+                record = Record(name=name, type='TXT', domain_id=domain_id)
+            elif record.content == content:
+                continue
+            record.content = content
+            record.save()
@@ -163,6 +163,28 @@ SANITY_CHECK_IP2HOST_HOSTNAME_REGEX = r'.*google.*'
 
 SINGLE_DISCOVERY_TIMEOUT = 43200 # 12 hours
 NETWORK_TASK_DELEGATION_TIMEOUT = 7200 # 2 hours
+# plugins with satisfied requirements run in parallel threads within a single
+# discovery task; set to 1 to run one plugin per Celery task instead
+DISCOVERY_PLUGIN_THREADS = 8
+DISCOVERY_PLUGIN_TIMEOUT = 600 # 10 minutes
+# `manage.py update` splits the known addresses into units of this size and
+# runs at most this many units of every discovery queue at once, queueing
+# all the hosts of a unit together; a unit, and every host, is stopped after
+# the timeout
+DISCOVERY_UPDATE_UNIT_SIZE = 256
+DISCOVERY_UPDATE_CONCURRENCY = 4
+DISCOVERY_UPDATE_UNIT_TIMEOUT = 7200 # 2 hours
+# known addresses that did not appear, change or get warnings in the last
+# DISCOVERY_ACTIVE_DAYS days are scanned less and less often, down to once
+# every DISCOVERY_MAX_SCAN_INTERVAL days; set it to 1 to always scan them all
+DISCOVERY_ACTIVE_DAYS = 7
+DISCOVERY_MAX_SCAN_INTERVAL = 32
+# how long plugins remember a digest of the data they saved for an address;
+# while it doesn't change they only mark the device as seen, 0 disables it
+DISCOVERY_RESULT_CACHE_TIMEOUT = 7 * 24 * 3600 # a week
+# how many component and device models every process keeps in memory by
+# their natural keys, 0 disables it
+DISCOVERY_MODEL_CACHE_SIZE = 4096
 # django.contrib.messages settings
 MESSAGE_STORAGE = 'django.contrib.messages.storage.session.SessionStorage'
 # activity middleware settings
@@ -226,6 +248,9 @@ DATABASES = {
         ),
     },
 }
+# how often, in seconds, every process checks in the database whether the
+# networks, permissions etc. it keeps in memory have changed
+TABLE_VERSION_CHECK_INTERVAL = 5
 CACHES = dict(
     default = dict(
         BACKEND = 'django.core.cache.backends.locmem.LocMemCache',
@@ -279,6 +304,11 @@ SPLUNK_USER = None
 SPLUNK_PASSWORD = None
 PUPPET_DB_URL = None
 PUPPET_SAVE_UNCHANGED_RESOURCES = False
+# how often the index of Puppet hosts is reloaded and for how long the facts
+# of the hosts loaded in bulk are kept in the cache, in seconds; the facts are
+# only loaded in bulk when the cache is shared, e.g. memcached
+PUPPET_SNAPSHOT_INTERVAL = 300
+PUPPET_FACTS_CACHE_TIMEOUT = 24 * 3600
 ZABBIX_URL = None
 ZABBIX_USER = None
 ZABBIX_PASSWORD = None
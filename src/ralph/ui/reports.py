@@ -7,52 +7,153 @@ from __future__ import unicode_literals
 
 import datetime
 
-from django.db.models.sql.aggregates import Aggregate
 from ralph.discovery.models import HistoryCost, DeviceType
 
 
-class SpanSum(Aggregate):
-    sql_function = "SUM"
-    sql_template = ("%(function)s(GREATEST(0, "
-                    "DATEDIFF(LEAST(end, DATE('%(end)s')),"
-                    "GREATEST(start, DATE('%(start)s')))) * %(field)s)")
-    default_alias = 'spansum'
+def _span_days(span_start, span_end, start, end):
+    """
+    The number of days the span from ``span_start`` to ``span_end`` overlaps
+    with the time span from ``start`` to ``end``, or None for spans without a
+    start date.
+    """
+    if span_start is None or span_end is None:
+        return None
+    return max(0, (min(span_end, end) - max(span_start, start)).days)
 
-    def __init__(self, lookup, **extra):
-        self.lookup = lookup
-        self.extra = extra
 
-    def add_to_query(self, query, alias, col, source, is_summary):
-        super(SpanSum, self).__init__(col, source, is_summary, **self.extra)
-        query.aggregate_select[alias] = self
+class _Bucket(object):
+    __slots__ = ('cost', 'days', 'cores', 'virtual_cores', 'devices_now')
 
-class SpanCount(Aggregate):
-    sql_function = "SUM"
-    sql_template = ("%(function)s(GREATEST(0, "
-                    "DATEDIFF(LEAST(end, DATE('%(end)s')),"
-                    "GREATEST(start, DATE('%(start)s')))))")
-    default_alias = 'spansum'
+    def __init__(self):
+        self.cost = None
+        self.days = 0
+        self.cores = 0
+        self.virtual_cores = 0
+        self.devices_now = set()
 
-    def __init__(self, **extra):
-        self.lookup = 'id'
-        self.extra = extra
 
-    def add_to_query(self, query, alias, col, source, is_summary):
-        super(SpanCount, self).__init__(col, source, is_summary, **self.extra)
-        query.aggregate_select[alias] = self
+class SpanTotals(object):
+    """
+    Totals of ``HistoryCost`` spans computed in Python instead of SQL.
+
+    All the spans of ``query`` are loaded with a single query and summed up
+    per venture, device type, data center, device model group and extra cost
+    in one pass. The totals for any combination of those are then added up
+    from the partial sums, without touching the database again. The results
+    are the same as from the ``get_total_*`` functions.
+    """
+
+    FIELDS = ('start', 'end', 'daily_cost', 'cores', 'device', 'venture',
+              'extra', 'device__model__type', 'device__model__group',
+              'device__dc')
+
+    def __init__(self, query, start, end, rows=None):
+        self.start = start
+        self.end = end
+        self.days = (end - start).days or 1
+        if rows is None:
+            rows = list(query.values_list(*self.FIELDS))
+        self.rows = rows
+        today = datetime.date.today()
+        virtual = DeviceType.virtual_server.id
+        buckets = {}
+        for (span_start, span_end, daily_cost, cores, device, venture, extra,
+             device_type, group, dc) in rows:
+            key = (venture, device_type, group, (dc or '').lower(), extra)
+            try:
+                bucket = buckets[key]
+            except KeyError:
+                bucket = buckets[key] = _Bucket()
+            if device is not None and span_end >= today:
+                bucket.devices_now.add(device)
+            days = _span_days(span_start, span_end, start, end)
+            if days is None:
+                continue
+            bucket.cost = (bucket.cost or 0) + days * daily_cost
+            bucket.days += days
+            if device_type == virtual:
+                bucket.virtual_cores += days * cores
+            else:
+                bucket.cores += days * cores
+        self.buckets = buckets
+
+    def daily(self, dates):
+        """
+        Return the ``cost`` and ``count`` of the spans on each day of the
+        sorted ``dates``, as a list of pairs. The spans are sorted by their
+        start and end once and swept along the dates, instead of being
+        summed up again for every day.
+        """
+        spans = [row[:3] for row in self.rows if row[0] is not None]
+        starts = sorted((span_start, daily_cost) for
+                        span_start, span_end, daily_cost in spans
+                        if span_start < span_end)
+        ends = sorted((span_end, daily_cost) for
+                      span_start, span_end, daily_cost in spans
+                      if span_start < span_end)
+        cost = count = 0
+        i = j = 0
+        result = []
+        for date in dates:
+            while i < len(starts) and starts[i][0] <= date:
+                cost += starts[i][1]
+                count += 1
+                i += 1
+            while j < len(ends) and ends[j][0] <= date:
+                cost -= ends[j][1]
+                count -= 1
+                j += 1
+            result.append((cost if spans else None, count))
+        return result
+
+    def total(self, ventures=None, types=None, dc=None, model_group=None,
+              extra=None):
+        """
+        Return a dict with the ``cost``, fractional ``count``, ``count_now``,
+        ``cores`` and ``virtual_cores`` of the spans matching all the given
+        conditions. ``ventures`` and ``types`` are collections of ids.
+        """
+        cost = None
+        days = cores = virtual_cores = 0
+        devices_now = set()
+        if dc is not None:
+            dc = dc.lower()
+        for (venture, device_type, group, bucket_dc, bucket_extra
+             ), bucket in self.buckets.iteritems():
+            if ventures is not None and venture not in ventures:
+                continue
+            if types is not None and device_type not in types:
+                continue
+            if dc is not None and bucket_dc != dc:
+                continue
+            if model_group is not None and group != model_group:
+                continue
+            if extra is not None and bucket_extra != extra:
+                continue
+            if bucket.cost is not None:
+                cost = (cost or 0) + bucket.cost
+            days += bucket.days
+            cores += bucket.cores
+            virtual_cores += bucket.virtual_cores
+            devices_now |= bucket.devices_now
+        return {
+            'cost': cost,
+            'count': days / self.days,
+            'count_now': len(devices_now),
+            'cores': cores / self.days,
+            'virtual_cores': virtual_cores / self.days,
+        }
+
+    def extras(self):
+        """Return the ids of all the extra costs in the spans."""
+        return set(key[4] for key in self.buckets if key[4] is not None)
 
 
 def get_total_cost(query, start, end):
     """
     Calculate a total cost of the HistoryCost query in the specified time span.
     """
-    return query.aggregate(
-        SpanSum(
-            'daily_cost',
-            start=start.strftime('%Y-%m-%d'),
-            end=end.strftime('%Y-%m-%d'),
-        ),
-    )['spansum']
+    return SpanTotals(query, start, end).total()['cost']
 
 
 def get_total_count(query, start, end):
@@ -63,21 +164,9 @@ def get_total_count(query, start, end):
     Additionally, the function returns the count of devices at the end of the
     time span, and a query with all the devices from the query.
     """
-    days = (end - start).days or 1
     devices = HistoryCost.filter_span(start, end, query).values_list('device')
-    today = datetime.date.today()
-    count_now = query.filter(
-        end__gte=today
-    ).values_list(
-        'device'
-    ).distinct().count()
-    count = float(query.aggregate(
-        SpanCount(
-            start=start.strftime('%Y-%m-%d'),
-            end=end.strftime('%Y-%m-%d'),
-        ),
-    )['spansum'] or 0) / days
-    return count, count_now, devices
+    totals = SpanTotals(query, start, end).total()
+    return totals['count'], totals['count_now'], devices
 
 
 def get_total_cores(query, start, end):
@@ -86,15 +175,7 @@ def get_total_cores(query, start, end):
     are not in the query for the whole time span are counted as a fraction.
     Only the physical servers are included.
     """
-    days = (end - start).days or 1
-    query = query.exclude(device__model__type=DeviceType.virtual_server.id)
-    return float(query.aggregate(
-        SpanSum(
-            'cores',
-            start=start.strftime('%Y-%m-%d'),
-            end=end.strftime('%Y-%m-%d'),
-        ),
-    )['spansum'] or 0) / days
+    return SpanTotals(query, start, end).total()['cores']
 
 
 def get_total_virtual_cores(query, start, end):
@@ -103,13 +184,4 @@ def get_total_virtual_cores(query, start, end):
     are not in the query for the whole time span are counted as a fraction.
     Only the virtual servers are included.
     """
-    days = (end - start).days or 1
-    query = query.filter(device__model__type=DeviceType.virtual_server.id)
-    return float(query.aggregate(
-        SpanSum(
-            'cores',
-            start=start.strftime('%Y-%m-%d'),
-            end=end.strftime('%Y-%m-%d'),
-        ),
-    )['spansum'] or 0)/ days
-
+    return SpanTotals(query, start, end).total()['virtual_cores']
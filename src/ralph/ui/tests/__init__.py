@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
 
-from ralph.ui.tests.reports import TestReportsServices
+from ralph.ui.tests.reports import TestReportsServices, TestSpanTotals
 from ralph.ui.tests.search import TestSearch
 from ralph.ui.tests.device import TestDeviceView
\ No newline at end of file
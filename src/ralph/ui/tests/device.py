@@ -68,3 +68,13 @@ class TestDeviceView(TestCase):
         software = dev.software_set.all()
         self.assertEqual(software[0], self.software1)
         self.assertEqual(software[1], self.software2)
+
+    def test_export_csv(self):
+        Device.create(sn='0000000002', model_name=DEVICE['model_name'],
+                      model_type=DeviceType.unknown)
+        response = self.client.get('/ui/search/info/', {'export': 'csv'},
+                                   HTTP_ACCEPT_ENCODING='gzip')
+        # the export is streamed past the middleware, not compressed
+        self.assertFalse(response.has_header('Content-Encoding'))
+        data = b''.join(response.streaming_content)
+        self.assertIn(DEVICE['sn'], data)
@@ -5,12 +5,18 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import datetime
+
 from django.conf import settings
 from django.test import TestCase
 
+from ralph.business.models import (Venture, VentureExtraCost,
+                                   VentureExtraCostType)
 from ralph.cmdb.models_ci import (
     CI, CIType, CIRelation, CI_RELATION_TYPES, CI_TYPES
 )
+from ralph.discovery.models import Device, DeviceType, HistoryCost
+from ralph.ui.reports import SpanTotals
 from ralph.ui.tests.helper import login_as_su
 
 
@@ -100,3 +106,81 @@ class TestReportsMargins(TestCase):
     I need test!
     """
     pass
+
+
+class TestSpanTotals(TestCase):
+    def setUp(self):
+        self.venture = Venture(name='Venture', symbol='venture')
+        self.venture.save()
+        self.server = Device.create(sn='sn1', model_name='rack',
+                                    model_type=DeviceType.rack_server)
+        self.server.dc = 'DC1'
+        self.server.save()
+        self.virtual = Device.create(sn='sn2', model_name='virtual',
+                                     model_type=DeviceType.virtual_server)
+        self.virtual.dc = 'dc2'
+        self.virtual.save()
+        HistoryCost.objects.all().delete()
+        day = datetime.date(2012, 1, 1)
+        for device, start, end, daily_cost, cores in [
+                (self.server, 0, 10, 2.0, 4),
+                (self.server, 10, None, 3.0, 8),
+                (self.virtual, 5, 15, 1.0, 2),
+                (self.virtual, None, 5, 7.0, 1)]:
+            HistoryCost(
+                device=device,
+                venture=self.venture,
+                start=day + datetime.timedelta(days=start) if
+                      start is not None else None,
+                end=day + datetime.timedelta(days=end) if
+                    end is not None else datetime.date(2199, 1, 1),
+                daily_cost=daily_cost,
+                cores=cores,
+            ).save()
+        self.start = day + datetime.timedelta(days=5)
+        self.end = day + datetime.timedelta(days=20)
+
+    def test_totals(self):
+        spans = SpanTotals(HistoryCost.objects.all(), self.start, self.end)
+        totals = spans.total()
+        self.assertEqual(totals['cost'], 5 * 2.0 + 10 * 3.0 + 10 * 1.0)
+        self.assertAlmostEqual(totals['count'], 25 / 15)
+        self.assertEqual(totals['count_now'], 1)
+        self.assertAlmostEqual(totals['cores'], (5 * 4 + 10 * 8) / 15)
+        self.assertAlmostEqual(totals['virtual_cores'], 10 * 2 / 15)
+        servers = spans.total(types=(DeviceType.rack_server.id,), dc='dc1')
+        self.assertEqual(servers['cost'], 40.0)
+        self.assertEqual(spans.total(dc='DC2')['cost'], 10.0)
+        self.assertEqual(spans.total(ventures=set())['cost'], None)
+        dates = [self.start + datetime.timedelta(days=i)
+                 for i in (-10, 0, 4, 5, 10, 20)]
+        self.assertEqual(spans.daily(dates), [
+            (0, 0), (3.0, 2), (3.0, 2), (4.0, 2), (3.0, 1), (3.0, 1),
+        ])
+
+    def test_count_now(self):
+        extra = VentureExtraCost(
+            venture=self.venture, cost=30.0,
+            type=VentureExtraCostType.objects.create(name='Support'),
+        )
+        extra.save()
+        HistoryCost(extra=extra, venture=self.venture, daily_cost=1.0,
+                    start=self.start).save()
+        HistoryCost(venture=self.venture, daily_cost=1.0,
+                    start=self.start).save()
+        today = datetime.date.today()
+        query = HistoryCost.objects.all()
+        spans = SpanTotals(query, self.start, today)
+        # the spans of extra costs and of deleted devices have no device and
+        # are not counted, as in the SQL that get_total_count used before
+        for totals, q in [
+                (spans.total(), query),
+                (spans.total(extra=extra.id), query.filter(extra=extra)),
+                (spans.total(types=(DeviceType.rack_server.id,)),
+                 query.filter(device__model__type=DeviceType.rack_server.id)),
+        ]:
+            self.assertEqual(
+                totals['count_now'],
+                q.filter(end__gte=today).values_list(
+                    'device').distinct().count(),
+            )
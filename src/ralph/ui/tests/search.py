@@ -300,3 +300,20 @@ class TestSearch(TestCase):
         self.assertEqual(context.model.type, DeviceType.unknown)
 
 
+
+    def _found(self, **params):
+        response = self.client.get('/ui/search/info/', params)
+        if response.status_code != 302:
+            return None
+        return int(response['Location'].split('?')[0].rsplit('/', 1)[1])
+
+    def test_search_index(self):
+        self.assertEqual(self._found(name='simpledev'), self.device.id)
+        self.assertEqual(self._found(address=DEVICE['ip']), self.device.id)
+        self.assertEqual(self._found(component='__processor'), self.device.id)
+        self.assertEqual(self._found(component='nothing|__Fibre'),
+                         self.device.id)
+        self.assertEqual(self._found(serial=DEVICE['mac']), self.device.id)
+        self.assertEqual(self._found(serial=DISKSHARE['wwn']), self.device.id)
+        self.assertEqual(self._found(serial=GENERIC['sn']), self.device.id)
+        self.assertIsNone(self._found(component='__Nothing'))
@@ -16,14 +16,13 @@ from django.conf import settings
 from ralph.account.models import Perm
 from ralph.discovery.models import (DeviceType, ComponentType, DeviceModel,
                                     DeviceModelGroup, ComponentModelGroup,
-                                    ComponentModel, Storage, Memory, Processor,
-                                    DiskShare, FibreChannel, GenericComponent,
-                                    Software, OperatingSystem, Device)
+                                    ComponentModel)
 from ralph.discovery.models_history import HistoryModelChange
 from ralph.ui.forms import ComponentModelGroupForm, DeviceModelGroupForm
 from ralph.ui.views.common import Base
 from ralph.util import pricing
 from ralph.util.presentation import COMPONENT_ICONS, DEVICE_ICONS
+from ralph.util.tasks import get_progress, schedule_update_cached_prices
 
 
 MODEL_GROUP_SORT_COLUMNS = {
@@ -37,6 +36,7 @@ HISTORY_SORT_COLUMNS = {
 }
 PAGE_SIZE = 25
 MAX_PAGE_SIZE = 65535
+PRICING_JOBS_SESSION_KEY = 'catalog_pricing_jobs'
 
 
 
@@ -87,8 +87,30 @@ class Catalog(Base):
         if not self.request.user.get_profile().has_perm(
                 Perm.edit_device_info_financial):
             return HttpResponseForbidden('You have no permission to view catalog')
+        self.report_update_cached()
         return super(Catalog, self).get(*args, **kwargs)
 
+    def schedule_update_cached(self, device_ids):
+        """Recalculate the cached prices in the background, so that saving
+        the catalog doesn't wait for it."""
+        if not device_ids:
+            return
+        job_id = schedule_update_cached_prices(device_ids)
+        jobs = self.request.session.get(PRICING_JOBS_SESSION_KEY, [])
+        self.request.session[PRICING_JOBS_SESSION_KEY] = jobs + [job_id]
+
+    def report_update_cached(self):
+        jobs = []
+        for job_id in self.request.session.get(PRICING_JOBS_SESSION_KEY, []):
+            progress = get_progress(job_id)
+            if not progress or progress['done'] >= progress['total']:
+                continue
+            jobs.append(job_id)
+            messages.info(self.request,
+                          "Recalculating prices: %d of %d devices done." % (
+                              progress['done'], progress['total']))
+        self.request.session[PRICING_JOBS_SESSION_KEY] = jobs
+
 
     def get_context_data(self, **kwargs):
         ret = super(Catalog, self).get_context_data(**kwargs)
@@ -142,8 +164,7 @@ class CatalogDevice(Catalog):
         self.form = None
 
     def update_cached(self, group):
-        for device in Device.objects.filter(model__group=group):
-            pricing.device_update_cached(device)
+        self.schedule_update_cached(pricing.device_model_group_devices(group))
 
     def post(self, *args, **kwargs):
         if not self.request.user.get_profile().has_perm(
@@ -169,7 +190,8 @@ class CatalogDevice(Catalog):
                 model.group = target
                 model.save(user=self.request.user)
             self.update_cached(target)
-            messages.success(self.request, "Items moved.")
+            messages.success(self.request, "Items moved, prices are being "
+                             "recalculated.")
             return HttpResponseRedirect(self.request.path)
         elif 'delete' in self.request.POST:
             try:
@@ -201,7 +223,8 @@ class CatalogDevice(Catalog):
                 self.form.save(commit=False)
                 self.form.instance.save(user=self.request.user)
                 self.update_cached(self.group)
-                messages.success(self.request, "Changes saved.")
+                messages.success(self.request, "Changes saved, prices are "
+                                 "being recalculated.")
                 return HttpResponseRedirect(self.request.path)
             else:
                 messages.error(self.request, "Correct the errors.")
@@ -261,13 +284,8 @@ class CatalogComponent(Catalog):
         self.form = None
 
     def update_cached(self, group):
-        devices = set()
-        for _class in (Storage, Memory, Processor, DiskShare, FibreChannel,
-                       GenericComponent, OperatingSystem, Software):
-            for component in _class.objects.filter(model__group=group):
-                devices.add(component.device)
-        for device in devices:
-            pricing.device_update_cached(device)
+        self.schedule_update_cached(
+            pricing.component_model_group_devices(group))
 
     def post(self, *args, **kwargs):
         if not self.request.user.get_profile().has_perm(
@@ -293,7 +311,8 @@ class CatalogComponent(Catalog):
                 model.group = target
                 model.save(user=self.request.user)
             self.update_cached(target)
-            messages.success(self.request, "Items moved.")
+            messages.success(self.request, "Items moved, prices are being "
+                             "recalculated.")
             return HttpResponseRedirect(self.request.path)
         elif 'delete' in self.request.POST:
             try:
@@ -325,7 +344,8 @@ class CatalogComponent(Catalog):
                 self.form.save(commit=False)
                 self.form.instance.save(user=self.request.user)
                 self.update_cached(self.group)
-                messages.success(self.request, "Changes saved.")
+                messages.success(self.request, "Changes saved, prices are "
+                                 "being recalculated.")
                 return HttpResponseRedirect(self.request.path)
             else:
                 messages.error(self.request, "Correct the errors.")
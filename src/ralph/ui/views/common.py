@@ -28,6 +28,7 @@ from ralph.dnsedit.util import (
     get_domain,
     set_revdns_record,
     get_revdns_records,
+    txt_records_batch,
 )
 from ralph.dnsedit.util import Error as DNSError
 from ralph.discovery.models import (
@@ -819,14 +820,15 @@ class Discover(DeviceDetailView):
 
 @nested_commit_on_success
 def bulk_update(devices, fields, data, user):
-    for d in devices:
-        if 'venture' in fields:
-            d.venture_role = None
-        for name in fields:
-            setattr(d, name, data[name])
-        d.save_comment = data.get('save_comment')
-        d.save(priority=SAVE_PRIORITY, user=user)
-        pricing.device_update_cached(d)
+    with txt_records_batch():
+        for d in devices:
+            if 'venture' in fields:
+                d.venture_role = None
+            for name in fields:
+                setattr(d, name, data[name])
+            d.save_comment = data.get('save_comment')
+            d.save(priority=SAVE_PRIORITY, user=user)
+    pricing.devices_update_cached(devices)
 
 
 class BulkEdit(BaseMixin, TemplateView):
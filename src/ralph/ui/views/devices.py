@@ -4,17 +4,20 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import cStringIO as StringIO
-
 from django.contrib import messages
 from django.core.paginator import InvalidPage
 from django.http import Http404
-from django.http import HttpResponseRedirect, HttpResponse
+from django.http import HttpResponseRedirect
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    from ralph.util.export import StreamingHttpResponse
 from django.utils.translation import ugettext as _
 from django.views.generic import ListView
 
 from ralph.account.models import Perm
-from ralph.util import csvutil
+from ralph.discovery.models import IPAddress
+from ralph.util import export
 
 
 PAGE_SIZE = 25
@@ -90,54 +93,87 @@ class BaseDeviceList(ListView):
         self.venture = None
         self.sort = None
 
+    def export_rows(self, query):
+        """
+        Yield the rows of the CSV export of ``query``. The devices are
+        fetched in chunks together with their addresses, and the permission
+        checks are done once per venture.
+        """
+        yield ['Id', 'Name', 'Venture', 'Role', 'Model', 'Data Center',
+               'Rack', 'SN','Position', 'Barcode', 'Margin', 'Deprecation',
+               'Price', 'Cost', 'Monthly Cost', 'Addresses', 'Management',
+               'Created', 'Last Seen', 'Purchased', 'Warranty Expiration',
+               'Support Expiration', 'Support Kind', 'Remarks']
+        venture_tabs = {}
+        venture_margins = {}
+        role_names = {}
+        for devices in export.iter_chunks(query, select_related=(
+                'venture', 'venture__margin_kind', 'venture_role', 'model',
+                'model__group', 'margin_kind', 'deprecation_kind',
+                'management')):
+            addresses = {}
+            for device_id, address in IPAddress.objects.filter(
+                    device__in=[dev.id for dev in devices]
+                ).values_list('device', 'address').order_by('id'):
+                addresses.setdefault(device_id, []).append(address)
+            for dev in devices:
+                if dev.venture_id not in venture_tabs:
+                    venture_tabs[dev.venture_id] = set(
+                        _get_show_tabs(self.request, None, dev))
+                show_tabs = venture_tabs[dev.venture_id]
+                role_id = dev.venture_role_id
+                if role_id and role_id not in role_names:
+                    role_names[role_id] = dev.venture_role.full_name
+                if dev.margin_kind:
+                    margin = dev.margin_kind.margin
+                elif dev.venture:
+                    if dev.venture_id not in venture_margins:
+                        venture_margins[dev.venture_id] = (
+                            dev.venture.get_margin())
+                    margin = venture_margins[dev.venture_id]
+                else:
+                    margin = 0
+                row = [
+                    str(dev.id),
+                    dev.name or '' if 'info' in show_tabs else '',
+                    dev.venture.symbol if
+                        dev.venture and 'info' in show_tabs else '',
+                    (role_names[role_id] if role_id and
+                        'info' in show_tabs else ''),
+                    dev.get_model_name() or '' if 'info' in show_tabs else '',
+                    dev.dc or '' if 'info' in show_tabs else '',
+                    dev.rack or '' if 'info' in show_tabs else '',
+                    dev.get_position() if 'info' in show_tabs else '',
+                    dev.barcode or '' if 'info' in show_tabs else '',
+                    dev.sn or '' if 'info' in show_tabs else '',
+                    str(margin) + '%' if 'prices' in show_tabs else '',
+                    (dev.deprecation_kind.name if dev.deprecation_kind and
+                        'prices' in show_tabs else ''),
+                    str(dev.cached_price) if 'prices' in show_tabs else '',
+                    str(dev.cached_cost) if 'costs' in show_tabs else '',
+                    ' '.join(addresses.get(dev.id, [])
+                        ) if 'info' in show_tabs else '',
+                    dev.management or '' if 'info' in show_tabs else '',
+                    dev.created or '' if 'history' in show_tabs else '',
+                    dev.last_seen or '' if 'history' in show_tabs else '',
+                    dev.purchase_date or '' if 'purchase' in show_tabs else '',
+                    dev.warranty_expiration_date or
+                        '' if 'purchase' in show_tabs else '',
+                    dev.support_expiration_date or '' if
+                        'purchase' in show_tabs else '',
+                    dev.support_kind or '' if 'purchase' in show_tabs else '',
+                    dev.sn or '' if 'purchase' in show_tabs else '',
+                    dev.remarks or '' if 'info' in show_tabs else '',
+                ]
+                yield [unicode(r) for r in row]
+
     def export_csv(self, query=None):
         if query is None:
             query = self.get_queryset()
-        rows = [
-            ['Id', 'Name', 'Venture', 'Role', 'Model', 'Data Center', 'Rack',
-             'SN','Position', 'Barcode', 'Margin', 'Deprecation', 'Price',
-             'Cost', 'Monthly Cost', 'Addresses', 'Management', 'Created',
-             'Last Seen', 'Purchased', 'Warranty Expiration',
-             'Support Expiration', 'Support Kind', 'Remarks'],
-        ]
-        for dev in query.all():
-            show_tabs = set(_get_show_tabs(self.request, None, dev))
-            row = [
-                str(dev.id),
-                dev.name or '' if 'info' in show_tabs else '',
-                dev.venture.symbol if
-                    dev.venture and 'info' in show_tabs else '',
-                (dev.venture_role.full_name if dev.venture_role and
-                    'info' in show_tabs else ''),
-                dev.get_model_name() or '' if 'info' in show_tabs else '',
-                dev.dc or '' if 'info' in show_tabs else '',
-                dev.rack or '' if 'info' in show_tabs else '',
-                dev.get_position() if 'info' in show_tabs else '',
-                dev.barcode or '' if 'info' in show_tabs else '',
-                dev.sn or '' if 'info' in show_tabs else '',
-                str(dev.get_margin()) + '%' if 'prices' in show_tabs else '',
-                (dev.deprecation_kind.name if dev.deprecation_kind and
-                    'prices' in show_tabs else ''),
-                str(dev.cached_price) if 'prices' in show_tabs else '',
-                str(dev.cached_cost) if 'costs' in show_tabs else '',
-                ' '.join(ip.address for ip in dev.ipaddress_set.all()
-                    ) if 'info' in show_tabs else '',
-                dev.management or '' if 'info' in show_tabs else '',
-                dev.created or '' if 'history' in show_tabs else '',
-                dev.last_seen or '' if 'history' in show_tabs else '',
-                dev.purchase_date or '' if 'purchase' in show_tabs else '',
-                dev.warranty_expiration_date or
-                    '' if 'purchase' in show_tabs else '',
-                dev.support_expiration_date or '' if
-                    'purchase' in show_tabs else '',
-                dev.support_kind or '' if 'purchase' in show_tabs else '',
-                dev.sn or '' if 'purchase' in show_tabs else '',
-                dev.remarks or '' if 'info' in show_tabs else '',
-            ]
-            rows.append([unicode(r) for r in row])
-        f = StringIO.StringIO()
-        csvutil.UnicodeWriter(f).writerows(rows)
-        response = HttpResponse(f.getvalue(), content_type="application/csv")
+        response = StreamingHttpResponse(
+            export.iter_csv(self.export_rows(query)),
+            content_type="application/csv",
+        )
         response['Content-Disposition'] = 'attachment; filename=ralph.csv'
         return response
 
@@ -26,7 +26,7 @@ from ralph.discovery.models_device import MarginKind, DeviceType, Device
 from ralph.discovery.models_history import HistoryCost
 from ralph.ui.forms import DateRangeForm, MarginsReportForm
 from ralph.ui.reports import (
-    get_total_cost, get_total_count, get_total_cores, get_total_virtual_cores
+    SpanTotals, get_total_cost, get_total_count
 )
 from ralph.ui.views.common import Base, DeviceDetailView
 from ralph.ui.views.devices import DEVICE_SORT_COLUMNS
@@ -234,11 +234,7 @@ class ReportMargins(SidebarReports, Base):
                 id=self.form.cleaned_data['margin_venture']
             )
             query = HistoryCost.objects.filter(
-                db.Q(venture=venture) |
-                db.Q(venture__parent=venture) |
-                db.Q(venture__parent__parent=venture) |
-                db.Q(venture__parent__parent__parent=venture) |
-                db.Q(venture__parent__parent__parent__parent=venture)
+                venture.subtree_q('venture__')
             ).exclude(device__deleted=True)
             total_cost = 0
             total_sim = 0
@@ -362,26 +358,30 @@ class ReportVentures(SidebarReports, Base):
                     device__model__type=DeviceType.cloud_server.id
                 ), start, end
             )
+            spans = SpanTotals(
+                HistoryCost.objects.exclude(device__deleted=True), start, end
+            )
+            children = {}
+            for venture_id, parent_id in Venture.objects.values_list(
+                    'id', 'parent'):
+                children.setdefault(parent_id, []).append(venture_id)
             for venture in self.ventures:
-                query = HistoryCost.objects.filter(
-                    db.Q(venture=venture) |
-                    db.Q(venture__parent=venture) |
-                    db.Q(venture__parent__parent=venture) |
-                    db.Q(venture__parent__parent__parent=venture) |
-                    db.Q(venture__parent__parent__parent__parent=venture)
-                ).exclude(device__deleted=True)
-                venture.total = get_total_cost(query, start, end)
-                (venture.count, venture.count_now,
-                 devices) = get_total_count(query, start, end)
-                venture.core_count = get_total_cores(devices, start, end)
-                venture.virtual_core_count = get_total_virtual_cores(
-                    devices, start, end
-                )
-                cloud_cost = get_total_cost(
-                    query.filter(
-                        device__model__type=DeviceType.cloud_server.id
-                    ), start, end
-                )
+                ventures = set([venture.id])
+                level = [venture.id]
+                for depth in xrange(4):
+                    level = [child for parent_id in level
+                             for child in children.get(parent_id, [])]
+                    ventures.update(level)
+                totals = spans.total(ventures=ventures)
+                venture.total = totals['cost']
+                venture.count = totals['count']
+                venture.count_now = totals['count_now']
+                venture.core_count = totals['cores']
+                venture.virtual_core_count = totals['virtual_cores']
+                cloud_cost = spans.total(
+                    ventures=ventures,
+                    types=(DeviceType.cloud_server.id,),
+                )['cost']
                 venture.cloud_use = (cloud_cost or 0) / total_cloud_cost * 100
         else:
             self.ventures = Venture.objects.none()
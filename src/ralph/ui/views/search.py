@@ -12,7 +12,6 @@ from django.contrib import messages
 from django.core.urlresolvers import reverse
 from django.db.models import Q
 from django.http import HttpResponseRedirect
-from powerdns.models import Record
 
 from ralph.account.models import Perm
 from ralph.discovery.models import ReadOnlyDevice, Device, ComponentModel
@@ -95,25 +94,10 @@ class SearchDeviceList(SidebarSearch, BaseMixin, BaseDeviceList):
             else:
                 self.query = Device.objects.all()
             if data['name']:
-                name = data['name'].strip()
-                names = set(n.strip('.') for (n,) in Record.objects.filter(
-                    type='CNAME'
-                ).filter(
-                    name__icontains=name
-                ).values_list('content'))
-                ips = set(ip.strip('.') for (ip,) in Record.objects.filter(
-                    type='A'
-                ).filter(
-                    Q(name__icontains=name) |
-                    Q(name__in=names)
-                ).values_list('content'))
-                q = (_search_fields_or([
-                    'name',
-                    'ipaddress__hostname__icontains',
-                ], name.split()) | Q(
-                    ipaddress__address__in=ips,
-                ))
-                self.query = self.query.filter(q).distinct()
+                q = _search_fields_or([
+                    'search__name__icontains',
+                ], data['name'].split())
+                self.query = self.query.filter(q)
             if data['address']:
                 if data['address'] == empty_field:
                     self.query = self.query.filter(
@@ -133,9 +117,9 @@ class SearchDeviceList(SidebarSearch, BaseMixin, BaseDeviceList):
                         )
                 else:
                     q = _search_fields_or([
-                        'ipaddress__address__icontains'
+                        'search__address__icontains'
                     ], data['address'].split(' '))
-                    self.query = self.query.filter(q).distinct()
+                    self.query = self.query.filter(q)
             if data['remarks']:
                 if data['remarks'] == empty_field:
                     self.query = self.query.filter(
@@ -172,31 +156,9 @@ class SearchDeviceList(SidebarSearch, BaseMixin, BaseDeviceList):
                     self.query = self.query.filter(q).distinct()
                 else:
                     q = _search_fields_or([
-                        'genericcomponent__label__icontains',
-                        'genericcomponent__model__name__icontains',
-                        'genericcomponent__model__group__name__icontains',
-                        'software__label__icontains',
-                        'software__model__name__icontains',
-                        'software__model__group__name__icontains',
-                        'ethernet__mac__icontains',
-                        'fibrechannel__label__icontains',
-                        'fibrechannel__model__name__icontains',
-                        'fibrechannel__model__group__name__icontains',
-                        'storage__label__icontains',
-                        'storage__model__name__icontains',
-                        'storage__model__group__name__icontains',
-                        'memory__label__icontains',
-                        'memory__model__name__icontains',
-                        'memory__model__group__name__icontains',
-                        'processor__label__icontains',
-                        'processor__model__name__icontains',
-                        'processor__model__group__name__icontains',
-                        'disksharemount__share__label__icontains',
-                        'disksharemount__share__wwn__icontains',
-                        'disksharemount__share__model__name__icontains',
-                        'operatingsystem__model__name__icontains'
+                        'search__component__icontains',
                     ], data['component'].split('|'))
-                    self.query = self.query.filter(q).distinct()
+                    self.query = self.query.filter(q)
             if data['serial']:
                 if data['serial'] == empty_field:
                     self.query = self.query.filter(
@@ -207,13 +169,9 @@ class SearchDeviceList(SidebarSearch, BaseMixin, BaseDeviceList):
                 else:
                     serial = data['serial'].replace(':', '')
                     q = _search_fields_or([
-                        'sn__icontains',
-                        'ethernet__mac__icontains',
-                        'genericcomponent__sn__icontains',
-                        'diskshare__wwn',
-                        'disksharemount__share__wwn',
+                        'search__serial__icontains',
                     ], serial.split())
-                    self.query = self.query.filter(q).distinct()
+                    self.query = self.query.filter(q)
             if data['barcode']:
                 if data['barcode'] == empty_field:
                     self.query = self.query.filter(
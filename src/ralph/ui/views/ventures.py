@@ -9,6 +9,7 @@ import datetime
 import calendar
 
 from django.contrib import messages
+from django.core.cache import cache
 from django.db import models as db
 from django.http import HttpResponseRedirect, HttpResponseForbidden
 from django.shortcuts import get_object_or_404
@@ -17,7 +18,8 @@ from django.utils import simplejson as json
 from bob.menu import MenuItem
 
 from ralph.account.models import Perm
-from ralph.business.models import Venture, VentureRole, VentureExtraCost
+from ralph.business.models import (Venture, VentureRole, VentureExtraCost,
+                                   venture_tree_version)
 from ralph.discovery.models import (ReadOnlyDevice, DeviceType, DataCenter,
                                     Device, DeviceModelGroup, HistoryCost,
                                     SplunkUsage, ComponentModel)
@@ -29,7 +31,7 @@ from ralph.ui.views.common import (Info, Prices, Addresses, Costs, Purchase,
 from ralph.cmdb.views import CMDB
 from ralph.ui.views.devices import BaseDeviceList
 from ralph.ui.views.reports import Reports, ReportDeviceList
-from ralph.ui.reports import get_total_cost, get_total_count
+from ralph.ui.reports import SpanTotals
 from ralph.util import presentation
 
 
@@ -55,15 +57,42 @@ def collect_ventures(parent, ventures, items, depth=0):
         collect_ventures(v, ventures, items, depth + 1)
 
 
-def venture_tree_menu(ventures, details, show_all=False):
+VENTURE_TREE_KEY = 'ralph.ui.venture_tree.%s'
+VENTURE_TREE_TIMEOUT = 24 * 3600
+
+
+def venture_tree():
+    """
+    Return the ``(nodes, children)`` of the whole venture tree, where
+    ``nodes`` maps venture ids to the data needed to render them in the
+    sidebar and ``children`` maps parent ids (None for the roots) to lists of
+    their children ids, in the sidebar order. The tree is kept in the cache
+    until any venture changes.
+    """
+    key = VENTURE_TREE_KEY % venture_tree_version()
+    tree = cache.get(key)
+    if tree is None:
+        nodes = {}
+        children = {}
+        for v in Venture.objects.select_related('department').order_by(
+                '-is_infrastructure', 'name'):
+            nodes[v.id] = (v.name, _normalize_venture(v.symbol),
+                           presentation.get_venture_icon(v), v.show_in_ralph)
+            children.setdefault(v.parent_id, []).append(v.id)
+        tree = nodes, children
+        cache.set(key, tree, VENTURE_TREE_TIMEOUT)
+    return tree
+
+
+def venture_tree_menu(venture_ids, details, show_all=False, tree=None):
+    nodes, children = tree or venture_tree()
     items = []
-    if not show_all:
-        ventures = ventures.filter(show_in_ralph=True)
-    for v in ventures.order_by('-is_infrastructure', 'name'):
-        symbol = _normalize_venture(v.symbol)
-        icon = presentation.get_venture_icon(v)
+    for venture_id in venture_ids:
+        name, symbol, icon, show_in_ralph = nodes[venture_id]
+        if not show_all and not show_in_ralph:
+            continue
         item = MenuItem(
-            v.name, name=symbol,
+            name, name=symbol,
             fugue_icon=icon,
             view_name='ventures',
             view_args=[symbol, details, ''],
@@ -71,9 +100,10 @@ def venture_tree_menu(ventures, details, show_all=False):
             collapsed = True,
             collapsible = True,
         )
-        item.venture_id = v.id
+        item.venture_id = venture_id
         item.subitems = venture_tree_menu(
-                v.child_set.all(), details, show_all)
+                children.get(venture_id, ()), details, show_all,
+                (nodes, children))
         for subitem in item.subitems:
             subitem.parent = item
         items.append(item)
@@ -107,7 +137,8 @@ class SidebarVentures(object):
         has_perm = profile.has_perm
         ventures = profile.perm_ventures(Perm.list_devices_generic)
         show_all = self.request.GET.get('show_all')
-        ventures = ventures.order_by('-is_infrastructure', 'name')
+        tree = venture_tree()
+        roots = set(ventures.filter(parent=None).values_list('id', flat=True))
 
         sidebar_items = [
             MenuItem(fugue_icon='fugue-prohibition', label="Unknown",
@@ -118,7 +149,8 @@ class SidebarVentures(object):
                      view_args=['*', details, ''])
         ]
         sidebar_items.extend(venture_tree_menu(
-                ventures.filter(parent=None), details, show_all))
+                [v for v in tree[1].get(None, ()) if v in roots],
+                details, show_all, tree))
         if self.venture and self.venture != '*':
             stack = list(sidebar_items)
             while stack:
@@ -247,16 +279,14 @@ class VenturesRoles(Ventures, Base):
         return ret
 
 
-def _total_dict(name, query, start, end, url=None):
-    cost = get_total_cost(query, start, end)
-    count, count_now, devices = get_total_count(query, start, end)
-    if not count:
+def _total_dict(name, totals, url=None):
+    if not totals['count']:
         return None
     return {
         'name': name,
-        'count': count,
-        'cost': cost,
-        'count_now': count_now,
+        'count': totals['count'],
+        'cost': totals['cost'],
+        'count_now': totals['count_now'],
         'url': url,
     }
 
@@ -282,143 +312,100 @@ def _get_search_url(venture, dc=None, type=(), model_group=None):
 
 
 def _get_summaries(query, start, end, overlap=True, venture=None):
+    spans = SpanTotals(query, start, end)
+    servers = (DeviceType.rack_server.id, DeviceType.blade_server.id,
+               DeviceType.virtual_server.id)
+    network = (DeviceType.switch.id, DeviceType.router.id,
+               DeviceType.firewall.id, DeviceType.smtp_gateway.id,
+               DeviceType.appliance.id)
+    storage = (DeviceType.storage.id, DeviceType.fibre_channel_switch.id)
+    data_centers = list(DataCenter.objects.all())
     if overlap:
-        yield _total_dict('Servers', query.filter(
-            device__model__type__in=(DeviceType.rack_server.id,
-                             DeviceType.blade_server.id,
-                             DeviceType.virtual_server.id)), start, end,
+        yield _total_dict('Servers', spans.total(types=servers),
             _get_search_url(venture, type=(201, 202, 203)))
-    for dc in DataCenter.objects.all():
-        yield _total_dict('  • Servers in %s' % dc.name, query.filter(
-            device__model__type__in=(DeviceType.rack_server.id,
-                             DeviceType.blade_server.id,
-                             DeviceType.virtual_server.id)
-            ).filter(device__dc__iexact=dc.name), start, end,
+    for dc in data_centers:
+        yield _total_dict('  • Servers in %s' % dc.name,
+            spans.total(types=servers, dc=dc.name),
             _get_search_url(venture, dc=dc, type=(201, 202, 203))
             )
         if overlap:
             yield _total_dict(
-                '    ∙ Rack servers in %s' % dc.name, query.filter(
-                        device__model__type=DeviceType.rack_server.id,
-                    ).filter(device__dc__iexact=dc.name), start, end,
-                        _get_search_url(venture, dc=dc, type=(201,))
+                '    ∙ Rack servers in %s' % dc.name,
+                spans.total(types=(DeviceType.rack_server.id,), dc=dc.name),
+                _get_search_url(venture, dc=dc, type=(201,))
                     )
             for mg in DeviceModelGroup.objects.filter(
                     type=DeviceType.rack_server.id).order_by('name'):
                 yield _total_dict(
-                    '        %s in %s' % (mg, dc.name), query.filter(
-                            device__model__group=mg,
-                        ).filter(device__dc__iexact=dc.name), start, end,
-                        _get_search_url(venture, dc=dc, type=(201,),
-                                        model_group=mg.id)
+                    '        %s in %s' % (mg, dc.name),
+                    spans.total(model_group=mg.id, dc=dc.name),
+                    _get_search_url(venture, dc=dc, type=(201,),
+                                    model_group=mg.id)
                         )
             yield _total_dict(
-                '    ∙ Blade servers in %s' % dc.name, query.filter(
-                        device__model__type=DeviceType.blade_server.id,
-                    ).filter(device__dc__iexact=dc.name), start, end,
-                        _get_search_url(venture, dc=dc, type=(202,))
+                '    ∙ Blade servers in %s' % dc.name,
+                spans.total(types=(DeviceType.blade_server.id,), dc=dc.name),
+                _get_search_url(venture, dc=dc, type=(202,))
                     )
             for mg in DeviceModelGroup.objects.filter(
                     type=DeviceType.blade_server.id).order_by('name'):
                 yield _total_dict(
-                    '        %s in %s' % (mg, dc.name), query.filter(
-                            device__model__group=mg,
-                        ).filter(device__dc__iexact=dc.name), start, end,
-                            _get_search_url(venture, dc=dc, type=(202,),
-                                            model_group=mg.id)
+                    '        %s in %s' % (mg, dc.name),
+                    spans.total(model_group=mg.id, dc=dc.name),
+                    _get_search_url(venture, dc=dc, type=(202,),
+                                    model_group=mg.id)
                         )
             yield _total_dict(
-                '    ∙ Virtual servers in %s' % dc.name, query.filter(
-                        device__model__type=DeviceType.virtual_server.id,
-                    ).filter(device__dc__iexact=dc.name), start, end,
-                        _get_search_url(venture, dc=dc, type=(203,))
+                '    ∙ Virtual servers in %s' % dc.name,
+                spans.total(types=(DeviceType.virtual_server.id,),
+                            dc=dc.name),
+                _get_search_url(venture, dc=dc, type=(203,))
                     )
     if overlap:
-        yield _total_dict('Loadbalancers', query.filter(
-                device__model__type__in=(DeviceType.load_balancer.id,)
-            ), start, end, _get_search_url(venture, type=(103,)))
-    for dc in DataCenter.objects.all():
-        yield _total_dict(' • Loadbalancers in %s' % dc.name, query.filter(
-                device__model__type__in=(DeviceType.load_balancer.id,)
-            ).filter(device__dc__iexact=dc.name), start, end,
-                _get_search_url(venture, dc=dc, type=(103,))
+        yield _total_dict('Loadbalancers',
+            spans.total(types=(DeviceType.load_balancer.id,)),
+            _get_search_url(venture, type=(103,)))
+    for dc in data_centers:
+        yield _total_dict(' • Loadbalancers in %s' % dc.name,
+            spans.total(types=(DeviceType.load_balancer.id,), dc=dc.name),
+            _get_search_url(venture, dc=dc, type=(103,))
             )
     if overlap:
-        yield _total_dict('Storage', query.filter(
-            device__model__type__in=(
-                DeviceType.storage.id,
-                DeviceType.fibre_channel_switch.id,
-            )), start, end,
+        yield _total_dict('Storage', spans.total(types=storage),
                 _get_search_url(venture, type=(301,))
             )
-    for dc in DataCenter.objects.all():
-        yield _total_dict(' • Storage in %s' % dc.name, query.filter(
-            device__model__type__in=(
-                    DeviceType.storage.id,
-                    DeviceType.fibre_channel_switch.id,
-                )
-            ).filter(device__dc__iexact=dc.name), start, end,
-                _get_search_url(venture, dc=dc, type=(301,))
+    for dc in data_centers:
+        yield _total_dict(' • Storage in %s' % dc.name,
+            spans.total(types=storage, dc=dc.name),
+            _get_search_url(venture, dc=dc, type=(301,))
             )
     if overlap:
-        yield _total_dict('Network', query.filter(
-            device__model__type__in=(
-                DeviceType.switch.id,
-                DeviceType.router.id,
-                DeviceType.firewall.id,
-                DeviceType.smtp_gateway.id,
-                DeviceType.appliance.id,
-            )
-            ), start, end,
-                _get_search_url(venture, type=(
-                    DeviceType.switch.id,
-                    DeviceType.router.id,
-                    DeviceType.firewall.id,
-                    DeviceType.smtp_gateway.id,
-                    DeviceType.appliance.id,
-                ))
-            )
-    for dc in DataCenter.objects.all():
-        yield _total_dict(' • Network in %s' % dc.name, query.filter(
-            device__model__type__in=(
-                DeviceType.switch.id,
-                DeviceType.router.id,
-                DeviceType.firewall.id,
-                DeviceType.smtp_gateway.id,
-                DeviceType.appliance.id,
+        yield _total_dict('Network', spans.total(types=network),
+                _get_search_url(venture, type=network)
             )
-            ).filter(device__dc__iexact=dc.name), start, end,
-                _get_search_url(venture, dc=dc, type=(
-                    DeviceType.switch.id,
-                    DeviceType.router.id,
-                    DeviceType.firewall.id,
-                    DeviceType.smtp_gateway.id,
-                    DeviceType.appliance.id,
-                ))
+    for dc in data_centers:
+        yield _total_dict(' • Network in %s' % dc.name,
+            spans.total(types=network, dc=dc.name),
+            _get_search_url(venture, dc=dc, type=network)
             )
-    yield _total_dict('Cloud', query.filter(
-            device__model__type__in=(DeviceType.cloud_server.id,)
-        ), start, end,
-            _get_search_url(venture, type=(DeviceType.cloud_server.id,))
+    yield _total_dict('Cloud',
+        spans.total(types=(DeviceType.cloud_server.id,)),
+        _get_search_url(venture, type=(DeviceType.cloud_server.id,))
         )
     if overlap:
-        yield _total_dict('Unknown', query.filter(
-            device__model__type__in=(DeviceType.unknown.id,)), start, end,
-                _get_search_url(venture, type=(DeviceType.unknown.id,))
+        yield _total_dict('Unknown',
+            spans.total(types=(DeviceType.unknown.id,)),
+            _get_search_url(venture, type=(DeviceType.unknown.id,))
             )
-    for dc in DataCenter.objects.all():
-        yield _total_dict(' • Unknown in %s' % dc.name, query.filter(
-            device__model__type__in=(DeviceType.unknown.id,)
-            ).filter(device__dc__iexact=dc.name), start, end,
-                _get_search_url(venture, dc=dc, type=(DeviceType.unknown.id,))
+    for dc in data_centers:
+        yield _total_dict(' • Unknown in %s' % dc.name,
+            spans.total(types=(DeviceType.unknown.id,), dc=dc.name),
+            _get_search_url(venture, dc=dc, type=(DeviceType.unknown.id,))
             )
     splunk_usage = SplunkUsage.objects.filter(day__gte=start, day__lte=end)
     if venture and venture != '*':
-        splunk_usage = splunk_usage.filter(db.Q(device__venture=venture) |
-            db.Q(device__venture__parent=venture) |
-            db.Q(device__venture__parent__parent=venture) |
-            db.Q(device__venture__parent__parent__parent=venture) |
-            db.Q(device__venture__parent__parent__parent__parent=venture))
+        splunk_usage = splunk_usage.filter(
+            venture.subtree_q('device__venture__'))
     elif not venture: # specifically "devices with no venture set"
         splunk_usage = splunk_usage.filter(device__venture=None)
     if splunk_usage.count():
@@ -444,31 +431,21 @@ def _get_summaries(query, start, end, overlap=True, venture=None):
             'count_now': splunk_count_now,
             'url': url,
         }
-    for extra_id, in query.values_list('extra_id').distinct():
-        if extra_id is None:
-            continue
-        extra = VentureExtraCost.objects.get(id=extra_id)
-        q = query.filter(extra=extra)
-        cost = get_total_cost(q, start, end)
-        count, count_now, devices = get_total_count(q, start, end)
+    for extra in VentureExtraCost.objects.filter(
+            id__in=spans.extras()).select_related('venture'):
+        totals = spans.total(extra=extra.id)
         yield {
             'name': extra.name + ' (from %s)' % extra.venture.name,
             'count': 'expires %s' % extra.expire.strftime(
                 '%Y-%m-%d') if extra.expire else '',
-            'cost': cost,
-            'count_now': count_now,
+            'cost': totals['cost'],
+            'count_now': totals['count_now'],
         }
     if overlap:
-        yield _total_dict('Total', query, start, end,
+        yield _total_dict('Total', spans.total(),
                 _get_search_url(venture, type=()))
 
 
-def _venture_children(venture, children):
-    children.append(venture)
-    for child in venture.child_set.all():
-        _venture_children(child, children)
-
-
 class VenturesVenture(SidebarVentures, Base):
     template_name = 'ui/ventures-venture.html'
 
@@ -506,10 +483,8 @@ class VenturesVenture(SidebarVentures, Base):
             elif self.venture == '*':
                 query = HistoryCost.objects.exclude(venture=None)
             else:
-                ventures = []
-                _venture_children(self.venture, ventures)
                 query = HistoryCost.objects.filter(
-                    venture__in=ventures
+                    self.venture.subtree_q('venture__')
                 )
             start = self.form.cleaned_data['start']
             end = self.form.cleaned_data['end']
@@ -518,7 +493,6 @@ class VenturesVenture(SidebarVentures, Base):
             items = _get_summaries(query.all(), start, end, True, self.venture)
             cost_data = []
             count_data = []
-            one_day = datetime.timedelta(days=1)
             datapoints = set(dp for dp, in
                              query.values_list('start').distinct())
             datapoints |= set(dp for dp, in
@@ -526,13 +500,12 @@ class VenturesVenture(SidebarVentures, Base):
             datapoints |= set([start, end])
             datapoints = set(min(max(start, date or start), end) for
                              date in datapoints)
-            for date in sorted(datapoints):
+            datapoints = sorted(datapoints)
+            daily = SpanTotals(query, start, end).daily(datapoints)
+            for date, (cost, count) in zip(datapoints, daily):
                 timestamp = calendar.timegm(date.timetuple()) * 1000
-                total_cost = get_total_cost(query, date, date + one_day)
-                total_count, now_count, devices = get_total_count(
-                        query, date, date + one_day)
-                cost_data.append([timestamp, total_cost])
-                count_data.append([timestamp, total_count])
+                cost_data.append([timestamp, cost])
+                count_data.append([timestamp, count])
         ret.update({
             'items': items,
             'venture': self.venture,
@@ -565,13 +538,7 @@ class VenturesDeviceList(SidebarVentures, BaseMixin, BaseDeviceList):
                 ).select_related(depth=3)
         else:
             queryset = ReadOnlyDevice.objects.filter(
-                    db.Q(venture=self.venture) |
-                    db.Q(venture__parent=self.venture) |
-                    db.Q(venture__parent__parent=self.venture) |
-                    db.Q(venture__parent__parent__parent=self.venture) |
-                    db.Q(venture__parent__parent__parent__parent=self.venture) |
-                    db.Q(venture__parent__parent__parent__parent__parent=
-                         self.venture)
+                    self.venture.subtree_q('venture__')
                 ).select_related(depth=3)
         return self.sort_queryset(queryset)
 
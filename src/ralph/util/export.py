@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Helpers for exporting large querysets as CSV or XLS files in constant
+memory.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import cStringIO as StringIO
+
+from django.http import HttpResponse
+
+from ralph.util import csvutil
+
+
+EXPORT_CHUNK_SIZE = 1000
+
+
+class StreamingHttpResponse(HttpResponse):
+    """
+    A response streamed from an iterator, for Django 1.4, which has none.
+    Its ``content`` is empty to the middleware, so neither
+    ``GZipMiddleware`` nor ``TimingMiddleware`` join the whole iterator in
+    memory, and the response is sent as it is generated. The data are
+    available as ``streaming_content``, like in later Django versions.
+    """
+
+    streaming = True
+
+    content = property(lambda self: b'', HttpResponse._set_content)
+
+    @property
+    def streaming_content(self):
+        return iter(self)
+
+
+def iter_chunks(query, chunk_size=EXPORT_CHUNK_SIZE, select_related=()):
+    """
+    Yield lists of at most ``chunk_size`` objects from ``query``. Unordered
+    querysets are walked by primary key, resuming after the last key seen,
+    so no chunk gets more expensive than the first one. Ordered querysets,
+    including those ordered by the default ordering of the model, fetch the
+    ordered primary keys first and then the objects chunk by chunk, keeping
+    the order.
+    """
+    model = query.model
+    if query.ordered:
+        seen = set()
+        ids = []
+        for pk in query.values_list('pk', flat=True):
+            if pk not in seen:
+                seen.add(pk)
+                ids.append(pk)
+        del seen
+        for start in xrange(0, len(ids), chunk_size):
+            chunk_ids = ids[start:start + chunk_size]
+            objects = model._default_manager.filter(pk__in=chunk_ids)
+            if select_related:
+                objects = objects.select_related(*select_related)
+            by_pk = dict((obj.pk, obj) for obj in objects)
+            yield [by_pk[pk] for pk in chunk_ids if pk in by_pk]
+        return
+    last_pk = None
+    while True:
+        chunk = query.order_by('pk')
+        if select_related:
+            chunk = chunk.select_related(*select_related)
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1].pk
+
+
+def iter_csv(rows, rows_per_chunk=100):
+    """
+    Encode ``rows`` of unicode strings as CSV and yield the data in pieces,
+    suitable as the content of a streamed response.
+    """
+    f = StringIO.StringIO()
+    writer = csvutil.UnicodeWriter(f)
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % rows_per_chunk == 0:
+            yield f.getvalue()
+            f.seek(0)
+            f.truncate()
+    data = f.getvalue()
+    if data:
+        yield data
+
+
+def write_csv(f, rows):
+    """Write ``rows`` as CSV into the file ``f``, piece by piece."""
+    for data in iter_csv(rows):
+        f.write(data)
+
+
+def write_xls(output, sheets, rows_per_flush=EXPORT_CHUNK_SIZE):
+    """
+    Write an XLS workbook into ``output`` with a sheet for each ``(name,
+    rows)`` pair in ``sheets``. The row data are flushed to the sheet's
+    storage every ``rows_per_flush`` rows, so that no sheet is ever kept
+    in memory as cell objects.
+    """
+    import xlwt
+    workbook = xlwt.Workbook()
+    for name, rows in sheets:
+        worksheet = workbook.add_sheet(name)
+        for i, row in enumerate(rows):
+            for j, value in enumerate(row):
+                worksheet.write(i, j, value)
+            if (i + 1) % rows_per_flush == 0:
+                worksheet.flush_row_data()
+        worksheet.flush_row_data()
+    workbook.save(output)
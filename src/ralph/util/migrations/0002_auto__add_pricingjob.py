@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'PricingJob'
+        db.create_table('util_pricingjob', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('created', self.gf('django.db.models.fields.DateTimeField')(default=datetime.datetime.now)),
+            ('total', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('done', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+        ))
+        db.send_create_signal('util', ['PricingJob'])
+
+
+    def backwards(self, orm):
+        # Deleting model 'PricingJob'
+        db.delete_table('util_pricingjob')
+
+
+    models = {
+        'util.pricingjob': {
+            'Meta': {'ordering': "(u'-created',)", 'object_name': 'PricingJob'},
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'done': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'total': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'})
+        }
+    }
+
+    complete_apps = ['util']
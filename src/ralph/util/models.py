@@ -8,9 +8,12 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from datetime import datetime
+
 from django.db import models as db
 from django.db.utils import DatabaseError
 from django.contrib.auth.models import User
+from django.utils.translation import ugettext_lazy as _
 from tastypie.models import create_api_key
 
 def create_api_key_ignore_dberrors(*args, **kwargs):
@@ -22,6 +25,26 @@ def create_api_key_ignore_dberrors(*args, **kwargs):
 db.signals.post_save.connect(create_api_key_ignore_dberrors, sender=User)
 
 
+class PricingJob(db.Model):
+    """Progress of a background recalculation of the cached prices, kept in
+    the database so that every process sees it."""
+
+    created = db.DateTimeField(verbose_name=_("created"),
+                               default=datetime.now)
+    total = db.PositiveIntegerField(verbose_name=_("number of devices"),
+                                    default=0)
+    done = db.PositiveIntegerField(verbose_name=_("devices done"),
+                                   default=0)
+
+    class Meta:
+        verbose_name = _("pricing job")
+        verbose_name_plural = _("pricing jobs")
+        ordering = ('-created',)
+
+    def __unicode__(self):
+        return "{} ({} of {})".format(self.created, self.done, self.total)
+
+
 # workaround for a unit test bug in Django 1.4.x
 
 from django.contrib.auth.tests import models as auth_test_models
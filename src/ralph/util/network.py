@@ -9,8 +9,15 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import collections
+import os
+import re
+import select
 import socket
+import struct
 import sys
+import threading
+import time
 import StringIO
 
 from dns.exception import DNSException
@@ -30,6 +37,21 @@ class ConnectError(Error):
 class AuthError(Error):
     pass
 
+class ConsoleError(Error):
+    pass
+
+class ConsoleTimeout(ConsoleError):
+    pass
+
+
+# seconds after which an unused pooled SSH connection is closed
+SSH_POOL_IDLE_TIMEOUT = 300
+# OpenSSH allows 10 sessions per connection by default
+SSH_MAX_CHANNELS = 8
+# seconds to wait for more output of an interactive shell
+SSH_SHELL_TIMEOUT = 30
+SSH_SHELL_RECV_SIZE = 32768
+
 
 @memoize
 def hostname(ip, reverse=False):
@@ -73,6 +95,110 @@ def ping(hostname, timeout=0.2, attempts=2, packet_size=64):
             result = None
     return result
 
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+
+def _icmp_checksum(data):
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack(b'!%dH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def _icmp_echo_request(ident, seq, packet_size=64):
+    payload = b'Q' * max(packet_size - 8, 0)
+    header = struct.pack(b'!BBHHH', ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    checksum = _icmp_checksum(header + payload)
+    header = struct.pack(b'!BBHHH', ICMP_ECHO_REQUEST, 0, checksum, ident,
+                         seq)
+    return header + payload
+
+
+def _icmp_echo_reply(packet):
+    """_icmp_echo_reply(packet) -> (ident, seq) or None
+
+    Parses a raw IPv4 packet as received on an ICMP socket. Returns the
+    identifier and sequence number if it holds an echo reply."""
+    if len(packet) < 20:
+        return None
+    header_length = (ord(packet[0]) & 0x0f) * 4
+    icmp = packet[header_length:header_length + 8]
+    if len(icmp) < 8:
+        return None
+    icmp_type, code, checksum, ident, seq = struct.unpack(b'!BBHHH', icmp)
+    if icmp_type != ICMP_ECHO_REPLY:
+        return None
+    return ident, seq
+
+
+def ping_sweep(hosts, timeout=0.2, attempts=2, packet_size=64,
+               batch_size=1024):
+    """ping_sweep(hosts, [timeout, attempts, packet_size, batch_size]) ->
+    generator of (host, delay)
+
+    Pings many IPv4 `hosts` at once from a single raw socket and yields only
+    the ones that answered, together with the ping value. Up to `batch_size`
+    probes are in flight at the same time, replies are matched by ICMP
+    identifier and sequence number. Non-responding hosts are probed again
+    up to `attempts` times. Raises socket.error if a raw socket cannot be
+    opened."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_RAW,
+                         socket.getprotobyname(b'icmp'))
+    ident = os.getpid() & 0xffff
+    try:
+        batch = []
+        for host in hosts:
+            batch.append(str(host))
+            if len(batch) >= batch_size:
+                for result in _sweep_batch(sock, ident, batch, timeout,
+                                           attempts, packet_size):
+                    yield result
+                batch = []
+        if batch:
+            for result in _sweep_batch(sock, ident, batch, timeout,
+                                       attempts, packet_size):
+                yield result
+    finally:
+        sock.close()
+
+
+def _sweep_batch(sock, ident, batch, timeout, attempts, packet_size):
+    pending = dict(enumerate(batch))
+    for attempt in xrange(attempts):
+        sent = {}
+        for seq, address in pending.iteritems():
+            try:
+                sock.sendto(_icmp_echo_request(ident, seq, packet_size),
+                            (address, 0))
+            except socket.error:
+                # e.g. ENOBUFS or an unroutable address, retry next attempt
+                continue
+            sent[seq] = time.time()
+        deadline = time.time() + timeout
+        while sent:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            readable, _, _ = select.select([sock], [], [], remaining)
+            if not readable:
+                break
+            packet, (address, port) = sock.recvfrom(1024)
+            received = time.time()
+            reply = _icmp_echo_reply(packet)
+            if not reply or reply[0] != ident:
+                continue
+            seq = reply[1]
+            if seq not in sent or pending.get(seq) != address:
+                continue
+            yield address, received - sent.pop(seq)
+            del pending[seq]
+        if not pending:
+            break
+
+
 def ping_main(hostname=None, timeout=0.2, attempts=2):
     """ping as a command. Installed as pping by setuptools."""
     # FIXME: This needs proper argparse support.
@@ -91,7 +217,58 @@ def check_tcp_port(ip, port, timeout=1):
     return result == 0
 
 
-def connect_ssh(ip, username, password=None, client=paramiko.SSHClient, key=None):
+class SSHClient(paramiko.SSHClient):
+    """A paramiko SSH client that can run a batch of commands at once and
+    that goes back to its pool instead of closing, if it came from one."""
+
+    pool = None
+    pool_key = None
+
+    def exec_commands(self, commands, max_channels=SSH_MAX_CHANNELS):
+        """exec_commands(commands, [max_channels]) -> list of outputs
+
+        Runs all the `commands`, up to `max_channels` at a time, each on its
+        own channel of the same connection, and returns their standard
+        outputs in the order of the commands."""
+        commands = list(commands)
+        outputs = []
+        transport = self.get_transport()
+        for start in xrange(0, len(commands), max_channels):
+            channels = []
+            for command in commands[start:start + max_channels]:
+                channel = transport.open_session()
+                channel.exec_command(command)
+                channels.append(channel)
+            for channel in channels:
+                try:
+                    outputs.append(channel.makefile('rb', -1).read())
+                finally:
+                    channel.close()
+        return outputs
+
+    def is_healthy(self):
+        transport = self.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except (socket.error, EOFError, paramiko.SSHException):
+            return False
+        return True
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.release(self)
+        else:
+            super(SSHClient, self).close()
+
+    def discard(self):
+        """Close the connection for good, even if it came from a pool."""
+        self.pool = None
+        super(SSHClient, self).close()
+
+
+def connect_ssh(ip, username, password=None, client=SSHClient, key=None):
     ssh = client()
     ssh.set_log_channel('critical_only')
     ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
@@ -107,6 +284,231 @@ def connect_ssh(ip, username, password=None, client=paramiko.SSHClient, key=None
     return ssh
 
 
+class SSHPool(object):
+    """Authenticated SSH connections kept open for reuse, by IP address and
+    user name. Closing a client taken from the pool puts it back, and it is
+    closed for good only after staying unused for `idle_timeout` seconds.
+    Every process has its own connections."""
+
+    def __init__(self, idle_timeout=SSH_POOL_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.idle = {}
+
+    def _check_pid(self):
+        if self.pid != os.getpid():
+            # connections inherited from the parent process can't be shared
+            self.pid = os.getpid()
+            self.idle = {}
+
+    def _expire(self, now):
+        expired = []
+        for key, clients in self.idle.items():
+            while clients and clients[0][0] < now - self.idle_timeout:
+                expired.append(clients.pop(0)[1])
+            if not clients:
+                del self.idle[key]
+        return expired
+
+    def connect(self, ip, username, password=None, key=None):
+        """connect(ip, username, [password, key]) -> SSHClient
+
+        Returns a working connection from the pool, or a new one."""
+        pool_key = ip, username
+        while True:
+            with self.lock:
+                self._check_pid()
+                expired = self._expire(time.time())
+                clients = self.idle.get(pool_key)
+                ssh = clients.pop()[1] if clients else None
+            for client in expired:
+                client.discard()
+            if ssh is None:
+                break
+            if ssh.is_healthy():
+                ssh.pool = self
+                return ssh
+            ssh.discard()
+        ssh = connect_ssh(ip, username, password, key=key)
+        ssh.pool = self
+        ssh.pool_key = pool_key
+        return ssh
+
+    def release(self, ssh):
+        ssh.pool = None
+        if not ssh.is_healthy():
+            ssh.discard()
+            return
+        with self.lock:
+            self._check_pid()
+            self.idle.setdefault(ssh.pool_key, []).append((time.time(), ssh))
+
+    def clear(self):
+        """Close all the idle connections."""
+        with self.lock:
+            clients = [ssh for clients in self.idle.itervalues()
+                       for released, ssh in clients]
+            self.idle = {}
+        for ssh in clients:
+            ssh.discard()
+
+
+SSH_POOL = SSHPool()
+
+
+def pooled_ssh(ip, username, password=None, key=None):
+    """pooled_ssh(ip, username, [password, key]) -> SSHClient
+
+    Like `connect_ssh`, but reuses the connections of SSH_POOL. Call
+    `close()` on the client when done to give it back."""
+    return SSH_POOL.connect(ip, username, password, key)
+
+
+class Shell(object):
+    """An interactive shell on an SSH channel of a device with a command-line
+    prompt, like the consoles of management modules and switches.
+
+    The output is read into a buffer until the `prompt` regular expression
+    matches the last, unfinished line. Every read waits at most `timeout`
+    seconds. When `pager` matches the last line instead, `pager_reply` is
+    sent to get the next page. Every command is typed and its echo awaited
+    before it is confirmed with `newline`, and with `prefix` it is preceded
+    by those characters, for consoles that garble the beginning of a
+    line."""
+
+    def __init__(self, channel, prompt, timeout=SSH_SHELL_TIMEOUT,
+                 newline=b'\r\n', prefix=None, pager=None, pager_reply=b'\n'):
+        self.channel = channel
+        self.prompt = re.compile(prompt)
+        self.newline = newline
+        self.prefix = prefix
+        self.pager = re.compile(pager) if pager else None
+        self.pager_reply = pager_reply
+        self.buffer = b''
+        self.channel.settimeout(timeout)
+
+    def _recv(self):
+        try:
+            chunk = self.channel.recv(SSH_SHELL_RECV_SIZE)
+        except socket.timeout:
+            raise ConsoleTimeout('No prompt, got %r.' % self.buffer[-256:])
+        if not chunk:
+            raise ConsoleError('The shell was closed, got %r.' %
+                               self.buffer[-256:])
+        self.buffer += chunk
+
+    def _last_line(self):
+        return self.buffer.rsplit(b'\n', 1)[-1]
+
+    def wait_prompt(self):
+        """Read everything until the prompt and return it."""
+        return b'\n'.join(self.lines())
+
+    def send(self, command):
+        """Type the command and confirm it, without waiting for its output.
+        Anything left in the buffer before is discarded."""
+        self.buffer = b''
+        if self.prefix:
+            self.channel.sendall(self.prefix)
+            time.sleep(0.125)
+        self.channel.sendall(command)
+        end = command[-32:]
+        while end not in self.buffer:
+            self._recv()
+        self.buffer = self.buffer.split(end, 1)[1]
+        self.channel.sendall(self.newline)
+        # the rest of the echoed line
+        while b'\n' not in self.buffer:
+            self._recv()
+        self.buffer = self.buffer.split(b'\n', 1)[1]
+
+    def lines(self):
+        """Yield the lines of output as they come, until the prompt. The
+        prompt itself is consumed."""
+        while True:
+            while b'\n' in self.buffer:
+                line, self.buffer = self.buffer.split(b'\n', 1)
+                yield line.rstrip(b'\r')
+            last = self._last_line()
+            if self.prompt.search(last):
+                self.buffer = b''
+                return
+            if self.pager and self.pager.search(last):
+                self.buffer = b''
+                self.channel.sendall(self.pager_reply)
+            self._recv()
+
+    def command(self, command, parse=list):
+        """command(command, [parse]) -> result
+
+        Run the command and return the result of `parse` called with an
+        iterator over the lines of its output, by default their list."""
+        self.send(command)
+        return _parse_all(parse, self.lines())
+
+    def close(self):
+        self.channel.close()
+
+
+def _parse_all(parse, lines):
+    try:
+        return parse(lines)
+    finally:
+        # skip what the parser didn't need, up to the prompt
+        for line in lines:
+            pass
+
+
+def open_shell(ssh, prompt, pty=False, **kwargs):
+    """open_shell(ssh, prompt, [pty, timeout, newline, ...]) -> Shell
+
+    Opens a new interactive shell on the connection, with a terminal if
+    `pty` is set, and waits for the prompt. The other arguments are the same
+    as of `Shell`."""
+    channel = ssh.get_transport().open_session()
+    if pty:
+        channel.get_pty()
+    channel.invoke_shell()
+    shell = Shell(channel, prompt, **kwargs)
+    channel.sendall(shell.newline)
+    try:
+        shell.wait_prompt()
+    except ConsoleError:
+        channel.close()
+        raise ConsoleError('Expected a system prompt, got %r.' %
+                           shell.buffer[-256:])
+    return shell
+
+
+def run_commands(shells, commands, parse=list):
+    """run_commands(shells, commands, [parse]) -> list of results
+
+    Runs the queue of `commands` on the `shells` and returns the results of
+    `parse` called with the lines of output of every command, in the order
+    of the commands. The first commands go to the shells in their order.
+    The outputs are read from the shells in turn and parsed as they come,
+    while the other shells keep working, and every shell gets the next
+    command from the queue as soon as the output of the last one is read."""
+    queue = collections.deque(enumerate(commands))
+    running = collections.deque()
+    results = [None] * len(queue)
+
+    def start(shell):
+        if queue:
+            index, command = queue.popleft()
+            shell.send(command)
+            running.append((shell, index))
+
+    for shell in shells:
+        start(shell)
+    while running:
+        shell, index = running.popleft()
+        results[index] = _parse_all(parse, shell.lines())
+        start(shell)
+    return results
+
+
 def validate_ip(address):
     ip = ipaddr.IPAddress(address)
     if ip.is_unspecified or ip.is_loopback or ip.is_link_local:
@@ -10,12 +10,118 @@ from __future__ import unicode_literals
 BY_NAME = {}
 BY_REQUIREMENTS = {}
 PRIORITIES = {}
+_COMPILED = {}
 
 
 class Restart(Exception):
     pass
 
 
+class Graph(object):
+    """
+    An immutable, indexed form of the requirements of a single chain.
+
+    Every plugin and every requirement gets a bit, so that checking whether
+    the requirements of a plugin are met is a single mask comparison.
+    `unlocks` maps each requirement to the plugins that need it, and `order`
+    lists all plugins from the highest priority down, ties broken by name.
+    """
+
+    def __init__(self, chain):
+        requirements = BY_REQUIREMENTS.get(chain, {})
+        priorities = PRIORITIES.get(chain, {})
+        names = set()
+        for reqs, plugins in requirements.iteritems():
+            names.update(reqs)
+            names.update(plugins)
+        self.bits = dict((name, 1 << i)
+                         for i, name in enumerate(sorted(names)))
+        self.needs = {}
+        self.requires = {}
+        unlocks = {}
+        roots = []
+        for reqs, plugins in requirements.iteritems():
+            mask = self.mask(reqs)
+            for name in plugins:
+                self.needs[name] = mask
+                self.requires[name] = reqs
+                if not reqs:
+                    roots.append(name)
+                for req in reqs:
+                    unlocks.setdefault(req, []).append(name)
+        self.order = tuple(sorted(self.needs,
+                                  key=lambda p: (-priorities.get(p, 100), p)))
+        self.rank = dict((name, i) for i, name in enumerate(self.order))
+        self.roots = frozenset(roots)
+        self.unlocks = dict((req, frozenset(plugins))
+                            for req, plugins in unlocks.iteritems())
+
+    def mask(self, names):
+        bits = self.bits
+        mask = 0
+        for name in names:
+            mask |= bits.get(name, 0)
+        return mask
+
+    def next(self, done_reqs):
+        if not isinstance(done_reqs, (set, frozenset)):
+            done_reqs = set(done_reqs)
+        unlocks = self.unlocks
+        candidates = set(self.roots)
+        candidates.update(*[unlocks[req] for req in done_reqs
+                            if req in unlocks])
+        requires = self.requires
+        return set(p for p in candidates if requires[p] <= done_reqs)
+
+    def prioritize(self, plugins):
+        rank = self.rank
+        return sorted(plugins, key=lambda p: rank.get(p, len(rank)))
+
+
+class Schedule(object):
+    """
+    Incrementally tracks which plugins of a chain are ready to run. Each call
+    to `complete` only looks at the plugins unlocked by the finished one.
+    """
+
+    def __init__(self, chain, done_reqs=(), done=()):
+        self.graph = compiled(chain)
+        self.mask = self.graph.mask(done_reqs)
+        self.done = set(done)
+        self.candidates = set(self.graph.roots)
+        for req in done_reqs:
+            self.candidates.update(self.graph.unlocks.get(req, ()))
+        self.candidates -= self.done
+
+    def complete(self, name, is_up):
+        self.done.add(name)
+        self.candidates.discard(name)
+        if is_up:
+            self.mask |= self.graph.bits.get(name, 0)
+            self.candidates.update(
+                self.graph.unlocks.get(name, frozenset()) - self.done)
+
+    def ready(self):
+        """Return the plugins that can be run now, highest priority first."""
+        needs = self.graph.needs
+        mask = self.mask
+        return self.graph.prioritize(p for p in self.candidates
+                                     if needs[p] & mask == needs[p])
+
+
+def compiled(chain):
+    """
+    Return the compiled `Graph` of a chain. It is built on first use and
+    rebuilt after the chain changes.
+    """
+
+    try:
+        return _COMPILED[chain]
+    except KeyError:
+        graph = _COMPILED[chain] = Graph(chain)
+        return graph
+
+
 def register(func=None, chain="default", requires=None, priority=None):
     """
     A decorator that registers a function as plugin.
@@ -32,6 +138,7 @@ def register(func=None, chain="default", requires=None, priority=None):
     BY_REQUIREMENTS.setdefault(chain, {}).setdefault(frozenset(requires),
         []).append(func.func_name)
     PRIORITIES.setdefault(chain, {})[func.func_name] = priority or 100
+    _COMPILED.pop(chain, None)
     return func
 
 def next(chain, done_reqs):
@@ -40,21 +147,25 @@ def next(chain, done_reqs):
     that has already been ran.
     """
 
-    ret = set()
     if chain not in BY_REQUIREMENTS:
-        return ret
-    done_reqs = set(done_reqs)
-    for needed_reqs, plugins in BY_REQUIREMENTS[chain].iteritems():
-        if needed_reqs <= done_reqs:
-            ret |= set(plugins)
-    return ret
+        return set()
+    return compiled(chain).next(done_reqs)
+
+def ready(chain, done_reqs, done):
+    """
+    Return the plugins whose requirements are satisfied by `done_reqs` and
+    which are not in `done` yet, highest priority first. Plugins with equal
+    priority are ordered by name so that the order is deterministic.
+    """
+
+    return prioritize(chain, next(chain, done_reqs) - set(done))
 
 def highest_priority(chain, plugins):
-    ret = max(plugins, key=lambda p: PRIORITIES.get(chain, {}).get(p, 100))
-    return ret
+    rank = compiled(chain).rank
+    return min(plugins, key=lambda p: rank.get(p, len(rank)))
 
 def prioritize(chain, reqs):
-    return sorted(reqs, key=lambda p: -PRIORITIES.get(chain, {}).get(p, 100))
+    return compiled(chain).prioritize(reqs)
 
 def run(chain, func_name, **kwargs):
     """
@@ -79,3 +190,4 @@ def purge(plugin_set):
                     to_delete.add(p)
             for p in to_delete:
                 pv.remove(p)
+    plugin._COMPILED.clear()
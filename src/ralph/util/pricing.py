@@ -8,6 +8,7 @@ from __future__ import unicode_literals
 
 import math
 
+from collections import defaultdict
 from datetime import date, timedelta, datetime, time
 from django.core.urlresolvers import reverse_lazy
 from django.db import models as db
@@ -15,7 +16,16 @@ from django.utils.html import escape
 from django.conf import settings
 
 from ralph.discovery.models import (DeviceType, ComponentModelGroup, DiskShare,
-                                    EthernetSpeed, OperatingSystem)
+                                    EthernetSpeed, OperatingSystem, Device,
+                                    DeprecationKind, DiskShareMount,
+                                    FibreChannel, GenericComponent, IPAddress,
+                                    Memory, Processor, Software, SplunkUsage,
+                                    Storage)
+from ralph.discovery.models_component import cores_from_model
+
+
+# Maximum number of ids passed in a single ``__in`` lookup.
+BULK_CHUNK_SIZE = 500
 
 
 def get_device_price(device):
@@ -235,24 +245,544 @@ def get_device_auto_price(device):
 
 
 def device_update_cached(device):
-    stack = [device]
-    devices = [device]
-    visited = {device}
-    while stack:
-        device = stack.pop()
-        devices.append(device)
-        for d in device.child_set.all():
-            if d in visited:
-                # Make sure we don't do the same device twice.
+    """Update the cached name, price and cost of the device and all the
+    devices inside it."""
+    result = PricingEngine([device.id], instances=[device]).save()
+    if device.id in result:
+        device.name, device.cached_price, device.cached_cost = (
+            result[device.id])
+
+
+def _chunks(items, size=BULK_CHUNK_SIZE):
+    items = list(items)
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _query_chunked(query, lookup, ids, *fields):
+    """Run ``query.filter(<lookup>=<chunk of ids>).values(*fields)`` for
+    every chunk of `ids` and chain the results."""
+    for chunk in _chunks(ids):
+        for row in query.filter(**{lookup: chunk}).values(*fields):
+            yield row
+
+
+MODEL_FIELDS = ('model', 'model__size', 'model__cores', 'model__name',
+                'model__group', 'model__group__price',
+                'model__group__per_size', 'model__group__size_modifier')
+
+
+def _model_price(row, size=None):
+    """Same as ``ComponentModel.get_price`` for a row of MODEL_FIELDS."""
+    if row['model__group'] is None:
+        return 0
+    if row['model__group__per_size']:
+        if not size:
+            size = row['model__size']
+        return (size / (row['model__group__size_modifier'] or 1) *
+                (row['model__group__price'] or 0))
+    return row['model__group__price'] or 0
+
+
+def _component_price(row, size=0):
+    """Same as ``Component.get_price`` for a row of MODEL_FIELDS."""
+    if row['model'] is None:
+        return 0
+    return _model_price(row, row['model__size'] or size or 0)
+
+
+def _processor_price(row):
+    """Same as ``Processor.get_price``, including the core count guess made
+    in ``Processor.__init__``."""
+    if row['model'] is None:
+        return 0
+    if row['model__cores']:
+        cores = row['model__cores']
+    else:
+        cores = max(1, row['model__cores'], row['cores'] or 0,
+                    row['model__size'], cores_from_model(row['model__name']))
+    return _component_price(row, cores)
+
+
+class PricingEngine(object):
+    """
+    Computes the same prices and costs as ``get_device_price`` and
+    ``get_device_cost``, but for many devices at once. All the components,
+    model groups, disk share mounts, deprecation kinds and margins are loaded
+    with a fixed number of queries (per chunk of ``BULK_CHUNK_SIZE`` devices)
+    and the computation is done in memory.
+    """
+
+    DEVICE_FIELDS = (
+        'id', 'parent', 'name', 'price', 'deprecation_date',
+        'cached_price', 'cached_cost', 'model', 'model__type',
+        'model__group', 'model__group__price', 'model__group__slots',
+        'deprecation_kind', 'deprecation_kind__months', 'margin_kind',
+        'margin_kind__margin', 'venture',
+    )
+    NAMED_GROUPS = (
+        'OS Detected CPU', 'Default CPU', 'OS Detected Memory',
+        'Default Memory', 'OS Detected Storage', 'Default Disk',
+    )
+
+    def __init__(self, device_ids, descendants=True, instances=()):
+        self.devices = {}
+        self.children = defaultdict(list)
+        self.updated_ids = set()
+        self._raw_prices = {}
+        self._prices = {}
+        self._load_devices(device_ids, descendants)
+        for device in instances:
+            self._use_instance(device)
+        self._load_components()
+
+    def _use_instance(self, device):
+        """Price ``device`` the way it is in memory, not in the database."""
+        row = self.devices.get(device.id)
+        if row is None:
+            return
+        row.update(
+            parent=device.parent_id, name=device.name, price=device.price,
+            deprecation_date=device.deprecation_date,
+            venture=device.venture_id, model=None, model__type=None,
+            model__group=None, model__group__price=None,
+            model__group__slots=None, deprecation_kind=None,
+            deprecation_kind__months=None, margin_kind=None,
+            margin_kind__margin=None,
+        )
+        if device.model:
+            row.update(model=device.model.id, model__type=device.model.type)
+            group = device.model.group
+            if group:
+                row.update(model__group=group.id,
+                           model__group__price=group.price,
+                           model__group__slots=group.slots)
+        if device.deprecation_kind:
+            row.update(deprecation_kind=device.deprecation_kind.id,
+                       deprecation_kind__months=device.deprecation_kind.months)
+        if device.margin_kind:
+            row.update(margin_kind=device.margin_kind.id,
+                       margin_kind__margin=device.margin_kind.margin)
+
+    def _add_devices(self, rows):
+        added = []
+        for row in rows:
+            if row['id'] in self.devices:
                 continue
-            visited.add(d)
-            stack.append(d)
-    devices.reverse()   # Do the children before their parent.
-    for d in devices:
-        d.name = d.get_name()
-        d.cached_price = get_device_price(d)
-        d.cached_cost = get_device_cost(d)
-        d.save()
+            self.devices[row['id']] = row
+            added.append(row['id'])
+        return added
+
+    def _load_devices(self, device_ids, descendants):
+        # The descendants are always needed to price their parents, but only
+        # get updated if `descendants` is True.
+        level = self._add_devices(_query_chunked(
+            Device.admin_objects, 'id__in', device_ids, *self.DEVICE_FIELDS))
+        self.updated_ids.update(level)
+        while level:
+            if descendants:
+                self.updated_ids.update(level)
+            # Same manager as the one used by ``device.child_set``.
+            rows = list(_query_chunked(
+                Device._default_manager, 'parent__in', level,
+                *self.DEVICE_FIELDS))
+            for row in rows:
+                self.children[row['parent']].append(row)
+            level = self._add_devices(rows)
+        for rows in self.children.itervalues():
+            rows.sort(key=lambda row: row['id'])
+        # Blade systems are needed for the chassis part of blade prices.
+        parent_ids = {
+            row['parent'] for row in self.devices.itervalues()
+            if row['model__type'] == DeviceType.blade_server.id and
+            row['parent'] and row['parent'] not in self.devices
+        }
+        self._add_devices(_query_chunked(
+            Device.admin_objects, 'id__in', parent_ids, *self.DEVICE_FIELDS))
+
+    def _group_by_device(self, query, *fields):
+        result = defaultdict(list)
+        for row in _query_chunked(query, 'device__in', self.devices,
+                                  'device', *fields):
+            result[row['device']].append(row)
+        return result
+
+    def _load_components(self):
+        self.processors = self._group_by_device(
+            Processor.objects, 'cores', *MODEL_FIELDS)
+        self.memory = self._group_by_device(Memory.objects, 'size',
+                                            *MODEL_FIELDS)
+        self.storage = self._group_by_device(Storage.objects, 'size',
+                                             *MODEL_FIELDS)
+        self.generic = self._group_by_device(GenericComponent.objects,
+                                             *MODEL_FIELDS)
+        self.fibre = self._group_by_device(FibreChannel.objects,
+                                           *MODEL_FIELDS)
+        self.software = self._group_by_device(Software.objects, *MODEL_FIELDS)
+        self.systems = self._group_by_device(
+            OperatingSystem.objects, 'cores_count', 'memory', 'storage',
+            *MODEL_FIELDS)
+        self.shares = self._group_by_device(
+            DiskShare.objects, 'id', 'size', 'snapshot_size', 'model',
+            'model__group', 'model__group__price')
+        self.mounts = self._group_by_device(
+            DiskShareMount.objects, 'size', 'share', 'share__size',
+            'share__snapshot_size', 'share__model',
+            'share__model__group', 'share__model__group__price')
+        last_month = date.today() - timedelta(days=31)
+        self.splunk = self._group_by_device(
+            SplunkUsage.objects.filter(day__gte=last_month).order_by(
+                'device', '-day'), 'size', *MODEL_FIELDS)
+        share_ids = {s['id'] for rows in self.shares.itervalues()
+                     for s in rows}
+        share_ids.update(m['share'] for rows in self.mounts.itervalues()
+                         for m in rows)
+        self.share_mounts = defaultdict(int)
+        self.share_physical_mounts = defaultdict(int)
+        for chunk in _chunks(share_ids):
+            for row in DiskShareMount.objects.exclude(device=None).filter(
+                    share__in=chunk).values('share', 'is_virtual'
+                    ).annotate(count=db.Count('id')).order_by():
+                self.share_mounts[row['share']] += row['count']
+                if not row['is_virtual']:
+                    self.share_physical_mounts[row['share']] += (
+                        row['count'])
+        self.groups = {
+            g.name: g for g in
+            ComponentModelGroup.objects.filter(name__in=self.NAMED_GROUPS)
+        }
+        try:
+            self.default_deprecation_kind = DeprecationKind.objects.get(
+                default=True)
+        except DeprecationKind.DoesNotExist:
+            self.default_deprecation_kind = None
+        self.ventures = {}
+        # Imported here, as this module is loaded by the discovery plugins.
+        from ralph.business.models import Venture
+        if any(d['venture'] and not d['margin_kind']
+               for d in self.devices.itervalues()):
+            self.ventures = {
+                v['id']: v for v in Venture.objects.values(
+                    'id', 'parent', 'margin_kind',
+                    'margin_kind__margin')
+            }
+
+    def _os(self, device_id):
+        for row in self.systems.get(device_id, []):
+            return row
+        return None
+
+    def _share_price(self, share):
+        if share['model'] is None or share['model__group'] is None:
+            return 0
+        total_size = (share['size'] or 0) + (share['snapshot_size'] or 0)
+        return (share['model__group__price'] or 0) * total_size / 1024
+
+    def _mount_size(self, mount):
+        return mount['size'] or ((mount['share__size'] or 0) +
+                                 (mount['share__snapshot_size'] or 0))
+
+    def _mount_price(self, mount):
+        if (mount['size'] and mount['share__model'] is not None and
+                mount['share__model__group'] is not None):
+            return ((mount['share__model__group__price'] or 0) *
+                    self._mount_size(mount) / 1024)
+        share_price = self._share_price({
+            'model': mount['share__model'],
+            'model__group': mount['share__model__group'],
+            'model__group__price': mount['share__model__group__price'],
+            'size': mount['share__size'],
+            'snapshot_size': mount['share__snapshot_size'],
+        })
+        return share_price / (
+            self.share_physical_mounts[mount['share']] or 1)
+
+    def cpu_price(self, device):
+        price = math.fsum(_processor_price(cpu)
+                          for cpu in self.processors.get(device['id'], []))
+        if not price and device['model'] and device['model__type'] in {
+                DeviceType.rack_server.id, DeviceType.blade_server.id}:
+            os = self._os(device['id'])
+            group = self.groups.get('OS Detected CPU')
+            if os and group and os['cores_count']:
+                return os['cores_count'] * group.price
+            group = self.groups.get('Default CPU')
+            if group:
+                return group.price
+        return price
+
+    def memory_price(self, device):
+        price = math.fsum(
+            _component_price(m, m['size']) for m in
+            self.memory.get(device['id'], []) if m['model'] is not None)
+        if not price and device['model'] and device['model__type'] in (
+                DeviceType.rack_server.id, DeviceType.blade_server.id,
+                DeviceType.virtual_server.id):
+            os = self._os(device['id'])
+            group = self.groups.get('OS Detected Memory')
+            if os and group:
+                if not group.per_size:
+                    return group.price or 0
+                if os['memory']:
+                    return (os['memory'] / (group.size_modifier or 1) *
+                            (group.price or 0))
+            group = self.groups.get('Default Memory')
+            if group:
+                return group.price
+        return price
+
+    def local_storage_price(self, device):
+        price = math.fsum(_component_price(s, s['size'])
+                          for s in self.storage.get(device['id'], []))
+        if not price and device['model'] and device['model__type'] in (
+                DeviceType.rack_server.id, DeviceType.blade_server.id,
+                DeviceType.virtual_server.id):
+            os = self._os(device['id'])
+            group = self.groups.get('OS Detected Storage')
+            if os and group:
+                if not group.per_size:
+                    return group.price or 0
+                storage = os['storage'] or 0
+                storage -= math.fsum(self._mount_size(m) for m in
+                                     self.mounts.get(device['id'], []))
+                if storage > 0:
+                    return (storage / (group.size_modifier or 1) *
+                            (group.price or 0))
+            if device['model__type'] != DeviceType.virtual_server.id:
+                group = self.groups.get('Default Disk')
+                if group:
+                    return group.price
+        return price
+
+    def auto_price(self, device):
+        device_id = device['id']
+        model_price = (device['model__group__price'] or 0) if (
+            device['model'] and device['model__group']) else 0
+        return math.fsum([
+            model_price,
+            self.memory_price(device),
+            self.cpu_price(device),
+            self.local_storage_price(device),
+            math.fsum(_component_price(c)
+                      for c in self.generic.get(device_id, [])),
+            math.fsum(_component_price(c)
+                      for c in self.fibre.get(device_id, [])),
+            math.fsum(_component_price(c)
+                      for c in self.software.get(device_id, [])),
+            math.fsum(_component_price(c)
+                      for c in self.systems.get(device_id, [])),
+        ])
+
+    def raw_price(self, device_id):
+        if device_id not in self._raw_prices:
+            device = self.devices[device_id]
+            today_midnight = datetime.combine(datetime.today(), time())
+            if (device['deprecation_date'] and
+                    today_midnight >= device['deprecation_date']):
+                price = 0
+            else:
+                price = device['price'] or self.auto_price(device)
+            self._raw_prices[device_id] = price
+        return self._raw_prices[device_id]
+
+    def chassis_price(self, device):
+        parent = self.devices.get(device['parent'])
+        if (device['model'] and device['model__group'] and
+                device['model__group__slots'] and parent and
+                parent['model'] and parent['model__group'] and
+                parent['model__group__slots']):
+            return (device['model__group__slots'] *
+                    self.raw_price(parent['id']) /
+                    parent['model__group__slots'])
+        return 0
+
+    def external_price(self, device):
+        device_id = device['id']
+        children = self.children.get(device_id, [])
+        price = 0
+        price -= math.fsum(
+            self.price(child['id']) for child in children
+            if child['model__type'] == DeviceType.virtual_server.id)
+        price -= math.fsum(
+            self._share_price(share) for share in
+            self.shares.get(device_id, []) if self.share_mounts[share['id']])
+        if device['model'] and (
+                device['model__type'] == DeviceType.blade_system.id):
+            for child in children:
+                if child['model__type'] == DeviceType.blade_server.id:
+                    price -= self.chassis_price(child)
+        elif device['model'] and (
+                device['model__type'] == DeviceType.blade_server.id):
+            price += self.chassis_price(device)
+        price += math.fsum(self._mount_price(m)
+                           for m in self.mounts.get(device_id, []))
+        return price
+
+    def price(self, device_id):
+        """Same as ``get_device_price``."""
+        if device_id not in self._prices:
+            self._prices[device_id] = max(
+                0,
+                self.raw_price(device_id) +
+                self.external_price(self.devices[device_id]),
+            )
+        return self._prices[device_id]
+
+    def margin(self, device):
+        if device['margin_kind']:
+            return device['margin_kind__margin']
+        venture = self.ventures.get(device['venture'])
+        visited = set()
+        while venture and venture['id'] not in visited:
+            visited.add(venture['id'])
+            if venture['margin_kind']:
+                return venture['margin_kind__margin']
+            venture = self.ventures.get(venture['parent'])
+        return 0
+
+    def additional_costs(self, device):
+        usages = self.splunk.get(device['id'])
+        if not usages:
+            return 0
+        size = sum(u['size'] for u in usages if u['size'] is not None)
+        latest = usages[0]
+        if latest['model'] is None:
+            return 0
+        return _model_price(latest, size or latest['size'])
+
+    def cost(self, device_id):
+        """Same as ``get_device_cost``."""
+        device = self.devices[device_id]
+        price = self.price(device_id)
+        if device['deprecation_kind']:
+            cost = price / device['deprecation_kind__months']
+        elif self.default_deprecation_kind:
+            cost = price / self.default_deprecation_kind.months
+        else:
+            cost = 0
+        margin = self.margin(device) or 0
+        return cost * (1 + margin / 100) + self.additional_costs(device)
+
+    def names(self):
+        """Same as ``Device.get_name`` for all the updated devices."""
+        names = {}
+        fallbacks = {}
+        for ip in _query_chunked(
+                IPAddress.objects.order_by('device', 'is_management',
+                                           '-last_seen', '-address'),
+                'device__in', self.updated_ids, 'device', 'hostname',
+                'address'):
+            device_id = ip['device']
+            fallbacks.setdefault(device_id, ip['hostname'] or ip['address'])
+            if ip['hostname'] is not None:
+                names.setdefault(device_id, ip['hostname'])
+        result = {}
+        for device_id in self.updated_ids:
+            device = self.devices[device_id]
+            if device['model'] and device['model__type'] in (
+                    DeviceType.rack.id, DeviceType.data_center.id):
+                result[device_id] = device['name']
+            else:
+                result[device_id] = names.get(
+                    device_id, fallbacks.get(device_id, 'unknown'))
+        return result
+
+    def save(self):
+        """
+        Write ``name``, ``cached_price`` and ``cached_cost`` of all the
+        updated devices. Devices with a new name or a cost change that
+        starts a new ``HistoryCost`` span are saved normally, so that the
+        history hooks run. The rest is written with one bulk update per
+        distinct price and cost. Returns a dict of id -> (name, price, cost).
+        """
+        result = {}
+        to_save = {}
+        to_update = defaultdict(list)
+        for device_id, name in self.names().iteritems():
+            device = self.devices[device_id]
+            price = self.price(device_id)
+            cost = self.cost(device_id)
+            result[device_id] = (name, price, cost)
+            old_cost = device['cached_cost']
+            if name != device['name'] or (
+                    cost != old_cost and not -1 < cost - (old_cost or 0) < 1):
+                to_save[device_id] = (name, price, cost)
+            elif price != device['cached_price'] or cost != old_cost:
+                to_update[price, cost].append(device_id)
+        for chunk in _chunks(to_save):
+            for device in Device.admin_objects.filter(id__in=chunk):
+                device.name, device.cached_price, device.cached_cost = (
+                    to_save[device.id])
+                device.save()
+        for (price, cost), ids in to_update.iteritems():
+            for chunk in _chunks(ids):
+                Device.admin_objects.filter(id__in=chunk).update(
+                    cached_price=price, cached_cost=cost)
+        return result
+
+
+def devices_update_cached(devices, descendants=True):
+    """
+    Bulk version of ``device_update_cached``. Updates the cached name, price
+    and cost of all the `devices` (a queryset or an iterable of devices or
+    device ids) and, if `descendants` is True, all the devices inside them.
+    Returns a dict of id -> (name, price, cost).
+    """
+    if hasattr(devices, 'values_list'):
+        device_ids = list(devices.values_list('id', flat=True))
+    else:
+        device_ids = [getattr(d, 'id', d) for d in devices]
+    if not device_ids:
+        return {}
+    return PricingEngine(device_ids, descendants).save()
+
+
+def device_model_group_devices(group):
+    """Ids of the devices whose price depends on a device model group."""
+    return set(Device.admin_objects.filter(
+        model__group=group).values_list('id', flat=True))
+
+
+def component_model_group_devices(group):
+    """Ids of the devices whose price or cost depends on a component model
+    group, including the servers that mount disk shares of that group."""
+    device_ids = set()
+    for _class in (Storage, Memory, Processor, DiskShare, FibreChannel,
+                   GenericComponent, OperatingSystem, Software, SplunkUsage):
+        device_ids.update(_class.objects.filter(
+            model__group=group).values_list('device', flat=True))
+    device_ids.update(DiskShareMount.objects.filter(
+        share__model__group=group).exclude(device=None).values_list(
+            'device', flat=True))
+    device_ids.discard(None)
+    return device_ids
+
+
+def affected_devices(device_ids):
+    """
+    Given the ids of devices whose own price changed, return the ids of all
+    devices that need their cached price recalculated: the devices, the
+    blade servers of changed blade systems (their part of the chassis price
+    changes), and the hypervisors and blade systems above them, which
+    subtract the prices of their virtual servers and blades.
+    """
+    affected = set(device_ids)
+    for chunk in _chunks(affected):
+        affected.update(Device._default_manager.filter(
+            parent__in=chunk, parent__model__type=DeviceType.blade_system.id,
+            model__type=DeviceType.blade_server.id,
+        ).values_list('id', flat=True))
+    level = set(affected)
+    while level:
+        parents = set()
+        for row in _query_chunked(Device.admin_objects, 'id__in', level,
+                                  'parent', 'model__type'):
+            if row['parent'] and row['model__type'] in (
+                    DeviceType.virtual_server.id, DeviceType.blade_server.id):
+                parents.add(row['parent'])
+        level = parents - affected
+        affected.update(level)
+    return affected
 
 
 def details_dev(dev, purchase_only=False):
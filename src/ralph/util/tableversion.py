@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Versions of database tables, for the data that every process keeps in
+memory.
+
+The version of a table is read from the database itself: the number of its
+rows, the largest id, the sum of the ``cache_version`` of all the rows, which
+``TimeTrackable`` bumps on every significant save, and the time of the latest
+of those saves, which tells apart the rows saved again after a rollback. It
+changes whenever
+a row is created, saved or deleted in any process, and it goes back when a
+transaction is rolled back, so nothing needs to be told about the changes
+through a shared cache.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import Count, Max, Sum
+
+
+CHECK_INTERVAL = settings.TABLE_VERSION_CHECK_INTERVAL
+
+
+def table_version(model):
+    """Return the current version of the table of ``model``. The rows of
+    models that are not ``TimeTrackable``, like the many-to-many tables,
+    are only ever created or deleted."""
+    aggregates = dict(count=Count('id'), last=Max('id'))
+    if 'cache_version' in model._meta.get_all_field_names():
+        aggregates.update(versions=Sum('cache_version'),
+                          modified=Max('modified'))
+    state = model._base_manager.aggregate(**aggregates)
+    return (state['count'], state['last'], state.get('versions'),
+            state.get('modified'))
+
+
+class TableVersion(object):
+    """
+    The version of the tables of ``models``, read from the database at most
+    every ``interval`` seconds.
+
+    After ``expire()``, called when this process changes the tables, the
+    version is read on every use for the next ``interval`` seconds, so that
+    neither the uncommitted changes nor their rollback are missed.
+    """
+
+    def __init__(self, models, interval=CHECK_INTERVAL):
+        self.models = models
+        self.interval = interval
+        self.value = None
+        self.checked = None
+        self.volatile_until = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            now = time.time()
+            if self.volatile_until is not None and now < self.volatile_until:
+                self.checked = None
+            elif (self.checked is not None and
+                    now - self.checked < self.interval):
+                return self.value
+            else:
+                self.checked = now
+                self.volatile_until = None
+            self.value = tuple(table_version(model) for model in self.models)
+            return self.value
+
+    def expire(self):
+        with self.lock:
+            self.checked = None
+            self.volatile_until = time.time() + self.interval
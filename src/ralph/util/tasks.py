@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Celery tasks for recalculating the cached device prices."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import datetime
+
+from celery.task import task
+
+from ralph.util import pricing
+from ralph.util.models import PricingJob
+
+
+PROGRESS_TIMEOUT = 24 * 3600
+
+
+def get_progress(job_id):
+    """Return a dict with the `total` and `done` device counts of a price
+    recalculation job, or None if the job is unknown or expired."""
+    progress = PricingJob.objects.filter(id=job_id).values('total', 'done')
+    return progress[0] if progress else None
+
+
+def _set_progress(job_id, total, done):
+    PricingJob.objects.filter(id=job_id).update(total=total, done=done)
+
+
+@task(ignore_result=True)
+def update_cached_prices(device_ids, job_id):
+    """Recalculate the cached prices of the devices whose own price changed
+    and of the devices that depend on them. Every affected device is
+    recalculated exactly once, in chunks, reporting the progress after each
+    chunk."""
+    device_ids = sorted(pricing.affected_devices(device_ids))
+    total = len(device_ids)
+    _set_progress(job_id, total, 0)
+    for start in xrange(0, total, pricing.BULK_CHUNK_SIZE):
+        chunk = device_ids[start:start + pricing.BULK_CHUNK_SIZE]
+        pricing.devices_update_cached(chunk, descendants=False)
+        _set_progress(job_id, total, start + len(chunk))
+
+
+def schedule_update_cached_prices(device_ids, remote=True):
+    """Queue the recalculation of cached prices after the prices of the
+    devices with `device_ids` changed. Returns the job id that can be passed
+    to ``get_progress``."""
+    device_ids = sorted(set(device_ids))
+    PricingJob.objects.filter(created__lt=datetime.datetime.now() -
+                              datetime.timedelta(seconds=PROGRESS_TIMEOUT),
+                              ).delete()
+    job = PricingJob(total=len(device_ids))
+    job.save()
+    job_id = job.id
+    if remote:
+        update_cached_prices.delay(device_ids, job_id)
+    else:
+        update_cached_prices(device_ids, job_id)
+    return job_id
@@ -16,6 +16,7 @@ from __future__ import unicode_literals
 
 import re
 import textwrap
+import time
 from datetime import datetime, timedelta
 
 from django.conf import settings
@@ -27,9 +28,11 @@ from tastypie.models import ApiKey
 
 from ralph.business.models import Venture
 from ralph.discovery.models import Device, DeviceType
+from ralph.discovery.models import ComponentModel, ComponentModelGroup
+from ralph.discovery.models import ComponentType, Memory
 from ralph.discovery.models import DeviceModelGroup
 from ralph.discovery.models import MarginKind, DeprecationKind
-from ralph.util import pricing
+from ralph.util import export, pricing
 from ralph.util.pricing import get_device_raw_price
 
 
@@ -75,6 +78,141 @@ class NetworkTest(TestCase):
         # non-existent host
         self.assertIsNone(hostname(NON_EXISTENT_HOST_IP))
 
+    def test_icmp_echo_packets(self):
+        import struct
+        from ralph.util.network import (_icmp_checksum, _icmp_echo_request,
+                                        _icmp_echo_reply)
+        request = _icmp_echo_request(1234, 42, 64)
+        self.assertEqual(len(request), 64)
+        self.assertEqual(_icmp_checksum(request), 0)
+        ip_header = b'\x45' + b'\x00' * 19
+        reply = b'\x00' + request[1:]
+        self.assertEqual(_icmp_echo_reply(ip_header + reply), (1234, 42))
+        # echo requests and truncated packets are ignored
+        self.assertIsNone(_icmp_echo_reply(ip_header + request))
+        self.assertIsNone(_icmp_echo_reply(ip_header + reply[:4]))
+        self.assertEqual(struct.unpack(b'!H', request[6:8])[0], 42)
+
+    def test_ping_sweep(self):
+        import mock
+        import socket
+        from ralph.util import network
+
+        class FakeSocket(object):
+            def __init__(self, *args):
+                self.replies = []
+
+            def sendto(self, packet, target):
+                address, port = target
+                if address == '10.0.0.9':
+                    raise socket.error('unroutable')
+                reply = b'\x45' + b'\x00' * 19 + b'\x00' + packet[1:]
+                if address == '10.0.0.1':
+                    self.replies.append((reply, (address, 0)))
+                    # a reply to somebody else's ping
+                    other = reply[:24] + b'\xff\xff' + reply[26:]
+                    self.replies.append((other, (address, 0)))
+                elif address == '10.0.0.2':
+                    # the right sequence number from the wrong address
+                    self.replies.append((reply, ('10.0.0.3', 0)))
+
+            def recvfrom(self, size):
+                return self.replies.pop(0)
+
+            def close(self):
+                pass
+
+        def select(rlist, wlist, xlist, timeout):
+            return [sock for sock in rlist if sock.replies], [], []
+
+        with mock.patch('socket.socket', FakeSocket):
+            with mock.patch('select.select', select):
+                with mock.patch('os.getpid', return_value=0x1234):
+                    alive = list(network.ping_sweep(
+                        ['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.9'],
+                        timeout=0.01, batch_size=2))
+        self.assertEqual([host for host, delay in alive], ['10.0.0.1'])
+
+    def test_ssh_pool(self):
+        import mock
+        from ralph.util.network import SSHClient, SSHPool
+
+        class FakeSSH(SSHClient):
+            def __init__(self):
+                self.healthy = True
+                self.discarded = False
+
+            def is_healthy(self):
+                return self.healthy
+
+            def discard(self):
+                self.pool = None
+                self.discarded = True
+
+        pool = SSHPool(idle_timeout=60)
+        with mock.patch('ralph.util.network.connect_ssh') as connect_ssh:
+            connect_ssh.side_effect = lambda *args, **kwargs: FakeSSH()
+            first = pool.connect('10.0.0.1', 'root', 'pass')
+            second = pool.connect('10.0.0.1', 'root', 'pass')
+            self.assertIsNot(first, second)
+            first.close()
+            self.assertFalse(first.discarded)
+            self.assertIs(pool.connect('10.0.0.1', 'root', 'pass'), first)
+            self.assertIsNot(pool.connect('10.0.0.1', 'admin', 'pass'), first)
+            first.close()
+            first.healthy = False
+            self.assertIsNot(pool.connect('10.0.0.1', 'root', 'pass'), first)
+            self.assertTrue(first.discarded)
+            second.close()
+            with mock.patch('time.time', return_value=time.time() + 61):
+                self.assertIsNot(pool.connect('10.0.0.1', 'root', 'pass'),
+                                 second)
+            self.assertTrue(second.discarded)
+            self.assertEqual(connect_ssh.call_count, 5)
+
+    def test_shell(self):
+        from ralph.discovery.tests.util import FakeShellDevice
+        from ralph.util import network
+
+        device = FakeShellDevice(b'system> ', {
+            b'list': b'one\ntwo\nthree\nfour\nfive\n',
+            b'info': b'Name: blade\r\nSlot: 1\r\n',
+        }, banner=b'Welcome!\r\n', page_size=2)
+        shell = network.open_shell(device, r'^system> ', prefix=b'\b',
+                                   pager=r'--- more --- $')
+        self.assertEqual(shell.command(b'list'),
+                         [b'one', b'two', b'three', b'four', b'five'])
+        self.assertEqual(shell.command(b'info', parse=lambda lines: next(
+            line for line in lines if line.startswith(b'Slot'))),
+            b'Slot: 1')
+        self.assertEqual(shell.command(b'nothing'), [b'% Invalid input'])
+        self.assertEqual([command for channel, command in device.log],
+                         [b'', b'list', b'info', b'nothing'])
+        device.prompt = b'$ '
+        with self.assertRaises(network.ConsoleTimeout):
+            shell.command(b'list')
+
+    def test_run_commands(self):
+        import paramiko
+        from ralph.discovery.tests.util import FakeShellDevice
+        from ralph.util import network
+
+        device = FakeShellDevice(b'system> ', dict(
+            (b'info %d' % i, b'blade %d\n' % i) for i in xrange(5)
+        ), max_channels=2)
+        shells = [network.open_shell(device, r'^system> ')
+                  for i in xrange(2)]
+        with self.assertRaises(paramiko.SSHException):
+            network.open_shell(device, r'^system> ')
+        self.assertEqual(
+            network.run_commands(shells, [b'info %d' % i for i in xrange(5)]),
+            [[b'blade %d' % i] for i in xrange(5)],
+        )
+        self.assertEqual(device.log[2:], [
+            (0, b'info 0'), (1, b'info 1'), (0, b'info 2'), (1, b'info 3'),
+            (0, b'info 4'),
+        ])
+
 
 class PricingTest(TestCase):
     def test_rack_server(self):
@@ -190,6 +328,95 @@ class PricingTest(TestCase):
         self.assertEqual(dev.cached_cost, 15)
         self.assertEqual(dev.cached_price, 100)
 
+    def test_bulk_engine_matches_single_device_pricing(self):
+        encl = Device.create(sn='devicex', model_type=DeviceType.blade_system,
+                             model_name='device encl')
+        blade = Device.create(sn='device', model_type=DeviceType.blade_server,
+                              model_name='device', parent=encl)
+        virtual = Device.create(sn='virtual',
+                                model_type=DeviceType.virtual_server,
+                                model_name='virtual', parent=blade)
+        encl_dmg = DeviceModelGroup(name='DeviceModelGroup encl', slots=4,
+                                    price=65535)
+        encl_dmg.save()
+        encl.model.group = encl_dmg
+        encl.model.save()
+        dmg = DeviceModelGroup(name='DeviceModelGroup', slots=1, price=1337)
+        dmg.save()
+        blade.model.group = dmg
+        blade.model.save()
+        cpu_group = ComponentModelGroup(name='Default CPU', price=100)
+        cpu_group.save()
+        mem_group = ComponentModelGroup(name='DIMM', price=3, per_size=True,
+                                        size_modifier=1024)
+        mem_group.save()
+        mem_model, created = ComponentModel.concurrent_get_or_create(
+            type=ComponentType.memory.id, size=4096, speed=0, cores=0,
+            family='', extra_hash='')
+        mem_model.group = mem_group
+        mem_model.save()
+        Memory(device=virtual, index=0, label='DIMM', model=mem_model).save()
+        blade.margin_kind = MarginKind(name='50%', margin=50)
+        blade.margin_kind.save()
+        blade.deprecation_kind = DeprecationKind(name='10 months', months=10)
+        blade.deprecation_kind.save()
+        blade.save()
+
+        expected = {}
+        for dev in (encl, blade, virtual):
+            dev = Device.objects.get(id=dev.id)
+            expected[dev.id] = (pricing.get_device_price(dev),
+                                pricing.get_device_cost(dev))
+        result = pricing.devices_update_cached([encl])
+        self.assertEqual(
+            {dev_id: (price, cost) for dev_id, (name, price, cost)
+             in result.iteritems()},
+            expected,
+        )
+        for dev_id, (price, cost) in expected.iteritems():
+            dev = Device.objects.get(id=dev_id)
+            self.assertEqual(dev.cached_price, price)
+            self.assertEqual(dev.cached_cost, cost)
+
+    def test_catalog_change_propagation(self):
+        from ralph.util.tasks import (get_progress,
+                                      schedule_update_cached_prices)
+        encl = Device.create(sn='devicex', model_type=DeviceType.blade_system,
+                             model_name='device encl')
+        blade = Device.create(sn='device', model_type=DeviceType.blade_server,
+                              model_name='device', parent=encl)
+        hypervisor = Device.create(sn='hypervisor',
+                                   model_type=DeviceType.rack_server,
+                                   model_name='hypervisor')
+        virtual = Device.create(sn='virtual',
+                                model_type=DeviceType.virtual_server,
+                                model_name='virtual', parent=hypervisor)
+        self.assertEqual(pricing.affected_devices([encl.id]),
+                         {encl.id, blade.id})
+        self.assertEqual(pricing.affected_devices([blade.id]),
+                         {encl.id, blade.id})
+        self.assertEqual(pricing.affected_devices([virtual.id]),
+                         {virtual.id, hypervisor.id})
+        self.assertEqual(pricing.affected_devices([hypervisor.id]),
+                         {hypervisor.id})
+
+        encl_dmg = DeviceModelGroup(name='DeviceModelGroup encl', slots=4,
+                                    price=65535)
+        encl_dmg.save()
+        encl.model.group = encl_dmg
+        encl.model.save()
+        dmg = DeviceModelGroup(name='DeviceModelGroup', slots=1, price=1337)
+        dmg.save()
+        blade.model.group = dmg
+        blade.model.save()
+        job_id = schedule_update_cached_prices(
+            pricing.device_model_group_devices(encl_dmg), remote=False)
+        self.assertEqual(get_progress(job_id), {'total': 2, 'done': 2})
+        self.assertEqual(Device.objects.get(id=blade.id).cached_price,
+                         17720.75)
+        self.assertEqual(Device.objects.get(id=encl.id).cached_price,
+                         49151.25)
+
 
 THROTTLE_AT = settings.API_THROTTLING['throttle_at']
 
@@ -272,3 +499,50 @@ class UncompressBase64DataTest(TestCase):
         encoded = base64.b64encode(raw)
         compressed = zlib.compress(encoded)
         self.assertEqual(uncompress_base64_data(compressed), encoded)
+
+
+class ExportTest(TestCase):
+    def setUp(self):
+        for i in xrange(7):
+            Device.create(sn='sn%d' % i, model_name='xxx',
+                          model_type=DeviceType.rack_server,
+                          name='dev%d' % (i % 3))
+
+    def test_iter_chunks(self):
+        query = Device.objects.all()
+        chunks = list(export.iter_chunks(query, chunk_size=3))
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 3, 1])
+        self.assertEqual(
+            [dev.id for chunk in chunks for dev in chunk],
+            list(query.order_by('id').values_list('id', flat=True)),
+        )
+        query = Device.objects.order_by('-name', 'sn')
+        self.assertEqual(
+            [dev.id for chunk in export.iter_chunks(query, chunk_size=2)
+             for dev in chunk],
+            list(query.values_list('id', flat=True)),
+        )
+        for symbol in ('b', 'c', 'a'):
+            Venture(name=symbol, symbol=symbol).save()
+        # the default ordering of the model is kept
+        query = Venture.objects.all()
+        self.assertEqual(
+            [venture.symbol
+             for chunk in export.iter_chunks(query, chunk_size=2)
+             for venture in chunk],
+            ['a', 'b', 'c'],
+        )
+
+    def test_iter_csv(self):
+        rows = [['a', 'ż'], ['1', '2']] * 150
+        data = list(export.iter_csv(rows))
+        self.assertEqual(len(data), 3)
+        self.assertEqual(b''.join(data), b'a;\xc5\xbc\r\n1;2\r\n' * 150)
+
+    def test_streaming_response(self):
+        response = export.StreamingHttpResponse(
+            export.iter_csv([['a', 'b']] * 150), content_type='text/csv')
+        # the middleware sees nothing to compress or to time
+        self.assertEqual(response.content, b'')
+        self.assertEqual(b''.join(response.streaming_content),
+                         b'a;b\r\n' * 150)